@@ -8,6 +8,7 @@
 #include "USB.h"
 #include "USBHIDKeyboard.h"
 #include <Adafruit_NeoPixel.h>
+#include "mbedtls/base64.h"
 
 // Pins
 #define BUTTON_PIN_1 2
@@ -34,6 +35,51 @@ struct DeviceConfig {
   String keymap2 = "";
 } cfg;
 
+// Bit per config field, so partial updates only persist what changed
+enum ConfigField : uint16_t {
+  F_WIFI_SSID = 1 << 0,
+  F_WIFI_PASS = 1 << 1,
+  F_MACRO1    = 1 << 2,
+  F_MACRO2    = 1 << 3,
+  F_ACTION1   = 1 << 4,
+  F_ACTION2   = 1 << 5,
+  F_KEYMAP1   = 1 << 6,
+  F_KEYMAP2   = 1 << 7,
+  F_ALL       = 0xFF
+};
+
+// Compiled keymaps (see macro_compiler.py): a header, then 3-byte records
+// {modifiers, key usage, wait ms} replayed straight into HID reports.
+#define COMPILED_MAX 4096
+#define COMPILED_HEADER 10
+#define COMPILED_WAIT_KEY 0xFF
+uint8_t compiledBuf[2][COMPILED_MAX];
+size_t compiledLen[2] = { 0, 0 };
+
+// Text macros longer than MACRO_INLINE_MAX don't go in the config: they are
+// uploaded in chunks through /macro/text into a LittleFS blob (/macroN.txt)
+// and typed straight from flash, MACRO_SLICE characters per loop() pass.
+#define MACRO_INLINE_MAX 256
+#define MACRO_BLOB_MAX 65536
+#define MACRO_CHUNK_MAX 4096
+#define MACRO_SLICE 16        // ~2 ms per character (press + release report)
+#define CONFIG_BODY_MAX 4096
+size_t macroBlobLen[2] = { 0, 0 };
+uint32_t macroBlobHash[2] = { 0, 0 };
+// Upload in progress per slot (size and hash announced with the first chunk);
+// the bytes received so far are the /macroN.part file
+size_t uploadTotal[2] = { 0, 0 };
+uint32_t uploadHash[2] = { 0, 0 };
+
+// Text macro being typed: from its blob file, or a copy of the config string
+struct MacroPlayback {
+  bool active = false;
+  int slot = 0;
+  File file;
+  String text;
+  size_t pos = 0;
+} playing;
+
 // Status NeoPixel
 #define STATUS_PIN 48
 #define STATUS_COUNT 1
@@ -63,12 +109,21 @@ const unsigned long debounceDelay = 50;
 int lastButtonState1 = HIGH;
 int lastButtonState2 = HIGH;
 
-void saveConfig() {
+// Persist the config. `fields` limits the NVS writes to the keys that changed;
+// nothing is written at all when it is 0.
+void saveConfigFields(uint16_t fields) {
+  if (fields == 0) {
+    Serial.println("Config unchanged; skipping flash write");
+    return;
+  }
+  // A macro saved in the config replaces the slot's blob
+  if ((fields & F_MACRO1) && cfg.macro1.length()) dropMacroBlob(1);
+  if ((fields & F_MACRO2) && cfg.macro2.length()) dropMacroBlob(2);
   // Always attempt to save to LittleFS (best for human inspection)
   bool lf_ok = false;
   File f = LittleFS.open("/config.json", "w");
   if (f) {
-    StaticJsonDocument<512> doc;
+    DynamicJsonDocument doc(configDocSize());
     doc["wifi_ssid"] = cfg.wifi_ssid;
     doc["wifi_pass"] = cfg.wifi_pass;
     doc["macro1"] = cfg.macro1;
@@ -91,14 +146,14 @@ void saveConfig() {
 
   // Also persist to NVS so settings survive if LittleFS is not available
   prefs.begin("macropad", false);
-  prefs.putString("wifi_ssid", cfg.wifi_ssid);
-  prefs.putString("wifi_pass", cfg.wifi_pass);
-  prefs.putString("macro1", cfg.macro1);
-  prefs.putString("macro2", cfg.macro2);
-  prefs.putString("action1", cfg.action1);
-  prefs.putString("action2", cfg.action2);
-  prefs.putString("keymap1", cfg.keymap1);
-  prefs.putString("keymap2", cfg.keymap2);
+  if (fields & F_WIFI_SSID) prefs.putString("wifi_ssid", cfg.wifi_ssid);
+  if (fields & F_WIFI_PASS) prefs.putString("wifi_pass", cfg.wifi_pass);
+  if (fields & F_MACRO1) prefs.putString("macro1", cfg.macro1);
+  if (fields & F_MACRO2) prefs.putString("macro2", cfg.macro2);
+  if (fields & F_ACTION1) prefs.putString("action1", cfg.action1);
+  if (fields & F_ACTION2) prefs.putString("action2", cfg.action2);
+  if (fields & F_KEYMAP1) prefs.putString("keymap1", cfg.keymap1);
+  if (fields & F_KEYMAP2) prefs.putString("keymap2", cfg.keymap2);
   prefs.end();
   Serial.println("Config saved to NVS (Preferences)");
 
@@ -107,12 +162,17 @@ void saveConfig() {
   }
 }
 
+void saveConfig() {
+  saveConfigFields(F_ALL);
+}
+
 void loadConfig() {
   // Try LittleFS first
   if (LittleFS.exists("/config.json")) {
     File f = LittleFS.open("/config.json", "r");
     if (f) {
-      StaticJsonDocument<512> doc;
+      // Strings read from a stream are copied into the document: the file size covers them
+      DynamicJsonDocument doc(JSON_OBJECT_SIZE(16) + f.size());
       DeserializationError err = deserializeJson(doc, f);
       f.close();
       if (!err) {
@@ -162,6 +222,92 @@ void loadConfig() {
   prefs.end();
 }
 
+// FNV-1a over a string; compiled blobs carry the hash of the keymap they came from
+uint32_t fnv1aUpdate(uint32_t h, const uint8_t* d, size_t n) {
+  for (size_t i = 0; i < n; i++) { h ^= d[i]; h *= 16777619u; }
+  return h;
+}
+
+uint32_t fnv1a(const String &s) {
+  return fnv1aUpdate(2166136261u, (const uint8_t*)s.c_str(), s.length());
+}
+
+// Same hash over a file's remaining bytes (macro blobs)
+uint32_t fnv1aFile(File &f) {
+  uint8_t buf[256];
+  uint32_t h = 2166136261u;
+  size_t n;
+  while ((n = f.read(buf, sizeof(buf))) > 0) h = fnv1aUpdate(h, buf, n);
+  return h;
+}
+
+// Header sanity check; with `keymap`, also that the blob was built from it.
+bool compiledHeaderOk(const uint8_t* b, size_t len, const String* keymap) {
+  if (len < COMPILED_HEADER || b[0] != 'M' || b[1] != 'K' || b[2] != 1) return false;
+  uint16_t count = b[8] | (b[9] << 8);
+  if (len != COMPILED_HEADER + (size_t)count * 3) return false;
+  if (keymap) {
+    uint32_t h = b[4] | (b[5] << 8) | ((uint32_t)b[6] << 16) | ((uint32_t)b[7] << 24);
+    if (h != fnv1a(*keymap)) return false;
+  }
+  return true;
+}
+
+const String& keymapFor(int slot) { return slot == 1 ? cfg.keymap1 : cfg.keymap2; }
+
+// Usable only while it still matches the saved keymap (after edits via the web
+// page the keymap is parsed on each press until the configurator recompiles).
+bool compiledValid(int slot) {
+  return compiledHeaderOk(compiledBuf[slot - 1], compiledLen[slot - 1], &keymapFor(slot));
+}
+
+void loadCompiled() {
+  for (int slot = 1; slot <= 2; slot++) {
+    String path = "/macro" + String(slot) + ".bin";
+    compiledLen[slot - 1] = 0;
+    if (!LittleFS.exists(path)) continue;
+    File f = LittleFS.open(path, "r");
+    if (!f) continue;
+    size_t n = f.read(compiledBuf[slot - 1], COMPILED_MAX);
+    f.close();
+    if (compiledHeaderOk(compiledBuf[slot - 1], n, nullptr)) compiledLen[slot - 1] = n;
+  }
+}
+
+String blobPath(int slot) { return "/macro" + String(slot) + ".txt"; }
+String partPath(int slot) { return "/macro" + String(slot) + ".part"; }
+
+void loadMacroBlobs() {
+  for (int slot = 1; slot <= 2; slot++) {
+    macroBlobLen[slot - 1] = 0;
+    macroBlobHash[slot - 1] = 0;
+    // An upload cut short by a reset can't be resumed: its size and hash were only in RAM
+    if (LittleFS.exists(partPath(slot))) LittleFS.remove(partPath(slot));
+    if (!LittleFS.exists(blobPath(slot))) continue;
+    File f = LittleFS.open(blobPath(slot), "r");
+    if (!f) continue;
+    macroBlobLen[slot - 1] = f.size();
+    macroBlobHash[slot - 1] = fnv1aFile(f);
+    f.close();
+  }
+}
+
+// Forget the slot's blob, and stop typing it if it is playing
+void dropMacroBlob(int slot) {
+  if (playing.active && playing.slot == slot) stopMacro();
+  if (!macroBlobLen[slot - 1]) return;
+  LittleFS.remove(blobPath(slot));
+  macroBlobLen[slot - 1] = 0;
+  macroBlobHash[slot - 1] = 0;
+}
+
+// Room for a JSON object holding copies of every config string
+size_t configDocSize() {
+  size_t n = JSON_OBJECT_SIZE(16) + 64;  // slack for mode/mac/version in GET /config
+  for (int i = 0; i < 8; i++) n += configField(cfg, i)->length() + 1;
+  return n;
+}
+
 void startCaptivePortal() {
   WiFi.mode(WIFI_AP);
   WiFi.softAP(AP_SSID);
@@ -338,11 +484,38 @@ String getIndexHtml() {
       });
     }
 
+    // Macros over INLINE_MAX bytes live in blobs on the device (/macro/text)
+    const INLINE_MAX = 256, CHUNK = 2048;
+    function fnv1a(bytes){
+      let h = 0x811c9dc5;
+      for (const b of bytes) { h ^= b; h = Math.imul(h, 16777619) >>> 0; }
+      return ('0000000' + h.toString(16)).slice(-8);
+    }
+    async function loadBlob(slot, size){
+      const out = new Uint8Array(size);
+      for (let off = 0; off < size; ) {
+        const r = await fetch('/macro/text?slot='+slot+'&offset='+off+'&length='+CHUNK);
+        if (!r.ok) throw new Error('HTTP '+r.status);
+        const b = new Uint8Array(await r.arrayBuffer());
+        if (!b.length) break;
+        out.set(b, off); off += b.length;
+      }
+      return new TextDecoder().decode(out);
+    }
+    async function uploadBlob(slot, data){
+      const q = '/macro/text?slot='+slot+'&total='+data.length+'&hash='+fnv1a(data)+'&offset=';
+      for (let off = 0; off < data.length; off += CHUNK) {
+        const r = await fetch(q+off, {method:'POST', headers:{'Content-Type':'text/plain'}, body: data.slice(off, off+CHUNK)});
+        if (!r.ok) throw new Error(await r.text());
+      }
+    }
+
     async function fetchConfig(){
       try{
         let r = await fetch('/config');
         if(!r.ok) return;
         let j = await r.json();
+        for (const b of BUTTONS) if (j[b.key+'_blob']) j[b.key] = await loadBlob(b.id, j[b.key+'_blob']);
         window.currentConfig = j;
         document.getElementById('statusText').textContent = 'Connected';
         // set initial payloads if a button is preselected
@@ -376,7 +549,19 @@ String getIndexHtml() {
       }
       document.getElementById('saveStatus').textContent = 'Saving...';
       try{
-        let r = await fetch('/config', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(body)});
+        // Long macros go up as blobs first; the config POST leaves them out
+        const post = Object.assign({}, body);
+        for (const b of BUTTONS) {
+          const data = new TextEncoder().encode(body[b.key] || '');
+          if (data.length > INLINE_MAX) {
+            if (b.id === id && actionType === 'macro') { await uploadBlob(id, data); body[b.key+'_blob'] = data.length; }
+            delete post[b.key];
+          } else if (b.id === id && !data.length && body[b.key+'_blob']) {
+            await fetch('/macro/text?slot='+id, {method:'DELETE'});
+            body[b.key+'_blob'] = 0;
+          }
+        }
+        let r = await fetch('/config', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(post)});
         if(r.ok){ document.getElementById('saveStatus').textContent = 'Saved'; window.currentConfig = body; setTimeout(()=>document.getElementById('saveStatus').textContent='',1200);} else { document.getElementById('saveStatus').textContent = 'Save failed'; }
       }catch(e){ document.getElementById('saveStatus').textContent = 'Error'; }
     });
@@ -474,8 +659,50 @@ void handleRoot() {
   server.send(200, "text/html", getIndexHtml());
 }
 
+// Content hash of the config, served as the ETag of GET /config so clients
+// can detect concurrent edits (FNV-1a over every field and the macro blobs' hashes).
+String configEtag() {
+  uint32_t h = 2166136261u;
+  const String* parts[] = { &cfg.wifi_ssid, &cfg.wifi_pass, &cfg.macro1, &cfg.macro2,
+                            &cfg.action1, &cfg.action2, &cfg.keymap1, &cfg.keymap2 };
+  for (const String* p : parts) {
+    for (size_t i = 0; i < p->length(); i++) { h ^= (uint8_t)(*p)[i]; h *= 16777619u; }
+    h ^= 0x1f; h *= 16777619u;  // field separator
+  }
+  if (macroBlobLen[0] || macroBlobLen[1]) {
+    h = fnv1aUpdate(h, (const uint8_t*)macroBlobHash, sizeof(macroBlobHash));
+  }
+  char buf[9];
+  snprintf(buf, sizeof(buf), "%08x", h);
+  return String(buf);
+}
+
+// Optimistic concurrency: reject the write if the config changed since the
+// client fetched it (If-Match carries the ETag from GET /config). Sends the
+// 412 and returns true when the write must not go ahead.
+bool ifMatchFails() {
+  if (!server.hasHeader("If-Match")) return false;
+  String want = server.header("If-Match");
+  want.replace("\"", "");
+  if (want.length() && want != "*" && want != configEtag()) {
+    server.sendHeader("ETag", "\"" + configEtag() + "\"");
+    server.send(412, "text/plain", "Config changed on device; fetch again");
+    return true;
+  }
+  return false;
+}
+
+// Copy doc[key] into dst if the key was sent and differs; record it in `changed`.
+void mergeField(JsonDocument &doc, const char* key, String &dst, uint16_t bit, uint16_t &changed) {
+  if (!doc.containsKey(key)) return;
+  const char* v = doc[key] | "";
+  if (dst == v) return;
+  dst = String(v);
+  changed |= bit;
+}
+
 void handleGetConfig() {
-  StaticJsonDocument<512> doc;
+  DynamicJsonDocument doc(configDocSize());
   doc["wifi_ssid"] = cfg.wifi_ssid;
   doc["wifi_pass"] = cfg.wifi_pass;
   doc["macro1"] = cfg.macro1;
@@ -484,50 +711,249 @@ void handleGetConfig() {
   doc["action2"] = cfg.action2;
   doc["keymap1"] = cfg.keymap1;
   doc["keymap2"] = cfg.keymap2;
+  // Bytes of text macro held as a blob (GET /macro/text); the macro field is empty then
+  doc["macro1_blob"] = macroBlobLen[0];
+  doc["macro2_blob"] = macroBlobLen[1];
+  // Lets clients know whether a POST will restart the device (ap) or apply live (sta)
+  doc["mode"] = (WiFi.status() == WL_CONNECTED) ? "sta" : "ap";
+  // Stable identity (the station MAC, same in AP mode) so clients can
+  // recognise a pad after it moves to another address
+  doc["mac"] = WiFi.macAddress();
+  String etag = configEtag();
+  doc["version"] = etag;
   String out;
   serializeJson(doc, out);
+  server.sendHeader("ETag", "\"" + etag + "\"");
   server.send(200, "application/json", out);
 }
 
+// GET /macro?slot=N: what compiled keymap the device holds for a button
+void handleGetMacro() {
+  int slot = server.arg("slot").toInt();
+  if (slot != 1 && slot != 2) { server.send(400, "text/plain", "slot must be 1 or 2"); return; }
+  const uint8_t* b = compiledBuf[slot - 1];
+  size_t len = compiledLen[slot - 1];
+  char buf[96];
+  if (len >= COMPILED_HEADER) {
+    uint32_t h = b[4] | (b[5] << 8) | ((uint32_t)b[6] << 16) | ((uint32_t)b[7] << 24);
+    snprintf(buf, sizeof(buf), "{\"slot\":%d,\"hash\":\"%08x\",\"reports\":%u,\"valid\":%s}",
+             slot, h, (unsigned)(b[8] | (b[9] << 8)), compiledValid(slot) ? "true" : "false");
+  } else {
+    snprintf(buf, sizeof(buf), "{\"slot\":%d,\"hash\":null,\"reports\":0,\"valid\":false}", slot);
+  }
+  server.send(200, "application/json", buf);
+}
+
+// POST /macro?slot=N with the base64 blob from macro_compiler.py as the body.
+// It must have been compiled from the keymap currently saved for that button.
+void handlePostMacro() {
+  int slot = server.arg("slot").toInt();
+  if (slot != 1 && slot != 2) { server.send(400, "text/plain", "slot must be 1 or 2"); return; }
+  String body = server.arg("plain");
+  body.trim();
+  static uint8_t tmp[COMPILED_MAX];
+  size_t n = 0;
+  if (mbedtls_base64_decode(tmp, sizeof(tmp), &n, (const unsigned char*)body.c_str(), body.length()) != 0) {
+    server.send(400, "text/plain", "Body must be a base64 blob of at most 4096 bytes");
+    return;
+  }
+  if (!compiledHeaderOk(tmp, n, nullptr)) {
+    server.send(400, "text/plain", "Not a compiled macro");
+    return;
+  }
+  if (!compiledHeaderOk(tmp, n, &keymapFor(slot))) {
+    server.send(409, "text/plain", "Blob was compiled from a different keymap");
+    return;
+  }
+  memcpy(compiledBuf[slot - 1], tmp, n);
+  compiledLen[slot - 1] = n;
+  File f = LittleFS.open("/macro" + String(slot) + ".bin", "w");
+  bool ok = f && f.write(tmp, n) == n;
+  if (f) f.close();
+  char buf[64];
+  snprintf(buf, sizeof(buf), "{\"ok\":true,\"reports\":%u,\"stored\":%s}",
+           (unsigned)((n - COMPILED_HEADER) / 3), ok ? "true" : "false");
+  server.send(200, "application/json", buf);
+}
+
+size_t uploadReceived(int slot) {
+  if (!uploadTotal[slot - 1] || !LittleFS.exists(partPath(slot))) return 0;
+  File f = LittleFS.open(partPath(slot), "r");
+  size_t n = f ? f.size() : 0;
+  if (f) f.close();
+  return n;
+}
+
+void sendUploadState(int code, int slot, size_t received, bool done) {
+  char buf[96];
+  snprintf(buf, sizeof(buf), "{\"received\":%u,\"total\":%u,\"done\":%s}",
+           (unsigned)received, (unsigned)uploadTotal[slot - 1], done ? "true" : "false");
+  server.sendHeader("ETag", "\"" + configEtag() + "\"");
+  server.send(code, "application/json", buf);
+}
+
+// GET /macro/text?slot=N: the slot's stored blob and any upload in progress.
+// With &offset=O[&length=L], the blob's bytes from O instead (at most 4 KiB).
+void handleGetMacroText() {
+  int slot = server.arg("slot").toInt();
+  if (slot != 1 && slot != 2) { server.send(400, "text/plain", "slot must be 1 or 2"); return; }
+  if (!server.hasArg("offset")) {
+    char buf[160];
+    snprintf(buf, sizeof(buf),
+             "{\"slot\":%d,\"size\":%u,\"hash\":\"%08x\",\"upload\":{\"received\":%u,\"total\":%u,\"hash\":\"%08x\"}}",
+             slot, (unsigned)macroBlobLen[slot - 1], macroBlobHash[slot - 1],
+             (unsigned)uploadReceived(slot), (unsigned)uploadTotal[slot - 1], uploadHash[slot - 1]);
+    server.send(200, "application/json", buf);
+    return;
+  }
+  size_t off = server.arg("offset").toInt();
+  size_t len = server.hasArg("length") ? server.arg("length").toInt() : MACRO_CHUNK_MAX;
+  if (len > MACRO_CHUNK_MAX) len = MACRO_CHUNK_MAX;
+  if (!macroBlobLen[slot - 1]) { server.send(404, "text/plain", "No macro blob for this slot"); return; }
+  if (off > macroBlobLen[slot - 1]) { server.send(416, "text/plain", "Offset past the end"); return; }
+  File f = LittleFS.open(blobPath(slot), "r");
+  if (!f || !f.seek(off)) {
+    if (f) f.close();
+    server.send(500, "text/plain", "Blob read failed");
+    return;
+  }
+  static uint8_t buf[MACRO_CHUNK_MAX];
+  size_t n = f.read(buf, min(len, macroBlobLen[slot - 1] - off));
+  f.close();
+  server.send_P(200, "text/plain; charset=utf-8", (const char*)buf, n);
+}
+
+// POST /macro/text?slot=N&offset=O&total=T&hash=H with the macro's next bytes
+// (UTF-8, at most 4 KiB) as the body. Offset 0 starts a new upload; any other
+// offset must be exactly what the device already holds for the same total and
+// hash, else 409 with {received} so the client resumes from there. The chunk
+// that completes the upload checks the hash and makes the blob the slot's macro.
+void handlePostMacroText() {
+  int slot = server.arg("slot").toInt();
+  if (slot != 1 && slot != 2) { server.send(400, "text/plain", "slot must be 1 or 2"); return; }
+  if (!server.hasArg("offset") || !server.hasArg("total") || !server.hasArg("hash")) {
+    server.send(400, "text/plain", "offset, total and hash required");
+    return;
+  }
+  if (ifMatchFails()) return;
+  size_t off = server.arg("offset").toInt();
+  size_t total = server.arg("total").toInt();
+  uint32_t hash = strtoul(server.arg("hash").c_str(), nullptr, 16);
+  String body = server.arg("plain");
+  int i = slot - 1;
+  if (total == 0 || total > MACRO_BLOB_MAX || body.length() > MACRO_CHUNK_MAX) {
+    server.send(413, "text/plain", "Macros up to 65536 bytes, in chunks of at most 4096");
+    return;
+  }
+  if (off == 0) {
+    if (LittleFS.totalBytes() - LittleFS.usedBytes() < total + 8192) {
+      server.send(507, "text/plain", "Not enough flash for this macro");
+      return;
+    }
+    File f = LittleFS.open(partPath(slot), "w");  // truncates an earlier attempt
+    if (!f) { server.send(500, "text/plain", "Blob write failed"); return; }
+    f.close();
+    uploadTotal[i] = total;
+    uploadHash[i] = hash;
+  }
+  size_t have = uploadReceived(slot);
+  if (uploadTotal[i] != total || uploadHash[i] != hash || off != have) {
+    if (uploadTotal[i] != total || uploadHash[i] != hash) have = 0;  // a different upload: start over
+    char buf[64];
+    snprintf(buf, sizeof(buf), "{\"received\":%u}", (unsigned)have);
+    server.send(409, "application/json", buf);
+    return;
+  }
+  if (off + body.length() > total) { server.send(400, "text/plain", "Chunk runs past total"); return; }
+  File f = LittleFS.open(partPath(slot), "a");
+  bool ok = f && f.write((const uint8_t*)body.c_str(), body.length()) == body.length();
+  if (f) f.close();
+  if (!ok) { server.send(500, "text/plain", "Blob write failed"); return; }
+  have += body.length();
+  if (have < total) { sendUploadState(200, slot, have, false); return; }
+
+  File p = LittleFS.open(partPath(slot), "r");
+  uint32_t got = p ? fnv1aFile(p) : 0;
+  if (p) p.close();
+  if (got != hash) {
+    LittleFS.remove(partPath(slot));
+    uploadTotal[i] = 0;
+    server.send(422, "text/plain", "Macro hash mismatch; upload it again");
+    return;
+  }
+  if (playing.active && playing.slot == slot) stopMacro();
+  // LittleFS renames over the old blob atomically: a reset leaves one or the other
+  if (!LittleFS.rename(partPath(slot), blobPath(slot))) {
+    server.send(500, "text/plain", "Blob rename failed");
+    return;
+  }
+  macroBlobLen[i] = total;
+  macroBlobHash[i] = hash;
+  String &inl = (slot == 1) ? cfg.macro1 : cfg.macro2;
+  if (inl.length()) {
+    inl = "";
+    saveConfigFields(slot == 1 ? F_MACRO1 : F_MACRO2);
+  }
+  sendUploadState(200, slot, have, true);
+  uploadTotal[i] = 0;
+}
+
+// DELETE /macro/text?slot=N: drop the slot's blob and any upload in progress
+void handleDeleteMacroText() {
+  int slot = server.arg("slot").toInt();
+  if (slot != 1 && slot != 2) { server.send(400, "text/plain", "slot must be 1 or 2"); return; }
+  if (ifMatchFails()) return;
+  if (LittleFS.exists(partPath(slot))) LittleFS.remove(partPath(slot));
+  uploadTotal[slot - 1] = 0;
+  dropMacroBlob(slot);
+  server.sendHeader("ETag", "\"" + configEtag() + "\"");
+  server.send(200, "application/json", "{\"ok\":true}");
+}
+
 void handlePostConfig() {
   if (server.hasArg("plain") == false) {
     server.send(400, "text/plain", "Body required");
     return;
   }
+  if (ifMatchFails()) return;
   String body = server.arg("plain");
-  StaticJsonDocument<512> doc;
+  if (body.length() > CONFIG_BODY_MAX) {
+    server.send(413, "text/plain", "Config body too large");
+    return;
+  }
+  DynamicJsonDocument doc(JSON_OBJECT_SIZE(16) + body.length());
   DeserializationError err = deserializeJson(doc, body);
   if (err) {
     server.send(400, "text/plain", "Invalid JSON");
     return;
   }
+  // Keys missing from the body are left as they are, so clients may send deltas.
+  uint16_t changed = 0;
   // If we're in AP/setup mode, expect wifi fields and reboot after saving.
   if (WiFi.status() != WL_CONNECTED) {
-    const char* _s2 = doc["wifi_ssid"] | "";
-    const char* _p2 = doc["wifi_pass"] | "";
-    cfg.wifi_ssid = String(_s2);
-    cfg.wifi_pass = String(_p2);
-    saveConfig();
-    server.send(200, "text/plain", "OK");
+    mergeField(doc, "wifi_ssid", cfg.wifi_ssid, F_WIFI_SSID, changed);
+    mergeField(doc, "wifi_pass", cfg.wifi_pass, F_WIFI_PASS, changed);
+    saveConfigFields(changed);
+    server.sendHeader("ETag", "\"" + configEtag() + "\"");
+    server.send(200, "application/json", "{\"ok\":true,\"restart\":true}");
     delay(500);
     ESP.restart();
     return;
   }
   // Otherwise we're connected: update macros, actions and keymaps (no reboot)
-  const char* _m3 = doc["macro1"] | "";
-  const char* _m4 = doc["macro2"] | "";
-  const char* _a1 = doc["action1"] | "macro";
-  const char* _a2 = doc["action2"] | "macro";
-  const char* _k1 = doc["keymap1"] | "";
-  const char* _k2 = doc["keymap2"] | "";
-  cfg.macro1 = String(_m3);
-  cfg.macro2 = String(_m4);
-  cfg.action1 = String(_a1);
-  cfg.action2 = String(_a2);
-  cfg.keymap1 = String(_k1);
-  cfg.keymap2 = String(_k2);
-  saveConfig();
-  server.send(200, "text/plain", "OK");
+  if (strlen(doc["macro1"] | "") > MACRO_INLINE_MAX || strlen(doc["macro2"] | "") > MACRO_INLINE_MAX) {
+    server.send(413, "text/plain", "Macros over 256 bytes are uploaded with POST /macro/text");
+    return;
+  }
+  mergeField(doc, "macro1", cfg.macro1, F_MACRO1, changed);
+  mergeField(doc, "macro2", cfg.macro2, F_MACRO2, changed);
+  mergeField(doc, "action1", cfg.action1, F_ACTION1, changed);
+  mergeField(doc, "action2", cfg.action2, F_ACTION2, changed);
+  mergeField(doc, "keymap1", cfg.keymap1, F_KEYMAP1, changed);
+  mergeField(doc, "keymap2", cfg.keymap2, F_KEYMAP2, changed);
+  saveConfigFields(changed);
+  server.sendHeader("ETag", "\"" + configEtag() + "\"");
+  server.send(200, "application/json", "{\"ok\":true,\"restart\":false}");
 }
 
 // Try to connect to saved WiFi credentials. Returns true on success.
@@ -554,6 +980,7 @@ bool attemptWiFiConnect() {
 }
 
 void setup() {
+  Serial.setRxBufferSize(2048);  // room for a couple of max-size frames between loop() passes
   Serial.begin(115200);
   delay(300);
   if (!LittleFS.begin()) {
@@ -561,6 +988,8 @@ void setup() {
     LittleFS.begin();
   }
   loadConfig();
+  loadCompiled();
+  loadMacroBlobs();
 
   pinMode(BUTTON_PIN_1, INPUT_PULLUP);
   pinMode(BUTTON_PIN_2, INPUT_PULLUP);
@@ -596,103 +1025,465 @@ void setup() {
   server.on("/", HTTP_GET, handleRoot);
   server.on("/config", HTTP_GET, handleGetConfig);
   server.on("/config", HTTP_POST, handlePostConfig);
+  server.on("/macro", HTTP_GET, handleGetMacro);
+  server.on("/macro", HTTP_POST, handlePostMacro);
+  server.on("/macro/text", HTTP_GET, handleGetMacroText);
+  server.on("/macro/text", HTTP_POST, handlePostMacroText);
+  server.on("/macro/text", HTTP_DELETE, handleDeleteMacroText);
+  const char* headerKeys[] = { "If-Match" };
+  server.collectHeaders(headerKeys, 1);
   server.begin();
 }
 
-void executeMacro(const String &m) {
-  if (m.length() == 0) return;
-  // simple: send as characters via HID keyboard
-  Keyboard.print(m.c_str());
+// Start typing the slot's text macro; pumpMacro() sends it from loop()
+void executeMacro(int slot) {
+  if (playing.active) {
+    Serial.println("Macro still playing; press ignored");
+    return;
+  }
+  if (macroBlobLen[slot - 1]) {
+    playing.file = LittleFS.open(blobPath(slot), "r");
+    if (!playing.file) return;
+    playing.text = "";
+  } else {
+    const String &m = (slot == 1) ? cfg.macro1 : cfg.macro2;
+    if (m.length() == 0) return;
+    playing.text = m;
+  }
+  playing.slot = slot;
+  playing.pos = 0;
+  playing.active = true;
+}
+
+void stopMacro() {
+  if (playing.file) playing.file.close();
+  playing.text = "";
+  playing.active = false;
+}
+
+// One slice of the playing macro per loop() pass, so the web server, serial
+// and buttons keep being served while a long macro types
+void pumpMacro() {
+  if (!playing.active) return;
+  uint8_t buf[MACRO_SLICE];
+  size_t n;
+  if (playing.file) {
+    n = playing.file.read(buf, sizeof(buf));
+  } else {
+    n = min(sizeof(buf), playing.text.length() - playing.pos);
+    memcpy(buf, playing.text.c_str() + playing.pos, n);
+  }
+  playing.pos += n;
+  if (n) Keyboard.write(buf, n);
+  bool more = playing.file ? playing.file.available() > 0 : playing.pos < playing.text.length();
+  if (n == 0 || !more) stopMacro();
+}
+
+void sendKeyReport(uint8_t mods, uint8_t key, uint8_t hold) {
+  KeyReport r;
+  memset(&r, 0, sizeof(r));
+  r.modifiers = mods;
+  r.keys[0] = key;
+  Keyboard.sendReport(&r);
+  if (hold) delay(hold);
+}
+
+// Replay a compiled keymap: no parsing or allocation, one sendReport per record
+void playCompiled(const uint8_t* b, size_t len) {
+  for (size_t i = COMPILED_HEADER; i + 3 <= len; i += 3) {
+    uint8_t mods = b[i], key = b[i + 1], wait = b[i + 2];
+    if (key == COMPILED_WAIT_KEY) {
+      delay(((uint16_t)mods << 8) | wait);
+      continue;
+    }
+    sendKeyReport(mods, key, wait);
+  }
+  Keyboard.releaseAll();
+}
+
+// ---- Keymap grammar: parse() and to_reports() of macro_compiler.py ----
+// Without a valid compiled blob (none uploaded yet, or stale after an edit)
+// the keymap is parsed on the press and sends exactly the reports its blob
+// would, so both paths type the same thing.
+#define KEYMAP_HOLD_MS 3  // macro_compiler.DEFAULT_HOLD_MS
+#define KM_CTRL 0x01
+#define KM_SHIFT 0x02
+#define KM_ALT 0x04
+#define KM_GUI 0x08
+
+struct NamedKey { const char* name; uint8_t usage; };
+const NamedKey NAMED_KEYS[] = {
+  { "enter", 0x28 }, { "return", 0x28 }, { "esc", 0x29 }, { "escape", 0x29 }, { "backspace", 0x2A },
+  { "tab", 0x2B }, { "space", 0x2C }, { "capslock", 0x39 }, { "printscreen", 0x46 }, { "scrolllock", 0x47 },
+  { "pause", 0x48 }, { "insert", 0x49 }, { "home", 0x4A }, { "pageup", 0x4B }, { "delete", 0x4C }, { "del", 0x4C },
+  { "end", 0x4D }, { "pagedown", 0x4E }, { "right", 0x4F }, { "left", 0x50 }, { "down", 0x51 }, { "up", 0x52 },
+};
+
+bool tokenIs(const char* s, size_t n, const char* name) {
+  return strlen(name) == n && strncasecmp(s, name, n) == 0;
+}
+
+int modifierBit(const char* s, size_t n) {
+  if (tokenIs(s, n, "ctrl") || tokenIs(s, n, "control")) return KM_CTRL;
+  if (tokenIs(s, n, "shift")) return KM_SHIFT;
+  if (tokenIs(s, n, "alt")) return KM_ALT;
+  if (tokenIs(s, n, "gui") || tokenIs(s, n, "win") || tokenIs(s, n, "cmd") || tokenIs(s, n, "meta")) return KM_GUI;
+  return -1;
+}
+
+int namedKey(const char* s, size_t n) {
+  for (const NamedKey &k : NAMED_KEYS) {
+    if (tokenIs(s, n, k.name)) return k.usage;
+  }
+  // F1-F12
+  if ((n == 2 || n == 3) && (s[0] == 'f' || s[0] == 'F') && s[1] != '0') {
+    int f = 0;
+    for (size_t i = 1; i < n; i++) {
+      if (!isdigit((unsigned char)s[i])) return -1;
+      f = f * 10 + (s[i] - '0');
+    }
+    if (f >= 1 && f <= 12) return 0x39 + f;
+  }
+  return -1;
+}
+
+// US layout, as macro_compiler.ASCII
+bool asciiKey(char c, uint8_t &usage, bool &shift) {
+  static const char* const SHIFTED_DIGITS = "!@#$%^&*()";
+  static const char* const PUNCT = "-=[]\\;'`,./";
+  static const char* const SHIFTED_PUNCT = "_+{}|:\"~<>?";
+  static const uint8_t PUNCT_USAGE[] = { 0x2D, 0x2E, 0x2F, 0x30, 0x31, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38 };
+  shift = false;
+  if (c >= 'a' && c <= 'z') { usage = 0x04 + (c - 'a'); return true; }
+  if (c >= 'A' && c <= 'Z') { usage = 0x04 + (c - 'A'); shift = true; return true; }
+  if (c >= '1' && c <= '9') { usage = 0x1E + (c - '1'); return true; }
+  if (c == '0') { usage = 0x27; return true; }
+  if (c == '\n') { usage = 0x28; return true; }
+  if (c == '\t') { usage = 0x2B; return true; }
+  if (c == ' ') { usage = 0x2C; return true; }
+  if (c == 0) return false;
+  const char* p;
+  if ((p = strchr(SHIFTED_DIGITS, c))) { usage = 0x1E + (p - SHIFTED_DIGITS); shift = true; return true; }
+  if ((p = strchr(PUNCT, c))) { usage = PUNCT_USAGE[p - PUNCT]; return true; }
+  if ((p = strchr(SHIFTED_PUNCT, c))) { usage = PUNCT_USAGE[p - SHIFTED_PUNCT]; shift = true; return true; }
+  return false;
+}
+
+// Report state of to_reports(); with play false nothing is sent (validation pass)
+struct KeymapPlayer {
+  bool play;
+  uint8_t mods, key;
+};
+
+void kmSend(KeymapPlayer &p, uint8_t mods, uint8_t key) {
+  if (p.play) sendKeyReport(mods, key, KEYMAP_HOLD_MS);
+}
+
+void kmStroke(KeymapPlayer &p, uint8_t mods, uint8_t key) {
+  if (p.key && (key == p.key || mods != p.mods)) {
+    kmSend(p, p.mods, 0);  // release the key before it repeats or modifiers change
+    p.key = 0;
+  }
+  if (mods != p.mods) {
+    if (mods) kmSend(p, mods, 0);  // modifiers down one report ahead of the key
+    p.mods = mods;
+  }
+  kmSend(p, p.mods, key);
+  p.key = key;
+}
+
+void kmWait(KeymapPlayer &p, uint16_t ms) {
+  if (p.key || p.mods) {
+    kmSend(p, 0, 0);  // nothing stays held across a pause
+    p.mods = p.key = 0;
+  }
+  if (p.play) delay(ms);
+}
+
+void keymapError(bool play, int slot, int n, const char* t, size_t tn, const char* msg) {
+  if (!play) Serial.printf("Keymap %d: token %d '%.*s': %s\n", slot, n, (int)tn, t, msg);
+}
+
+// Validate (play false) or type (play true) a keymap; returns the number of errors
+int runKeymap(const String &keymap, bool play, int slot) {
+  KeymapPlayer p = { play, 0, 0 };
+  const char* s = keymap.c_str();
+  size_t len = keymap.length(), i = 0;
+  int errors = 0, n = 0;
+  while (i < len) {
+    while (i < len && isspace((unsigned char)s[i])) i++;
+    if (i >= len) break;
+    const char* t = s + i;
+    while (i < len && !isspace((unsigned char)s[i])) i++;
+    size_t tn = (s + i) - t;
+    n++;
+
+    if (tn >= 5 && strncasecmp(t, "wait:", 5) == 0) {
+      long ms = tn > 5 ? 0 : -1;
+      for (size_t k = 5; k < tn && ms >= 0; k++) {
+        ms = (isdigit((unsigned char)t[k]) && ms <= 0xFFFF) ? ms * 10 + (t[k] - '0') : -1;
+      }
+      if (ms < 0 || ms > 0xFFFF) { keymapError(play, slot, n, t, tn, "wait must be 0-65535 ms"); errors++; }
+      else kmWait(p, ms);
+      continue;
+    }
+
+    // Modifiers before the last '+', but a trailing '++' means the '+' key
+    size_t modEnd = 0, keyStart = 0;
+    if (tn >= 2 && t[tn - 1] == '+' && t[tn - 2] == '+') { modEnd = tn - 2; keyStart = tn - 1; }
+    else if (!(tn == 1 && t[0] == '+')) {
+      for (size_t k = tn; k-- > 0;) {
+        if (t[k] == '+') { modEnd = k; keyStart = k + 1; break; }
+      }
+    }
+    uint8_t mods = 0;
+    for (size_t a = 0; a < modEnd;) {
+      size_t b = a;
+      while (b < modEnd && t[b] != '+') b++;
+      if (b > a) {
+        int bit = modifierBit(t + a, b - a);
+        if (bit < 0) { keymapError(play, slot, n, t, tn, "unknown modifier"); errors++; }
+        else mods |= bit;
+      }
+      a = b + 1;
+    }
+
+    const char* k = t + keyStart;
+    size_t kn = tn - keyStart;
+    int named = kn ? namedKey(k, kn) : -1;
+    uint8_t usage;
+    bool shift;
+    if (kn == 0) { keymapError(play, slot, n, t, tn, "missing key after modifiers"); errors++; }
+    else if (named >= 0) kmStroke(p, mods, named);
+    else if (kn == 1) {
+      if (!asciiKey(k[0], usage, shift)) { keymapError(play, slot, n, t, tn, "no US-layout key"); errors++; continue; }
+      // With modifiers a letter names the key (Ctrl+A is select-all, not Ctrl+Shift+A)
+      if (shift && !(mods && isalpha((unsigned char)k[0]))) mods |= KM_SHIFT;
+      kmStroke(p, mods, usage);
+    } else if (mods) { keymapError(play, slot, n, t, tn, "unknown key name"); errors++; }
+    else {
+      // Any other word is typed as text
+      bool ok = true;
+      for (size_t c = 0; c < kn; c++) ok = ok && asciiKey(k[c], usage, shift);
+      if (!ok) { keymapError(play, slot, n, t, tn, "no US-layout key for every character"); errors++; continue; }
+      for (size_t c = 0; c < kn; c++) {
+        asciiKey(k[c], usage, shift);
+        kmStroke(p, shift ? KM_SHIFT : 0, usage);
+      }
+    }
+  }
+  if (p.key || p.mods) kmSend(p, 0, 0);
+  if (play) Keyboard.releaseAll();
+  return errors;
 }
 
 // Execute action for a given button id (1-based)
 void executeAction(int id) {
-  String action = (id == 1) ? cfg.action1 : cfg.action2;
-  String macro = (id == 1) ? cfg.macro1 : cfg.macro2;
-  String keymap = (id == 1) ? cfg.keymap1 : cfg.keymap2;
+  const String &action = (id == 1) ? cfg.action1 : cfg.action2;
+  const String &keymap = (id == 1) ? cfg.keymap1 : cfg.keymap2;
 
   if (action == "disabled") return;
   if (action == "macro") {
-    executeMacro(macro);
+    executeMacro(id);
     return;
   }
   if (action == "keystroke") {
-    // Parse tokens separated by spaces. Each token may be like 'Ctrl+Shift+A' or 'Enter'
-    String s = keymap;
-    int pos = 0;
-    while (pos < s.length()) {
-      // find next token
-      int sp = s.indexOf(' ', pos);
-      String token;
-      if (sp == -1) { token = s.substring(pos); pos = s.length(); }
-      else { token = s.substring(pos, sp); pos = sp + 1; }
-      token.trim();
-      if (token.length() == 0) continue;
-
-      // split modifiers and key by '+'
-      int plus = token.lastIndexOf('+');
-      String keypart = token;
-      String mods = "";
-      if (plus != -1) { mods = token.substring(0, plus); keypart = token.substring(plus + 1); }
-
-      bool modCtrl = false, modAlt = false, modShift = false;
-      if (mods.length()) {
-        // parse each modifier
-        int p = 0;
-        while (p < mods.length()) {
-          int p2 = mods.indexOf('+', p);
-          String m;
-          if (p2 == -1) { m = mods.substring(p); p = mods.length(); } else { m = mods.substring(p, p2); p = p2 + 1; }
-          m.trim();
-          m.toLowerCase();
-          if (m == "ctrl" || m == "control") modCtrl = true;
-          else if (m == "alt") modAlt = true;
-          else if (m == "shift") modShift = true;
+    if (compiledValid(id)) {
+      playCompiled(compiledBuf[id - 1], compiledLen[id - 1]);
+      return;
+    }
+    // Like compile_keymap(), a keymap with any error types nothing
+    if (runKeymap(keymap, false, id) == 0) runKeymap(keymap, true, id);
+    else Serial.printf("Keymap %d has errors; nothing typed\n", id);
+  }
+}
+
+// ==========================================
+// Framed serial protocol (serial_proto.py)
+// ==========================================
+// A5 5A | type | seq | len u16 LE | payload | CRC-16/CCITT u16 LE over type..payload.
+// Replies echo seq with type|0x80 and a status byte first. SETs are staged and
+// written to flash together on COMMIT.
+#define FRAME_SYNC1 0xA5
+#define FRAME_SYNC2 0x5A
+#define FRAME_MAX 1024
+#define FRAME_TIMEOUT_MS 200
+#define SERIAL_BUDGET 1024  // input bytes handled per loop() pass
+
+enum FrameType : uint8_t { FT_PING = 1, FT_GET, FT_SET, FT_COMMIT, FT_GET_ALL, FT_ABORT };
+enum FrameStatus : uint8_t { FS_OK = 0, FS_UNKNOWN_FIELD, FS_BAD_REQUEST, FS_TOO_LARGE, FS_INCOMPLETE };
+
+// Field names in ConfigField bit order
+const char* const FIELD_NAMES[] = { "wifi_ssid", "wifi_pass", "macro1", "macro2",
+                                    "action1", "action2", "keymap1", "keymap2" };
+
+uint8_t rxFrame[FRAME_MAX + 8];
+size_t rxFrameLen = 0;
+unsigned long rxFrameStart = 0;
+char rxLine[256];
+size_t rxLineLen = 0;
+bool rxLineOverflow = false;  // a command longer than rxLine is refused, not cut short
+DeviceConfig staged;
+uint16_t stagedMask = 0;
+// The last COMMIT applied, so a retransmission after a lost reply is re-acked
+int16_t lastCommitSeq = -1;
+uint16_t lastCommitWant = 0;
+uint16_t lastCommitChanged = 0;
+
+String* configField(DeviceConfig &c, int i) {
+  String* f[] = { &c.wifi_ssid, &c.wifi_pass, &c.macro1, &c.macro2,
+                  &c.action1, &c.action2, &c.keymap1, &c.keymap2 };
+  return f[i];
+}
+
+int fieldIndex(const uint8_t* name, size_t n) {
+  for (int i = 0; i < 8; i++) {
+    if (strlen(FIELD_NAMES[i]) == n && memcmp(FIELD_NAMES[i], name, n) == 0) return i;
+  }
+  return -1;
+}
+
+uint16_t crc16Update(uint16_t crc, const uint8_t* d, size_t n) {
+  while (n--) {
+    crc ^= (uint16_t)(*d++) << 8;
+    for (int b = 0; b < 8; b++) crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+void sendFrame(uint8_t type, uint8_t seq, uint8_t status, const uint8_t* data, size_t n) {
+  uint8_t hdr[7] = { FRAME_SYNC1, FRAME_SYNC2, (uint8_t)(type | 0x80), seq,
+                     (uint8_t)((n + 1) & 0xFF), (uint8_t)((n + 1) >> 8), status };
+  uint16_t crc = crc16Update(0xFFFF, hdr + 2, 5);
+  crc = crc16Update(crc, data, n);
+  uint8_t tail[2] = { (uint8_t)(crc & 0xFF), (uint8_t)(crc >> 8) };
+  Serial.write(hdr, 7);
+  if (n) Serial.write(data, n);
+  Serial.write(tail, 2);
+}
+
+void handleFrame(uint8_t type, uint8_t seq, const uint8_t* p, size_t n) {
+  switch (type) {
+    case FT_PING:
+      sendFrame(type, seq, FS_OK, nullptr, 0);
+      break;
+    case FT_GET: {
+      int i = fieldIndex(p, n);
+      if (i < 0) { sendFrame(type, seq, FS_UNKNOWN_FIELD, nullptr, 0); break; }
+      String* v = configField(cfg, i);
+      sendFrame(type, seq, FS_OK, (const uint8_t*)v->c_str(), v->length());
+      break;
+    }
+    case FT_GET_ALL: {
+      DynamicJsonDocument doc(configDocSize());
+      for (int i = 0; i < 8; i++) doc[FIELD_NAMES[i]] = *configField(cfg, i);
+      // Text macros stored as blobs are too big for a frame; say they exist
+      if (macroBlobLen[0]) doc["macro1_blob"] = macroBlobLen[0];
+      if (macroBlobLen[1]) doc["macro2_blob"] = macroBlobLen[1];
+      String out;
+      serializeJson(doc, out);
+      if (out.length() >= FRAME_MAX) { sendFrame(type, seq, FS_TOO_LARGE, nullptr, 0); break; }
+      sendFrame(type, seq, FS_OK, (const uint8_t*)out.c_str(), out.length());
+      break;
+    }
+    case FT_SET: {
+      const uint8_t* nul = (const uint8_t*)memchr(p, 0, n);
+      if (!nul) { sendFrame(type, seq, FS_BAD_REQUEST, nullptr, 0); break; }
+      int i = fieldIndex(p, nul - p);
+      if (i < 0) { sendFrame(type, seq, FS_UNKNOWN_FIELD, nullptr, 0); break; }
+      const uint8_t* v = nul + 1;
+      size_t vn = n - (v - p);
+      // Same limit as POST /config: longer text macros go up as blobs over HTTP
+      if (((1 << i) & (F_MACRO1 | F_MACRO2)) && vn > MACRO_INLINE_MAX) {
+        sendFrame(type, seq, FS_TOO_LARGE, nullptr, 0);
+        break;
+      }
+      String* dst = configField(staged, i);
+      *dst = "";
+      dst->reserve(vn);
+      for (size_t k = 0; k < vn; k++) *dst += (char)v[k];
+      stagedMask |= (1 << i);
+      sendFrame(type, seq, FS_OK, nullptr, 0);
+      break;
+    }
+    case FT_COMMIT: {
+      // The host sends the mask it staged; a SET still being retransmitted
+      // must not be left behind.
+      uint16_t want = (n >= 2) ? (p[0] | (p[1] << 8)) : 0;
+      uint8_t have[2] = { (uint8_t)(stagedMask & 0xFF), (uint8_t)(stagedMask >> 8) };
+      if ((stagedMask & want) != want) {
+        if (seq == lastCommitSeq && want == lastCommitWant) {
+          // Already applied; only the reply was lost
+          uint8_t out[2] = { (uint8_t)(lastCommitChanged & 0xFF), (uint8_t)(lastCommitChanged >> 8) };
+          sendFrame(type, seq, FS_OK, out, 2);
+          break;
+        }
+        sendFrame(type, seq, FS_INCOMPLETE, have, 2);
+        break;
+      }
+      uint16_t changed = 0;
+      for (int i = 0; i < 8; i++) {
+        if (!(stagedMask & (1 << i))) continue;
+        if (*configField(cfg, i) != *configField(staged, i)) {
+          *configField(cfg, i) = *configField(staged, i);
+          changed |= (1 << i);
         }
       }
+      stagedMask = 0;
+      lastCommitSeq = seq;
+      lastCommitWant = want;
+      lastCommitChanged = changed;
+      saveConfigFields(changed);  // one flash write for the whole batch
+      uint8_t out[2] = { (uint8_t)(changed & 0xFF), (uint8_t)(changed >> 8) };
+      sendFrame(type, seq, FS_OK, out, 2);
+      break;
+    }
+    case FT_ABORT:
+      stagedMask = 0;
+      lastCommitSeq = -1;
+      sendFrame(type, seq, FS_OK, nullptr, 0);
+      break;
+    default:
+      sendFrame(type, seq, FS_BAD_REQUEST, nullptr, 0);
+  }
+}
 
-      // Press modifiers if supported
-#ifdef KEY_LEFT_CTRL
-      if (modCtrl) Keyboard.press(KEY_LEFT_CTRL);
-#endif
-#ifdef KEY_LEFT_ALT
-      if (modAlt) Keyboard.press(KEY_LEFT_ALT);
-#endif
-#ifdef KEY_LEFT_SHIFT
-      if (modShift) Keyboard.press(KEY_LEFT_SHIFT);
-#endif
-
-      // Send key
-      String k = keypart;
-      k.trim();
-      if (k.equalsIgnoreCase("Enter")) {
-        Keyboard.write('\n');
-      } else if (k.equalsIgnoreCase("Tab")) {
-        Keyboard.write('\t');
-      } else if (k.equalsIgnoreCase("Space")) {
-        Keyboard.write(' ');
-      } else if (k.length() == 1) {
-        // single character
-        Keyboard.write(k.charAt(0));
+// Non-blocking serial pump: frames go to handleFrame, anything else is
+// collected into text command lines for handleSerialLine.
+void pollSerial() {
+  if (rxFrameLen && millis() - rxFrameStart > FRAME_TIMEOUT_MS) rxFrameLen = 0;  // stalled frame
+  int budget = SERIAL_BUDGET;
+  while (budget-- > 0 && Serial.available() > 0) {
+    uint8_t b = Serial.read();
+    if (rxFrameLen == 0) {
+      if (b == FRAME_SYNC1) {
+        rxFrame[0] = b;
+        rxFrameLen = 1;
+        rxFrameStart = millis();
+      } else if (b == '\n') {
+        rxLine[rxLineLen] = 0;
+        rxLineLen = 0;
+        if (rxLineOverflow) Serial.printf("Command over %u characters ignored\n", (unsigned)(sizeof(rxLine) - 1));
+        else handleSerialLine(String(rxLine));
+        rxLineOverflow = false;
+      } else if (rxLineLen < sizeof(rxLine) - 1) {
+        rxLine[rxLineLen++] = (char)b;
       } else {
-        // long names: try first char
-        Keyboard.print(k.c_str());
+        rxLineOverflow = true;
       }
-
-      delay(10);
-      // release modifiers
-#ifdef KEY_LEFT_CTRL
-      if (modCtrl) Keyboard.release(KEY_LEFT_CTRL);
-#endif
-#ifdef KEY_LEFT_ALT
-      if (modAlt) Keyboard.release(KEY_LEFT_ALT);
-#endif
-#ifdef KEY_LEFT_SHIFT
-      if (modShift) Keyboard.release(KEY_LEFT_SHIFT);
-#endif
-      Keyboard.releaseAll();
-      delay(10);
+      continue;
     }
+    rxFrame[rxFrameLen++] = b;
+    if (rxFrameLen == 2 && b != FRAME_SYNC2) { rxFrameLen = 0; continue; }
+    if (rxFrameLen < 6) continue;
+    size_t n = rxFrame[4] | (rxFrame[5] << 8);
+    if (n > FRAME_MAX) { rxFrameLen = 0; continue; }
+    if (rxFrameLen < 6 + n + 2) continue;
+    uint16_t crc = rxFrame[6 + n] | (rxFrame[7 + n] << 8);
+    if (crc == crc16Update(0xFFFF, rxFrame + 2, 4 + n)) {
+      handleFrame(rxFrame[2], rxFrame[3], rxFrame + 6, n);
+    }  // bad CRC: drop it, the host resends after its timeout
+    rxFrameLen = 0;
   }
 }
 
@@ -750,9 +1541,7 @@ void wifiScanSerial() {
   }
 }
 
-void handleSerial() {
-  if (Serial.available() == 0) return;
-  String line = Serial.readStringUntil('\n');
+void handleSerialLine(String line) {
   line.trim();
   if (line.length() == 0) return;
   Serial.print("CMD: "); Serial.println(line);
@@ -768,8 +1557,11 @@ void handleSerial() {
   } else if (verb == "cfg") {
     printConfigSerial();
   } else if (verb == "macros") {
-    Serial.print("Macro1: "); Serial.println(cfg.macro1);
-    Serial.print("Macro2: "); Serial.println(cfg.macro2);
+    for (int slot = 1; slot <= 2; slot++) {
+      Serial.printf("Macro%d: ", slot);
+      if (macroBlobLen[slot - 1]) Serial.printf("(%u-byte blob)\n", (unsigned)macroBlobLen[slot - 1]);
+      else Serial.println(slot == 1 ? cfg.macro1 : cfg.macro2);
+    }
   } else if (verb == "set") {
     // arg expected: "macro1 <text>" or "macro2 <text>" or "wifi <ssid> <pass>" or wifi_ssid/wifi_pass
     int sp2 = arg.indexOf(' ');
@@ -780,11 +1572,11 @@ void handleSerial() {
       String value = arg.substring(sp2 + 1);
       if (key == "macro1") {
         cfg.macro1 = value;
-        saveConfig();
+        saveConfigFields(F_MACRO1);
         Serial.println("macro1 saved");
       } else if (key == "macro2") {
         cfg.macro2 = value;
-        saveConfig();
+        saveConfigFields(F_MACRO2);
         Serial.println("macro2 saved");
       } else if (key == "wifi") {
         // value: '<ssid> <pass>' (password may contain spaces)
@@ -798,15 +1590,15 @@ void handleSerial() {
           cfg.wifi_ssid = ssid;
           cfg.wifi_pass = pass;
         }
-        saveConfig();
+        saveConfigFields(F_WIFI_SSID | F_WIFI_PASS);
         Serial.println("WiFi credentials saved");
       } else if (key == "wifi_ssid") {
         cfg.wifi_ssid = value;
-        saveConfig();
+        saveConfigFields(F_WIFI_SSID);
         Serial.println("wifi_ssid saved");
       } else if (key == "wifi_pass") {
         cfg.wifi_pass = value;
-        saveConfig();
+        saveConfigFields(F_WIFI_PASS);
         Serial.println("wifi_pass saved");
       } else {
         Serial.println("Unknown set key. Use macro1, macro2, wifi, wifi_ssid, or wifi_pass.");
@@ -854,8 +1646,10 @@ void handleSerial() {
 void loop() {
   server.handleClient();
   dnsServer.processNextRequest();
-  // Handle serial debug commands
-  handleSerial();
+  // Framed config requests and serial debug commands (never blocks)
+  pollSerial();
+  // Next slice of a text macro being typed
+  pumpMacro();
 
   int reading1 = digitalRead(BUTTON_PIN_1);
   if (reading1 != lastButtonState1) {
@@ -879,5 +1673,5 @@ void loop() {
   }
   lastButtonState2 = reading2;
 
-  delay(10);
+  delay(playing.active ? 1 : 10);
 }
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Benchmark pooled DeviceClient requests against one-off requests.get calls.
+
+The emulated device charges ``--connect-latency`` for every new TCP
+connection, standing in for connection setup to the ESP32 WebServer.
+
+Usage: python bench/bench_client.py [--requests 50] [--connect-latency 0.03]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from device_client import DeviceClient
+from emulator import FakeDevice
+
+
+def run(fn, n):
+    lat = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        lat.append(time.perf_counter() - t0)
+    return lat
+
+
+def report(name, lat, conns):
+    print(f'{name:<10} mean={statistics.mean(lat) * 1000:6.1f} ms  '
+          f'p50={statistics.median(lat) * 1000:6.1f} ms  '
+          f'max={max(lat) * 1000:6.1f} ms  connections={conns}')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--requests', type=int, default=50)
+    ap.add_argument('--latency', type=float, default=0.005)
+    ap.add_argument('--connect-latency', type=float, default=0.03)
+    args = ap.parse_args()
+
+    with FakeDevice(latency=args.latency, connect_latency=args.connect_latency) as dev:
+        lat = run(lambda: requests.get(dev.url + '/config', timeout=3).json(), args.requests)
+        report('one-off', lat, dev.connections)
+
+        before = dev.connections
+        client = DeviceClient(dev.url)
+        lat = run(client.get_config, args.requests)
+        report('pooled', lat, dev.connections - before)
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Benchmark subnet discovery against emulated devices on 127.0.0.0/24.
+
+Starts fake ``/config`` servers on a handful of loopback addresses (Linux
+routes the whole 127/8 to lo) and parks silent listeners on every other
+address, so each non-device host costs a full timeout the way an
+unanswered connect does on a real LAN. The concurrent scan of the /24 is
+compared against a single-worker sweep of one /28, extrapolated to /24.
+
+Usage: python bench/bench_discovery.py [--devices 8] [--port 18080]
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discovery
+from emulator import FakeDevice
+
+
+def silent_listener(host, port):
+    # Accepts the TCP handshake in the kernel but never answers the request
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((host, port))
+    s.listen(64)
+    return s
+
+
+def timed_scan(net, port, workers, timeout):
+    t0 = time.monotonic()
+    hits = discovery.scan([net], port=port, workers=workers, connect_timeout=timeout,
+                          read_timeout=timeout, candidates=())
+    return time.monotonic() - t0, hits
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--devices', type=int, default=8)
+    ap.add_argument('--port', type=int, default=18080)
+    ap.add_argument('--workers', type=int, default=64)
+    ap.add_argument('--timeout', type=float, default=0.3)
+    args = ap.parse_args()
+
+    step = 250 // args.devices
+    dev_hosts = {f'127.0.0.{2 + i * step}' for i in range(args.devices)}
+    devs = [FakeDevice(h, args.port).start() for h in sorted(dev_hosts)]
+    silent = [silent_listener(f'127.0.0.{i}', args.port)
+              for i in range(1, 255) if f'127.0.0.{i}' not in dev_hosts]
+    try:
+        elapsed, hits = timed_scan('127.0.0.0/24', args.port, args.workers, args.timeout)
+        print(f'concurrent  workers={args.workers:<3} found={len(hits)}/{len(devs)} '
+              f'elapsed={elapsed:.2f} s')
+        seq, _ = timed_scan('127.0.0.0/28', args.port, 1, args.timeout)
+        print(f'sequential  workers=1   /28 elapsed={seq:.2f} s '
+              f'-> /24 estimate {seq * 254 / 14:.1f} s')
+    finally:
+        for d in devs:
+            d.stop()
+        for s in silent:
+            s.close()
+
+
+if __name__ == '__main__':
+    main()
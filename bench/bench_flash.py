@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Benchmark full vs incremental flashing against bench/fake_esptool.py.
+
+Scenarios, each on the same emulated device:
+
+    legacy       erase-flash, then write all four images (the old tools)
+    first        incremental with no history (writes everything, no erase)
+    app-update   new firmware.bin only
+    unchanged    same release again
+    verify       app-update with the history lost, asking the chip instead
+    no-serial    a port without a USB serial number, flashed once, then
+    swapped      a blank pad plugged into that port: nothing may be skipped
+    erase-fail   a factory erase whose write-flash fails, then
+    part-fail    a flash that fails in firmware.bin, then
+    recovered    the same flash again: only the unconfirmed region is written
+
+Usage: python bench/bench_flash.py [--scale 0.1]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import flasher
+
+SIZES = {
+    '0x0000': ('bootloader.bin', 15 * 1024),
+    '0x8000': ('partitions.bin', 3 * 1024),
+    '0xE000': ('boot_app0.bin', 8 * 1024),
+    '0x10000': ('firmware.bin', 1024 * 1024),
+}
+
+
+def make_images(d, tag):
+    images = []
+    for addr, (name, size) in SIZES.items():
+        path = os.path.join(d, f'{tag}-{name}')
+        # Only the app changes between releases
+        seed = tag if name == 'firmware.bin' else 'static'
+        with open(path, 'wb') as f:
+            f.write((seed.encode() * size)[:size])
+        images.append((addr, path))
+    return images
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--scale', type=float, default=0.1,
+                    help='fraction of real esptool timings to simulate')
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['FAKE_ESPTOOL_STATE'] = os.path.join(tmp, 'state')
+        os.environ['FAKE_ESPTOOL_SCALE'] = str(args.scale)
+        esptool = [sys.executable, os.path.join(HERE, 'fake_esptool.py')]
+        v1 = make_images(tmp, 'v1')
+        v2 = make_images(tmp, 'v2')
+        hist_path = os.path.join(tmp, 'history.json')
+        # Fake ports aren't in comports(); give all but fake-bare USB serial numbers
+        port_key = flasher.device_key
+        flasher.device_key = lambda port: port_key(port) if port == 'fake-bare' else f'usb:{port}'
+
+        def run(label, images, port='fake0', fail=None, **kw):
+            if fail:
+                os.environ['FAKE_ESPTOOL_FAIL'] = fail
+            t0 = time.monotonic()
+            try:
+                r = flasher.flash(port, images, esptool=esptool,
+                                  history=flasher.FlashHistory(hist_path), **kw)
+            except flasher.FlashError as e:
+                print(f'{label:<11} {time.monotonic() - t0:6.2f} s  failed: {e}')
+                return None
+            finally:
+                os.environ.pop('FAKE_ESPTOOL_FAIL', None)
+            dt = time.monotonic() - t0
+            print(f'{label:<11} {dt:6.2f} s ({dt / args.scale:5.1f} s real)  '
+                  f'wrote={",".join(r.written) or "-"}  '
+                  f'phases={ {k: round(v, 2) for k, v in r.phases.items()} }')
+
+        run('legacy', v1, port='fake-legacy', erase=True)
+        run('first', v1)
+        run('app-update', v2)
+        run('unchanged', v2)
+        os.unlink(hist_path)
+        run('verify', v1, verify=True)
+        run('no-serial', v1, port='fake-bare')
+        os.unlink(os.path.join(tmp, 'state', 'fake-bare.json'))  # a different, blank pad
+        run('swapped', v1, port='fake-bare')
+        run('erase-fail', v2, erase=True, fail='fake0')
+        run('part-fail', v2, fail='fake0@0x10000')
+        run('recovered', v2)
+        ok = flasher.verify_regions('fake0', v2, esptool)
+        print(f'{"":<11} chip holds v2 in {len(ok)} of {len(v2)} regions')
+        assert len(ok) == len(v2), 'history skipped regions the chip does not hold'
+
+
+if __name__ == '__main__':
+    main()
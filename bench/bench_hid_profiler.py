@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""What the host sees while a macro plays: hid_profiler against the emulator.
+
+SerialDevice writes what it types to a FIFO as evdev ``input_event``
+records, standing in for the pad's ``/dev/input/eventN``. ``record`` then
+triggers it with ``test1`` on the serial console and reads the FIFO
+(without a grab, which needs a real evdev node):
+
+- playback: a ``--text-size`` text macro typed by one blocking
+  ``Keyboard.print`` vs in slices per loop pass, and a ``--strokes``
+  keymap parsed on the press vs played from its compiled blob (both must
+  type the same keys);
+- faults: keys dropped, swapped and autorepeated in a recorded log must
+  be counted as such, and an intact log must come out clean;
+- offline: a log saved and loaded again analyzes the same.
+
+Usage: python bench/bench_hid_profiler.py [--text-size 512] [--strokes 40] [--report-ms 1.0]
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial
+
+import hid_profiler as hp
+import macro_compiler
+from emulator import FakeDevice, SerialDevice
+
+WORDS = 'the quick brown Fox jumps over lazy dog, Ticket #42: deploy & review!'.split()
+
+
+def text_of(size, seed=0):
+    rng = random.Random(seed)
+    out = ''
+    while len(out) < size:
+        out += rng.choice(WORDS) + rng.choice((' ', ' ', '\n'))
+    return out[:size]
+
+
+def keymap_of(strokes, seed=0):
+    rng = random.Random(seed)
+    keys = ['a', 'B', 'ctrl+c', 'ctrl+v', 'Tab', 'Enter', 'shift+Left', '7', 'alt+F4', 'gui+r']
+    return ' '.join(rng.choice(keys) for _ in range(strokes))
+
+
+def play(label, fifo, config, macro_slice, args, blob=None):
+    dev = FakeDevice().start()
+    dev.config.update(config)
+    if blob is not None:
+        dev.macros[1] = blob
+    rfd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)  # so opening the write end doesn't block
+    with open(fifo, 'wb', buffering=0) as hid:
+        os.close(rfd)
+        with SerialDevice(device=dev, macro_slice=macro_slice, report_ms=args.report_ms, hid=hid) as sd:
+            ser = serial.Serial(sd.port, 115200, timeout=0.05)
+            log = hp.record(1, device=fifo, url=dev.url, grab=False, ser=ser, idle=0.3, timeout=30)
+            ser.close()
+    dev.stop()
+    print(f'{label:<10} ' + hp.format_profile(hp.analyze(log, args.stall / 1000), args.stall / 1000))
+    return log
+
+
+def playback(args, tmp):
+    fifo = os.path.join(tmp, 'event0')
+    os.mkfifo(fifo)
+    text = text_of(args.text_size, seed=1)
+    keymap = keymap_of(args.strokes, seed=2)
+    logs = {
+        'print': play('print', fifo, {'macro1': text}, None, args),
+        'sliced': play('sliced', fifo, {'macro1': text}, 16, args),
+        'parsed': play('parsed', fifo, {'action1': 'keystroke', 'keymap1': keymap}, 16, args),
+        'compiled': play('compiled', fifo, {'action1': 'keystroke', 'keymap1': keymap}, 16, args,
+                         blob=macro_compiler.compile_keymap(keymap)),
+    }
+    for name, log in logs.items():
+        p = hp.analyze(log, args.stall / 1000)
+        assert (p.dropped, p.extra, p.reordered) == (0, 0, 0), f'{name} typed wrong keys: {p.errors[:2]}'
+    return logs
+
+
+def key_downs(log):
+    return [i for i, e in enumerate(log['events']) if e[1] == hp.EV_KEY and e[3] == 1
+            and e[2] not in hp.MODIFIER_KEYS]
+
+
+def faults(log, stall):
+    clean = hp.analyze(log, stall)
+    broken = copy.deepcopy(log)
+    events = broken['events']
+    downs = key_downs(broken)
+    # Swap the key codes of two adjacent unshifted, distinct presses (and their releases):
+    # one key typed out of place
+    a, b = next((x, y) for x, y in zip(downs, downs[1:])
+                if events[x][2] != events[y][2] and all(e[2] not in hp.MODIFIER_KEYS
+                                                         for e in events[x - 1:y + 3]))
+    ca, cb = events[a][2], events[b][2]
+    for e in events[a:b + 4]:
+        if e[1] == hp.EV_KEY:
+            e[2] = cb if e[2] == ca else ca if e[2] == cb else e[2]
+    # Drop three presses far from the swap, and autorepeat one key twice
+    gone = [i for i in downs if i > b + 20][:30:10]
+    rep = events[downs[len(downs) // 2]]
+    events.insert(downs[len(downs) // 2] + 1, [rep[0] + 0.5, hp.EV_KEY, rep[2], 2])
+    events.insert(downs[len(downs) // 2] + 1, [rep[0] + 0.5, hp.EV_KEY, rep[2], 2])
+    for i in sorted(gone, reverse=True):
+        del events[i]
+    p = hp.analyze(broken, stall)
+    ok = (clean.dropped, clean.extra, clean.reordered) == (0, 0, 0) and \
+        (p.dropped, p.extra, p.reordered, p.repeats) == (len(gone), 0, 1, clean.repeats + 2)
+    print(f'clean      dropped {clean.dropped} extra {clean.extra} reordered {clean.reordered}')
+    print(f'injected   {len(gone)} dropped, 1 swap, 2 autorepeats -> found dropped {p.dropped} '
+          f'extra {p.extra} reordered {p.reordered} autorepeats {p.repeats}: {"ok" if ok else "WRONG"}')
+    for e in p.errors[:4]:
+        print(f'           {e}')
+    assert ok, 'injected faults miscounted'
+
+
+def offline(logs, tmp, stall):
+    same = True
+    for name, log in logs.items():
+        path = hp.save_log(log, os.path.join(tmp, f'{name}.json'))
+        same &= hp.analyze(hp.load_log(path), stall) == hp.analyze(log, stall)
+    print(f'offline    {len(logs)} logs saved and re-analyzed: {"identical" if same else "DIFFERENT"}')
+    assert same, 'a saved log analyzes differently'
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--text-size', type=int, default=512, help='characters in the text macro')
+    ap.add_argument('--strokes', type=int, default=40, help='strokes in the keymap')
+    ap.add_argument('--report-ms', type=float, default=1.0, help='ms per HID report')
+    ap.add_argument('--stall', type=float, default=20, help='report gap counted as a stall, ms')
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        logs = playback(args, tmp)
+        print()
+        faults(logs['sliced'], args.stall / 1000)
+        print()
+        offline(logs, tmp, args.stall / 1000)
+
+
+if __name__ == '__main__':
+    main()
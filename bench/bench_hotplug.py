@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Attach latency and idle cost of the hotplug watcher: uevents vs polling.
+
+No USB hardware is needed. A datagram socketpair stands in for the netlink
+socket, and the bench writes kernel-format uevents into it. Port
+enumeration returns a simulated set of pads, but it also runs the real
+``comports()`` each time, so every rescan costs what it would on this
+machine. For each mode the bench:
+
+- plugs in ``--plugs`` pads one at a time and measures the time from the
+  plug to the ``add`` callback;
+- replays a ``--after hard-reset`` (the pad comes back on the next ttyACM
+  number) and checks that it is reported as the same pad;
+- leaves the watcher idle for ``--idle`` seconds and reports the CPU time
+  it used.
+
+Usage: python bench/bench_hotplug.py [--plugs 20] [--idle 5]
+"""
+import argparse
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial.tools.list_ports
+
+from hotplug import HotplugWatcher, UsbPort
+
+
+class FakeBus:
+    """Simulated pads plus a uevent socket to announce them on."""
+
+    def __init__(self):
+        self.ports = {}
+        self.kernel, self.listener = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.next_acm = 0
+
+    def enumerate(self):
+        serial.tools.list_ports.comports()  # pay the real enumeration cost
+        return dict(self.ports)
+
+    def _uevent(self, action, name):
+        self.kernel.send(f'{action}@/devices/pci0000:00/usb1/1-1/1-1:1.0/tty/{name}\0'
+                         f'ACTION={action}\0SUBSYSTEM=tty\0DEVNAME={name}\0'.encode())
+
+    def plug(self, serial_number):
+        name = f'ttyACM{self.next_acm}'
+        self.next_acm += 1
+        key = f'usb:{serial_number}'
+        self.ports[key] = UsbPort(f'/dev/{name}', key, serial_number, 0x303A, 0x1001, 'USB JTAG/serial')
+        self._uevent('add', name)
+        return key
+
+    def unplug(self, key):
+        p = self.ports.pop(key)
+        self._uevent('remove', p.device[len('/dev/'):])
+        return p
+
+    def reset(self, key):
+        """What ``--after hard-reset`` looks like: gone, then back one ttyACM number up."""
+        old = self.unplug(key)
+        self.plug(old.serial_number)
+        return old.device, self.ports[key].device
+
+
+def run(mode, args):
+    bus = FakeBus()
+    arrived = {}
+    cond = threading.Condition()
+
+    def on_event(ev):
+        if ev.action == 'add':
+            with cond:
+                arrived[ev.port.key] = (time.perf_counter(), ev)
+                cond.notify_all()
+
+    def wait(key, timeout=5.0):
+        with cond:
+            cond.wait_for(lambda: key in arrived, timeout)
+            return arrived.pop(key, (None, None))
+
+    kw = {'source': bus.listener} if mode == 'uevent' else {'poll': True, 'poll_interval': args.poll_interval}
+    w = HotplugWatcher(on_event, enumerate=bus.enumerate, **kw).start()
+    try:
+        rng = random.Random(1)
+        lat = []
+        for i in range(args.plugs):
+            t0 = time.perf_counter()
+            key = bus.plug(f'F4:12:FA:00:00:{i:02X}')
+            t1, _ = wait(key)
+            lat.append(t1 - t0)
+            time.sleep(rng.uniform(0.05, 0.5))  # plugs come at random points of a poll cycle
+
+        key = next(iter(bus.ports))
+        old, new = bus.reset(key)
+        _, ev = wait(key)
+        same = ev is not None and ev.previous == old and ev.port.device == new
+
+        c0 = time.process_time()
+        time.sleep(args.idle)
+        idle_cpu = time.process_time() - c0
+    finally:
+        w.stop()
+    print(f'{mode:<7} attach p50={statistics.median(lat) * 1000:7.1f} ms  max={max(lat) * 1000:7.1f} ms  '
+          f'renumbered reset {"followed" if same else "MISSED"} ({old} -> {new})  '
+          f'idle CPU {idle_cpu / args.idle * 1000:.2f} ms/s')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--plugs', type=int, default=20)
+    ap.add_argument('--idle', type=float, default=5.0)
+    ap.add_argument('--poll-interval', type=float, default=1.0)
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    serial.tools.list_ports.comports()
+    print(f'comports() here: {(time.perf_counter() - t0) * 1000:.2f} ms per enumeration')
+    for mode in ('uevent', 'poll'):
+        run(mode, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Multi-kilobyte text macros: chunked upload, resume, round trip and playback.
+
+Runs against emulator.py, which refuses macros over 256 bytes in
+``POST /config`` as the firmware now does, and takes them through the
+``/macro/text`` chunk protocol instead:
+
+- throughput: ``upload_text_macro`` for each ``--sizes`` x ``--chunks``
+  pair, with ``--latency`` per request and ``--flash-rate`` for writing
+  the chunks, plus the inline POST it replaces;
+- resume: replies to some chunks are lost, and a client that gives up
+  half way is followed by a fresh one. Both must finish by sending only
+  what the device doesn't hold yet;
+- round trip: ``DeviceClient.save`` with a long macro, then
+  ``get_config`` from a new client; then shortening and clearing it;
+- serial: the framed SET and the ``set macroN`` line must refuse what
+  ``POST /config`` refuses;
+- playback: ``test1`` for a ``--play-size`` macro while the framed serial
+  protocol is pinged, typed in slices per loop pass vs one blocking
+  ``Keyboard.print``.
+
+Every check asserts, so a mismatch exits non-zero.
+
+Usage: python bench/bench_large_macro.py [--sizes 1024 4096 16384 65536] [--chunks 512 1024 2048 4096]
+                                         [--latency 0.02] [--flash-rate 200000] [--play-size 4096]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial
+
+from device_client import DeviceClient, DeviceError
+from emulator import FakeDevice, SerialDevice
+from serial_proto import SET, TOO_LARGE, SerialProtoError, SerialTransport
+
+STATUS = {TOO_LARGE: 'too large'}
+WORDS = ('the quick brown fox jumps over lazy dog ticket deploy review merge '
+         'branch release notes thanks regards Enter Tab').split()
+
+
+def text_of(size, seed=0):
+    rng = random.Random(seed)
+    out = []
+    n = 0
+    while n < size:
+        w = rng.choice(WORDS) + rng.choice((' ', ' ', ' ', '\n', ', '))
+        out.append(w)
+        n += len(w)
+    return ''.join(out)[:size]
+
+
+def throughput(args):
+    print(f'{"size":>7} {"chunk":>6} {"requests":>9} {"time":>8} {"KiB/s":>8}')
+    with FakeDevice(latency=args.latency, flash_rate=args.flash_rate) as dev:
+        client = DeviceClient(dev.url)
+        for size in args.sizes:
+            text = text_of(size, seed=size)
+            try:
+                client.put_config({'macro1': text}, retries=0)
+                inline = 'accepted'
+            except DeviceError as e:
+                inline = f'HTTP {e.status}'
+            for chunk in args.chunks:
+                client.delete_text_macro(1)
+                before = dev.chunks
+                t0 = time.perf_counter()
+                client.upload_text_macro(1, text, chunk_size=chunk)
+                dt = time.perf_counter() - t0
+                assert dev.blobs[1] == text.encode(), 'stored blob differs'
+                print(f'{size:>7} {chunk:>6} {dev.chunks - before:>9} {dt * 1000:>6.0f} ms '
+                      f'{size / dt / 1024:>8.1f}')
+            print(f'{size:>7} inline POST /config: {inline}')
+        client.close()
+
+
+def resume(args):
+    size = max(args.sizes)
+    text = text_of(size, seed=1)
+    chunk = 2048
+    needed = -(-size // chunk)
+    with FakeDevice(latency=args.latency, flash_rate=args.flash_rate) as dev:
+        client = DeviceClient(dev.url, backoff=0.02)
+        dev.drop_replies = 3
+        t0 = time.perf_counter()
+        client.upload_text_macro(1, text, chunk_size=chunk)
+        dt = time.perf_counter() - t0
+        ok = dev.blobs[1] == text.encode()
+        print(f'lost replies  3 of {needed} chunks lost their reply: {dev.chunks} chunks stored, '
+              f'{dt * 1000:.0f} ms, {"intact" if ok else "CORRUPT"}')
+        assert ok, 'blob corrupt after lost replies'
+
+        client.delete_text_macro(1)
+        dev.chunks = 0
+        armed = []
+
+        def half_way(n, total):
+            if n >= total // 2 and not armed:
+                armed.append(n)
+                dev.drop_replies = 1
+
+        try:
+            # Gives up at its first failure, half way through
+            client.upload_text_macro(1, text, chunk_size=chunk, attempts=1, on_progress=half_way)
+        except DeviceError:
+            pass
+        first = dev.chunks
+        fresh = DeviceClient(dev.url)
+        fresh.upload_text_macro(1, text, chunk_size=chunk)
+        ok = dev.blobs[1] == text.encode()
+        print(f'new client    first stopped after {first} chunks, second sent {dev.chunks - first} '
+              f'(of {needed}): {"intact" if ok else "CORRUPT"}')
+        assert ok and dev.chunks - first < needed, 'resumed upload corrupt or started over'
+
+        before = dev.chunks
+        fresh.upload_text_macro(1, text, chunk_size=chunk)
+        print(f'unchanged     re-upload of the same text sent {dev.chunks - before} chunks')
+        assert dev.chunks == before, 're-upload of an unchanged macro sent chunks'
+        client.close()
+        fresh.close()
+
+
+def round_trip(args):
+    text = text_of(8192, seed=2)
+    with FakeDevice(latency=args.latency, flash_rate=args.flash_rate) as dev:
+        client = DeviceClient(dev.url)
+        cfg = client.get_config()
+        cfg.macro1, cfg.macro2 = text, 'short one'
+        progress = []
+        res = client.save(cfg, on_progress=lambda key, n, total: progress.append((key, n, total)))
+        back = DeviceClient(dev.url).get_config()
+        same = back.macro1 == text and back.macro2 == 'short one'
+        print(f'save          sent {res.sent}, {len(progress)} progress updates, '
+              f'read back {"identical" if same else "DIFFERENT"} '
+              f'(config field {dev.config["macro1"]!r}, blob {len(dev.blobs.get(1, b""))} bytes)')
+        assert same, 'long macro did not survive save -> get_config'
+        assert dev.config['macro1'] == '' and dev.blobs.get(1) == text.encode(), 'long macro not stored as a blob'
+
+        cfg.macro1 = 'now short'
+        client.save(cfg)
+        short = 1 not in dev.blobs and dev.config['macro1'] == 'now short'
+        cfg.macro1 = text
+        client.save(cfg)
+        cfg.macro1 = ''
+        client.save(cfg)
+        cleared = 1 not in dev.blobs and dev.config['macro1'] == ''
+        print(f'replace       shortened -> inline, blob dropped: {"yes" if short else "NO"}; '
+              f'cleared -> blob deleted: {"yes" if cleared else "NO"}')
+        assert short and cleared, 'replacing a long macro left a stale blob'
+        assert DeviceClient(dev.url).get_config().macro1 == '', 'cleared macro read back non-empty'
+        client.close()
+
+
+def serial_limit(args):
+    long = text_of(512, seed=4).replace('\n', ' ')
+    with SerialDevice() as sd:
+        before = (sd.config['macro1'], sd.config['macro2'])
+        ser = serial.Serial(sd.port, 115200, timeout=0.02)
+        with SerialTransport(ser, timeout=0.5) as t:
+            try:
+                t.set_fields({'macro1': long})
+                host = 'accepted'
+            except SerialProtoError as e:
+                host = STATUS.get(e.status, e.status)
+            device = STATUS.get(t.call(SET, b'macro1\0' + long.encode(), check=False).status)
+        ser.write(f'set macro2 {long}\n'.encode())
+        time.sleep(0.2)
+        line = ser.read(ser.in_waiting).decode('utf-8', 'replace').strip().splitlines()[-1:]
+        ser.close()
+        stored = (sd.config['macro1'], sd.config['macro2'])
+    print(f'serial        512-byte macro: set_fields {host}, framed SET {device}, '
+          f'set line {line[0] if line else "-"!r}')
+    assert host == device == 'too large' and stored == before, 'serial path took a long inline macro'
+
+
+def playback(args):
+    size = args.play_size
+    text = text_of(size, seed=3)
+    for label, slice_ in (('blocking', None), ('sliced', 16)):
+        dev = FakeDevice().start()
+        dev.blobs[1] = text.encode()
+        with SerialDevice(device=dev, macro_slice=slice_, report_ms=args.report_ms) as sd:
+            ser = serial.Serial(sd.port, 115200, timeout=0.005)
+            with SerialTransport(ser, window=1, timeout=0.5, retries=1) as t:
+                t.ping()
+                ser.write(b'test1\n')
+                rtts, lost = [], 0
+                deadline = time.monotonic() + 2 * size * args.report_ms / 1000 + 10
+                while not sd.triggered and time.monotonic() < deadline:
+                    try:
+                        rtts.append(t.ping())
+                    except SerialProtoError:
+                        lost += 1
+                    time.sleep(0.02)
+            ser.close()
+        dev.stop()
+        typed = sd.triggered[0][3] / 1000 if sd.triggered else float('nan')
+        med = statistics.median(rtts) * 1000 if rtts else float('nan')
+        worst = max(rtts) * 1000 if rtts else float('nan')
+        print(f'{label:<13} {size} bytes typed in {typed:.1f} s; pings during it: {len(rtts)} answered '
+              f'(median {med:.0f} ms, max {worst:.0f} ms), {lost} timed out')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--sizes', type=int, nargs='+', default=[1024, 4096, 16384, 65536])
+    ap.add_argument('--chunks', type=int, nargs='+', default=[512, 1024, 2048, 4096])
+    ap.add_argument('--latency', type=float, default=0.02, help='seconds per emulated request')
+    ap.add_argument('--flash-rate', type=float, default=200_000, help='LittleFS write bytes/s')
+    ap.add_argument('--report-ms', type=float, default=1.0, help='ms per HID report')
+    ap.add_argument('--play-size', type=int, default=4096, help='bytes of macro typed in the playback run')
+    args = ap.parse_args()
+    throughput(args)
+    print()
+    resume(args)
+    print()
+    round_trip(args)
+    serial_limit(args)
+    print()
+    playback(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Benchmark the macro library as it grows.
+
+Builds synthetic libraries of increasing size (random words from a fixed
+vocabulary, seeded so runs are repeatable) and times, per size:
+
+- full-text search for the first page of results (p50/p95 over a query mix
+  of whole words, prefixes and two-word queries) and its match count;
+- the same queries as a ``LIKE '%word%'`` scan, the cost without the index;
+- browsing by name: the first page and a page 50 pages deep (keyset);
+- applying a profile to ``--devices`` emulated pads.
+
+Search, browse and apply should stay flat while the LIKE scan grows with
+the library.
+
+Usage: python bench/bench_library.py [--sizes 1000,10000,100000] [--devices 10]
+"""
+import argparse
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from emulator import FakeDevice
+from library import PAGE_SIZE, Library
+
+
+def vocabulary(rng, n=5000):
+    return [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+            for _ in range(n)]
+
+
+def synthetic(rng, words, n):
+    tags = words[:20]
+    for i in range(n):
+        kind = 'keystroke' if i % 5 == 0 else 'macro'
+        body = ('CTRL+' + rng.choice(string.ascii_uppercase) if kind == 'keystroke'
+                else ' '.join(rng.choices(words, k=rng.randint(8, 30))))
+        yield (' '.join(rng.choices(words, k=rng.randint(1, 3))), body, kind, rng.choice(tags))
+
+
+def timed(fn, repeat):
+    out = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - t0)
+    return out
+
+
+def pct(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--sizes', default='1000,10000,100000')
+    ap.add_argument('--queries', type=int, default=60)
+    ap.add_argument('--devices', type=int, default=10)
+    ap.add_argument('--latency', type=float, default=0.01)
+    args = ap.parse_args()
+
+    rng = random.Random(42)
+    words = vocabulary(rng)
+    queries = ([rng.choice(words) for _ in range(args.queries // 3)]
+               + [rng.choice(words)[:3] for _ in range(args.queries // 3)]
+               + [' '.join(rng.sample(words, 2)) for _ in range(args.queries // 3)])
+    devs = [FakeDevice(latency=args.latency).start() for _ in range(args.devices)]
+    print(f'{"size":>7} {"build s":>8} {"search p50/p95 ms":>18} {"count ms":>9} '
+          f'{"LIKE p50 ms":>12} {"browse ms":>10} {"page 50 ms":>11} {"apply ms":>9}')
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for size in (int(s) for s in args.sizes.split(',')):
+                path = os.path.join(tmp, f'lib{size}.sqlite3')
+                with Library(path, seed=False) as lib:
+                    t0 = time.perf_counter()
+                    lib.add_macros(synthetic(rng, words, size))
+                    build = time.perf_counter() - t0
+
+                    search = [s for q in queries for s in timed(lambda: lib.search(q), 3)]
+                    count = [s for q in queries for s in timed(lambda: lib.count(q), 1)]
+
+                    def like(q):
+                        pattern = f'%{q.split()[0]}%'
+                        lib.db.execute('SELECT id, name, kind, body FROM macros WHERE name LIKE ? '
+                                       'OR body LIKE ? OR tags LIKE ? ORDER BY name LIMIT ?',
+                                       (pattern, pattern, pattern, PAGE_SIZE)).fetchall()
+                    scan = [s for q in queries[:10] for s in timed(lambda: like(q), 1)]
+
+                    browse = timed(lambda: lib.search(), 20)
+                    page = lib.search()
+                    for _ in range(49):
+                        page = lib.search(cursor=page.cursor)
+                    deep = timed(lambda: lib.search(cursor=page.cursor), 20)
+
+                    lib.save_profile('bench', {'macro1': 'hello', 'action2': 'keystroke',
+                                               'keymap2': 'CTRL+C'})
+                    addresses = [d.url for d in devs]
+                    results = []
+                    apply = timed(lambda: results.extend(lib.apply_profile('bench', addresses)), 3)
+                    assert all(r.ok for r in results), [r.error for r in results if not r.ok]
+                    print(f'{size:>7} {build:>8.2f} {pct(search, 0.5):>8.2f} /{pct(search, 0.95):>8.2f} '
+                          f'{statistics.median(count) * 1000:>9.2f} {pct(scan, 0.5):>12.1f} '
+                          f'{pct(browse, 0.5):>10.2f} {pct(deep, 0.5):>11.2f} {pct(apply, 0.5):>9.1f}')
+    finally:
+        for d in devs:
+            d.stop()
+
+
+if __name__ == '__main__':
+    main()
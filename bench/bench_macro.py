@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Compare compiled keymaps with the per-press token loop firmware used to run.
+
+For a set of representative keymaps, reports how many HID reports and how
+much wall time each form needs (``--report-ms`` per report sent, plus the
+token loop's two ``delay(10)`` per token or the compiled hold times), and
+how many heap Strings the token loop allocates per press. A host model
+replays each compiled blob and checks that it produces exactly the key
+presses the keymap asks for, so the modifier merging loses nothing.
+Finally the blobs are uploaded to an emulated device.
+
+Usage: python bench/bench_macro.py [--report-ms 1.0] [--hold 3]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import macro_compiler as mc
+from device_client import DeviceClient
+from emulator import FakeDevice
+
+KEYMAPS = {
+    'copy-paste': 'Ctrl+C Ctrl+V',
+    'new-tab': 'Ctrl+T github.com Enter',
+    'shortcuts': 'Ctrl+Shift+Esc Alt+Tab Ctrl+Alt+T Ctrl+Shift+N',
+    'signature': 'Best regards, Enter Jane Doe Enter ACME Corp.',
+    'select-copy': 'Ctrl+A Ctrl+C Ctrl+A Ctrl+X Ctrl+V Ctrl+V Ctrl+V',
+    'long-text': ' '.join(['The quick brown fox jumps over the lazy dog.'] * 6),
+}
+
+
+def host_presses(reports):
+    """Key-down events a host sees: (modifiers, key) for each newly pressed key."""
+    out, held = [], 0
+    for r in reports:
+        if r.key == mc.WAIT_KEY:
+            continue
+        if r.key and r.key != held:
+            out.append((r.mods, r.key))
+        held = r.key
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--report-ms', type=float, default=1.0, help='USB time per report')
+    ap.add_argument('--hold', type=int, default=mc.DEFAULT_HOLD_MS)
+    args = ap.parse_args()
+
+    print(f'{"keymap":<12} {"bytes":>5} {"reports":>13} {"ms":>15} {"allocs":>6}  equivalent')
+    tot_old = tot_new = 0.0
+    blobs = {}
+    for name, keymap in KEYMAPS.items():
+        blob = mc.compile_keymap(keymap, args.hold)
+        blobs[name] = blob
+        old = mc.simulate_token_loop(keymap, args.report_ms)
+        new = mc.simulate_blob(blob, args.report_ms)
+        want = [(s.mods, s.key) for s in mc.parse(keymap)]
+        same = host_presses(mc.decode(blob)[1]) == want
+        tot_old += old.ms
+        tot_new += new.ms
+        print(f'{name:<12} {len(blob):>5} {old.reports:>5} -> {new.reports:<5} '
+              f'{old.ms:>6.0f} -> {new.ms:<6.0f} {old.allocs:>6}  {same}')
+    print(f'total typing time {tot_old:.0f} ms -> {tot_new:.0f} ms ({tot_old / tot_new:.1f}x faster)')
+
+    with FakeDevice(config={'action1': 'keystroke'}) as dev:
+        client = DeviceClient(dev.url)
+        for name, keymap in KEYMAPS.items():
+            client.get_config()
+            client.save({'keymap1': keymap})
+            r = client.upload_macro(1, blobs[name])
+            assert r['ok'] and client.macro_info(1)['valid']
+        print(f'uploaded {len(KEYMAPS)} blobs to the emulator, last: {client.macro_info(1)}')
+
+
+if __name__ == '__main__':
+    main()
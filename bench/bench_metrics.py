@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Measure what the metrics layer costs per observation.
+
+Times ``inc``, ``observe`` and a full ``span`` in a tight loop (single
+thread, then contended by several threads) so the overhead can be
+compared with the operations being measured: a LAN round-trip to the pad
+is milliseconds, a span should be a few microseconds.
+
+Usage: python bench/bench_metrics.py [--n 200000] [--threads 4]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Registry
+
+
+def per_op(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--n', type=int, default=200000)
+    ap.add_argument('--threads', type=int, default=4)
+    args = ap.parse_args()
+
+    reg = Registry()
+
+    def span():
+        with reg.span('http_request', method='GET', path='/config', device='http://10.0.0.5'):
+            pass
+
+    cases = {
+        'inc': lambda: reg.inc('serial_read_bytes_total', 64, port='/dev/ttyACM0'),
+        'observe': lambda: reg.observe('flash_phase_seconds', 0.01, phase='write', port='/dev/ttyACM0'),
+        'span': span,
+    }
+    for name, fn in cases.items():
+        print(f'{name:<8} {per_op(fn, args.n) * 1e6:6.2f} us/op')
+
+    threads = [threading.Thread(target=per_op, args=(span, args.n // args.threads))
+               for _ in range(args.threads)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    dt = time.perf_counter() - t0
+    print(f'span x{args.threads} threads {dt / args.n * 1e6:6.2f} us/op wall')
+    t0 = time.perf_counter()
+    text = reg.prometheus()
+    print(f'prometheus export {len(text)} bytes in {(time.perf_counter() - t0) * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Upstream traffic for a provisioning room: every updater downloading vs a LAN mirror.
+
+A bandwidth- and latency-capped FakeReleaseServer stands in for GitHub.
+``--clients`` updaters, each with its own empty cache, fetch the latest
+release at the same time:
+
+- direct: each one downloads every asset from upstream;
+- mirror: mirror.py syncs the release once, then the updaters get it from
+  the mirror on localhost (``$MACROPAD_MIRROR``).
+
+Both runs report wall time and the bytes upstream served. The bench also
+checks a Range request against the mirror, the old/flash.py raw files
+through ``/raw/``, picking up a newly published tag, and falling back to
+upstream once the mirror is stopped.
+
+The per-connection cap flatters the direct run: a real shared uplink would
+divide its bandwidth between all the updaters.
+
+Usage: python bench/bench_mirror.py [--clients 10] [--bandwidth 4000000] [--latency 0.05]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+import metrics
+import mirror
+from emulator import FakeReleaseServer
+from firmware_download import Cache
+from release_cache import ReleaseCache
+
+SIZES = {
+    'bootloader.bin': 15 * 1024,
+    'partitions.bin': 3 * 1024,
+    'boot_app0.bin': 8 * 1024,
+    'firmware.bin': 1024 * 1024,
+}
+
+
+def run_clients(n, tmp, label, api, **kw):
+    def one(i):
+        root = os.path.join(tmp, f'{label}-{i}')
+        os.makedirs(root)
+        releases = ReleaseCache(os.path.join(root, 'releases.json'))
+        release, paths = mirror.fetch_release(list(SIZES), releases, api, cache=Cache(root), **kw)
+        return release['tag_name'], paths
+
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        results = list(pool.map(one, range(n)))
+    return time.monotonic() - t0, results
+
+
+def check(results, blobs):
+    for _, paths in results:
+        for name, path in paths.items():
+            with open(path, 'rb') as f:
+                assert f.read() == blobs[name], name
+
+
+def counter(name):
+    return {tuple(sorted(c['labels'].items())): c['value']
+            for c in metrics.snapshot()['counters'] if c['name'] == name}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--clients', type=int, default=10)
+    ap.add_argument('--bandwidth', type=int, default=4_000_000, help='upstream bytes/s per connection')
+    ap.add_argument('--latency', type=float, default=0.05, help='upstream seconds per request')
+    args = ap.parse_args()
+    os.environ.pop('MACROPAD_MIRROR', None)
+
+    blobs = {name: os.urandom(n) for name, n in SIZES.items()}
+    with FakeReleaseServer(blobs, latency=args.latency, bandwidth=args.bandwidth) as up, \
+            tempfile.TemporaryDirectory() as tmp:
+        before = up.bytes_sent
+        elapsed, results = run_clients(args.clients, tmp, 'direct', up.api_url)
+        check(results, blobs)
+        print(f'direct   {args.clients} clients  {elapsed:6.2f} s  upstream {up.bytes_sent - before:>10,} bytes')
+
+        m = mirror.Mirror(up.api_url, f'{up.url}/raw', Cache(os.path.join(tmp, 'mirror')))
+        server = mirror.MirrorServer(m, '127.0.0.1', 0, interval=3600).start(sync=False)
+        before = up.bytes_sent
+        t0 = time.monotonic()
+        m.sync()
+        synced = time.monotonic() - t0
+        os.environ['MACROPAD_MIRROR'] = server.url
+        elapsed, results = run_clients(args.clients, tmp, 'mirror', up.api_url)
+        check(results, blobs)
+        print(f'mirror   {args.clients} clients  {elapsed:6.2f} s  upstream {up.bytes_sent - before:>10,} bytes  '
+              f'(sync {synced:.2f} s, then LAN only; served '
+              f'{sum(counter("mirror_bytes_sent_total").values()):,} bytes)')
+
+        assets = requests.get(f'{server.url}/release', timeout=5).json()['assets']
+        fw = next(a['browser_download_url'] for a in assets if a['name'] == 'firmware.bin')
+        r = requests.get(fw, headers={'Range': 'bytes=1000-1999'}, timeout=5)
+        tail = requests.get(fw, headers={'Range': 'bytes=-10'}, timeout=5)
+        bad = requests.get(fw, headers={'Range': f'bytes={SIZES["firmware.bin"]}-'}, timeout=5)
+        ok = r.status_code == 206 and r.content == blobs['firmware.bin'][1000:2000] \
+            and tail.content == blobs['firmware.bin'][-10:] and bad.status_code == 416
+        print(f'range    206 {r.headers.get("Content-Range")}, suffix, 416 past the end: '
+              f'{"ok" if ok else "WRONG"}')
+        assert ok, 'range requests answered wrongly'
+
+        before = up.bytes_sent
+        raw_ok = 0
+        for i in range(args.clients):
+            paths = mirror.fetch_raw({n: n for n in SIZES}, f'{up.url}/raw',
+                                     cache=Cache(os.path.join(tmp, f'raw-{i}')))
+            raw_ok += all(open(p, 'rb').read() == blobs[n] for n, p in paths.items())
+        print(f'raw      {args.clients} clients  upstream {up.bytes_sent - before:>10,} bytes  '
+              f'({raw_ok}/{args.clients} identical)')
+
+        blobs = {name: os.urandom(n) for name, n in SIZES.items()}
+        up.publish('v1.1.0', blobs)
+        m.sync()
+        _, results = run_clients(1, tmp, 'new', up.api_url)
+        check(results, blobs)
+        print(f'publish  clients now get {results[0][0]}')
+
+        server.stop()
+        t0 = time.monotonic()
+        _, results = run_clients(1, tmp, 'down', up.api_url)
+        check(results, blobs)
+        falls = {dict(k)['what']: v for k, v in counter('mirror_fallbacks_total').items()}
+        print(f'down     fell back to upstream in {time.monotonic() - t0:.2f} s '
+              f'({results[0][0]}, fallbacks {falls})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Time to first interaction: cold discovery vs reconnecting from the registry.
+
+Sets up the same loopback LAN as bench_discovery.py (fake pads on a few
+127.0.0.x addresses, silent listeners everywhere else) and measures:
+
+- cold: a fresh launch with no registry, scanning the /24 until the pad
+  the user wants (the one used last, below) answers, and until the scan
+  finishes;
+- warm: a fresh launch with the registry the cold run left on disk,
+  reconnecting to the last-used pad (the same form-filling config);
+- warm, last pad gone: its address is now silent, so reconnect falls back
+  to the next known pad after the probe timeout;
+- one health-monitor sweep over every known pad;
+- the missing pad back on another address: it must be the same entry,
+  found by the MAC the emulator reports;
+- the registry saved from two threads at once, as the health thread and
+  the UI do.
+
+Usage: python bench/bench_registry.py [--devices 8] [--port 18080] [--rounds 5]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discovery
+from bench_discovery import silent_listener
+from device_registry import DeviceRegistry, HealthMonitor
+from emulator import FakeDevice
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--devices', type=int, default=8)
+    ap.add_argument('--port', type=int, default=18080)
+    ap.add_argument('--timeout', type=float, default=0.3)
+    ap.add_argument('--rounds', type=int, default=5)
+    args = ap.parse_args()
+
+    step = 250 // args.devices
+    dev_hosts = [f'127.0.0.{2 + i * step}' for i in range(args.devices)]
+    devs = [FakeDevice(h, args.port).start() for h in dev_hosts]
+    silent = [silent_listener(f'127.0.0.{i}', args.port)
+              for i in range(1, 255) if f'127.0.0.{i}' not in dev_hosts]
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'devices.json')
+            reg = DeviceRegistry(path)
+            seen = {}
+            t0 = time.monotonic()
+
+            def found(d):
+                seen[d.url] = time.monotonic() - t0
+                reg.record(d.url, d.config, d.rtt, save=False)
+
+            hits = discovery.scan(['127.0.0.0/24'], port=args.port, candidates=(),
+                                  connect_timeout=args.timeout, on_found=found)
+            full = time.monotonic() - t0
+            reg.save()
+            assert sorted(d.key for d in reg.devices()) == sorted(d.mac.lower() for d in devs), \
+                'pads not keyed by MAC'
+            target = reg.devices()[0].url  # last recorded: the one the next launch reconnects to
+            print(f'cold scan       pad found {seen[target] * 1000:7.1f} ms   full scan {full * 1000:7.1f} ms '
+                  f'({len(hits)} pads, first hit {min(seen.values()) * 1000:.1f} ms)')
+
+            warm = []
+            for _ in range(args.rounds):
+                t0 = time.monotonic()
+                hit = DeviceRegistry(path).reconnect(timeout=args.timeout)
+                warm.append(time.monotonic() - t0)
+                assert hit is not None
+            print(f'warm reconnect  median    {statistics.median(warm) * 1000:7.1f} ms   '
+                  f'({hit.url}, registry load included)')
+
+            # The most recent pad disappears and a silent host takes its address
+            last = DeviceRegistry(path).devices()[0]
+            gone = next(d for d in devs if d.url == last.url)
+            gone.stop()
+            silent.append(silent_listener(gone.host, args.port))
+            t0 = time.monotonic()
+            hit = DeviceRegistry(path).reconnect(timeout=args.timeout)
+            print(f'last pad gone   fallback  {(time.monotonic() - t0) * 1000:7.1f} ms   ({hit.url})')
+
+            mon = HealthMonitor(DeviceRegistry(path), timeout=args.timeout)
+            t0 = time.monotonic()
+            mon.sweep()
+            alive = sum(d.alive for d in mon.registry.devices())
+            print(f'health sweep    {len(hits)} pads  {(time.monotonic() - t0) * 1000:7.1f} ms   '
+                  f'({alive} alive)')
+            mon.registry.save()
+
+            # The missing pad comes back on another address (a new DHCP lease)
+            back = FakeDevice('127.0.0.1', args.port + 1, mac=gone.mac).start()
+            devs.append(back)
+            reg = DeviceRegistry(path)
+            before = len(reg.devices())
+            hits = discovery.scan(['127.0.0.1/32'], port=args.port + 1, candidates=(),
+                                  connect_timeout=args.timeout)
+            d = reg.record(hits[0].url, hits[0].config)
+            same = d.key == last.key and d.url == back.url and len(reg.devices()) == before
+            print(f'moved           {last.url} -> {back.url}: '
+                  f'{"same entry" if same else "NEW ENTRY"} ({d.key})')
+            assert same, 'a pad that moved was not recognised by its MAC'
+
+            errors = []
+
+            def saves():
+                try:
+                    for _ in range(50):
+                        reg.save()
+                except OSError as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=saves) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            intact = len(DeviceRegistry(path).devices()) == before
+            print(f'concurrent save 2 threads x 50: {len(errors)} errors, '
+                  f'registry {"intact" if intact else "DAMAGED"}')
+            assert not errors and intact
+    finally:
+        for d in devs:
+            try:
+                d.stop()
+            except OSError:
+                pass
+        for s in silent:
+            s.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Benchmark release-metadata lookups at startup against a local stand-in.
+
+Measures time-to-first-paint (how long until the UI has a release to show)
+for the old blocking ``requests.get`` and for ReleaseCache in each state:
+cold, fresh (within TTL), stale (served from disk, 304 in the background),
+stale after a new release (background update fires) and offline.
+
+Usage: python bench/bench_release.py [--latency 0.4]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from emulator import FakeReleaseServer
+from release_cache import ReleaseCache
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--latency', type=float, default=0.4, help='seconds per API request')
+    args = ap.parse_args()
+
+    with FakeReleaseServer({'firmware.bin': b'\0' * 1024}, latency=args.latency) as srv, \
+            tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'releases.json')
+        url = srv.api_url
+
+        t0 = time.monotonic()
+        requests.get(url, timeout=6).json()
+        print(f'{"blocking":<14} paint={1000 * (time.monotonic() - t0):7.1f} ms')
+
+        def run(label, ttl=600, expect_update=False):
+            rc = ReleaseCache(path, ttl=ttl)
+            updated = threading.Event()
+            before = srv.requests, srv.not_modified
+            t0 = time.monotonic()
+            try:
+                hit = rc.get(url, on_update=lambda h: updated.set())
+                paint = time.monotonic() - t0
+                tag, source = hit.data['tag_name'], hit.source
+            except requests.RequestException:
+                paint, tag, source = time.monotonic() - t0, None, 'error'
+            rc.wait()
+            if expect_update:
+                updated.wait(5)
+            print(f'{label:<14} paint={1000 * paint:7.1f} ms  source={source:<7} tag={tag}  '
+                  f'requests={srv.requests - before[0]} 304s={srv.not_modified - before[1]} '
+                  f'background_update={updated.is_set()}')
+
+        run('cold')
+        run('fresh')
+        run('stale', ttl=0)
+        srv.publish('v1.1.0')
+        run('new-release', ttl=0, expect_update=True)
+        run('after-update')
+        srv.stop()
+        run('offline', ttl=0)
+
+
+if __name__ == '__main__':
+    main()
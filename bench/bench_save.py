@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Benchmark save-to-ready latency in station and AP (restarting) mode,
+and the request size and flash writes of delta saves versus full saves.
+
+Usage: python bench/bench_save.py [--saves 20] [--reboot-delay 2.0]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from device_client import DeviceClient
+from emulator import FakeDevice
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--saves', type=int, default=20)
+    ap.add_argument('--latency', type=float, default=0.01)
+    ap.add_argument('--reboot-delay', type=float, default=2.0)
+    args = ap.parse_args()
+
+    with FakeDevice(latency=args.latency, mode='sta') as dev:
+        client = DeviceClient(dev.url)
+        cfg = client.get_config()
+        lat = []
+        for i in range(args.saves):
+            cfg.macro1 = f'macro {i}'
+            lat.append(client.save(cfg).ready_latency)
+        print(f'station  saves={args.saves} restarts={dev.restarts} '
+              f'save-to-ready p50={statistics.median(lat) * 1000:.0f} ms')
+        assert dev.config['macro1'] == cfg.macro1, 'last save did not reach the device'
+
+    big = 'x' * 400
+    with FakeDevice(latency=args.latency, mode='sta', config={'macro2': big}) as dev:
+        client = DeviceClient(dev.url)
+        cfg = client.get_config()
+        full = delta = 0
+        for i in range(args.saves):
+            cfg.macro1 = f'macro {i}'
+            full += len(json.dumps(cfg.to_dict()))
+            delta += len(json.dumps({k: getattr(cfg, k) for k in client.save(cfg).sent}))
+        print(f'delta    body bytes full={full} delta={delta} '
+              f'fields written={dev.field_writes} (full saves would write {8 * args.saves})')
+        assert dev.field_writes == args.saves, 'each delta save should write macro1 only'
+
+    with FakeDevice(latency=args.latency, mode='ap', reboot_delay=args.reboot_delay) as dev:
+        client = DeviceClient(dev.url)
+        cfg = client.get_config()
+        cfg.wifi_ssid = 'bench'
+        res = client.save(cfg, candidates=[dev.url])
+        print(f'ap       restarts={dev.restarts} reboot={args.reboot_delay:.1f} s '
+              f'save-to-ready={res.ready_latency:.2f} s')
+        assert res.restart and res.ready_url and dev.config['wifi_ssid'] == 'bench'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Benchmark the serial monitor reader against a pty-based chatty device.
+
+A writer thread plays the device: it streams debug output (``CMD:`` echoes,
+``wifi scan`` listings) into a pty at the configured baud rate. The bulk
+reader (SerialReader drained at a fixed frame rate into a capped scrollback)
+is compared with the old per-line ``readline()`` loop feeding an unbounded
+buffer. Reported: delivered line rate, reader CPU time and traced memory
+sampled over the run.
+
+Usage: python bench/bench_serial.py [--seconds 5] [--baud 115200] [--lines 500]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial
+
+from emulator import PtyPort
+from serial_monitor import SerialReader, drain
+
+CHATTER = [
+    b'CMD: wifi scan\r\n',
+    b'Scanning WiFi networks...\r\n',
+] + [f'{i}: Network-{i:02d} (-{40 + i} dBm) SEC\r\n'.encode() for i in range(1, 13)] + [
+    b'CMD: status\r\n',
+    b'--- Status ---\r\n',
+    b'WiFi status: 3\r\n',
+    b'IP: 192.168.1.57\r\n',
+    b'LED state: 3 \xe2\x9c\x94\r\n',  # multi-byte UTF-8 split across reads
+]
+
+
+def device(pty, seconds, baud, stop):
+    """Write CHATTER lines paced at ``baud`` (10 bits per byte); return (bytes, lines)."""
+    rate = baud / 10 if baud else None
+    t0 = time.monotonic()
+    sent = 0
+    i = 0
+    while time.monotonic() - t0 < seconds and not stop.is_set():
+        line = CHATTER[i % len(CHATTER)]
+        i += 1
+        pty.write(line)
+        sent += len(line)
+        if rate:
+            ahead = sent / rate - (time.monotonic() - t0)
+            if ahead > 0:
+                time.sleep(ahead)
+    return sent, i
+
+
+class Sink:
+    """Headless widget stand-in: counts lines and keeps a capped tail."""
+
+    def __init__(self, max_lines):
+        self.lines = deque(maxlen=max_lines) if max_lines else []
+        self.count = 0
+        self._partial = ''
+
+    def feed(self, text):
+        parts = (self._partial + text).split('\n')
+        self._partial = parts.pop()
+        self.count += len(parts)
+        self.lines.extend(parts)
+
+
+def run(mode, seconds, baud, max_lines, fps=30):
+    with PtyPort() as pty:
+        ser = serial.Serial(pty.port, 115200, timeout=0.05)
+        stop = threading.Event()
+        result = {}
+        writer = threading.Thread(target=lambda: result.update(zip(('sent', 'lines'),
+                                                                   device(pty, seconds, baud, stop))))
+        tracemalloc.start()
+        mem = []
+        cpu0 = time.process_time()
+        writer.start()
+        t0 = time.monotonic()
+        if mode == 'bulk':
+            sink = Sink(max_lines)
+            reader = SerialReader(ser)
+            reader.start()
+            while writer.is_alive() or reader.chunks:
+                time.sleep(1.0 / fps)
+                text = drain(reader.chunks)
+                if text:
+                    sink.feed(text)
+                mem.append(tracemalloc.get_traced_memory()[0])
+                if not writer.is_alive() and ser.in_waiting == 0 and not reader.chunks:
+                    break
+            reader.stop()
+            reader.join()
+        else:
+            sink = Sink(0)  # the old tools never trimmed the ScrolledText
+            last = time.monotonic()
+            while writer.is_alive() or ser.in_waiting:
+                line = ser.readline().decode(errors='ignore')
+                if line:
+                    sink.feed(line)
+                if time.monotonic() - last > 1.0 / fps:
+                    mem.append(tracemalloc.get_traced_memory()[0])
+                    last = time.monotonic()
+        elapsed = time.monotonic() - t0
+        cpu = time.process_time() - cpu0
+        tracemalloc.stop()
+        writer.join()
+        ser.close()
+    q = max(1, len(mem) // 4)
+    print(f'{mode:<7} lines={sink.count}/{result["lines"]} '
+          f'rate={sink.count / elapsed:7.0f} lines/s cpu={cpu:.2f} s '
+          f'mem first/last quarter={max(mem[:q]) / 1024:.0f}/{max(mem[-q:]) / 1024:.0f} KiB')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--seconds', type=float, default=5.0)
+    ap.add_argument('--baud', type=int, default=115200, help='0 = as fast as the pty allows')
+    ap.add_argument('--lines', type=int, default=500, help='scrollback cap for the bulk reader')
+    args = ap.parse_args()
+    for mode in ('bulk', 'legacy'):
+        run(mode, args.seconds, args.baud, args.lines)
+
+
+if __name__ == '__main__':
+    main()
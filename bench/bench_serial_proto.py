@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Benchmark the framed serial config protocol against a pty device emulator.
+
+The emulated firmware runs a 10 ms ``loop()`` and charges ``--flash-ms`` per
+config save. Compared:
+
+    legacy        ``set macroN <text>`` lines, one blocking readStringUntil per
+                  loop pass, one flash write per field
+    stop-and-wait framed SET/COMMIT with a window of 1
+    pipelined     framed with a window of 8 (all SETs in flight, one COMMIT)
+
+Also reported: PING round-trip latency, bulk SET throughput, an update
+with 10% of frames dropped to show retransmission recovering, one
+whose COMMIT reply is lost, which must still succeed with one flash write,
+and a device unplugged mid-session, whose requests must fail, not hang.
+
+Usage: python bench/bench_serial_proto.py [--fields 8] [--flash-ms 30]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial
+
+from emulator import SerialDevice
+from serial_proto import COMMIT, PING, SerialProtoError, SerialTransport
+
+FIELDS = ('macro1', 'macro2', 'keymap1', 'keymap2', 'action1', 'action2', 'wifi_ssid', 'wifi_pass')
+
+
+def updates(n, tag):
+    return {FIELDS[i % len(FIELDS)]: f'{tag}-{i}-' + 'x' * 40 for i in range(n)}
+
+
+def legacy(n, flash):
+    fields = {k: v for k, v in updates(n, 'legacy').items() if k in ('macro1', 'macro2', 'wifi_ssid', 'wifi_pass')}
+    with SerialDevice(legacy=True, flash_write=flash) as dev:
+        ser = serial.Serial(dev.port, 115200, timeout=0.02)
+        buf = bytearray()
+        t0 = time.monotonic()
+        for k, v in fields.items():
+            ser.write(f'set {k} {v}\n'.encode())
+            want = f'{k} saved'.encode()
+            while want not in buf:
+                buf += ser.read(max(ser.in_waiting, 1))
+            buf.clear()
+        dt = time.monotonic() - t0
+        ser.close()
+        return dt, len(fields), dev.flash_writes
+
+
+def framed(n, flash, window, drop=0.0, retries=3, lost_commits=0):
+    fields = updates(n, f'w{window}')
+    with SerialDevice(flash_write=flash, drop=drop) as dev:
+        dev.drop_replies[COMMIT] = lost_commits
+        ser = serial.Serial(dev.port, 115200, timeout=0.02)
+        with SerialTransport(ser, window=window, timeout=0.1, retries=retries) as t:
+            t0 = time.monotonic()
+            t.set_fields(fields)
+            dt = time.monotonic() - t0
+            assert t.get_all() == {**dev.config, **fields}
+            resent = t.retransmits
+        ser.close()
+        return dt, len(fields), dev.flash_writes, resent
+
+
+class Unplug:
+    """A port whose reads fail once ``pulled`` while writes still vanish without error,
+    as a USB CDC port can behave after the pad is unplugged."""
+
+    def __init__(self, ser):
+        self.ser, self.pulled, self.port = ser, False, ser.port
+
+    @property
+    def in_waiting(self):
+        return 0 if self.pulled else self.ser.in_waiting
+
+    def read(self, n):
+        if self.pulled:
+            raise serial.SerialException('device reports readiness to read but returned no data')
+        return self.ser.read(n)
+
+    def write(self, data):
+        return len(data) if self.pulled else self.ser.write(data)
+
+
+def unplugged():
+    with SerialDevice() as dev:
+        ser = serial.Serial(dev.port, 115200, timeout=0.02)
+        port = Unplug(ser)
+        with SerialTransport(port, timeout=0.1) as t:
+            t.ping()
+            port.pulled = True
+            t0 = time.monotonic()
+            outcome = []
+            for _ in range(2):
+                try:
+                    t.submit(PING).result(timeout=5)
+                    outcome.append('answered')
+                except SerialProtoError as e:
+                    outcome.append(str(e))
+                except TimeoutError:
+                    outcome.append('HUNG')
+            dt = time.monotonic() - t0
+        ser.close()
+    return dt, outcome
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--fields', type=int, default=8)
+    ap.add_argument('--flash-ms', type=float, default=30.0)
+    ap.add_argument('--pings', type=int, default=200)
+    args = ap.parse_args()
+    flash = args.flash_ms / 1000
+
+    dt, n, writes = legacy(args.fields, flash)
+    print(f'{"legacy":<14} {dt * 1000:7.1f} ms for {n} fields  flash writes={writes}')
+    for label, window in (('stop-and-wait', 1), ('pipelined', 8)):
+        dt, n, writes, _ = framed(args.fields, flash, window)
+        print(f'{label:<14} {dt * 1000:7.1f} ms for {n} fields  flash writes={writes}')
+    dt, n, writes, resent = framed(args.fields, flash, 8, drop=0.1, retries=10)
+    print(f'{"10% dropped":<14} {dt * 1000:7.1f} ms for {n} fields  flash writes={writes} '
+          f'retransmits={resent}')
+    dt, n, writes, resent = framed(args.fields, flash, 8, lost_commits=1)
+    print(f'{"lost COMMIT":<14} {dt * 1000:7.1f} ms for {n} fields  flash writes={writes} '
+          f'retransmits={resent}')
+    assert writes == 1, 'a resent COMMIT wrote flash again'
+    dt, outcome = unplugged()
+    print(f'{"unplugged":<14} {dt * 1000:7.1f} ms to fail 2 pings: {"; ".join(outcome)}')
+    assert 'HUNG' not in outcome and 'answered' not in outcome
+
+    with SerialDevice(flash_write=flash) as dev:
+        ser = serial.Serial(dev.port, 115200, timeout=0.005)
+        with SerialTransport(ser, window=8) as t:
+            rtts = sorted(t.ping() for _ in range(args.pings))
+            print(f'ping rtt       median={statistics.median(rtts) * 1000:.1f} ms '
+                  f'p95={rtts[int(len(rtts) * 0.95)] * 1000:.1f} ms')
+            value = 'y' * 1000
+            t0 = time.monotonic()
+            futures = [t.submit(0x03, b'keymap1\0' + value.encode()) for _ in range(100)]
+            assert all(f.result().status == 0 for f in futures)
+            dt = time.monotonic() - t0
+            print(f'bulk SET       {100 * len(value) / dt / 1024:.1f} KiB/s (window 8, 1000-byte values)')
+        ser.close()
+
+
+if __name__ == '__main__':
+    main()
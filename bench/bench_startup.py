@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Compare startup cost of the headless CLI with the Tk configurator.
+
+Runs each command ``--runs`` times in a fresh interpreter and reports the
+median wall time, plus the import time ``python -X importtime`` attributes
+to the modules each one loads. The GUI is measured up to the point where
+it would open its window (importing lolin_configurator), so this needs no
+display and understates its real launch time.
+
+Usage: python bench/bench_startup.py [--runs 10]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {
+    'cli --help': [os.path.join(ROOT, 'macropad_cli.py'), '--help'],
+    'cli set --help': [os.path.join(ROOT, 'macropad_cli.py'), 'set', '--help'],
+    'gui import': ['-c', 'import lolin_configurator'],
+}
+
+
+def import_profile(argv):
+    """Total self import time (ms) and the slowest top-level imports from -X importtime."""
+    r = subprocess.run([sys.executable, '-X', 'importtime', *argv], cwd=ROOT,
+                       capture_output=True, text=True)
+    total, top = 0, []
+    for line in r.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        if not name.startswith('  '):  # nested imports are indented further
+            top.append((int(cumulative), name.strip()))
+    return total / 1000, sorted(top, reverse=True)[:3]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--runs', type=int, default=10)
+    args = ap.parse_args()
+
+    baseline = None
+    for label, argv in CASES.items():
+        walls = []
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, *argv], cwd=ROOT, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            walls.append(time.perf_counter() - t0)
+        wall = statistics.median(walls) * 1000
+        imports, top = import_profile(argv)
+        baseline = baseline or wall
+        heavy = ', '.join(f'{n} {c / 1000:.0f} ms' for c, n in top)
+        print(f'{label:<15} wall={wall:6.1f} ms ({wall / baseline:4.1f}x)  imports={imports:6.1f} ms  '
+              f'top: {heavy}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Benchmark the flashing station against bench/fake_esptool.py.
+
+Flashes trays of N emulated pads (one esptool process per port) and
+compares the wall time with flashing the same pads one after another.
+Aggregate progress is polled while the station runs, the way the UI does.
+One port per tray fails its first attempt, so the retry path is exercised
+too.
+
+Usage: python bench/bench_station.py [--sizes 1 4 8 20] [--scale 0.05]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import flasher
+from station import DONE, Station
+
+SIZES = {'0x0000': 15 * 1024, '0x8000': 3 * 1024, '0xE000': 8 * 1024, '0x10000': 1024 * 1024}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 8, 20])
+    ap.add_argument('--scale', type=float, default=0.05,
+                    help='fraction of real esptool timings to simulate')
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['FAKE_ESPTOOL_STATE'] = os.path.join(tmp, 'state')
+        os.environ['FAKE_ESPTOOL_SCALE'] = str(args.scale)
+        os.environ['FAKE_ESPTOOL_FAIL'] = 'flaky:1'
+        os.environ['MACROPAD_CACHE'] = os.path.join(tmp, 'cache')  # fresh flash history
+        esptool = [sys.executable, os.path.join(HERE, 'fake_esptool.py')]
+        images = []
+        for addr, size in SIZES.items():
+            path = os.path.join(tmp, f'{addr}.bin')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            images.append((addr, path))
+
+        t0 = time.monotonic()
+        flasher.flash('fake-single', images, esptool=esptool,
+                      history=flasher.FlashHistory(os.path.join(tmp, 'single.json')))
+        single = time.monotonic() - t0
+        print(f'one device  {single:.2f} s')
+
+        for n in args.sizes:
+            ports = [f'fake-{n}-{i}' for i in range(n - 1)] + [f'fake-{n}-flaky']
+            station = Station(ports, images, retries=1, esptool=esptool, retry_delay=0.1)
+            samples = []
+            station.start()
+            while station.running():
+                samples.append(station.progress())
+                time.sleep(0.05)
+            lanes = station.wait()
+            elapsed = station.finished - station.started
+            ok = sum(l.state == DONE for l in lanes)
+            retried = sum(l.attempts > 1 for l in lanes)
+            print(f'{n:>3} devices {elapsed:6.2f} s  sequential~{n * single:6.2f} s  '
+                  f'speedup={n * single / elapsed:4.1f}x  ok={ok}/{n} retried={retried} '
+                  f'progress polls={len(samples)} last={samples[-1] if samples else 0:.0f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Tk event-loop responsiveness during fleet work: inline calls vs ui_dispatch.
+
+Runs a Tcl event loop without a display (``tkinter.Tcl()`` pumped with
+``dooneevent``) under a StallWatchdog and drives ``--devices`` emulated
+pads the way the configurator does:
+
+- fetch: ``GET /config`` from every pad;
+- fleet: ``fleet.push`` of a macro change to every pad, showing progress
+  as each pad finishes;
+- reconnect: ``DeviceRegistry.reconnect`` with the last-used pad's address
+  now silent, so it waits out the probe timeout before falling back.
+
+In the ``inline`` run, each step runs inside a Tk callback, as the
+configurator's Fetch/Save used to. In the ``dispatched`` run, each step
+goes through ``Dispatcher.submit`` and the progress through ``call``. The
+bench reports heartbeat lag (how late the loop turned) and the stalls the
+watchdog logged, with the culprit it profiled.
+
+Usage: python bench/bench_ui.py [--devices 16] [--latency 0.05] [--threshold 100]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tkinter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fleet
+import metrics
+from device_client import get_client
+from bench_discovery import silent_listener
+from device_registry import DeviceRegistry
+from emulator import FakeDevice
+from ui_dispatch import Dispatcher, StallWatchdog
+
+
+def culprit(stack):
+    # Innermost frame in this repo: what the blocked callback was waiting on
+    lines = [l.strip() for l in stack.splitlines() if l.strip().startswith('File "' + ROOT)]
+    return lines[-1][len('File "' + ROOT) + 1:] if lines else '?'
+
+
+def workload(devs, registry):
+    return [
+        lambda progress: [get_client(d.url).get_config() for d in devs],
+        lambda progress: fleet.push([(d.url, {'macro1': f'bench {i}'}) for i, d in enumerate(devs)],
+                                    on_result=progress),
+        lambda progress: registry.reconnect(timeout=0.3),
+    ]
+
+
+def run(mode, devs, registry, args, tmp):
+    metrics.reset()
+    root = tkinter.Tcl()
+    wd = StallWatchdog(root, threshold=args.threshold / 1000, on_stall=lambda s: None,
+                       out_dir=os.path.join(tmp, f'stalls-{mode}')).start()
+    ui = Dispatcher(root)
+    shown = []
+    remaining = workload(devs, registry)
+    finished = []
+
+    def show(r):
+        # On the Tk thread when dispatched; inline, fleet.push calls it from
+        # its workers, where touching Tk would raise, so it only counts there
+        shown.append(r)
+        if mode == 'dispatched':
+            root.setvar('status', f'{len(shown)} done')
+
+    def next_step():
+        if not remaining:
+            finished.append(time.monotonic())
+            return
+        fn = remaining.pop(0)
+        if mode == 'inline':
+            fn(show)
+            root.after(50, next_step)
+        else:
+            ui.submit(fn, lambda r: ui.call(show, r), on_done=lambda _: root.after(50, next_step))
+
+    root.after(100, next_step)
+    t0 = time.monotonic()
+    deadline = t0 + 60
+    while not finished and time.monotonic() < deadline:
+        root.dooneevent()
+    elapsed = (finished or [time.monotonic()])[0] - t0
+    wd.stop()
+    ui.shutdown()
+
+    lag = next(h for h in metrics.snapshot()['histograms'] if h['name'] == 'ui_loop_lag_seconds')
+    print(f'{mode:<10} {elapsed:5.2f} s  loop lag p50={lag["p50"] * 1000:6.1f} ms  p95={lag["p95"] * 1000:7.1f} ms  '
+          f'max={lag["max"] * 1000:7.1f} ms  stalls over {args.threshold:.0f} ms: {len(wd.stalls)}')
+    for s in wd.stalls:
+        print(f'           {s.duration * 1000:6.0f} ms in {s.callback}  '
+              f'profile={"yes" if s.profile else "no"}  '
+              f'waiting in {culprit(s.stack)}')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--devices', type=int, default=16)
+    ap.add_argument('--latency', type=float, default=0.05, help='seconds per emulated request')
+    ap.add_argument('--threshold', type=float, default=100, help='stall threshold in ms')
+    args = ap.parse_args()
+
+    devs = [FakeDevice(latency=args.latency).start() for _ in range(args.devices)]
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = DeviceRegistry(os.path.join(tmp, 'devices.json'))
+            for d in devs:
+                registry.record(d.url, {'mac': d.mac}, save=False)
+            gone = devs[-1]  # the most recently used pad; its address stops answering
+            gone.stop()
+            silent = silent_listener(gone.host, gone.port)
+            for mode in ('inline', 'dispatched'):
+                registry.record(gone.url, {'mac': gone.mac}, save=False)
+                run(mode, devs[:-1], registry, args, tmp)
+            silent.close()
+    finally:
+        for d in devs:
+            try:
+                d.stop()
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Stand-in for ``esptool`` that emulates an ESP32-S3 without hardware.
+
+Understands the subset of the command line the tools use (``--chip``,
+``--port``, ``--baud``, ``--before``, ``--after`` and the ``erase-flash``,
+``write-flash``, ``verify-flash`` and ``read-mac`` commands), prints
+esptool-style output including ``Writing at 0x... (N %)`` progress, and
+sleeps for roughly as long as the real thing would. Flash contents are
+tracked per port as region MD5s in a JSON state file, so ``verify-flash``
+reports what was actually written.
+
+Environment:
+    FAKE_ESPTOOL_STATE   state directory (default: <tmp>/fake_esptool)
+    FAKE_ESPTOOL_SCALE   multiply all simulated delays (default 1.0)
+    FAKE_ESPTOOL_FAIL    fail writes on ports containing this substring;
+                         "substr:N" fails only the first N attempts per port,
+                         "substr@0x10000" only once the write reaches that region
+
+    MACROPAD_ESPTOOL="python bench/fake_esptool.py" python old/flash.py
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+FLASH_SIZE = 16 * 1024 * 1024
+CONNECT_S = 1.2
+ERASE_S = 22.0                    # whole 16 MB chip
+SECTOR_ERASE_BPS = 1_200_000      # erase before write, bytes/s
+COMPRESSION = 0.6                 # typical deflate ratio for app images
+MD5_BPS = 4_000_000               # on-chip flash MD5
+
+
+def scale():
+    return float(os.environ.get('FAKE_ESPTOOL_SCALE', '1.0'))
+
+
+def nap(seconds):
+    time.sleep(seconds * scale())
+
+
+def state_path(port):
+    d = os.environ.get('FAKE_ESPTOOL_STATE') or os.path.join(tempfile.gettempdir(), 'fake_esptool')
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, port.strip('/').replace('/', '_') + '.json')
+
+
+def load(port):
+    try:
+        with open(state_path(port), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(port, regions):
+    with open(state_path(port), 'w', encoding='utf-8') as f:
+        json.dump(regions, f, indent=1)
+
+
+def pairs(args):
+    if len(args) % 2:
+        sys.exit('A fatal error occurred: address/file arguments must come in pairs')
+    out = []
+    for i in range(0, len(args), 2):
+        with open(args[i + 1], 'rb') as f:
+            out.append((int(args[i], 0), f.read()))
+    return out
+
+
+def connect(port, chip, baud):
+    print(f'esptool.py v4.8.1\nSerial port {port}')
+    print('Connecting...', flush=True)
+    nap(CONNECT_S)
+    print(f'Chip is {chip.upper().replace("ESP32S3", "ESP32-S3")} (QFN56) (revision v0.2)')
+    print('Features: WiFi, BLE, Embedded PSRAM 2MB (AP_3v3)')
+    print('Crystal is 40MHz')
+    print(f'MAC: {mac(port)}')
+    print('Uploading stub...\nRunning stub...\nStub running...')
+    if baud and int(baud) != 115200:
+        print(f'Changing baud rate to {baud}\nChanged.')
+    print('Configuring flash size...', flush=True)
+
+
+def mac(port):
+    h = hashlib.md5(port.encode()).digest()
+    return ':'.join(f'{b:02x}' for b in (b'\x34\x85\x18' + h[:3]))
+
+
+def should_fail(port):
+    spec = os.environ.get('FAKE_ESPTOOL_FAIL')
+    if not spec:
+        return False
+    substr, _, times = spec.partition('@')[0].partition(':')
+    if substr not in port:
+        return False
+    if not times:
+        return True
+    marker = state_path(port) + '.failures'
+    try:
+        with open(marker, encoding='utf-8') as f:
+            n = int(f.read() or 0)
+    except (OSError, ValueError):
+        n = 0
+    if n >= int(times):
+        return False
+    with open(marker, 'w', encoding='utf-8') as f:
+        f.write(str(n + 1))
+    return True
+
+
+def fail_region():
+    at = os.environ.get('FAKE_ESPTOOL_FAIL', '').partition('@')[2]
+    return int(at, 0) if at else None
+
+
+def write(port, baud, images):
+    regions = load(port)
+    fail, fail_at = should_fail(port), fail_region()
+    rate = int(baud or 115200) / 10
+    for addr, data in images:
+        end = addr + len(data)
+        print(f'Flash will be erased from 0x{addr:08x} to 0x{(end + 0xfff) & ~0xfff:08x}...')
+    for addr, data in images:
+        packed = max(1, int(len(data) * COMPRESSION))
+        print(f'Compressed {len(data)} bytes to {packed}...', flush=True)
+        t0 = time.monotonic()
+        blocks = max(1, packed // 0x4000)
+        per_block = (packed / rate + len(data) / SECTOR_ERASE_BPS) / blocks
+        for i in range(blocks):
+            print(f'Writing at 0x{addr + i * len(data) // blocks:08x}... ({100 * i // blocks} %)',
+                  flush=True)
+            nap(per_block)
+            if fail and fail_at in (None, addr) and i == blocks // 2:
+                print('A fatal error occurred: Packet content transfer stopped (received 8 bytes)')
+                sys.exit(2)
+        print(f'Writing at 0x{addr + len(data):08x}... (100 %)')
+        dt = max(time.monotonic() - t0, 1e-3)
+        print(f'Wrote {len(data)} bytes ({packed} compressed) at 0x{addr:08x} in {dt:.1f} seconds '
+              f'(effective {len(data) * 8 / dt / 1000:.1f} kbit/s)...')
+        print('Hash of data verified.', flush=True)
+        regions[f'0x{addr:x}'] = hashlib.md5(data).hexdigest()
+        save(port, regions)
+
+
+def verify(port, images):
+    regions = load(port)
+    print('Verifying flash...')
+    bad = False
+    for addr, data in images:
+        nap(len(data) / MD5_BPS)
+        ok = regions.get(f'0x{addr:x}') == hashlib.md5(data).hexdigest()
+        bad |= not ok
+        print(f'Verifying 0x{len(data):x} ({len(data)}) bytes @ 0x{addr:08x} in flash against '
+              f'{"" if ok else "local "}file... -- verify {"OK (digest matched)" if ok else "FAILED (digest mismatch)"}',
+              flush=True)
+    if bad:
+        print('A fatal error occurred: Verify failed.')
+        sys.exit(2)
+
+
+def main():
+    ap = argparse.ArgumentParser(prog='esptool')
+    ap.add_argument('--chip', default='esp32s3')
+    ap.add_argument('--port', '-p', required=True)
+    ap.add_argument('--baud', '-b')
+    ap.add_argument('--before', default='default-reset')
+    ap.add_argument('--after', default='hard-reset')
+    ap.add_argument('command')
+    ap.add_argument('rest', nargs='*')
+    args = ap.parse_args()
+    cmd = args.command.replace('_', '-')
+
+    if not os.path.exists(args.port) and not args.port.startswith(('fake', 'COM')):
+        print(f"A fatal error occurred: Could not open {args.port}, the port doesn't exist")
+        sys.exit(2)
+    connect(args.port, args.chip, args.baud)
+    if cmd == 'erase-flash':
+        print('Erasing flash (this may take a while)...', flush=True)
+        nap(ERASE_S)
+        save(args.port, {})
+        print(f'Chip erase completed successfully in {ERASE_S * scale():.1f}s')
+    elif cmd == 'write-flash':
+        write(args.port, args.baud, pairs(args.rest))
+    elif cmd == 'verify-flash':
+        verify(args.port, pairs(args.rest))
+    elif cmd == 'read-mac':
+        print(f'MAC: {mac(args.port)}')
+    else:
+        sys.exit(f'A fatal error occurred: unsupported command {args.command}')
+    if args.after == 'hard-reset':
+        print('\nLeaving...\nHard resetting via RTS pin...')
+
+
+if __name__ == '__main__':
+    main()
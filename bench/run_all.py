@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""Run the configurator's hot paths against N emulated devices and record the results.
+
+Each scenario drives the real client code against emulator.py (and
+bench/fake_esptool.py for flashing), so it runs on any POSIX machine
+without hardware:
+
+    discovery      concurrent subnet scan finding N devices on 127.0.0.0/24
+    fetch          GET /config from N devices at once, keep-alive reused
+    save           save-to-ready in station mode and in AP mode (restart)
+    serial         pipelined framed update, PING and a text command on N ptys
+    flash          flashing station over N fake ports, then an unchanged re-flash
+
+Results go to a JSON file (``--out``, by default a timestamped file under
+``<cache>/bench``) together with the git revision, so runs can be compared
+across releases; ``--baseline`` prints the change in every timing against
+an earlier results file.
+
+Usage: python bench/run_all.py [--devices 8] [--only fetch save] [--out results.json]
+                               [--baseline previous.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import serial
+
+import discovery
+import fleet
+import metrics
+from device_client import DeviceClient
+from emulator import FakeDevice, SerialDevice
+from firmware_download import cache_dir
+from serial_proto import SerialTransport
+from station import DONE, Station
+
+IMAGES = {'0x0000': 15 * 1024, '0x8000': 3 * 1024, '0xE000': 8 * 1024, '0x10000': 1024 * 1024}
+
+
+def ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench_discovery(args):
+    port = args.port
+    step = 250 // args.devices
+    devs = [FakeDevice(f'127.0.0.{2 + i * step}', port, latency=args.latency).start()
+            for i in range(args.devices)]
+    try:
+        t0 = time.monotonic()
+        hits = discovery.scan(['127.0.0.0/24'], port=port, connect_timeout=0.3, read_timeout=1.0,
+                              candidates=())
+        elapsed = time.monotonic() - t0
+    finally:
+        for d in devs:
+            d.stop()
+    return {'elapsed_ms': ms(elapsed), 'found': len(hits), 'expected': len(devs)}
+
+
+def bench_fetch(args):
+    devs = [FakeDevice(latency=args.latency, connect_latency=args.connect_latency).start()
+            for _ in range(args.devices)]
+    clients = [DeviceClient(d.url) for d in devs]
+    try:
+        with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+            t0 = time.monotonic()
+            list(pool.map(lambda c: c.get_config(), clients))
+            cold = time.monotonic() - t0
+            lat = []
+
+            def fetch(c):
+                for _ in range(args.rounds):
+                    t = time.monotonic()
+                    c.get_config()
+                    lat.append(time.monotonic() - t)
+
+            t0 = time.monotonic()
+            list(pool.map(fetch, clients))
+            warm = time.monotonic() - t0
+        connections = sum(d.connections for d in devs)
+    finally:
+        for c in clients:
+            c.close()
+        for d in devs:
+            d.stop()
+    return {'cold_all_ms': ms(cold), 'warm_all_ms': ms(warm),
+            'request_p50_ms': ms(statistics.median(lat)), 'request_p95_ms': ms(pct(lat, 0.95)),
+            'requests': len(lat) + len(clients), 'connections': connections}
+
+
+def bench_save(args):
+    out = {}
+    for mode in ('sta', 'ap'):
+        devs = [FakeDevice(latency=args.latency, mode=mode, reboot_delay=args.reboot_delay).start()
+                for _ in range(args.devices)]
+        if mode == 'sta':
+            entries = [(d.url, {'macro1': f'bench {i}', 'action1': 'macro'}) for i, d in enumerate(devs)]
+        else:
+            entries = [(d.url, {'wifi_ssid': 'MacropadLab', 'wifi_pass': 'secret'}) for d in devs]
+        try:
+            t0 = time.monotonic()
+            results = fleet.push(entries, ready_timeout=args.reboot_delay + 10)
+            summary = fleet.summarize(results, time.monotonic() - t0)
+            restarts = sum(d.restarts for d in devs)
+        finally:
+            for d in devs:
+                d.stop()
+        out[mode] = {'elapsed_ms': ms(summary['elapsed']), 'ok': summary['ok'],
+                     'ready_p50_ms': ms(summary['latency_p50'] or 0),
+                     'ready_p95_ms': ms(summary['latency_p95'] or 0), 'restarts': restarts}
+    return out
+
+
+def _serial_one(dev, fields, pings):
+    ser = serial.Serial(dev.port, 115200, timeout=0.005)
+    try:
+        with SerialTransport(ser, window=8) as t:
+            t0 = time.monotonic()
+            t.set_fields(fields)
+            update = time.monotonic() - t0
+            rtts = [t.ping() for _ in range(pings)]
+        # Text commands share the port once the transport has let go of it
+        t0 = time.monotonic()
+        ser.write(b'status\n')
+        buf = bytearray()
+        while b'LED state' not in buf and time.monotonic() - t0 < 2:
+            buf += ser.read(max(ser.in_waiting, 1))
+        text = time.monotonic() - t0
+    finally:
+        ser.close()
+    return update, rtts, text
+
+
+def bench_serial(args):
+    fields = {k: f'bench-{k}-' + 'x' * 40
+              for k in ('macro1', 'macro2', 'keymap1', 'keymap2', 'wifi_ssid', 'wifi_pass')}
+    devs = [SerialDevice(flash_write=args.flash_ms / 1000).start() for _ in range(args.devices)]
+    try:
+        with ThreadPoolExecutor(max_workers=len(devs)) as pool:
+            t0 = time.monotonic()
+            runs = list(pool.map(lambda d: _serial_one(d, fields, args.rounds), devs))
+            elapsed = time.monotonic() - t0
+        writes = sum(d.flash_writes for d in devs)
+    finally:
+        for d in devs:
+            d.stop()
+    updates = [u for u, _, _ in runs]
+    rtts = [r for _, rs, _ in runs for r in rs]
+    texts = [t for _, _, t in runs]
+    return {'elapsed_ms': ms(elapsed), 'fields': len(fields),
+            'update_p50_ms': ms(statistics.median(updates)), 'update_max_ms': ms(max(updates)),
+            'flash_writes': writes, 'ping_p50_ms': ms(statistics.median(rtts)),
+            'ping_p95_ms': ms(pct(rtts, 0.95)), 'text_cmd_p50_ms': ms(statistics.median(texts))}
+
+
+def bench_flash(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {'FAKE_ESPTOOL_STATE': os.path.join(tmp, 'state'),
+               'FAKE_ESPTOOL_SCALE': str(args.scale), 'MACROPAD_CACHE': os.path.join(tmp, 'cache')}
+        saved = {k: os.environ.get(k) for k in env}
+        os.environ.update(env)
+        try:
+            esptool = [sys.executable, os.path.join(HERE, 'fake_esptool.py')]
+            images = []
+            for addr, size in IMAGES.items():
+                path = os.path.join(tmp, f'{addr}.bin')
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(size))
+                images.append((addr, path))
+            ports = [f'fake-run-all-{i}' for i in range(args.devices)]
+            out = {}
+            for label in ('first', 'unchanged'):
+                station = Station(ports, images, retries=1, esptool=esptool, retry_delay=0.1)
+                lanes = station.run()
+                out[label] = {'elapsed_ms': ms(station.finished - station.started),
+                              'ok': sum(l.state == DONE for l in lanes),
+                              'regions_written': sum(len(l.written) for l in lanes)}
+            return out
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+
+BENCHES = {'discovery': bench_discovery, 'fetch': bench_fetch, 'save': bench_save,
+           'serial': bench_serial, 'flash': bench_flash}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def flatten(d, prefix=''):
+    for k, v in d.items():
+        key = f'{prefix}{k}'
+        if isinstance(v, dict):
+            yield from flatten(v, key + '.')
+        else:
+            yield key, v
+
+
+def compare(results, baseline):
+    old = dict(flatten(baseline.get('results', {})))
+    print(f'\nvs {baseline.get("revision")} ({baseline.get("timestamp")}):')
+    for key, value in flatten(results):
+        before = old.get(key)
+        if not key.endswith('_ms') or not isinstance(before, (int, float)) or not before:
+            continue
+        change = (value - before) / before * 100
+        # Ignore jitter on timings that are only a few ms either way
+        flag = '  REGRESSION' if change > 20 and value - before > 5 else ''
+        print(f'  {key:<32} {before:>9.1f} -> {value:>9.1f} ms ({change:+.0f}%){flag}')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the configurator against emulated devices')
+    ap.add_argument('--devices', type=int, default=8)
+    ap.add_argument('--only', nargs='+', choices=sorted(BENCHES), help='run just these scenarios')
+    ap.add_argument('--out', help='results file (default: <cache>/bench/results-<time>.json)')
+    ap.add_argument('--baseline', help='earlier results file to compare against')
+    ap.add_argument('--metrics', help='also write the per-operation timings (.json or Prometheus text)')
+    ap.add_argument('--port', type=int, default=18080, help='port for the discovery scan')
+    ap.add_argument('--latency', type=float, default=0.01, help='seconds per HTTP request')
+    ap.add_argument('--connect-latency', type=float, default=0.05, help='seconds per TCP connection')
+    ap.add_argument('--reboot-delay', type=float, default=1.0)
+    ap.add_argument('--flash-ms', type=float, default=30.0, help='serial config flash write cost')
+    ap.add_argument('--rounds', type=int, default=20, help='requests/pings per device')
+    ap.add_argument('--scale', type=float, default=0.05,
+                    help='fraction of real esptool timings to simulate')
+    args = ap.parse_args()
+    if args.devices < 1:
+        ap.error('--devices must be at least 1')
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in args.only or BENCHES:
+        t0 = time.monotonic()
+        results[name] = BENCHES[name](args)
+        print(f'{name:<10} {time.monotonic() - t0:6.2f} s  {json.dumps(results[name])}')
+
+    doc = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'revision': git_revision(),
+           'python': platform.python_version(), 'platform': platform.platform(),
+           'devices': args.devices, 'params': {k: v for k, v in vars(args).items()
+                                               if k not in ('devices', 'only', 'out', 'baseline', 'metrics')},
+           'results': results}
+    if not args.out:
+        args.out = os.path.join(cache_dir(), 'bench', time.strftime('results-%Y%m%d-%H%M%S.json'))
+        os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(doc, f, indent=2)
+    print(f'wrote {args.out}')
+    if args.metrics:
+        metrics.write(args.metrics)
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+"""Headless HTTP client for Lolin S3 macropads.
+
+Wraps the firmware's ``/config`` API behind a small typed interface so the
+Tk configurator and scripts share one implementation. Each device gets a
+``requests.Session`` with its own keep-alive connection pool; TCP setup to
+the ESP32 is the bulk of a round-trip, so reusing the socket matters.
+
+    client = get_client('192.168.1.50')
+    cfg = client.get_config()
+    cfg.macro1 = 'hello'
+    result = client.save(cfg)   # waits for a restart only if the device does one
+
+The client caches the last config it fetched or saved along with its ETag.
+``save`` then sends only the fields that differ, guarded by ``If-Match``, so
+a concurrent edit on the device raises ConflictError instead of being
+silently overwritten.
+
+Text macros longer than INLINE_MACRO_MAX bytes don't fit in the firmware's
+config document. ``save`` uploads them in chunks to ``/macro/text``, where
+the device keeps them as LittleFS blobs; an interrupted upload resumes from
+the offset the device reports. ``get_config`` downloads them back, so a
+DeviceConfig always holds the full text.
+"""
+import base64
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, fields
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import macro_compiler
+import metrics
+
+CONFIG_FIELDS = ('wifi_ssid', 'wifi_pass', 'macro1', 'macro2',
+                 'action1', 'action2', 'keymap1', 'keymap2')
+AP_BASE = 'http://192.168.4.1'
+INLINE_MACRO_MAX = 256  # longer text macros are stored as blobs (POST /macro/text)
+MACRO_CHUNK = 2048      # bytes per /macro/text request; the firmware takes up to 4096
+
+
+class DeviceError(Exception):
+    """Raised when a device cannot be reached or rejects a request.
+
+    ``status`` holds the HTTP status for rejected requests, None otherwise.
+    """
+
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status
+
+
+class ConflictError(DeviceError):
+    """The device config changed since it was fetched (HTTP 412)."""
+
+
+@dataclass
+class DeviceConfig:
+    wifi_ssid: str = ''
+    wifi_pass: str = ''
+    macro1: str = ''
+    macro2: str = ''
+    action1: str = 'macro'  # 'macro' | 'keystroke' | 'disabled'
+    action2: str = 'macro'
+    keymap1: str = ''
+    keymap2: str = ''
+
+    @classmethod
+    def from_dict(cls, d):
+        known = {f.name: f.default for f in fields(cls)}
+        return cls(**{k: str(d.get(k, v)) for k, v in known.items()})
+
+    def to_dict(self):
+        return asdict(self)
+
+
+@dataclass
+class SaveResult:
+    restart: bool          # whether the device restarted to apply the config
+    ready_url: str         # where the device answered afterwards (None if it never did)
+    post_latency: float    # seconds spent on the POST itself
+    ready_latency: float   # seconds from starting the save until the device was ready
+    sent: tuple = ()       # names of the fields actually sent
+
+
+def diff_config(old, new):
+    """Return ``{field: value}`` for each field of ``new`` that differs from ``old``.
+
+    Either side may be a DeviceConfig or a dict; fields missing from a dict
+    ``new`` are treated as unchanged.
+    """
+    old = old.to_dict() if isinstance(old, DeviceConfig) else dict(old)
+    new = new.to_dict() if isinstance(new, DeviceConfig) else dict(new)
+    return {k: new[k] for k in CONFIG_FIELDS if k in new and new[k] != old.get(k)}
+
+
+def backoff_delay(attempt, base=0.2):
+    """Exponential backoff with full jitter, so a fleet doesn't retry in lockstep."""
+    return random.uniform(0, base * (2 ** attempt))
+
+
+def normalize_base(raw):
+    """Turn a user-entered address into ``http://host[:port]`` (None if empty)."""
+    if not raw:
+        return None
+    raw = raw.strip()
+    if not raw:
+        return None
+    if raw.startswith('http://') or raw.startswith('https://'):
+        return raw.rstrip('/')
+    return 'http://' + raw.rstrip('/')
+
+
+class DeviceClient:
+    """Pooled, retrying client for one device.
+
+    ``timeout`` is a ``(connect, read)`` pair or a single float applied to
+    both. Failed attempts (connection errors, timeouts, 5xx) are retried up to
+    ``retries`` times with exponential backoff and full jitter.
+    """
+
+    def __init__(self, base, timeout=(1.0, 3.0), retries=2, backoff=0.2, pool_size=4):
+        self.base = normalize_base(base)
+        if not self.base:
+            raise ValueError('device address required')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.mode = None  # 'ap' or 'sta' as last reported by GET /config
+        self.cached = None  # DeviceConfig as of the last fetch/save
+        self.etag = None    # its ETag; None for firmware that can't merge deltas
+        self.mac = None     # identity reported by GET /config (None on older firmware)
+        self.macro_blobs = {}  # slot -> bytes of text macro the device holds as a blob
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __repr__(self):
+        return f'DeviceClient({self.base!r})'
+
+    def request(self, method, path, timeout=None, retries=None, **kw):
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        url = self.base + path
+        route = path.split('?', 1)[0]
+        last = None
+        for attempt in range(retries + 1):
+            if attempt:
+                metrics.inc('http_retries_total', method=method, path=route, device=self.base)
+                time.sleep(backoff_delay(attempt - 1, self.backoff))
+            with metrics.span('http_request', method=method, path=route, device=self.base) as sp:
+                try:
+                    r = self.session.request(method, url, timeout=timeout, **kw)
+                except requests.RequestException as e:
+                    sp.fail(type(e).__name__)
+                    last = e
+                    continue
+                if r.status_code >= 400:
+                    sp.fail(f'http_{r.status_code}')
+            if r.status_code >= 500:
+                last = DeviceError(f'{method} {url}: HTTP {r.status_code}', r.status_code)
+                continue
+            if r.status_code == 412:
+                raise ConflictError(f'{method} {url}: config changed on the device', 412)
+            if r.status_code >= 400:
+                raise DeviceError(f'{method} {url}: HTTP {r.status_code} {r.text.strip()}', r.status_code)
+            return r
+        raise DeviceError(f'{method} {url} failed after {retries + 1} attempt(s): {last}')
+
+    def get_config(self, timeout=None, retries=None):
+        r = self.request('GET', '/config', timeout=timeout, retries=retries)
+        try:
+            j = r.json()
+        except ValueError as e:
+            raise DeviceError(f'Invalid /config response from {self.base}: {e}')
+        for slot in (1, 2):
+            if j.get(f'macro{slot}_blob'):
+                j[f'macro{slot}'] = self.get_text_macro(slot, timeout=timeout)
+        return self.use_config(j, _etag(r))
+
+    def use_config(self, doc, etag=None):
+        """Adopt a ``/config`` document fetched elsewhere (discovery, the device
+        registry) as the baseline for the next save; return it as a DeviceConfig.
+        """
+        self.mode = doc.get('mode', self.mode)
+        self.mac = doc.get('mac', self.mac)
+        self.etag = etag or doc.get('version')
+        self.macro_blobs = {s: doc.get(f'macro{s}_blob') or 0 for s in (1, 2)}
+        self.cached = DeviceConfig.from_dict(doc)
+        return DeviceConfig.from_dict(doc)
+
+    def put_config(self, cfg, timeout=None, retries=None, if_match=None):
+        """POST ``cfg`` (a DeviceConfig or a dict of fields) to the device."""
+        payload = cfg.to_dict() if isinstance(cfg, DeviceConfig) else dict(cfg)
+        headers = {'If-Match': f'"{if_match}"'} if if_match else None
+        return self.request('POST', '/config', json=payload, timeout=timeout, retries=retries,
+                            headers=headers)
+
+    def expects_restart(self, r):
+        """Tell from a POST /config reply whether the device is restarting."""
+        # Current firmware says so in the POST reply; otherwise go by the mode
+        # reported on the last fetch. Firmware without either always restarted.
+        try:
+            j = r.json()
+            if isinstance(j, dict) and 'restart' in j:
+                return bool(j['restart'])
+        except ValueError:
+            pass
+        return self.mode != 'sta'
+
+    def save(self, cfg, timeout=None, ready_timeout=20.0, candidates=None, delta=True, wait=True,
+             on_progress=None):
+        """POST ``cfg`` and, if the device restarts to apply it, wait until it is back.
+
+        With ``delta`` and a cached config from firmware that merges partial
+        updates, only changed fields are sent (nothing at all if none changed)
+        and a concurrent edit raises ConflictError. Macros longer than
+        INLINE_MACRO_MAX go up first through ``upload_text_macro``, reporting
+        ``on_progress(field, sent, total)``. ``candidates`` are the addresses
+        to probe after a restart (default: this device and the setup AP); pass
+        ``wait=False`` to return right after the POST and do the waiting
+        yourself. Returns a SaveResult.
+        """
+        t0 = time.monotonic()
+        if delta and self.cached is not None and self.etag:
+            payload, if_match = diff_config(self.cached, cfg), self.etag
+            if not payload:
+                return SaveResult(False, self.base, 0.0, 0.0)
+        else:
+            payload = cfg.to_dict() if isinstance(cfg, DeviceConfig) else dict(cfg)
+            if_match = None
+        blobs, if_match = self._save_macro_blobs(payload, if_match, timeout, on_progress)
+        if payload:
+            r = self.put_config(payload, timeout=timeout, retries=0, if_match=if_match)
+            restart, etag = self.expects_restart(r), _etag(r)
+        else:
+            restart, etag = False, if_match
+        post = time.monotonic() - t0
+        if self.cached is not None and not restart:
+            self.cached = DeviceConfig.from_dict(dict(self.cached.to_dict(), **blobs, **payload))
+            self.etag = etag
+        else:
+            # After a restart (or without a baseline) the next save starts from a fetch
+            self.cached = self.etag = None
+        sent = tuple(blobs) + tuple(payload)
+        if not restart:
+            metrics.observe('save_to_ready_seconds', post, device=self.base, restart='false')
+            return SaveResult(False, self.base, post, post, sent)
+        if not wait:
+            return SaveResult(True, None, post, post, sent)
+        cands = candidates or [self.base, AP_BASE]
+        url = wait_ready(cands, timeout=ready_timeout)
+        ready = time.monotonic() - t0
+        if url:
+            metrics.observe('save_to_ready_seconds', ready, device=self.base, restart='true')
+        return SaveResult(True, url, post, ready, sent)
+
+    def _save_macro_blobs(self, payload, if_match, timeout, on_progress):
+        # Long macros become blobs; emptying a blob-backed one deletes the blob
+        # (an empty config field would leave it in place). Handled fields are
+        # taken out of ``payload``. Returns them and the If-Match for what follows.
+        done = {}
+        for slot in (1, 2):
+            key = f'macro{slot}'
+            text = payload.get(key)
+            if text is None:
+                continue
+            progress = on_progress and (lambda n, total, key=key: on_progress(key, n, total))
+            try:
+                if len(text.encode('utf-8')) > INLINE_MACRO_MAX:
+                    etag = self.upload_text_macro(slot, text, if_match=if_match, timeout=timeout,
+                                                  on_progress=progress)
+                elif not text and self.macro_blobs.get(slot):
+                    etag = self.delete_text_macro(slot, if_match=if_match, timeout=timeout)
+                else:
+                    continue
+            except DeviceError as e:
+                if e.status == 404:  # firmware without blobs: send it inline as before
+                    continue
+                raise
+            done[key] = payload.pop(key)
+            if if_match:
+                if_match = etag
+        return done, if_match
+
+    def text_macro_info(self, slot, timeout=None):
+        """The text macro blob held for button ``slot`` and any upload in progress.
+
+        ``{'slot', 'size', 'hash', 'upload': {'received', 'total', 'hash'}}``
+        from GET /macro/text; hashes are FNV-1a as 8 hex digits.
+        """
+        return self.request('GET', f'/macro/text?slot={slot}', timeout=timeout).json()
+
+    def get_text_macro(self, slot, chunk_size=MACRO_CHUNK, timeout=None):
+        """Download the text macro stored as a blob for button ``slot``."""
+        info = self.text_macro_info(slot, timeout=timeout)
+        data = bytearray()
+        while len(data) < info['size']:
+            r = self.request('GET', f'/macro/text?slot={slot}&offset={len(data)}&length={chunk_size}',
+                             timeout=timeout)
+            if not r.content:
+                break
+            data += r.content
+        if len(data) != info['size'] or '%08x' % macro_compiler.fnv1a(data) != info['hash']:
+            raise DeviceError(f'Macro {slot} on {self.base} changed while it was read')
+        return data.decode('utf-8', 'replace')
+
+    def upload_text_macro(self, slot, text, chunk_size=MACRO_CHUNK, if_match=None, timeout=None,
+                          attempts=5, on_progress=None):
+        """Store ``text`` as the text macro of button ``slot``, ``chunk_size`` bytes per request.
+
+        After a dropped connection, a lost reply or a 409, the upload resumes
+        from the offset the device reports holding; it gives up after
+        ``attempts`` failures in a row. Nothing is sent if the device already
+        holds this text. ``on_progress(sent, total)`` follows each chunk.
+        Returns the device's new ETag (None if the reply carrying it was lost).
+        """
+        data = text.encode('utf-8')
+        total, digest = len(data), '%08x' % macro_compiler.fnv1a(data)
+        query = f'/macro/text?slot={slot}&total={total}&hash={digest}&offset='
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if if_match:
+            headers['If-Match'] = f'"{if_match}"'
+        t0 = time.monotonic()
+        offset = self._resume_offset(slot, total, digest, timeout)
+        etag, failures = None, 0
+        while offset < total:
+            try:
+                r = self.request('POST', query + str(offset), data=data[offset:offset + chunk_size],
+                                 headers=headers, timeout=timeout, retries=0)
+                offset, etag, failures = r.json()['received'], _etag(r), 0
+                if on_progress is not None:
+                    on_progress(offset, total)
+                continue
+            except ConflictError:
+                raise
+            except DeviceError as e:
+                # None: no answer or a 5xx; 409: offset mismatch; 422: hash mismatch (starts over)
+                failures += 1
+                if e.status not in (None, 409, 422) or failures >= attempts:
+                    raise
+            time.sleep(backoff_delay(failures - 1, self.backoff))
+            try:
+                offset = self._resume_offset(slot, total, digest, timeout)
+            except DeviceError:
+                pass  # still unreachable: the next POST tells
+            metrics.inc('macro_upload_resumes_total', device=self.base)
+        metrics.observe('macro_upload_seconds', time.monotonic() - t0, device=self.base)
+        self.macro_blobs[slot] = total
+        return etag
+
+    def _resume_offset(self, slot, total, digest, timeout):
+        # Where an upload of (total, digest) stands on the device: all of it
+        # if that blob is already stored, else the bytes of a matching partial upload
+        info = self.text_macro_info(slot, timeout=timeout)
+        if (info.get('size'), info.get('hash')) == (total, digest):
+            return total
+        up = info.get('upload') or {}
+        if (up.get('total'), up.get('hash')) == (total, digest):
+            return up.get('received', 0)
+        return 0
+
+    def delete_text_macro(self, slot, if_match=None, timeout=None):
+        """Drop the text macro blob of button ``slot``; return the new ETag."""
+        headers = {'If-Match': f'"{if_match}"'} if if_match else None
+        r = self.request('DELETE', f'/macro/text?slot={slot}', timeout=timeout, headers=headers)
+        self.macro_blobs[slot] = 0
+        return _etag(r)
+
+    def macro_info(self, slot, timeout=None):
+        """What compiled keymap the device holds for button ``slot`` (GET /macro)."""
+        return self.request('GET', f'/macro?slot={slot}', timeout=timeout).json()
+
+    def upload_macro(self, slot, blob, timeout=None):
+        """Store a compiled keymap blob for button ``slot``.
+
+        The device only accepts a blob compiled from its saved keymap (409
+        otherwise), so save the config first.
+        """
+        r = self.request('POST', f'/macro?slot={slot}', timeout=timeout,
+                         data=base64.b64encode(blob), headers={'Content-Type': 'text/plain'})
+        return r.json()
+
+    def ping(self, timeout=1.0):
+        """Return True if the device answers ``GET /config`` within ``timeout``."""
+        try:
+            self.request('GET', '/config', timeout=timeout, retries=0)
+            return True
+        except DeviceError:
+            return False
+
+    def close(self):
+        self.session.close()
+
+
+def _etag(r):
+    tag = r.headers.get('ETag')
+    if not tag:
+        return None
+    return tag[2:].strip('"') if tag.startswith('W/') else tag.strip('"')
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base, **kw):
+    """Return the shared client (and its connection pool) for ``base``."""
+    key = normalize_base(base)
+    with _clients_lock:
+        c = _clients.get(key)
+        if c is None:
+            c = _clients[key] = DeviceClient(key, **kw)
+        return c
+
+
+def wait_ready(candidates, timeout=20.0, settle=0.6, probe_timeout=1.0, backoff=0.2, max_backoff=1.6):
+    """Probe ``candidates`` concurrently until one answers; return its URL or None.
+
+    ``settle`` skips the window where the firmware has replied but not yet
+    restarted (it waits 500 ms before ``ESP.restart()``). Rounds are spaced by
+    exponential backoff, capped at ``max_backoff``.
+    """
+    with metrics.span('wait_ready') as sp:
+        url = _wait_ready(candidates, timeout, settle, probe_timeout, backoff, max_backoff)
+        if url is None:
+            sp.fail('timeout')
+    return url
+
+
+def _wait_ready(candidates, timeout, settle, probe_timeout, backoff, max_backoff):
+    deadline = time.monotonic() + timeout
+    time.sleep(min(settle, timeout))
+    clients = [get_client(c) for c in dict.fromkeys(candidates)]
+    delay = backoff
+    # Not a with-block: a winner must not wait for the losers' probes to time out
+    pool = ThreadPoolExecutor(max_workers=len(clients), thread_name_prefix='ready')
+    try:
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return None
+            t = min(probe_timeout, left)
+            pending = {pool.submit(c.ping, t): c for c in clients}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    c = pending.pop(f)
+                    if f.result():
+                        return c.base
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return None
+            time.sleep(min(delay, left))
+            delay = min(delay * 2, max_backoff)
+    finally:
+        pool.shutdown(wait=False)
@@ -0,0 +1,247 @@
+"""Persistent registry of known macropads, plus a background health monitor.
+
+Each pad is keyed by the MAC address its firmware reports in ``GET /config``
+(older firmware without one is keyed by its URL). The registry remembers
+the pad's last address, config version (the ETag), mode, round-trip time
+and when it was last seen. It is stored as ``devices.json`` in the cache
+directory, so on the next launch ``reconnect()`` can try the last-used
+address first: that is one round trip instead of a subnet scan.
+
+``HealthMonitor`` probes every known pad every ``interval`` seconds (one
+small ``GET /config`` each, all concurrently), keeps ``alive`` and ``rtt``
+up to date, and reports pads that go up or down or whose config changes.
+
+    reg = DeviceRegistry()
+    dev = reg.reconnect()                 # discovery.Device or None
+    reg.record('http://192.168.1.50', doc)  # after a fetch or discovery hit
+    mon = HealthMonitor(reg, on_change=print).start()
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, fields
+from urllib.parse import urlsplit
+
+import metrics
+from discovery import Device, probe
+from firmware_download import cache_dir
+
+
+@dataclass
+class KnownDevice:
+    key: str               # normalised MAC, or 'url:<base>' without one
+    url: str               # last address it answered on
+    mac: str = None
+    version: str = None    # config ETag as last seen
+    mode: str = None       # 'sta' or 'ap'
+    last_seen: float = 0.0  # time.time() of the last successful contact
+    rtt: float = None      # seconds, from the last probe
+    alive: bool = False
+    failures: int = 0      # consecutive failed probes
+
+    @classmethod
+    def from_dict(cls, d):
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in d.items() if k in known})
+
+
+def device_key(url, doc):
+    mac = (doc or {}).get('mac')
+    return mac.lower() if mac else f'url:{url}'
+
+
+def _probe(url, timeout):
+    parts = urlsplit(url)
+    t0 = time.monotonic()
+    doc = probe(parts.hostname, parts.port or 80, connect_timeout=timeout, read_timeout=timeout)
+    return doc, time.monotonic() - t0
+
+
+class DeviceRegistry:
+    """``{key: KnownDevice}`` persisted as JSON; safe to share between threads."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'devices.json')
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # the health thread and the UI both save
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = {k: KnownDevice.from_dict(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError, TypeError, AttributeError):
+            self.entries = {}
+        for d in self.entries.values():
+            d.alive = False  # nothing is known to be up until it is probed
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                data = {k: asdict(d) for k, d in self.entries.items()}
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp, self.path)
+
+    def devices(self):
+        """Known devices, most recently seen first."""
+        with self._lock:
+            return sorted(self.entries.values(), key=lambda d: d.last_seen, reverse=True)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def find(self, url):
+        """The device most recently seen at ``url``, or None."""
+        return next((d for d in self.devices() if d.url == url), None)
+
+    def forget(self, key):
+        with self._lock:
+            self.entries.pop(key, None)
+        self.save()
+
+    def record(self, url, doc, rtt=None, save=True):
+        """Note that the pad described by ``doc`` (a ``/config`` document) answered at ``url``.
+
+        Returns its KnownDevice. Any other entry last seen at the same address
+        is marked offline, since DHCP has handed that address to this pad.
+        """
+        key = device_key(url, doc)
+        with self._lock:
+            d = self.entries.get(key)
+            if d is None:
+                d = self.entries[key] = KnownDevice(key, url)
+            for other in self.entries.values():
+                if other is not d and other.url == url:
+                    other.alive = False
+            d.url = url
+            d.mac = doc.get('mac', d.mac)
+            d.version = doc.get('version', d.version)
+            d.mode = doc.get('mode', d.mode)
+            d.last_seen = time.time()
+            d.rtt = rtt if rtt is not None else d.rtt
+            d.alive = True
+            d.failures = 0
+        if save:
+            self.save()
+        return d
+
+    def candidates(self, key):
+        """Addresses to try for device ``key`` (its last known one), for post-restart probing."""
+        d = self.entries.get(key)
+        return [d.url] if d else []
+
+    def reconnect(self, timeout=1.0, limit=8):
+        """Probe the most recently used device at its last address.
+
+        If it doesn't answer (as its own MAC) within ``timeout``, the next
+        ``limit - 1`` most recent ones are probed concurrently and the most
+        recent of those that answers wins. Returns a discovery ``Device``
+        carrying the ``/config`` document, or None. For the usual case this is
+        one round trip.
+        """
+        known = self.devices()[:limit]
+        if not known:
+            return None
+        hit = self._try(known[0], _probe(known[0].url, timeout))
+        if hit is not None or len(known) == 1:
+            return hit
+        # Not a with-block: a hit must not wait for the other probes to time out
+        pool = ThreadPoolExecutor(max_workers=len(known) - 1, thread_name_prefix='reconnect')
+        try:
+            probes = [(d, pool.submit(_probe, d.url, timeout)) for d in known[1:]]
+            for d, fut in probes:
+                hit = self._try(d, fut.result())
+                if hit is not None:
+                    return hit
+            return None
+        finally:
+            pool.shutdown(wait=False)
+
+    def _try(self, d, probed):
+        doc, rtt = probed
+        metrics.inc('registry_reconnects_total', result='ok' if doc else 'miss')
+        if doc is None:
+            return None
+        self.record(d.url, doc, rtt)
+        if device_key(d.url, doc) != d.key:
+            return None  # a different pad has this address now
+        parts = urlsplit(d.url)
+        return Device(d.url, parts.hostname, parts.port or 80, doc, rtt)
+
+    def mark(self, key, doc, rtt):
+        """Update liveness from a probe; return True if the device went up/down or its config changed."""
+        with self._lock:
+            d = self.entries.get(key)
+            if d is None:
+                return False
+            if doc is None or device_key(d.url, doc) != key:
+                d.failures += 1
+                changed, d.alive = d.alive, False
+                return changed
+            changed = not d.alive or doc.get('version', d.version) != d.version
+            d.alive, d.failures, d.rtt, d.last_seen = True, 0, rtt, time.time()
+            d.version = doc.get('version', d.version)
+            d.mode = doc.get('mode', d.mode)
+            return changed
+
+
+class HealthMonitor:
+    """Probe every known device periodically on a background thread.
+
+    ``on_change(device)`` is called from that thread when a device goes up
+    or down or its config version changes.
+    """
+
+    def __init__(self, registry, interval=10.0, timeout=1.0, workers=16, on_change=None):
+        self.registry = registry
+        self.interval = interval
+        self.timeout = timeout
+        self.workers = workers
+        self.on_change = on_change
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='health', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.timeout + 1)
+        self.registry.save()
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='health') as pool:
+            while not self._stop.is_set():
+                try:
+                    self.sweep(pool)
+                except OSError as e:
+                    # devices.json couldn't be written; keep probing
+                    metrics.inc('health_sweep_errors_total', reason=type(e).__name__)
+                self._stop.wait(self.interval)
+
+    def sweep(self, pool=None):
+        """Probe every known device once; return the devices whose state changed."""
+        known = self.registry.devices()
+        if pool is None:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(known)))) as p:
+                return self.sweep(p)
+        changed = []
+        probes = [(d, pool.submit(_probe, d.url, self.timeout)) for d in known]
+        for d, fut in probes:
+            doc, rtt = fut.result()
+            if doc is None:
+                metrics.inc('health_probe_errors_total', reason='unreachable', device=d.url)
+            else:
+                metrics.observe('health_probe_seconds', rtt, device=d.url)
+            if self.registry.mark(d.key, doc, rtt):
+                changed.append(d)
+                if self.on_change:
+                    self.on_change(d)
+        if changed:
+            self.registry.save()
+        return changed
@@ -0,0 +1,104 @@
+"""Tk diagnostics panel: live per-operation timings and errors from metrics.py.
+
+``DiagnosticsPanel`` is a frame (the control center embeds it as a tab);
+``open_window(master)`` shows it in its own window, reusing one that is
+already open. Rows are grouped by operation and device, slowest total time
+first, and refresh once a second. Export writes the registry as Prometheus
+text or a JSON snapshot, picked by file extension.
+
+    DiagnosticsPanel(notebook).pack(fill='both', expand=True)
+"""
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+
+import metrics
+
+COLUMNS = (('op', 'Operation', 150), ('labels', 'Device / labels', 260), ('count', 'Count', 60),
+           ('errors', 'Errors', 60), ('p50', 'p50 ms', 70), ('p95', 'p95 ms', 70),
+           ('max', 'Max ms', 70), ('total', 'Total s', 70))
+
+
+def _ms(seconds):
+    return '' if seconds is None else f'{seconds * 1000:.1f}'
+
+
+class DiagnosticsPanel(ttk.Frame):
+    def __init__(self, master, registry=metrics.REGISTRY, interval=1000):
+        super().__init__(master)
+        self.registry = registry
+        self.interval = interval
+
+        bar = ttk.Frame(self)
+        bar.pack(fill='x', pady=4)
+        ttk.Button(bar, text='Export...', command=self.export).pack(side='left')
+        ttk.Button(bar, text='Reset', command=self.reset).pack(side='left', padx=5)
+        self.totals = ttk.Label(bar, text='')
+        self.totals.pack(side='left', padx=10)
+
+        self.tree = ttk.Treeview(self, columns=[c for c, _, _ in COLUMNS], show='headings', height=14)
+        for col, title, width in COLUMNS:
+            self.tree.heading(col, text=title)
+            self.tree.column(col, width=width, anchor='w' if col in ('op', 'labels') else 'e')
+        scroll = ttk.Scrollbar(self, orient='vertical', command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scroll.set)
+        self.tree.pack(side='left', fill='both', expand=True)
+        scroll.pack(side='right', fill='y')
+        self.refresh()
+
+    def refresh(self):
+        if not self.winfo_exists():
+            return
+        rows = self.registry.summary()
+        # Update rows in place so the scroll position and selection survive a refresh
+        seen = set()
+        for i, r in enumerate(rows):
+            labels = ', '.join(f'{k}={v}' for k, v in sorted(r['labels'].items()))
+            iid = f'{r["name"]}|{labels}'
+            values = (r['name'], labels, r['count'], r['errors'] or '', _ms(r['p50']),
+                      _ms(r['p95']), _ms(r['max']), f'{r["total"]:.2f}')
+            if self.tree.exists(iid):
+                self.tree.item(iid, values=values)
+                self.tree.move(iid, '', i)
+            else:
+                self.tree.insert('', i, iid=iid, values=values)
+            seen.add(iid)
+        stale = [iid for iid in self.tree.get_children() if iid not in seen]
+        if stale:
+            self.tree.delete(*stale)
+        calls = sum(r['count'] for r in rows)
+        errors = sum(r['errors'] for r in rows)
+        self.totals.config(text=f'{calls} timed operations, {errors} errors')
+        self.after(self.interval, self.refresh)
+
+    def export(self):
+        path = filedialog.asksaveasfilename(
+            title='Export metrics', defaultextension='.prom',
+            filetypes=[('Prometheus text', '*.prom'), ('JSON snapshot', '*.json'), ('All files', '*')])
+        if not path:
+            return
+        try:
+            self.registry.write(path)
+        except OSError as e:
+            messagebox.showerror('Export failed', str(e))
+
+    def reset(self):
+        self.registry.reset()
+        children = self.tree.get_children()
+        if children:
+            self.tree.delete(*children)
+
+
+_window = None
+
+
+def open_window(master):
+    """Show the diagnostics window (one per application)."""
+    global _window
+    if _window is not None and _window.winfo_exists():
+        _window.deiconify()
+        _window.lift()
+        return _window
+    _window = tk.Toplevel(master)
+    _window.title('Diagnostics')
+    DiagnosticsPanel(_window).pack(fill='both', expand=True, padx=6, pady=6)
+    return _window
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Concurrent LAN discovery for Lolin S3 macropads.
+
+Probes ``GET /config`` on every host of the local subnets (plus the AP
+address and mDNS name) with a bounded worker pool and short connect
+timeouts. Hits are reported through a callback as soon as they answer,
+so a /24 clears in a couple of seconds instead of minutes.
+
+Usage: python discovery.py [CIDR ...] [--port 80] [--workers 64]
+"""
+import argparse
+import http.client
+import ipaddress
+import json
+import socket
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+DEFAULT_CANDIDATES = ['192.168.4.1', 'lolin.local']
+# Keys every firmware revision returns from GET /config
+CONFIG_KEYS = ('wifi_ssid', 'macro1', 'macro2')
+
+Device = namedtuple('Device', 'url host port config rtt')
+
+
+def local_networks(prefix=24):
+    """Guess the IPv4 subnets this machine sits on (as /prefix networks)."""
+    addrs = set()
+    # Connecting a UDP socket sends nothing; it only asks the kernel for a route
+    for target in ('10.255.255.255', '8.8.8.8'):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect((target, 1))
+            addrs.add(s.getsockname()[0])
+        except OSError:
+            pass
+        finally:
+            s.close()
+    try:
+        addrs.update(socket.gethostbyname_ex(socket.gethostname())[2])
+    except OSError:
+        pass
+    nets = []
+    for a in sorted(addrs):
+        if a.startswith('127.') or a.startswith('0.'):
+            continue
+        net = ipaddress.ip_network(f'{a}/{prefix}', strict=False)
+        if net not in nets:
+            nets.append(net)
+    return nets
+
+
+def probe(host, port=80, connect_timeout=0.3, read_timeout=1.0):
+    """Return the parsed /config dict if ``host`` answers like a macropad, else None."""
+    conn = http.client.HTTPConnection(host, port, timeout=connect_timeout)
+    try:
+        conn.connect()
+        # Connect is what takes long on dead hosts; give a live one more time to answer
+        conn.sock.settimeout(read_timeout)
+        conn.request('GET', '/config')
+        r = conn.getresponse()
+        if r.status != 200:
+            return None
+        j = json.loads(r.read())
+        if isinstance(j, dict) and all(k in j for k in CONFIG_KEYS):
+            return j
+    except (OSError, ValueError, http.client.HTTPException):
+        pass
+    finally:
+        conn.close()
+    return None
+
+
+def iter_hosts(networks=None, candidates=DEFAULT_CANDIDATES):
+    """Yield each host to probe once: explicit candidates first, then subnet hosts."""
+    seen = set()
+    for c in candidates or ():
+        if c not in seen:
+            seen.add(c)
+            yield c
+    for net in networks or ():
+        net = ipaddress.ip_network(net, strict=False)
+        hosts = net.hosts() if net.num_addresses > 2 else iter(net)
+        for ip in hosts:
+            h = str(ip)
+            if h not in seen:
+                seen.add(h)
+                yield h
+
+
+def scan(networks=None, port=80, workers=64, connect_timeout=0.3, read_timeout=1.0,
+         candidates=DEFAULT_CANDIDATES, on_found=None, stop=None):
+    """Probe every host concurrently and return the list of ``Device`` hits.
+
+    ``networks`` defaults to ``local_networks()``. ``on_found`` is called from a
+    worker thread for each hit as it arrives. Setting the ``stop`` event
+    abandons hosts that have not been probed yet.
+    """
+    if networks is None:
+        networks = local_networks()
+    found = []
+    lock = threading.Lock()
+    # Keep only a bounded number of hosts queued so /16 scans don't build huge backlogs
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def work(host):
+        try:
+            if stop is not None and stop.is_set():
+                return
+            t0 = time.monotonic()
+            cfg = probe(host, port, connect_timeout, read_timeout)
+            metrics.inc('discovery_probes_total', found='false' if cfg is None else 'true')
+            if cfg is None:
+                return
+            base = f'http://{host}' if port == 80 else f'http://{host}:{port}'
+            dev = Device(base, host, port, cfg, time.monotonic() - t0)
+            metrics.observe('discovery_hit_seconds', dev.rtt, device=base)
+            with lock:
+                found.append(dev)
+            if on_found:
+                on_found(dev)
+        finally:
+            slots.release()
+
+    with metrics.span('discovery_scan'), \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix='discover') as pool:
+        for host in iter_hosts(networks, candidates):
+            if stop is not None and stop.is_set():
+                break
+            slots.acquire()
+            pool.submit(work, host)
+    return found
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Find Lolin S3 macropads on the local network')
+    ap.add_argument('networks', nargs='*', help='CIDR ranges to scan (default: local subnets)')
+    ap.add_argument('--port', type=int, default=80)
+    ap.add_argument('--workers', type=int, default=64)
+    ap.add_argument('--timeout', type=float, default=0.3, help='connect timeout in seconds')
+    args = ap.parse_args()
+
+    t0 = time.monotonic()
+    hits = scan(args.networks or None, port=args.port, workers=args.workers,
+                connect_timeout=args.timeout,
+                on_found=lambda d: print(f'{d.url}\t{d.rtt * 1000:.0f} ms', flush=True))
+    print(f'{len(hits)} device(s) in {time.monotonic() - t0:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
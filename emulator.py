@@ -0,0 +1,1025 @@
+#!/usr/bin/env python3
+"""Local stand-in for the LolinS3Buttons firmware.
+
+Serves the firmware's ``GET/POST /config`` API on a local address so the
+configurator tools and benchmarks can run without hardware. ``PtyPort``
+gives serial tools a pseudo-terminal to talk to in place of the USB CDC port,
+and ``FakeReleaseServer`` stands in for GitHub's release API and assets. Connections are
+kept alive (HTTP/1.1); ``connect_latency`` is charged once per new TCP
+connection and ``latency`` once per request, to model the ESP32's costs.
+
+POST /config follows ``handlePostConfig``: in AP (setup) mode only the WiFi
+fields are stored and the device restarts, dropping every request for
+``reboot_delay`` seconds and coming back in station mode if an SSID was set;
+in station mode macros, actions and keymaps are applied without a restart.
+Keys missing from a POST are left untouched, and the config's content hash
+is served as an ETag that ``If-Match`` is checked against (412 on mismatch).
+``GET/POST /macro?slot=N`` store compiled keymaps (see macro_compiler.py).
+Text macros over 256 bytes are refused in the config and go through
+``GET/POST/DELETE /macro/text?slot=N`` instead: a chunked upload that
+resumes at the offset the device holds, stored as a blob. ``flash_rate``
+charges for writing the chunks, and ``drop_replies`` stores that many chunks
+but loses their replies, to exercise resuming.
+``SerialDevice`` answers the framed serial protocol (serial_proto.py) and
+the ``handleSerialLine`` text commands on a pty, optionally sharing state
+with a FakeDevice.
+
+Usage: python emulator.py [--host 127.0.0.1] [--port 8080] [--serial]
+"""
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import os
+import random
+import select
+import struct
+import threading
+import time
+import zlib
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import macro_compiler
+import serial_proto
+
+DEFAULT_CONFIG = {
+    'wifi_ssid': '',
+    'wifi_pass': '',
+    'macro1': '',
+    'macro2': '',
+    'action1': 'macro',
+    'action2': 'macro',
+    'keymap1': '',
+    'keymap2': '',
+}
+INLINE_MACRO_MAX = 256
+MACRO_BLOB_MAX = 65536
+MACRO_CHUNK_MAX = 4096
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'LolinS3Emu/1.0'
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        dev = self.server.device
+        with dev.lock:
+            dev.connections += 1
+        if dev.connect_latency:
+            time.sleep(dev.connect_latency)
+
+    def parse_request(self):
+        ok = super().parse_request()
+        dev = self.server.device
+        if ok and dev.rebooting():
+            # Nobody home: drop the connection without answering
+            self.close_connection = True
+            return False
+        if ok and dev.latency:
+            time.sleep(dev.latency)
+        return ok
+
+    def _send(self, code, body, ctype='text/plain', etag=None):
+        data = body.encode() if isinstance(body, str) else body
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        if etag:
+            self.send_header('ETag', f'"{etag}"')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _slot(self):
+        q = parse_qs(urlsplit(self.path).query)
+        slot = (q.get('slot') or [''])[0]
+        return int(slot) if slot in ('1', '2') else None
+
+    def _if_match_fails(self, dev):
+        # ifMatchFails(): answers 412 if the client's ETag is stale; call with dev.lock held
+        want = (self.headers.get('If-Match') or '').strip().strip('"')
+        if want and want != '*' and want != dev.etag():
+            self._send(412, 'Config changed on device; fetch again', etag=dev.etag())
+            return True
+        return False
+
+    def do_GET(self):
+        dev = self.server.device
+        path = urlsplit(self.path).path
+        if path == '/macro':
+            return self._get_macro()
+        if path == '/macro/text':
+            return self._get_macro_text()
+        if path != '/config':
+            return self._send(404, 'Not found')
+        with dev.lock:
+            etag = dev.etag()
+            out = json.dumps(dict(dev.config, mode=dev.mode, mac=dev.mac, version=etag,
+                                  macro1_blob=len(dev.blobs.get(1, b'')),
+                                  macro2_blob=len(dev.blobs.get(2, b''))))
+        self._send(200, out, 'application/json', etag)
+
+    def _get_macro(self):
+        dev = self.server.device
+        slot = self._slot()
+        if slot is None:
+            return self._send(400, 'slot must be 1 or 2')
+        with dev.lock:
+            blob = dev.macros.get(slot)
+            info = {'slot': slot, 'hash': None, 'reports': 0, 'valid': False}
+            if blob:
+                h, recs = macro_compiler.decode(blob)
+                info.update(hash='%08x' % h, reports=len(recs),
+                            valid=h == macro_compiler.keymap_hash(dev.config[f'keymap{slot}']))
+        self._send(200, json.dumps(info), 'application/json')
+
+    def _post_macro(self):
+        # Mirrors handlePostMacro: base64 body, 4 KiB cap, must match the saved keymap
+        dev = self.server.device
+        slot = self._slot()
+        if slot is None:
+            return self._send(400, 'slot must be 1 or 2')
+        n = int(self.headers.get('Content-Length') or 0)
+        try:
+            blob = base64.b64decode(self.rfile.read(n).strip(), validate=True)
+            if len(blob) > 4096:
+                raise ValueError('too big')
+        except ValueError:
+            return self._send(400, 'Body must be a base64 blob of at most 4096 bytes')
+        try:
+            h, recs = macro_compiler.decode(blob)
+        except ValueError:
+            return self._send(400, 'Not a compiled macro')
+        with dev.lock:
+            if h != macro_compiler.keymap_hash(dev.config[f'keymap{slot}']):
+                return self._send(409, 'Blob was compiled from a different keymap')
+            dev.macros[slot] = blob
+        self._send(200, json.dumps({'ok': True, 'reports': len(recs), 'stored': True}),
+                   'application/json')
+
+    def _get_macro_text(self):
+        # Mirrors handleGetMacroText: blob and upload state, or a slice of the blob
+        dev = self.server.device
+        slot = self._slot()
+        if slot is None:
+            return self._send(400, 'slot must be 1 or 2')
+        q = parse_qs(urlsplit(self.path).query)
+        with dev.lock:
+            blob = dev.blobs.get(slot, b'')
+            up = dev.uploads.get(slot)
+            received = len(up[2]) if up else 0
+        if 'offset' not in q:
+            info = {'slot': slot, 'size': len(blob), 'hash': '%08x' % (macro_compiler.fnv1a(blob) if blob else 0),
+                    'upload': {'received': received, 'total': up[0] if up else 0,
+                               'hash': '%08x' % (up[1] if up else 0)}}
+            return self._send(200, json.dumps(info), 'application/json')
+        try:
+            offset = int(q['offset'][0])
+            length = min(int((q.get('length') or [MACRO_CHUNK_MAX])[0]), MACRO_CHUNK_MAX)
+        except ValueError:
+            return self._send(400, 'Bad offset or length')
+        if not blob:
+            return self._send(404, 'No macro blob for this slot')
+        if offset > len(blob):
+            return self._send(416, 'Offset past the end')
+        self._send(200, blob[offset:offset + length], 'text/plain; charset=utf-8')
+
+    def _post_macro_text(self):
+        # Mirrors handlePostMacroText: append at exactly the offset held, 409 otherwise
+        dev = self.server.device
+        slot = self._slot()
+        if slot is None:
+            return self._send(400, 'slot must be 1 or 2')
+        q = parse_qs(urlsplit(self.path).query)
+        try:
+            offset, total, digest = int(q['offset'][0]), int(q['total'][0]), int(q['hash'][0], 16)
+        except (KeyError, ValueError):
+            return self._send(400, 'offset, total and hash required')
+        chunk = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not 0 < total <= MACRO_BLOB_MAX or len(chunk) > MACRO_CHUNK_MAX:
+            return self._send(413, 'Macros up to 65536 bytes, in chunks of at most 4096')
+        if dev.flash_rate:
+            time.sleep(len(chunk) / dev.flash_rate)
+        with dev.lock:
+            if self._if_match_fails(dev):
+                return
+            if offset == 0:
+                dev.uploads[slot] = [total, digest, bytearray()]
+            up = dev.uploads.get(slot)
+            if up is None or up[:2] != [total, digest] or offset != len(up[2]):
+                have = len(up[2]) if up is not None and up[:2] == [total, digest] else 0
+                return self._send(409, json.dumps({'received': have}), 'application/json')
+            if offset + len(chunk) > total:
+                return self._send(400, 'Chunk runs past total')
+            up[2] += chunk
+            dev.chunks += 1
+            received = len(up[2])
+            if received == total:
+                del dev.uploads[slot]
+                if macro_compiler.fnv1a(up[2]) != digest:
+                    return self._send(422, 'Macro hash mismatch; upload it again')
+                dev.blobs[slot] = bytes(up[2])
+                dev.config[f'macro{slot}'] = ''
+            etag = dev.etag()
+            lost = dev.drop_replies > 0
+            if lost:
+                dev.drop_replies -= 1
+        if lost:
+            # Stored, but the connection drops before the reply
+            self.close_connection = True
+            return
+        self._send(200, json.dumps({'received': received, 'total': total, 'done': received == total}),
+                   'application/json', etag)
+
+    def do_DELETE(self):
+        dev = self.server.device
+        if urlsplit(self.path).path != '/macro/text':
+            return self._send(404, 'Not found')
+        slot = self._slot()
+        if slot is None:
+            return self._send(400, 'slot must be 1 or 2')
+        with dev.lock:
+            if self._if_match_fails(dev):
+                return
+            dev.uploads.pop(slot, None)
+            dev.drop_blob(slot)
+            etag = dev.etag()
+        self._send(200, json.dumps({'ok': True}), 'application/json', etag)
+
+    def do_POST(self):
+        dev = self.server.device
+        path = urlsplit(self.path).path
+        if path == '/macro':
+            return self._post_macro()
+        if path == '/macro/text':
+            return self._post_macro_text()
+        if path != '/config':
+            return self._send(404, 'Not found')
+        n = int(self.headers.get('Content-Length') or 0)
+        if n == 0:
+            return self._send(400, 'Body required')
+        try:
+            doc = json.loads(self.rfile.read(n))
+        except ValueError:
+            return self._send(400, 'Invalid JSON')
+        with dev.lock:
+            if self._if_match_fails(dev):
+                return
+            restart = dev.mode == 'ap'
+            if restart:
+                keys = ('wifi_ssid', 'wifi_pass')
+            else:
+                keys = ('macro1', 'macro2', 'action1', 'action2', 'keymap1', 'keymap2')
+                if any(len(str(doc.get(k, '')).encode('utf-8')) > INLINE_MACRO_MAX for k in ('macro1', 'macro2')):
+                    return self._send(413, 'Macros over 256 bytes are uploaded with POST /macro/text')
+            changed = [k for k in keys if k in doc and str(doc[k]) != dev.config[k]]
+            for k in changed:
+                dev.config[k] = str(doc[k])
+                if k.startswith('macro') and dev.config[k]:
+                    dev.drop_blob(int(k[-1]))  # a macro saved in the config replaces the blob
+            if changed:
+                dev.saves += 1
+                dev.field_writes += len(changed)
+            etag = dev.etag()
+        self._send(200, json.dumps({'ok': True, 'restart': restart}), 'application/json', etag)
+        if restart:
+            dev.restart()
+
+
+class _Server:
+    """A ThreadingHTTPServer run on a daemon thread; ``handler`` finds us as ``server.device``."""
+
+    def __init__(self, host, port, handler):
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.device = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return self.httpd.server_address[0]
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeDevice(_Server):
+    """One emulated macropad listening on ``host:port`` (port 0 picks a free one)."""
+
+    _macs = itertools.count(1)
+
+    def __init__(self, host='127.0.0.1', port=0, config=None, latency=0.0, connect_latency=0.0,
+                 mode='sta', reboot_delay=2.0, mac=None, flash_rate=0.0):
+        self.config = dict(DEFAULT_CONFIG, **(config or {}))
+        # WiFi.macAddress(): unique per emulated pad, locally administered range
+        n = next(self._macs)
+        self.mac = mac or f'02:00:00:{n >> 16 & 0xff:02X}:{n >> 8 & 0xff:02X}:{n & 0xff:02X}'
+        self.mode = mode  # 'sta' (joined WiFi) or 'ap' (captive portal)
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.reboot_delay = reboot_delay
+        self.connections = 0
+        self.saves = 0          # POSTs that changed something (one flash commit each)
+        self.field_writes = 0   # individual fields written to NVS
+        self.restarts = 0
+        self.macros = {}        # slot -> compiled keymap blob (POST /macro)
+        self.blobs = {}         # slot -> long text macro, UTF-8 (POST /macro/text)
+        self.uploads = {}       # slot -> [total, hash, bytes so far] of an upload in progress
+        self.chunks = 0         # /macro/text chunks stored
+        self.flash_rate = flash_rate  # bytes/s for writing chunks; 0 costs nothing
+        self.drop_replies = 0   # chunks still to store without replying
+        self._down_until = 0.0
+        self.lock = threading.Lock()
+        super().__init__(host, port, _Handler)
+
+    def restart(self):
+        """Go dark for ``reboot_delay`` seconds, then come back in the mode setup() picks."""
+        with self.lock:
+            # The sketch waits 500 ms after replying before ESP.restart()
+            self._down_until = time.monotonic() + 0.5 + self.reboot_delay
+            self.restarts += 1
+            self.mode = 'sta' if self.config['wifi_ssid'] else 'ap'
+            self.uploads.clear()  # upload state is in RAM; setup() removes the partial files
+
+    def drop_blob(self, slot):
+        """dropMacroBlob(): forget the slot's text macro blob. Call with ``lock`` held."""
+        self.blobs.pop(slot, None)
+
+    def etag(self):
+        blobs = {s: macro_compiler.fnv1a(b) for s, b in sorted(self.blobs.items())}
+        return '%08x' % zlib.crc32(json.dumps([self.config, blobs], sort_keys=True).encode())
+
+    def rebooting(self):
+        return time.monotonic() < self._down_until
+
+
+class _ReleaseHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeGitHub/1.0'
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, code, data=b'', ctype='application/octet-stream', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        return data
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+    def do_GET(self):
+        self._route(head=False)
+
+    def _route(self, head):
+        srv = self.server.device
+        with srv.lock:
+            srv.requests += 1
+        if srv.latency:
+            time.sleep(srv.latency)
+        path = self.path.split('?', 1)[0]
+        if path == f'/repos/{srv.repo}/releases/latest':
+            body = json.dumps(srv.release_json()).encode()
+            etag = '"%08x"' % zlib.crc32(body)
+            modified = formatdate(srv.published, usegmt=True)
+            validators = [('ETag', etag), ('Last-Modified', modified)]
+            inm = self.headers.get('If-None-Match')
+            ims = self.headers.get('If-Modified-Since')
+            if inm == etag or (not inm and ims == modified):
+                with srv.lock:
+                    srv.not_modified += 1
+                return self._reply(304, headers=validators)
+            data = self._reply(200, body, 'application/json', validators)
+            if not head:
+                self.wfile.write(data)
+            return
+        name = None
+        if path.startswith(f'/download/{srv.tag}/'):
+            name = path.rsplit('/', 1)[1]
+        elif path.startswith('/raw/'):
+            name = path[5:]
+        if name not in srv.assets:
+            data = self._reply(404, b'Not found', 'text/plain')
+            if not head:
+                self.wfile.write(data)
+            return
+        blob = srv.assets[name]
+        etag = '"%s"' % hashlib.sha256(blob).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return self._reply(304, headers=[('ETag', etag)])
+        start, end, code = 0, len(blob) - 1, 200
+        rng = self.headers.get('Range')
+        extra = [('ETag', etag), ('Accept-Ranges', 'bytes')]
+        if rng and rng.startswith('bytes='):
+            a, _, b = rng[6:].partition('-')
+            start = int(a) if a else max(0, len(blob) - int(b))
+            end = int(b) if a and b else len(blob) - 1
+            code = 206
+            extra.append(('Content-Range', f'bytes {start}-{end}/{len(blob)}'))
+        part = blob[start:end + 1]
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(part)))
+        for k, v in extra:
+            self.send_header(k, v)
+        self.end_headers()
+        if head:
+            return
+        step = 16 * 1024
+        t0 = time.monotonic()
+        for i in range(0, len(part), step):
+            self.wfile.write(part[i:i + step])
+            if srv.bandwidth:
+                ahead = (i + step) / srv.bandwidth - (time.monotonic() - t0)
+                if ahead > 0:
+                    time.sleep(ahead)
+        with srv.lock:
+            srv.bytes_sent += len(part)
+
+
+class FakeReleaseServer(_Server):
+    """Stand-in for the GitHub releases API and asset downloads.
+
+    Serves ``/repos/<repo>/releases/latest`` (with ETag and Last-Modified,
+    honouring If-None-Match and If-Modified-Since) and each asset at ``/download/<tag>/<name>`` and
+    ``/raw/<name>``, with ETag, Range and an optional per-connection
+    ``bandwidth`` cap in bytes/s. ``digests=False`` leaves out the per-asset
+    SHA-256 ``digest`` field, as older GitHub responses did.
+    """
+
+    def __init__(self, assets, tag='v1.0.0', repo='Archer2121/Macropad', host='127.0.0.1', port=0,
+                 latency=0.0, bandwidth=None, digests=True):
+        self.assets = dict(assets)
+        self.tag = tag
+        self.repo = repo
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.digests = digests
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.published = int(time.time())
+        self.lock = threading.Lock()
+        super().__init__(host, port, _ReleaseHandler)
+
+    def publish(self, tag, assets=None):
+        """Make ``tag`` (optionally with new ``assets``) the latest release."""
+        with self.lock:
+            self.tag = tag
+            if assets is not None:
+                self.assets = dict(assets)
+            self.published = int(time.time())
+
+    @property
+    def api_url(self):
+        return f'{self.url}/repos/{self.repo}/releases/latest'
+
+    def release_json(self):
+        assets = []
+        for name, blob in sorted(self.assets.items()):
+            a = {'name': name, 'size': len(blob),
+                 'browser_download_url': f'{self.url}/download/{self.tag}/{name}'}
+            if self.digests:
+                a['digest'] = 'sha256:' + hashlib.sha256(blob).hexdigest()
+            assets.append(a)
+        return {'tag_name': self.tag, 'name': self.tag, 'assets': assets}
+
+
+class PtyPort:
+    """A raw pseudo-terminal pair (POSIX only).
+
+    The emulated device reads and writes the master side; tools open
+    ``port`` with pyserial as if it were the device's CDC port.
+    """
+
+    def __init__(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(self.master, view)
+            view = view[n:]
+
+    def read(self, n=4096, timeout=None):
+        """Return up to ``n`` bytes written by the tool, or b'' after ``timeout``."""
+        r, _, _ = select.select([self.master], [], [], timeout)
+        if not r:
+            return b''
+        try:
+            return os.read(self.master, n)
+        except OSError:  # tool side closed
+            return b''
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _print_reports(text):
+    # Keyboard.print(): press then release each typable byte, modifiers with the key
+    out = []
+    for b in text:
+        usage = macro_compiler.ASCII.get(chr(b))
+        if usage is not None:
+            out += [macro_compiler.Report(macro_compiler.MOD_SHIFT if usage[1] else 0, usage[0], 0),
+                    macro_compiler.Report(0, 0, 0)]
+    return out
+
+
+class SerialDevice:
+    """The firmware's USB serial side on a pty: framed protocol plus text commands.
+
+    A loop thread stands in for ``loop()``: every ``tick`` seconds it takes
+    up to ``budget`` input bytes, runs them through the frame parser (text
+    outside frames is handled as command lines) and answers. Each config
+    save costs ``flash_write`` seconds and is counted in ``flash_writes``.
+    ``legacy=True`` models the old ``readStringUntil`` loop instead: one
+    blocking line per pass and no frames. ``drop`` discards that fraction of
+    incoming frames to exercise retransmission; ``drop_replies`` maps a
+    frame type to how many of its replies to lose after acting on the
+    request.
+
+    Text commands follow ``handleSerialLine`` (``help`` lists them); a line
+    over LINE_MAX bytes is refused, as is a framed SET of a macro over
+    INLINE_MACRO_MAX bytes. Pass a
+    FakeDevice as ``device`` to share its config, compiled macros and mode,
+    so ``reboot`` restarts it and ``wifi connect`` moves it to station mode.
+    ``test1``/``test2`` are logged in ``triggered`` as ``(slot, action,
+    reports, ms)`` once done. Text macros (inline or the device's blob) are
+    typed ``macro_slice`` characters per loop pass, as ``pumpMacro`` does, so
+    ``ms`` is the time from trigger to the last key; ``macro_slice=None``
+    types them in one blocking call like the old ``Keyboard.print``.
+    Keymaps always block the loop for as long as typing takes. ``hid``, a
+    writable binary file such as a FIFO, gets what the pad types as evdev
+    ``input_event`` records, for hid_profiler to read.
+    """
+
+    HELP = (
+        'Serial debug commands:',
+        '  help                : Show this help',
+        '  cfg                 : Print saved configuration',
+        '  macros              : Show macros',
+        '  set macro1 <text>   : Set macro for button 1 and save',
+        '  set macro2 <text>   : Set macro for button 2 and save',
+        '  set wifi <ssid> <pass> : Set WiFi credentials and save',
+        '  set wifi_ssid <ssid>   : Set saved WiFi SSID',
+        '  set wifi_pass <pass>   : Set saved WiFi password',
+        '  test1               : Trigger macro1 immediately',
+        '  test2               : Trigger macro2 immediately',
+        '  led [ap|connecting|connected|error|off] : Set status LED state',
+        '  status              : Print runtime status (WiFi, LED)',
+        '  reboot              : Restart the device',
+        '  wifi scan           : Scan nearby WiFi networks (shows SSID,RSSI,enc)',
+        '  wifi connect        : Try connecting to saved WiFi credentials',
+    )
+    LED_STATES = ('off', 'ap', 'connecting', 'connected', 'error')  # DeviceLEDState order
+    WL_CONNECTED, WL_DISCONNECTED = 3, 6
+    LINE_MAX = 255  # sizeof(rxLine) - 1
+
+    def __init__(self, config=None, tick=0.01, flash_write=0.03, budget=1024, legacy=False,
+                 drop=0.0, device=None, networks=None, report_ms=1.0, scan_time=2.0, connect_timeout=10.0,
+                 macro_slice=16, hid=None):
+        self.device = device
+        if device is not None:
+            config, self.lock = device.config, device.lock
+        else:
+            self.lock = threading.Lock()
+        self.config = config if config is not None else dict(DEFAULT_CONFIG)
+        self.tick = tick
+        self.flash_write = flash_write
+        self.budget = budget
+        self.legacy = legacy
+        self.drop = drop
+        # (ssid, rssi, open) as WiFi.scanNetworks() would report them
+        self.networks = list(networks if networks is not None else
+                             [('MacropadLab', -48, False), ('Guest', -71, True)])
+        self.report_ms = report_ms
+        self.scan_time = scan_time
+        self.connect_timeout = connect_timeout
+        self.macro_slice = macro_slice
+        self.hid = hid
+        self.pty = PtyPort()
+        self.port = self.pty.port
+        self.parser = serial_proto.FrameParser()
+        self.staged = {}
+        self.drop_replies = {}
+        self._last_commit = None  # (seq, want, changed) of the last COMMIT applied
+        self.flash_writes = 0
+        self.frames = 0
+        self.lines = 0
+        self.restarts = 0
+        self.triggered = []
+        self._playing = None  # [slot, text bytes, position, started] while a macro types
+        self.led = self.LED_STATES.index('ap' if self.mode == 'ap' else 'connected')
+        self._line = bytearray()
+        self._rng = random.Random(1)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def mode(self):
+        return self.device.mode if self.device is not None else 'sta'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='serial-device')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(1.0)
+        self.pty.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def println(self, text=''):
+        self.pty.write((text + '\r\n').encode())
+
+    def save(self, fields):
+        if not fields:
+            self.println('Config unchanged; skipping flash write')
+            return
+        time.sleep(self.flash_write)
+        self.flash_writes += 1
+        self.println('Config saved to LittleFS')
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            t0 = time.monotonic()
+            if self.legacy:
+                self._legacy_pass()
+            else:
+                data = self.pty.read(self.budget, timeout=0)
+                for item in self.parser.feed(data) if data else ():
+                    if isinstance(item, serial_proto.Frame):
+                        if self.drop and self._rng.random() < self.drop:
+                            continue
+                        self.frames += 1
+                        self._frame(item)
+                    else:
+                        self._text(item)
+                self._pump()
+            # loop() waits 1 ms instead of 10 while a macro is typing
+            rest = (0.001 if self._playing else self.tick) - (time.monotonic() - t0)
+            if rest > 0:
+                self._stopped.wait(rest)
+
+    def _legacy_pass(self):
+        # handleSerial(): readStringUntil('\n') blocks (1 s timeout) once anything arrived
+        if not self._line:
+            data = self.pty.read(1, timeout=0)
+            if not data:
+                return
+            self._line += data
+        deadline = time.monotonic() + 1.0
+        while b'\n' not in self._line and time.monotonic() < deadline:
+            self._line += self.pty.read(1, timeout=max(0, deadline - time.monotonic()))
+        line, _, rest = bytes(self._line).partition(b'\n')
+        self._line = bytearray(rest)
+        self._command(line.decode('utf-8', 'replace'))
+
+    def _text(self, data):
+        self._line += data
+        while b'\n' in self._line:
+            line, _, rest = bytes(self._line).partition(b'\n')
+            self._line = bytearray(rest)
+            # pollSerial() collects a line into a 256-byte buffer and refuses longer ones
+            if len(line) > self.LINE_MAX:
+                self.println(f'Command over {self.LINE_MAX} characters ignored')
+                continue
+            self._command(line.decode('utf-8', 'replace'))
+
+    def _command(self, line):
+        # Mirrors handleSerialLine(): the verb is case-insensitive, arguments are not
+        line = line.strip()
+        if not line:
+            return
+        self.lines += 1
+        self.println(f'CMD: {line}')
+        verb, _, arg = line.partition(' ')
+        verb = verb.lower()
+        cfg = self.config
+        if verb == 'help':
+            for text in self.HELP:
+                self.println(text)
+        elif verb == 'cfg':
+            self.println('--- Config ---')
+            self.println(f'WiFi SSID: {cfg["wifi_ssid"]}')
+            self.println(f'WiFi Pass: {"(hidden)" if cfg["wifi_pass"] else "(empty)"}')
+            self.println(f'Macro1: {cfg["macro1"]}')
+            self.println(f'Macro2: {cfg["macro2"]}')
+        elif verb == 'macros':
+            blobs = self.device.blobs if self.device is not None else {}
+            for slot in (1, 2):
+                if blobs.get(slot):
+                    self.println(f'Macro{slot}: ({len(blobs[slot])}-byte blob)')
+                else:
+                    self.println(f'Macro{slot}: {cfg[f"macro{slot}"]}')
+        elif verb == 'set':
+            self._set(arg)
+        elif verb == 'wifi':
+            arg = arg.strip()
+            if not arg:
+                self.println('Usage: wifi scan | wifi connect')
+            elif arg.startswith('scan'):
+                self._wifi_scan()
+            elif arg.startswith('connect'):
+                self.println('Attempting WiFi connect using saved credentials...')
+                self.println('Connected' if self._wifi_connect() else 'Connect failed')
+            else:
+                self.println("Unknown wifi command. Use 'wifi scan' or 'wifi connect'")
+        elif verb in ('test1', 'test2'):
+            slot = int(verb[-1])
+            self.println(f'Triggering macro{slot}')
+            self._execute(slot)
+        elif verb == 'led':
+            state = arg.lower()
+            if state in self.LED_STATES:
+                self.led = self.LED_STATES.index(state)
+            else:
+                self.println('Usage: led [ap|connecting|connected|error|off]')
+        elif verb == 'status':
+            connected = self.mode == 'sta'
+            self.println('--- Status ---')
+            self.println(f'WiFi status: {self.WL_CONNECTED if connected else self.WL_DISCONNECTED}')
+            if connected:
+                self.println(f'IP: {self.device.host if self.device is not None else "127.0.0.1"}')
+            self.println(f'LED state: {self.led}')
+        elif verb == 'reboot':
+            self.println('Rebooting...')
+            self.restarts += 1
+            self.staged = {}
+            if self.device is not None:
+                self.device.restart()
+            self.led = self.LED_STATES.index('ap' if self.mode == 'ap' else 'connected')
+        else:
+            self.println("Unknown command. Type 'help'.")
+
+    def _set(self, arg):
+        key, sep, value = arg.partition(' ')
+        if not sep:
+            self.println('Usage: set macro1 <text> | set wifi <ssid> <pass> | '
+                         'set wifi_ssid <ssid> | set wifi_pass <pass>')
+            return
+        if key == 'wifi':
+            # '<ssid> <pass>'; the password may contain spaces
+            ssid, _, password = value.partition(' ')
+            updates, done = {'wifi_ssid': ssid, 'wifi_pass': password}, 'WiFi credentials saved'
+        elif key in ('macro1', 'macro2', 'wifi_ssid', 'wifi_pass'):
+            updates, done = {key: value}, f'{key} saved'
+        else:
+            self.println('Unknown set key. Use macro1, macro2, wifi, wifi_ssid, or wifi_pass.')
+            return
+        with self.lock:
+            self.config.update(updates)
+            self._macros_saved(updates)
+        self.save(list(updates))
+        self.println(done)
+
+    def _macros_saved(self, names):
+        # saveConfigFields(): a macro saved in the config replaces the slot's blob
+        if self.device is None:
+            return
+        for slot in (1, 2):
+            if f'macro{slot}' in names and self.config[f'macro{slot}']:
+                self.device.drop_blob(slot)
+
+    def _wifi_scan(self):
+        self.println('Scanning WiFi networks...')
+        time.sleep(self.scan_time)  # scanNetworks() blocks the loop
+        if not self.networks:
+            self.println('No networks found')
+            return
+        for i, (ssid, rssi, is_open) in enumerate(self.networks, 1):
+            self.pty.write(f'{i}: {ssid} ({rssi} dBm) {"OPEN" if is_open else "SEC"}\n'.encode())
+
+    def _wifi_connect(self):
+        # attemptWiFiConnect(): polls every 250 ms, gives up after 10 s
+        ssid = self.config['wifi_ssid']
+        if not ssid:
+            return False
+        self.pty.write(f"Attempting WiFi connect to '{ssid}'...\n".encode())
+        self.led = self.LED_STATES.index('connecting')
+        if ssid in {n[0] for n in self.networks}:
+            time.sleep(0.25)
+            if self.device is not None:
+                with self.lock:
+                    self.device.mode = 'sta'
+            self.println(f'Connected. IP: {self.device.host if self.device is not None else "127.0.0.1"}')
+            self.led = self.LED_STATES.index('connected')
+            return True
+        time.sleep(self.connect_timeout)
+        self.println('WiFi connect attempt failed')
+        self.led = self.LED_STATES.index('error')
+        return False
+
+    def _execute(self, slot):
+        # executeAction(): types the macro, replays a valid compiled keymap, or
+        # parses the keymap into the same reports; the loop is blocked meanwhile
+        with self.lock:
+            action = self.config[f'action{slot}']
+            macro, keymap = self.config[f'macro{slot}'], self.config[f'keymap{slot}']
+            blob = self.device.macros.get(slot) if self.device is not None else None
+            text = self.device.blobs.get(slot) if self.device is not None else None
+        text = text or macro.encode('utf-8')
+        if action == 'disabled':
+            return
+        if action == 'macro' and self.macro_slice and not self.legacy:
+            if self._playing is not None:
+                self.println('Macro still playing; press ignored')
+            elif text:
+                self._playing = [slot, text, 0, time.monotonic()]
+            return
+        if action == 'keystroke':
+            if blob and macro_compiler.decode(blob)[0] == macro_compiler.keymap_hash(keymap):
+                action = 'compiled'
+            else:
+                # runKeymap(): parsed on the press into the reports its blob would hold
+                try:
+                    blob = macro_compiler.compile_keymap(keymap)
+                except macro_compiler.MacroSyntaxError as e:
+                    for err in e.errors:
+                        self.println(f'Keymap {slot}: {err}')
+                    self.println(f'Keymap {slot} has errors; nothing typed')
+                    blob = macro_compiler.encode([], keymap)
+            sim = macro_compiler.simulate_blob(blob, self.report_ms)
+            reports, ms = sim.reports, sim.ms
+            typed = macro_compiler.decode(blob)[1]
+        else:
+            # Keyboard.print: a press and a release report per character
+            reports = 2 * len(text)
+            ms = reports * self.report_ms
+            typed = _print_reports(text)
+        if self.hid is not None:
+            self._type(typed)
+        else:
+            time.sleep(ms / 1000)
+        self.triggered.append((slot, action, reports, ms))
+
+    def _type(self, reports):
+        # Hold each report report_ms past its own wait, writing its key events to ``hid``
+        import hid_profiler
+        for r, (batch, ms) in zip(reports, hid_profiler.report_batches(reports)):
+            if batch:
+                self.hid.write(hid_profiler.encode_events(time.monotonic(), batch))
+                self.hid.flush()
+            time.sleep((ms + (0 if r.key == macro_compiler.WAIT_KEY else self.report_ms)) / 1000)
+
+    def _pump(self):
+        # pumpMacro(): the next slice of the playing text macro
+        if self._playing is None:
+            return
+        slot, text, pos, started = self._playing
+        n = min(self.macro_slice, len(text) - pos)
+        if self.hid is not None:
+            self._type(_print_reports(text[pos:pos + n]))
+        else:
+            time.sleep(2 * n * self.report_ms / 1000)
+        if pos + n < len(text):
+            self._playing[2] = pos + n
+            return
+        self._playing = None
+        self.triggered.append((slot, 'macro', 2 * len(text), (time.monotonic() - started) * 1000))
+
+    def _reply(self, frame, status, data=b''):
+        if self.drop_replies.get(frame.type):
+            self.drop_replies[frame.type] -= 1
+            return
+        self.pty.write(serial_proto.encode_frame(frame.type | serial_proto.REPLY, frame.seq,
+                                                 bytes([status]) + data))
+
+    def _frame(self, f):
+        # Mirrors handleFrame() in the firmware
+        sp = serial_proto
+        if f.type == sp.PING:
+            return self._reply(f, sp.OK)
+        if f.type == sp.GET:
+            name = f.payload.decode('utf-8', 'replace')
+            if name not in self.config:
+                return self._reply(f, sp.UNKNOWN_FIELD)
+            return self._reply(f, sp.OK, self.config[name].encode())
+        if f.type == sp.GET_ALL:
+            with self.lock:
+                doc = dict(self.config)
+                for slot, text in (self.device.blobs if self.device is not None else {}).items():
+                    if text:
+                        doc[f'macro{slot}_blob'] = len(text)
+                body = json.dumps(doc).encode()
+            return self._reply(f, sp.OK, body)
+        if f.type == sp.SET:
+            name, sep, value = f.payload.partition(b'\0')
+            name = name.decode('utf-8', 'replace')
+            if not sep:
+                return self._reply(f, sp.BAD_REQUEST)
+            if name not in sp.FIELD_BITS:
+                return self._reply(f, sp.UNKNOWN_FIELD)
+            if name in ('macro1', 'macro2') and len(value) > INLINE_MACRO_MAX:
+                return self._reply(f, sp.TOO_LARGE)
+            self.staged[name] = value.decode('utf-8', 'replace')
+            return self._reply(f, sp.OK)
+        if f.type == sp.COMMIT:
+            want = struct.unpack('<H', f.payload[:2])[0] if len(f.payload) >= 2 else 0
+            have = 0
+            for name in self.staged:
+                have |= sp.FIELD_BITS[name]
+            if have & want != want:
+                last = self._last_commit
+                if last is not None and last[:2] == (f.seq, want):
+                    # Already applied; only the reply was lost
+                    return self._reply(f, sp.OK, struct.pack('<H', last[2]))
+                return self._reply(f, sp.INCOMPLETE, struct.pack('<H', have))
+            changed = 0
+            with self.lock:
+                for name, value in self.staged.items():
+                    if self.config[name] != value:
+                        self.config[name] = value
+                        changed |= sp.FIELD_BITS[name]
+                self._macros_saved([n for n in self.staged if changed & sp.FIELD_BITS[n]])
+            self.staged = {}
+            self._last_commit = (f.seq, want, changed)
+            self.save(changed)
+            return self._reply(f, sp.OK, struct.pack('<H', changed))
+        if f.type == sp.ABORT:
+            self.staged = {}
+            self._last_commit = None
+            return self._reply(f, sp.OK)
+        self._reply(f, sp.BAD_REQUEST)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Emulate a Lolin S3 macropad')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8080)
+    ap.add_argument('--latency', type=float, default=0.0, help='seconds added per request')
+    ap.add_argument('--connect-latency', type=float, default=0.0, help='seconds added per connection')
+    ap.add_argument('--mode', choices=('ap', 'sta'), default='sta')
+    ap.add_argument('--reboot-delay', type=float, default=2.0)
+    ap.add_argument('--serial', action='store_true', help='also expose the serial console on a pty')
+    args = ap.parse_args()
+    dev = FakeDevice(args.host, args.port, latency=args.latency, connect_latency=args.connect_latency,
+                     mode=args.mode, reboot_delay=args.reboot_delay)
+    print(f'Emulated device at {dev.url}')
+    console = SerialDevice(device=dev).start() if args.serial else None
+    if console:
+        print(f'Serial console at {console.port}')
+    try:
+        dev.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if console:
+            console.stop()
+
+
+if __name__ == '__main__':
+    main()
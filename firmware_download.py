@@ -0,0 +1,248 @@
+"""Parallel, hash-verified firmware downloads with a content-addressed cache.
+
+Release assets are fetched concurrently and streamed to disk in chunks while
+being hashed. When the expected SHA-256 is known (GitHub's per-asset
+``digest``, or a ``SHA256SUMS``/``manifest.json`` asset in the release) a
+mismatch is an error, and an asset already in the cache is not downloaded at
+all. Assets without a known hash are revalidated with ``If-None-Match``.
+
+Cache layout (``$MACROPAD_CACHE`` or ``~/.cache/macropad``)::
+
+    objects/ab/ab12...      one file per SHA-256
+    index.json              url -> {sha256, etag, size}
+
+    assets = assets_from_release(release_json, FILES)
+    paths = fetch_all(assets, on_progress=lambda done, total: ...)
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import metrics
+
+CHUNK = 64 * 1024
+
+Asset = namedtuple('Asset', 'name url sha256 size')
+Asset.__new__.__defaults__ = (None, None)
+
+
+class DownloadError(Exception):
+    """Raised when an asset is missing, can't be fetched, or fails verification."""
+
+
+def cache_dir():
+    d = os.environ.get('MACROPAD_CACHE')
+    if not d:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        d = os.path.join(base, 'macropad')
+    return d
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Cache:
+    """Content-addressed object store plus a url -> hash/ETag index."""
+
+    def __init__(self, root=None):
+        self.root = root or cache_dir()
+        self.objects = os.path.join(self.root, 'objects')
+        self.index_path = os.path.join(self.root, 'index.json')
+        self._lock = threading.Lock()
+        os.makedirs(self.objects, exist_ok=True)
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def path(self, sha):
+        return os.path.join(self.objects, sha[:2], sha)
+
+    def has(self, sha):
+        return bool(sha) and os.path.isfile(self.path(sha))
+
+    def add(self, tmp_path, sha):
+        """Move a verified temp file into the store; return its object path."""
+        dst = self.path(sha)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(tmp_path, dst)
+        return dst
+
+    def remember(self, url, sha, etag=None, size=None):
+        with self._lock:
+            self.index[url] = {'sha256': sha, 'etag': etag, 'size': size}
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(tmp, self.index_path)
+
+    def lookup(self, url):
+        e = self.index.get(url)
+        if e and self.has(e.get('sha256')):
+            return e
+        return None
+
+
+def _parse_sums(text):
+    # "<sha256>  <name>" lines, as written by sha256sum
+    out = {}
+    for line in text.splitlines():
+        parts = line.strip().split()
+        if len(parts) >= 2 and len(parts[0]) == 64:
+            out[parts[-1].lstrip('*')] = parts[0].lower()
+    return out
+
+
+def assets_from_release(release, names, session=None, timeout=15):
+    """Build the Asset list for ``names`` from a GitHub release JSON document.
+
+    Expected hashes come from each asset's ``digest`` field, falling back to a
+    ``SHA256SUMS`` or ``manifest.json`` asset ({"files": {name: {"sha256": ..}}}).
+    """
+    by_name = {a['name']: a for a in release.get('assets', [])}
+    missing = [n for n in names if n not in by_name]
+    if missing:
+        raise DownloadError(f'Missing {", ".join(missing)} in release')
+    sums = {}
+    if not all((by_name[n].get('digest') or '').startswith('sha256:') for n in names):
+        http = session or requests
+        try:
+            if 'SHA256SUMS' in by_name:
+                r = http.get(by_name['SHA256SUMS']['browser_download_url'], timeout=timeout)
+                r.raise_for_status()
+                sums = _parse_sums(r.text)
+            elif 'manifest.json' in by_name:
+                r = http.get(by_name['manifest.json']['browser_download_url'], timeout=timeout)
+                r.raise_for_status()
+                sums = {k: v.get('sha256') for k, v in r.json().get('files', {}).items()}
+        except (requests.RequestException, ValueError) as e:
+            raise DownloadError(f'Could not read release manifest: {e}')
+    out = []
+    for n in names:
+        a = by_name[n]
+        digest = a.get('digest') or ''
+        sha = digest[7:] if digest.startswith('sha256:') else sums.get(n)
+        out.append(Asset(n, a['browser_download_url'], sha.lower() if sha else None, a.get('size')))
+    return out
+
+
+class _Progress:
+    def __init__(self, total, cb):
+        self.total = total
+        self.done = 0
+        self.cb = cb
+        self.lock = threading.Lock()
+
+    def add(self, n=0, total=0):
+        if not self.cb:
+            return
+        with self.lock:
+            self.done += n
+            self.total += total
+            done, tot = self.done, self.total
+        self.cb(done, tot)
+
+
+def _download(asset, cache, session, timeout, progress):
+    entry = cache.lookup(asset.url)
+    headers = {}
+    if not asset.sha256 and entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    try:
+        r = session.get(asset.url, stream=True, timeout=timeout, headers=headers)
+    except requests.RequestException as e:
+        raise DownloadError(f'{asset.name}: {e}')
+    with r:
+        if r.status_code == 304 and entry:
+            progress.add(entry.get('size') or 0, 0 if asset.size else entry.get('size') or 0)
+            return cache.path(entry['sha256']), 0
+        if r.status_code != 200:
+            raise DownloadError(f'{asset.name}: HTTP {r.status_code}')
+        length = int(r.headers.get('Content-Length') or 0)
+        if not asset.size and length:
+            progress.add(0, length)
+        h = hashlib.sha256()
+        got = 0
+        fd, tmp = tempfile.mkstemp(dir=cache.root, prefix='.dl-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in r.iter_content(CHUNK):
+                    f.write(block)
+                    h.update(block)
+                    got += len(block)
+                    progress.add(len(block))
+            sha = h.hexdigest()
+            if asset.sha256 and sha != asset.sha256:
+                raise DownloadError(f'{asset.name}: SHA-256 mismatch (expected {asset.sha256}, got {sha})')
+            path = cache.add(tmp, sha)
+        except BaseException as e:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            if isinstance(e, requests.RequestException):
+                raise DownloadError(f'{asset.name}: {e}') from e
+            raise
+    cache.remember(asset.url, sha, r.headers.get('ETag'), got)
+    return path, got
+
+
+def _timed_download(asset, cache, session, timeout, progress):
+    with metrics.span('firmware_download', asset=asset.name):
+        path, got = _download(asset, cache, session, timeout, progress)
+    metrics.inc('firmware_download_bytes_total', got, asset=asset.name)
+    return path, got
+
+
+class FetchResult(dict):
+    """``{name: path}`` with a ``downloaded`` byte count."""
+    downloaded = 0
+
+
+def fetch_all(assets, cache=None, workers=4, timeout=(5, 30), on_progress=None, session=None):
+    """Download ``assets`` concurrently; return ``{name: path}`` of verified files.
+
+    Assets whose hash is already cached are not requested. ``on_progress`` is
+    called as ``(done_bytes, total_bytes)`` from worker threads. The returned
+    ``.downloaded`` attribute counts bytes actually transferred.
+    """
+    cache = cache or Cache()
+    total = sum(a.size or 0 for a in assets)
+    progress = _Progress(total, on_progress)
+    result = FetchResult()
+    todo = []
+    for a in assets:
+        if cache.has(a.sha256):
+            metrics.inc('firmware_cache_hits_total', asset=a.name)
+            result[a.name] = cache.path(a.sha256)
+            size = os.path.getsize(result[a.name])
+            progress.add(size, 0 if a.size else size)
+        else:
+            todo.append(a)
+    if not todo:
+        return result
+    own = session is None
+    session = session or requests.Session()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(todo))),
+                                thread_name_prefix='fw-dl') as pool:
+            futures = {a.name: pool.submit(_timed_download, a, cache, session, timeout, progress)
+                       for a in todo}
+            for name, f in futures.items():
+                path, got = f.result()
+                result[name] = path
+                result.downloaded += got
+    finally:
+        if own:
+            session.close()
+    return result
@@ -0,0 +1,249 @@
+"""Incremental esptool flashing with per-device flash history.
+
+A full ``erase-flash`` followed by writing every image wipes the LittleFS
+config and rewrites megabytes that usually haven't changed. ``flash()``
+instead writes only the regions whose image differs from what was last
+flashed to that device, as recorded in ``flash_history.json`` next to the
+firmware cache. It can also ask the chip itself (``verify-flash``, an MD5
+per region) when the history may be stale. A factory erase is opt-in.
+
+Devices are keyed by their USB serial number (the MAC on ESP32-S3 CDC), so
+the history follows a pad across port renumbering. A port without a serial
+number can't say which pad is on it, so its history is never trusted:
+regions are checked with ``verify-flash`` instead.
+
+The esptool command defaults to ``esptool``; ``$MACROPAD_ESPTOOL`` (or the
+``esptool`` argument) overrides it, e.g. with bench/fake_esptool.py.
+"""
+import json
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from firmware_download import cache_dir, sha256_file
+
+CHIP = 'esp32s3'
+FLASH_BAUD = '460800'
+
+FlashResult = namedtuple('FlashResult', 'written skipped erased phases')
+
+
+class FlashError(Exception):
+    """Raised when an esptool step fails."""
+
+
+def esptool_cmd(esptool=None):
+    if esptool:
+        return list(esptool) if not isinstance(esptool, str) else shlex.split(esptool)
+    return shlex.split(os.environ.get('MACROPAD_ESPTOOL', 'esptool'))
+
+
+def device_key(port):
+    """Stable identity for the device on ``port`` (USB serial number if known)."""
+    try:
+        import serial.tools.list_ports
+        for p in serial.tools.list_ports.comports():
+            if p.device == port and p.serial_number:
+                return f'usb:{p.serial_number}'
+    except ImportError:
+        pass
+    return f'port:{port}'
+
+
+class FlashHistory:
+    """``{device_key: {address: {"sha256", "size", "time"}}}`` persisted as JSON."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'flash_history.json')
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+
+    def get(self, key, addr):
+        return self.data.get(key, {}).get(_norm_addr(addr))
+
+    def record(self, key, images):
+        with self._lock:
+            regions = self.data.get(key, {})
+            for addr, path, sha in images:
+                regions[_norm_addr(addr)] = {'sha256': sha, 'size': os.path.getsize(path),
+                                             'time': round(time.time())}
+            self.data[key] = regions
+            self._save()
+
+    def forget(self, key, addrs=None):
+        """Drop what is known about ``key`` (only regions ``addrs`` if given), on disk too."""
+        with self._lock:
+            if addrs is None:
+                self.data.pop(key, None)
+            else:
+                regions = self.data.get(key, {})
+                for addr in addrs:
+                    regions.pop(_norm_addr(addr), None)
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def _norm_addr(addr):
+    return '0x%x' % int(str(addr), 0)
+
+
+def run_esptool(args, port, esptool=None, baud=None, on_output=None, after='hard-reset',
+                check=True):
+    """Run one esptool command, streaming output lines to ``on_output``; return the output.
+
+    With ``check`` a non-zero exit raises FlashError.
+    """
+    cmd = esptool_cmd(esptool) + ['--chip', CHIP, '--port', port]
+    if baud:
+        cmd += ['--baud', str(baud)]
+    cmd += ['--before', 'default-reset', '--after', after] + list(args)
+    with metrics.span('esptool', command=args[0] if args else None, port=port) as sp:
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    text=True, errors='replace', bufsize=1)
+        except OSError as e:
+            raise FlashError(f'Cannot run {cmd[0]}: {e}')
+        out = []
+        for line in proc.stdout:
+            out.append(line)
+            if on_output:
+                on_output(line)
+        if proc.wait() != 0 and check:
+            sp.fail(f'exit_{proc.returncode}')
+            raise FlashError(f'{" ".join(args[:1])} failed on {port} (exit {proc.returncode})')
+    return ''.join(out)
+
+
+_PROGRESS_RE = re.compile(r'\((\d+)\s*%\)|\s(\d+(?:\.\d+)?)%')
+
+
+def parse_progress(line):
+    """Percentage from an esptool "Writing at 0x... (42 %)" line, else None."""
+    if 'Writing at' not in line:
+        return None
+    m = _PROGRESS_RE.search(line)
+    if not m:
+        return None
+    return float(m.group(1) or m.group(2))
+
+
+_VERIFY_RE = re.compile(r'@\s*(0x[0-9a-fA-F]+).*?verify (OK|FAILED)', re.I)
+
+
+def verify_regions(port, images, esptool=None, on_output=None):
+    """Return the set of addresses whose flash contents already match the image."""
+    args = ['verify-flash']
+    for addr, path in images:
+        args += [addr, path]
+    # esptool exits non-zero when any region differs; the output still says which
+    out = run_esptool(args, port, esptool, on_output=on_output, after='no-reset', check=False)
+    ok = set()
+    for m in _VERIFY_RE.finditer(out):
+        if m.group(2).upper() == 'OK':
+            ok.add(_norm_addr(m.group(1)))
+    return ok
+
+
+_WROTE_RE = re.compile(r'Wrote \d+ bytes.*? at (0x[0-9a-fA-F]+)')
+
+
+def confirmed_writes(out):
+    """Addresses that write-flash output ``out`` reports as written and hash-verified."""
+    done, last = set(), None
+    for line in out.splitlines():
+        m = _WROTE_RE.search(line)
+        if m:
+            last = _norm_addr(m.group(1))
+        elif 'Hash of data verified' in line and last:
+            done.add(last)
+            last = None
+    return done
+
+
+def flash(port, images, erase=False, verify=False, esptool=None, baud=FLASH_BAUD,
+          history=None, on_output=None, on_plan=None):
+    """Flash ``images`` (``[(address, path), ...]``) to the device on ``port``.
+
+    Unless ``erase`` is set, regions whose image matches the device's flash
+    history (or, with ``verify`` or no USB serial number, the chip's own
+    MD5) are skipped. The history forgets each region before it is erased
+    or rewritten and learns its new hash once esptool confirms the write,
+    so a failed flash never leaves it vouching for a region. Returns a
+    FlashResult with the written and skipped addresses and per-phase seconds.
+    ``on_plan`` is called with the addresses about to be written.
+    """
+    history = history or FlashHistory()
+    key = device_key(port)
+    # Keyed by port only: another pad may have been plugged in since
+    known = not key.startswith('port:')
+    hashed = [(addr, path, sha256_file(path)) for addr, path in images]
+    phases = {}
+    same = set()
+    if erase:
+        if known:
+            history.forget(key)  # on disk before the chip is blank, in case a later step fails
+        t0 = time.monotonic()
+        run_esptool(['erase-flash'], port, esptool, on_output=on_output, after='no-reset')
+        phases['erase'] = time.monotonic() - t0
+        todo = hashed
+    else:
+        todo = [(a, p, s) for a, p, s in hashed
+                if not known or (history.get(key, a) or {}).get('sha256') != s]
+        if (verify or not known) and todo:
+            t0 = time.monotonic()
+            same = verify_regions(port, [(a, p) for a, p, _ in todo], esptool, on_output)
+            phases['verify'] = time.monotonic() - t0
+            todo = [(a, p, s) for a, p, s in todo if _norm_addr(a) not in same]
+
+    written = {a for a, _, _ in todo}
+    if on_plan:
+        on_plan([a for a, _, _ in todo])
+    if known:
+        # A write that fails half way leaves these regions neither old nor new: forget
+        # them first. Regions confirmed identical by verify-flash are as good as written.
+        history.forget(key, written)
+        if same:
+            history.record(key, [t for t in hashed if _norm_addr(t[0]) in same])
+    if todo:
+        t0 = time.monotonic()
+        args = ['write-flash']
+        for addr, path, _ in todo:
+            args += [addr, path]
+        out = []
+
+        def collect(line):
+            out.append(line)
+            if on_output:
+                on_output(line)
+
+        try:
+            run_esptool(args, port, esptool, baud=baud, on_output=collect)
+        except FlashError:
+            if known:
+                done = confirmed_writes(''.join(out))
+                history.record(key, [t for t in todo if _norm_addr(t[0]) in done])
+            raise
+        phases['write'] = time.monotonic() - t0
+        if known:
+            history.record(key, todo)
+    for phase, seconds in phases.items():
+        metrics.observe('flash_phase_seconds', seconds, phase=phase, port=port)
+    metrics.inc('flash_regions_total', len(written), port=port, result='written')
+    metrics.inc('flash_regions_total', len(hashed) - len(written), port=port, result='skipped')
+    return FlashResult([a for a, _, _ in hashed if a in written],
+                       [a for a, _, _ in hashed if a not in written], erase, phases)
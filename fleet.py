@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Fleet provisioning: push configs to many macropads in parallel.
+
+A manifest maps device addresses to configs, either as CSV (an ``address``
+column plus one column per /config field to send) or as JSON (a list of
+``{"address": ..., "config": {...}}`` objects, or an ``{address: config}``
+mapping). Each entry is POSTed through a worker pool; a per-host cap stops
+a burst of workers from piling onto one device. Results stream to a
+callback and end up in a JSON results file.
+
+Usage: python fleet.py manifest.csv [--workers 32] [--per-host 1] [--out results.json]
+                       [--metrics metrics.prom]
+"""
+import argparse
+import csv
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from urllib.parse import urlsplit
+
+import metrics
+from device_client import (CONFIG_FIELDS, DeviceClient, DeviceError, backoff_delay, normalize_base,
+                           wait_ready)
+
+
+@dataclass
+class PushResult:
+    address: str
+    ok: bool
+    attempts: int
+    latency: float  # seconds from first attempt to final outcome
+    error: str = ''
+    restart: bool = False  # device restarted to apply the config (AP mode)
+    ready_latency: float = None  # save-to-ready seconds; None if it never came back
+
+
+def load_manifest(path):
+    """Return a list of ``(address, config_dict)`` pairs from a CSV or JSON manifest."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            data = json.load(f)
+            if isinstance(data, dict):
+                items = list(data.items())
+            else:
+                items = [(e['address'], e.get('config', {})) for e in data]
+        else:
+            items = []
+            for row in csv.DictReader(f):
+                addr = (row.pop('address', None) or '').strip()
+                if addr:
+                    items.append((addr, row))
+    out = []
+    for addr, cfg in items:
+        unknown = set(cfg) - set(CONFIG_FIELDS)
+        if unknown:
+            raise ValueError(f'{path}: unknown config field(s) for {addr}: {", ".join(sorted(unknown))}')
+        out.append((addr, {k: '' if v is None else str(v) for k, v in cfg.items()}))
+    return out
+
+
+def _host(address):
+    # host:port, so emulated devices sharing an IP still count separately
+    return urlsplit(normalize_base(address)).netloc
+
+
+def push(entries, workers=32, per_host=1, retries=2, backoff=0.2, timeout=(1.0, 5.0),
+         ready_timeout=20.0, on_result=None):
+    """POST each ``(address, config)`` concurrently; return PushResults in input order.
+
+    ``on_result`` is called from a worker thread as each device finishes.
+    Rejections (HTTP 4xx) are not retried. Devices that restart to apply the
+    config are waited for up to ``ready_timeout`` seconds, without holding
+    their host's ``per_host`` slot, and fail if they don't come back.
+    """
+    host_caps = {}
+    for addr, _ in entries:
+        host_caps.setdefault(_host(addr), threading.BoundedSemaphore(per_host))
+
+    def one(addr, cfg):
+        client = DeviceClient(addr, timeout=timeout, pool_size=per_host)
+        cap = host_caps[_host(addr)]
+        t0 = time.monotonic()
+        attempts, err, saved = 0, '', None
+        try:
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(backoff_delay(attempt - 1, backoff))
+                attempts += 1
+                started = time.monotonic()
+                try:
+                    with cap:
+                        saved = client.save(cfg, wait=False)
+                    err = ''
+                    break
+                except DeviceError as e:
+                    err = str(e)
+                    if e.status is not None and e.status < 500:
+                        break
+            if saved is not None and saved.restart:
+                url = wait_ready([client.base], timeout=ready_timeout)
+                saved = replace(saved, ready_url=url, ready_latency=time.monotonic() - started)
+                if url:
+                    metrics.observe('save_to_ready_seconds', saved.ready_latency, device=client.base,
+                                    restart='true')
+                else:
+                    err = f'did not come back after restart (waited {ready_timeout:.0f} s)'
+        finally:
+            client.close()
+        res = PushResult(addr, not err, attempts, time.monotonic() - t0, err)
+        metrics.observe('fleet_push_seconds', res.latency, device=client.base)
+        if err:
+            lost = saved is not None and saved.restart and not saved.ready_url
+            metrics.inc('fleet_push_errors_total', device=client.base, reason='not_ready' if lost else 'failed')
+        if saved is not None:
+            res.restart = saved.restart
+            res.ready_latency = saved.ready_latency if saved.ready_url else None
+        if on_result:
+            on_result(res)
+        return res
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='fleet') as pool:
+        futures = [pool.submit(one, addr, cfg) for addr, cfg in entries]
+        return [f.result() for f in futures]
+
+
+def summarize(results, elapsed):
+    lat = sorted(r.latency for r in results if r.ok)
+    return {
+        'devices': len(results),
+        'ok': sum(r.ok for r in results),
+        'failed': sum(not r.ok for r in results),
+        'retries': sum(r.attempts - 1 for r in results),
+        'elapsed': round(elapsed, 4),
+        'throughput': round(len(results) / elapsed, 2) if elapsed else None,
+        'latency_p50': round(statistics.median(lat), 4) if lat else None,
+        'latency_p95': round(lat[int(0.95 * (len(lat) - 1))], 4) if lat else None,
+    }
+
+
+def write_results(path, results, elapsed, **meta):
+    doc = dict(meta, summary=summarize(results, elapsed), results=[asdict(r) for r in results])
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(doc, f, indent=2)
+    return doc
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Push configs to a fleet of Lolin S3 macropads')
+    ap.add_argument('manifest', help='CSV or JSON manifest of device addresses and configs')
+    ap.add_argument('--workers', type=int, default=32)
+    ap.add_argument('--per-host', type=int, default=1, help='max concurrent requests per host')
+    ap.add_argument('--retries', type=int, default=2)
+    ap.add_argument('--out', default='fleet_results.json')
+    ap.add_argument('--metrics', help='also write per-operation timings here (.json or Prometheus text)')
+    args = ap.parse_args()
+
+    entries = load_manifest(args.manifest)
+    out_lock = threading.Lock()
+
+    def show(r):
+        state = 'ok' if r.ok else f'FAILED {r.error}'
+        with out_lock:
+            print(f'{r.address}\t{r.latency * 1000:.0f} ms\tattempts={r.attempts}\t{state}', flush=True)
+
+    t0 = time.monotonic()
+    results = push(entries, workers=args.workers, per_host=args.per_host,
+                   retries=args.retries, on_result=show)
+    doc = write_results(args.out, results, time.monotonic() - t0, manifest=args.manifest,
+                        workers=args.workers, per_host=args.per_host)
+    s = doc['summary']
+    print(f"{s['ok']}/{s['devices']} ok, {s['failed']} failed in {s['elapsed']:.2f} s -> {args.out}")
+    if args.metrics:
+        metrics.write(args.metrics)
+    raise SystemExit(1 if s['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""Measure how fast and how faithfully a macropad types: a host-side HID profiler (Linux).
+
+The pad's keyboard interface is read straight from its evdev node
+(``/dev/input/eventN``), matched by USB vendor ID in sysfs and paired with
+its serial port by USB serial number. The node is grabbed while recording,
+so the keystrokes don't land in whatever window has focus. A run:
+
+1. reads the button's action and macro or keymap (framed serial, or
+   ``GET /config`` with ``url`` when the macro is a blob);
+2. sends ``test1``/``test2`` on the serial console and notes the time;
+3. records key and sync events until the pad has been quiet for ``idle``
+   seconds.
+
+The recording is an event log (a JSON document) that ``analyze`` turns
+into a Profile. Logs can be saved and analyzed again offline, on any OS:
+
+- throughput in strokes (characters) per second;
+- gaps between HID reports, and how many exceed ``stall`` seconds;
+- keys dropped, added or reordered relative to the configured macro;
+- autorepeats, a sign of a key held too long;
+- latency from the trigger command to the first keystroke.
+
+    log = record(slot=1)                  # the only pad attached
+    save_log(log, 'run1.json')
+    print(format_profile(analyze(load_log('run1.json'))))
+
+Usage: python hid_profiler.py list
+       python hid_profiler.py run [--slot 1] [--port /dev/ttyACM0] [--device /dev/input/event7]
+                                  [--url http://192.168.1.50] [--expect TEXT [--action keystroke]]
+                                  [--runs 3] [--out run.json]
+       python hid_profiler.py analyze run.json [...] [--stall-ms 20]
+"""
+import argparse
+import difflib
+import glob
+import json
+import os
+import select
+import statistics
+import struct
+import sys
+import time
+from collections import Counter, namedtuple
+
+import macro_compiler as mc
+import metrics
+from station import ESPRESSIF_VID
+
+LOG_FORMAT = 1
+EV_SYN, EV_KEY = 0, 1
+SYN_REPORT = 0
+# struct input_event: struct timeval, u16 type, u16 code, s32 value (native long size)
+INPUT_EVENT = struct.Struct('llHHi')
+EVIOCGRAB = 0x40044590      # _IOW('E', 0x90, int)
+EVIOCSCLOCKID = 0x400445A0  # _IOW('E', 0xa0, int): timestamp events with CLOCK_MONOTONIC
+CLOCK_MONOTONIC = 1
+KEY_A = 30
+
+# HID keyboard usage -> Linux key code, as the kernel's hid-input maps them
+HID_TO_EVDEV = dict(zip(range(0x04, 0x1E), (30, 48, 46, 32, 18, 33, 34, 35, 23, 36, 37, 38, 50, 49,
+                                            24, 25, 16, 19, 31, 20, 22, 47, 17, 45, 21, 44)))
+HID_TO_EVDEV.update(zip(range(0x1E, 0x28), range(2, 12)))            # 1-9, 0
+HID_TO_EVDEV.update(zip(range(0x28, 0x3A), (28, 1, 14, 15, 57, 12, 13, 26, 27, 43, 43, 39,
+                                            40, 41, 51, 52, 53, 58)))
+HID_TO_EVDEV.update(zip(range(0x3A, 0x46), (59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 87, 88)))  # F1-F12
+HID_TO_EVDEV.update(zip(range(0x46, 0x53), (99, 70, 119, 110, 102, 104, 111, 107, 109,
+                                            106, 105, 108, 103)))
+EVDEV_TO_HID = {code: usage for usage, code in sorted(HID_TO_EVDEV.items(), reverse=True)}
+# Modifier key codes (left and right) -> macro_compiler modifier bits
+MODIFIER_KEYS = {29: mc.MOD_CTRL, 97: mc.MOD_CTRL, 42: mc.MOD_SHIFT, 54: mc.MOD_SHIFT,
+                 56: mc.MOD_ALT, 100: mc.MOD_ALT, 125: mc.MOD_GUI, 126: mc.MOD_GUI}
+MODIFIER_CODES = {mc.MOD_CTRL: 29, mc.MOD_SHIFT: 42, mc.MOD_ALT: 56, mc.MOD_GUI: 125}
+
+InputDevice = namedtuple('InputDevice', 'path name vid pid serial_number')
+# Times in seconds; cps is strokes per second over first..last keystroke;
+# first_key is None without a trigger time; errors lists the first mismatches
+Profile = namedtuple('Profile', 'action expected strokes reports duration cps first_key '
+                                'gap_p50 gap_p95 gap_max stalls dropped extra reordered repeats '
+                                'untypable errors')
+
+
+class ProfilerError(Exception):
+    """Raised when no pad can be found, paired or triggered."""
+
+
+def _sysfs(path, default=''):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def _has_key(bitmap, code):
+    # capabilities/key: hex words, most significant first, one per unsigned long
+    words = bitmap.split()[::-1]
+    bits = struct.calcsize('l') * 8
+    i = code // bits
+    return i < len(words) and bool(int(words[i], 16) >> (code % bits) & 1)
+
+
+def find_keyboards(vid=ESPRESSIF_VID, sysfs='/sys/class/input'):
+    """Keyboard event nodes of USB devices with vendor ``vid`` (any vendor if None)."""
+    out = []
+    for node in sorted(glob.glob(os.path.join(sysfs, 'event*')), key=lambda p: int(p.rsplit('event', 1)[1])):
+        dev = os.path.join(node, 'device')
+        try:
+            v, p = int(_sysfs(f'{dev}/id/vendor', '0'), 16), int(_sysfs(f'{dev}/id/product', '0'), 16)
+        except ValueError:
+            continue
+        if vid is not None and v != vid:
+            continue
+        if not _has_key(_sysfs(f'{dev}/capabilities/key'), KEY_A):
+            continue  # consumer/system control collections, not the keyboard
+        out.append(InputDevice(f'/dev/input/{os.path.basename(node)}', _sysfs(f'{dev}/name'),
+                               v, p, _sysfs(f'{dev}/uniq') or None))
+    return out
+
+
+def pick_pad(port=None, device=None, vid=ESPRESSIF_VID):
+    """Return ``(serial port, event node)`` for one pad.
+
+    Either may be given; the other is found by matching USB serial numbers.
+    With neither, exactly one pad must be attached.
+    """
+    import hotplug
+    ports = list(hotplug.enumerate_ports(lambda p: p.vid == vid).values()) if vid is not None \
+        else list(hotplug.enumerate_ports(None).values())
+    keyboards = find_keyboards(vid)
+    if port is None and device is None:
+        if len(ports) != 1 or len(keyboards) != 1:
+            raise ProfilerError(f'found {len(ports)} pad serial port(s) and {len(keyboards)} keyboard(s); '
+                                f'pick one with --port/--device')
+        return ports[0].device, keyboards[0].path
+    if device is None:
+        sn = next((p.serial_number for p in ports if p.device == port), None)
+        match = [k for k in keyboards if sn and k.serial_number == sn]
+        if len(match) != 1:
+            raise ProfilerError(f'no keyboard with the serial number of {port} ({sn}); pass --device')
+        return port, match[0].path
+    if port is None:
+        sn = next((k.serial_number for k in keyboards if k.path == device), None)
+        match = [p for p in ports if sn and p.serial_number == sn]
+        if len(match) != 1:
+            raise ProfilerError(f'no serial port with the serial number of {device} ({sn}); pass --port')
+        return match[0].device, device
+    return port, device
+
+
+class EventCapture:
+    """Key and sync events from one evdev node, timestamped on the monotonic clock.
+
+    ``grab`` takes the device exclusively (EVIOCGRAB) so what it types
+    reaches only us. Anything else that yields ``input_event`` records, such
+    as a FIFO, can be read with ``grab=False``.
+    """
+
+    def __init__(self, path, grab=True):
+        import fcntl
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.grabbed = False
+        try:
+            fcntl.ioctl(self.fd, EVIOCSCLOCKID, struct.pack('i', CLOCK_MONOTONIC))
+        except OSError:
+            pass  # not an evdev node: its writer picks the clock
+        if grab:
+            try:
+                fcntl.ioctl(self.fd, EVIOCGRAB, 1)
+                self.grabbed = True
+            except OSError as e:
+                os.close(self.fd)
+                raise ProfilerError(f'cannot grab {path}: {e}')
+        self._buf = b''
+
+    def drain(self):
+        """Discard events already queued."""
+        self._events(0)
+
+    def read(self, idle=0.5, timeout=30.0):
+        """Events until ``idle`` seconds pass without a key event (after the first) or ``timeout``."""
+        out = []
+        deadline = time.monotonic() + timeout
+        last = None
+        while True:
+            now = time.monotonic()
+            wait = deadline - now if last is None else min(deadline, last + idle) - now
+            if wait <= 0:
+                return out
+            got = self._events(wait)
+            if any(e[1] == EV_KEY for e in got):
+                last = time.monotonic()
+            out.extend(got)
+
+    def _events(self, timeout):
+        out = []
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        while r:
+            try:
+                data = os.read(self.fd, INPUT_EVENT.size * 64)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self._buf += data
+            n = len(self._buf) - len(self._buf) % INPUT_EVENT.size
+            for sec, usec, etype, code, value in INPUT_EVENT.iter_unpack(self._buf[:n]):
+                if etype in (EV_SYN, EV_KEY):
+                    out.append([sec + usec / 1e6, etype, code, value])
+            self._buf = self._buf[n:]
+            r, _, _ = select.select([self.fd], [], [], 0)
+        return out
+
+    def close(self):
+        if self.grabbed:
+            import fcntl
+            try:
+                fcntl.ioctl(self.fd, EVIOCGRAB, 0)
+            except OSError:
+                pass
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_config(ser, url=None):
+    """The pad's config: over HTTP with ``url`` (includes blob macros), else framed serial."""
+    if url:
+        from device_client import DeviceClient
+        client = DeviceClient(url)
+        try:
+            return client.get_config().to_dict()
+        finally:
+            client.close()
+    from serial_proto import SerialTransport
+    with SerialTransport(ser, timeout=0.3) as t:
+        return t.get_all()
+
+
+def record(slot=1, port=None, device=None, url=None, expected=None, action=None, idle=0.5,
+           timeout=30.0, grab=True, ser=None):
+    """Trigger button ``slot`` over serial and record what the pad types; return the event log.
+
+    ``expected``/``action`` override what the pad's config says the button
+    does; an open ``ser`` is used instead of opening ``port``. Raises
+    ProfilerError for a blob text macro without ``url``, which the serial
+    console can't read back.
+    """
+    import serial
+    if device is None:
+        port, device = pick_pad(port or getattr(ser, 'port', None), device)
+    own = ser is None
+    ser = ser or serial.Serial(port, 115200, timeout=0.05)
+    try:
+        if expected is None or action is None:
+            cfg = read_config(ser, url)
+            action = action or cfg.get(f'action{slot}', 'macro')
+            if expected is None:
+                if action != 'keystroke' and cfg.get(f'macro{slot}_blob'):
+                    raise ProfilerError(f'button {slot} types a {cfg[f"macro{slot}_blob"]}-byte stored text '
+                                        f'macro the serial console can\'t read; pass --url (or --expect)')
+                expected = cfg.get(f'keymap{slot}' if action == 'keystroke' else f'macro{slot}', '')
+        with EventCapture(device, grab=grab) as cap:
+            cap.drain()
+            ser.reset_input_buffer()
+            trigger = time.monotonic()
+            ser.write(f'test{slot}\n'.encode())
+            events = cap.read(idle=idle, timeout=timeout)
+    finally:
+        if own:
+            ser.close()
+    log = {'format': LOG_FORMAT, 'device': device, 'port': getattr(ser, 'port', port), 'slot': slot,
+           'action': action, 'expected': expected, 'trigger': trigger, 'events': events}
+    keys = [e[0] for e in events if e[1] == EV_KEY]
+    if keys:
+        metrics.observe('hid_first_key_seconds', keys[0] - trigger, slot=str(slot))
+    return log
+
+
+def report_batches(reports):
+    """Evdev events for a run of macro_compiler Reports, as the kernel turns them into input.
+
+    Yields ``(batch, ms)``: the ``(type, code, value)`` changes the report
+    makes, ending in SYN_REPORT (empty for a wait or an unchanged report),
+    and how long it is held.
+    """
+    mods, key = 0, 0
+    for r in reports:
+        if r.key == mc.WAIT_KEY:
+            yield [], (r.mods << 8) | r.wait
+            continue
+        # Boot keyboard report: the modifier byte first, then releases before presses
+        batch = [(EV_KEY, code, 1 if r.mods & bit else 0) for bit, code in MODIFIER_CODES.items()
+                 if (mods ^ r.mods) & bit]
+        if r.key != key:
+            if key:
+                batch.append((EV_KEY, HID_TO_EVDEV[key], 0))
+            if r.key:
+                batch.append((EV_KEY, HID_TO_EVDEV[r.key], 1))
+        if batch:
+            batch.append((EV_SYN, SYN_REPORT, 0))
+        mods, key = r.mods, r.key
+        yield batch, r.wait
+
+
+def encode_events(t, batch):
+    """``input_event`` records for one batch stamped ``t`` (what an evdev node yields)."""
+    sec = int(t)
+    usec = int((t - sec) * 1e6)
+    return b''.join(INPUT_EVENT.pack(sec, usec, *e) for e in batch)
+
+
+def save_log(log, path):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(log, f)
+    os.replace(tmp, path)
+    return path
+
+
+def load_log(path):
+    with open(path, encoding='utf-8') as f:
+        log = json.load(f)
+    if log.get('format') != LOG_FORMAT:
+        raise ValueError(f'{path}: not a hid_profiler log (format {log.get("format")!r})')
+    return log
+
+
+def expected_strokes(action, expected):
+    """``(strokes, untypable)``: the key presses the configured macro should produce.
+
+    Text macros give one stroke per character the firmware can type (US
+    layout); keymaps are parsed like macro_compiler does.
+    """
+    if action == 'keystroke':
+        return [(s.mods, s.key) for s in mc.parse(expected) if isinstance(s, mc.Stroke)], 0
+    out, untypable = [], 0
+    for c in expected:
+        if c not in mc.ASCII:
+            untypable += 1
+            continue
+        usage, shift = mc.ASCII[c]
+        out.append((mc.MOD_SHIFT if shift else 0, usage))
+    return out, untypable
+
+
+def observed_strokes(events):
+    """``(strokes, stroke times, report times, repeats)`` from a log's events.
+
+    A stroke is a key press with the modifiers held once its report is in;
+    report times are the sync events that closed a report with key changes.
+    """
+    strokes, times, reports = [], [], []
+    mods, pending, changed, repeats = 0, [], False, 0
+    for t, etype, code, value in events:
+        if etype == EV_KEY:
+            if value == 2:
+                repeats += 1
+                continue
+            changed = True
+            bit = MODIFIER_KEYS.get(code)
+            if bit is not None:
+                mods = mods | bit if value else mods & ~bit
+            elif value == 1:
+                pending.append(code)
+        elif etype == EV_SYN and code == SYN_REPORT and changed:
+            for code in pending:
+                strokes.append((mods, EVDEV_TO_HID.get(code, 0x100 + code)))
+                times.append(t)
+            reports.append(t)
+            pending, changed = [], False
+    return strokes, times, reports, repeats
+
+
+def stroke_text(stroke):
+    """A stroke as keymap text: ``a``, ``A``, ``Ctrl+C``, ``Enter``."""
+    mods, usage = stroke
+    names = [n.title() for n, bit in (('ctrl', mc.MOD_CTRL), ('alt', mc.MOD_ALT), ('gui', mc.MOD_GUI))
+             if mods & bit]
+    shift = bool(mods & mc.MOD_SHIFT)
+    char = next((c for c, u in mc.ASCII.items() if u == (usage, shift) and c.isprintable() and c != ' '), None)
+    if char is None:
+        char = next((n.title() for n, u in mc.NAMED_KEYS.items() if u == usage), f'key{usage:#x}')
+        if shift:
+            names.append('Shift')
+    return '+'.join(names + [char])
+
+
+def analyze(log, stall=0.02, max_errors=10):
+    """Turn an event log into a Profile."""
+    action = log.get('action', 'macro')
+    want, untypable = expected_strokes(action, log.get('expected', ''))
+    got, times, reports, repeats = observed_strokes(log['events'])
+
+    dropped, extra, errors = Counter(), Counter(), []
+    sm = difflib.SequenceMatcher(None, want, got, autojunk=False)
+    for op, i1, i2, j1, j2 in sm.get_opcodes():
+        if op == 'equal':
+            continue
+        dropped.update(want[i1:i2])
+        extra.update(got[j1:j2])
+        if len(errors) < max_errors:
+            exp = ' '.join(map(stroke_text, want[i1:i2])) or '-'
+            obs = ' '.join(map(stroke_text, got[j1:j2])) or '-'
+            errors.append(f'at key {i1 + 1}: expected {exp}, typed {obs}')
+    # A key both missing in one place and extra in another was typed out of order
+    moved = dropped & extra
+    reordered = sum(moved.values())
+
+    gaps = [b - a for a, b in zip(reports, reports[1:])]
+    duration = times[-1] - times[0] if times else 0.0
+    trigger = log.get('trigger')
+    first = times[0] - trigger if times and trigger is not None else None
+    return Profile(
+        action=action, expected=len(want), strokes=len(got), reports=len(reports),
+        duration=duration, cps=(len(got) - 1) / duration if duration > 0 else None,
+        first_key=first,
+        gap_p50=statistics.median(gaps) if gaps else None,
+        gap_p95=sorted(gaps)[int(0.95 * (len(gaps) - 1))] if gaps else None,
+        gap_max=max(gaps) if gaps else None,
+        stalls=sum(g > stall for g in gaps),
+        dropped=sum(dropped.values()) - reordered, extra=sum(extra.values()) - reordered,
+        reordered=reordered, repeats=repeats, untypable=untypable, errors=errors)
+
+
+def format_profile(p, stall=0.02):
+    def ms(v):
+        return '-' if v is None else f'{v * 1000:.1f} ms'
+
+    lines = [
+        f'{p.action}: {p.strokes}/{p.expected} strokes in {p.reports} reports over {p.duration:.3f} s'
+        + (f' = {p.cps:.1f} strokes/s' if p.cps else ''),
+        f'  trigger -> first key {ms(p.first_key)}',
+        f'  report gaps p50 {ms(p.gap_p50)}  p95 {ms(p.gap_p95)}  max {ms(p.gap_max)}  '
+        f'over {stall * 1000:.0f} ms: {p.stalls}',
+        f'  dropped {p.dropped}  extra {p.extra}  reordered {p.reordered}  autorepeats {p.repeats}'
+        + (f'  (untypable chars skipped: {p.untypable})' if p.untypable else ''),
+    ]
+    lines += [f'  {e}' for e in p.errors]
+    return '\n'.join(lines)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Profile macro playback as the host sees it')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    sub.add_parser('list', help='pad keyboards and serial ports')
+    p = sub.add_parser('run', help='trigger a button and record what it types')
+    p.add_argument('--slot', type=int, choices=(1, 2), default=1)
+    p.add_argument('--port', help='serial console (default: paired with the keyboard)')
+    p.add_argument('--device', help='/dev/input/eventN (default: paired with the port)')
+    p.add_argument('--url', help='read the config over HTTP (needed for blob macros)')
+    p.add_argument('--expect', help='compare with this text/keymap instead of the config')
+    p.add_argument('--action', choices=('macro', 'keystroke'),
+                   help="read --expect as text or as a keymap (default: the button's action)")
+    p.add_argument('--runs', type=int, default=1)
+    p.add_argument('--idle', type=float, default=0.5, help='seconds of quiet that end a run')
+    p.add_argument('--timeout', type=float, default=30.0)
+    p.add_argument('--no-grab', action='store_true', help="don't take the keyboard exclusively")
+    p.add_argument('--out', help='save the event log here (run N of several gets -N)')
+    p.add_argument('--stall-ms', type=float, default=20)
+    p = sub.add_parser('analyze', help='profile saved event logs')
+    p.add_argument('logs', nargs='+')
+    p.add_argument('--stall-ms', type=float, default=20)
+    args = ap.parse_args()
+
+    if args.cmd == 'list':
+        import hotplug
+        for k in find_keyboards():
+            print(f'{k.path}\t{k.vid:04x}:{k.pid:04x}\t{k.serial_number or "-"}\t{k.name}')
+        for p in hotplug.enumerate_ports().values():
+            print(f'{p.device}\t{p.vid:04x}:{p.pid:04x}\t{p.serial_number or "-"}\t{p.description}')
+        return
+    stall = args.stall_ms / 1000
+    try:
+        if args.cmd == 'analyze':
+            for path in args.logs:
+                print(f'{path}: ' + format_profile(analyze(load_log(path), stall), stall))
+            return
+        port, device = pick_pad(args.port, args.device)
+        for n in range(1, args.runs + 1):
+            log = record(args.slot, port, device, url=args.url, expected=args.expect,
+                         action=args.action,
+                         idle=args.idle, timeout=args.timeout, grab=not args.no_grab)
+            if args.out:
+                root, ext = os.path.splitext(args.out)
+                save_log(log, f'{root}-{n}{ext}' if args.runs > 1 else args.out)
+            print(f'run {n}: ' + format_profile(analyze(log, stall), stall))
+    except (ProfilerError, OSError, ValueError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""USB hotplug watcher for ESP32-S3 macropads.
+
+On Linux the watcher listens for kernel uevents on a netlink socket. It
+sleeps in ``select()`` until a tty comes or goes, then re-enumerates the
+serial ports once. A pad shows up within the ``settle`` time after it is
+plugged in, and an idle watcher costs no CPU. Where netlink isn't
+available (other OSes, sandboxes), it polls ``comports()`` every
+``poll_interval`` seconds instead.
+
+Pads are identified by their USB serial number (the key ``flasher`` uses
+for flash history, ``usb:<serial>``), not their device path. When
+esptool's ``--after hard-reset`` makes the pad re-enumerate as
+/dev/ttyACM1 instead of /dev/ttyACM0, the watcher reports a ``remove``
+and then an ``add`` whose ``previous`` is the old path. ``wait_for(key,
+since=t)`` blocks until a given pad has been (re)attached after ``t`` and
+returns its new path.
+
+    def on_event(ev):                    # called on the watcher thread
+        print(ev.action, ev.port.device, ev.port.key, ev.previous)
+    watcher = HotplugWatcher(on_event).start()
+    t = time.monotonic(); flasher.flash(port, images)
+    port = watcher.wait_for('usb:F4:12:FA:00:11:22', since=t, timeout=10)
+
+Usage: python hotplug.py [--poll] [--all]
+"""
+import argparse
+import os
+import select
+import socket
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from station import ESPRESSIF_VID
+
+NETLINK_KOBJECT_UEVENT = 15
+RESYNC_INTERVAL = 30.0  # full re-enumeration even without events, in case one was lost
+
+UsbPort = namedtuple('UsbPort', 'device key serial_number vid pid description')
+# action: 'add' or 'remove'; previous: the pad's last path if it came back on a new one;
+# latency: seconds from the first uevent (or poll) to the event
+HotplugEvent = namedtuple('HotplugEvent', 'action port previous latency')
+
+
+def is_macropad(p):
+    return p.vid == ESPRESSIF_VID
+
+
+def enumerate_ports(match=is_macropad):
+    """Current serial ports passing ``match`` (all ports if None), keyed like flasher.device_key."""
+    import serial.tools.list_ports
+    out = {}
+    for p in serial.tools.list_ports.comports():
+        if match is not None and not match(p):
+            continue
+        key = f'usb:{p.serial_number}' if p.serial_number else f'port:{p.device}'
+        out[key] = UsbPort(p.device, key, p.serial_number, p.vid, p.pid, p.description)
+    return out
+
+
+def open_uevent_socket():
+    """A netlink socket receiving kernel uevents, or None where that isn't possible."""
+    if not hasattr(socket, 'AF_NETLINK'):
+        return None
+    try:
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        s.bind((0, 1))  # group 1: kernel events, so it works without udevd
+        return s
+    except OSError:
+        return None
+
+
+def parse_uevent(data):
+    """``add@/devices/...\\0ACTION=add\\0SUBSYSTEM=tty\\0...`` as a dict (None if malformed)."""
+    parts = data.split(b'\0')
+    if not parts or b'@' not in parts[0]:
+        return None  # udev's own re-broadcasts start with 'libudev'
+    env = {}
+    for item in parts[1:]:
+        k, sep, v = item.partition(b'=')
+        if sep:
+            env[k.decode('ascii', 'replace')] = v.decode('utf-8', 'replace')
+    return env
+
+
+class HotplugWatcher:
+    """Report pads arriving and leaving to ``on_event(HotplugEvent)`` from a background thread.
+
+    ``source`` replaces the netlink socket (anything with ``fileno`` and
+    ``recv``) and ``enumerate`` replaces ``enumerate_ports``; pass
+    ``poll=True`` to force polling.
+    """
+
+    def __init__(self, on_event=None, match=is_macropad, poll_interval=1.0, settle=0.05,
+                 poll=False, source=None, enumerate=None):
+        self.on_event = on_event
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.enumerate = enumerate or (lambda: enumerate_ports(match))
+        self.source = source if source is not None or poll else open_uevent_socket()
+        self.mode = 'uevent' if self.source is not None else 'poll'
+        self._ports = {}   # key -> UsbPort currently present
+        self._paths = {}   # key -> last device path, kept after removal
+        self._added = {}   # key -> time.monotonic() of its last arrival
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = None
+
+    def start(self):
+        self._scan(time.monotonic())
+        self._thread = threading.Thread(target=self._run, name='hotplug', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        os.write(self._wake_w, b'x')
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        for fd in (self._wake_r, self._wake_w):
+            os.close(fd)
+        if self.source is not None and hasattr(self.source, 'close'):
+            self.source.close()
+
+    def ports(self):
+        """``{key: UsbPort}`` for the pads present now."""
+        with self._cond:
+            return dict(self._ports)
+
+    def port_for(self, key):
+        """Current device path of pad ``key``, or None while it is absent."""
+        with self._cond:
+            p = self._ports.get(key)
+            return p.device if p else None
+
+    def wait_for(self, key, timeout=10.0, since=None):
+        """Block until pad ``key`` is present (and arrived after ``since``, a
+        ``time.monotonic()`` value); return its path, or None on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                p = self._ports.get(key)
+                if p is not None and (since is None or self._added.get(key, 0) > since):
+                    return p.device
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+
+    def _run(self):
+        if self.source is None:
+            while not self._stop.wait(self.poll_interval):
+                self._scan(time.monotonic())
+            return
+        last_scan = time.monotonic()
+        while not self._stop.is_set():
+            timeout = max(0.0, RESYNC_INTERVAL - (time.monotonic() - last_scan))
+            ready, _, _ = select.select([self.source, self._wake_r], [], [], timeout)
+            if self._stop.is_set():
+                break
+            if not ready:
+                self._scan(time.monotonic())
+                last_scan = time.monotonic()
+                continue
+            t0 = time.monotonic()
+            removed, added = self._collect()
+            if removed is None:
+                continue
+            self._scan(t0, removed, added)
+            last_scan = time.monotonic()
+
+    def _collect(self):
+        """Read a burst of uevents (one plug-in emits several); return tty devnames removed/added."""
+        removed, added, relevant = set(), set(), False
+        deadline = None
+        while True:
+            try:
+                env = parse_uevent(self.source.recv(65536))
+            except OSError:  # ENOBUFS: events were lost, a full rescan covers it
+                env, relevant = None, True
+            if env and env.get('SUBSYSTEM') in ('tty', 'usb'):
+                relevant = True
+                name = env.get('DEVNAME')
+                if env.get('SUBSYSTEM') == 'tty' and name:
+                    path = name if name.startswith('/') else '/dev/' + name
+                    (removed if env.get('ACTION') == 'remove' else added).add(path)
+            if not relevant:
+                return None, None
+            deadline = deadline or time.monotonic() + self.settle
+            left = deadline - time.monotonic()
+            if left <= 0 or not select.select([self.source], [], [], left)[0]:
+                return removed, added
+
+    def _scan(self, t0, removed=(), added=()):
+        now = self.enumerate()
+        # A tty announced as added may take a moment to be listed
+        retry_until = time.monotonic() + 1.0
+        while added and not added & {p.device for p in now.values()} \
+                and time.monotonic() < retry_until and not self._stop.is_set():
+            time.sleep(0.05)
+            now = self.enumerate()
+        events = []
+        with self._cond:
+            old = self._ports
+            for key, p in old.items():
+                # Gone, moved, or removed and re-added between two scans (a fast reset)
+                if key not in now or now[key].device != p.device or p.device in removed:
+                    events.append(('remove', p))
+            for key, p in now.items():
+                if key not in old or old[key].device != p.device or old[key].device in removed:
+                    events.append(('add', p))
+            self._ports = now
+            previous = dict(self._paths)
+            self._paths.update({k: p.device for k, p in now.items()})
+            arrived = time.monotonic()
+            self._added.update({p.key: arrived for action, p in events if action == 'add'})
+            self._cond.notify_all()
+        latency = time.monotonic() - t0
+        for action, p in events:
+            prev = previous.get(p.key) if action == 'add' else None
+            ev = HotplugEvent(action, p, prev if prev != p.device else None, latency)
+            metrics.inc('hotplug_events_total', action=action, source=self.mode)
+            if action == 'add':
+                metrics.observe('hotplug_attach_seconds', latency, source=self.mode)
+            if self.on_event:
+                self.on_event(ev)
+        return events
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Print macropads as they are plugged in and out')
+    ap.add_argument('--poll', action='store_true', help='poll instead of using netlink uevents')
+    ap.add_argument('--all', action='store_true', help='every serial port, not just Espressif ones')
+    args = ap.parse_args()
+
+    def show(ev):
+        moved = f' (was {ev.previous})' if ev.previous else ''
+        print(f'{ev.action:<6} {ev.port.device} {ev.port.key}{moved}  +{ev.latency * 1000:.0f} ms',
+              flush=True)
+
+    w = HotplugWatcher(show, match=None if args.all else is_macropad, poll=args.poll)
+    print(f'watching ({w.mode}); pads already present are listed as added')
+    w.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        w.stop()
+
+
+if __name__ == '__main__':
+    main()
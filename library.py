@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""Local macro and profile library in SQLite, with full-text search.
+
+Macros are named snippets: ``kind='macro'`` is text the pad types,
+``kind='keystroke'`` a keymap (see macro_compiler.py). Names, bodies and
+tags are indexed with FTS5, so a search is an index lookup however big the
+library grows. Every word typed is matched as a prefix (``ctrl+c`` finds
+``Ctrl+C Ctrl+V``). A profile is a saved set of ``/config`` fields. Applying it
+POSTs exactly that payload to one device or a whole fleet (via fleet.py),
+then uploads its keymaps compiled.
+
+Results come back a page at a time. ``search()`` returns a Page whose
+``cursor`` fetches the next one, so a UI only loads the rows it shows.
+With no query, rows are browsed by name with keyset pagination.
+
+    lib = Library()                       # <cache dir>/library.sqlite3
+    lib.add_macro('sig', 'Best regards, Jane')
+    page = lib.search('regards')
+    more = lib.search('regards', cursor=page.cursor)
+    lib.save_profile('office', {'action1': 'keystroke', 'keymap1': 'Ctrl+C'})
+    lib.apply_profile('office', ['192.168.1.50', '192.168.1.51'])
+
+Usage: python library.py search <words> | add <name> <body> [--kind keystroke]
+       | import <file.json|file.csv> | profile <name> key=value ... | apply <profile> <address>...
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from device_client import CONFIG_FIELDS
+from firmware_download import cache_dir
+
+KINDS = ('macro', 'keystroke')
+PAGE_SIZE = 200
+
+Macro = namedtuple('Macro', 'id name kind body tags updated')
+Profile = namedtuple('Profile', 'id name config updated')
+Page = namedtuple('Page', 'rows cursor')  # cursor is None on the last page
+
+# The presets old/conf.py used to hard-code; seeded into a new library
+DEFAULT_MACROS = [
+    ('Copy', 'CTRL+C', 'keystroke'), ('Paste', 'CTRL+V', 'keystroke'),
+    ('Cut', 'CTRL+X', 'keystroke'), ('Switch window', 'ALT+TAB', 'keystroke'),
+    ('Show desktop', 'WIN+D', 'keystroke'), ('Lock screen', 'WIN+L', 'keystroke'),
+    ('Task manager', 'CTRL+ALT+DEL', 'keystroke'),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS macros (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'macro',
+    body TEXT NOT NULL,
+    tags TEXT NOT NULL DEFAULT '',
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS macros_by_name ON macros (name COLLATE NOCASE, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS macros_fts USING fts5 (
+    name, body, tags, content='macros', content_rowid='id', prefix='1 2 3'
+);
+CREATE TRIGGER IF NOT EXISTS macros_ai AFTER INSERT ON macros BEGIN
+    INSERT INTO macros_fts (rowid, name, body, tags) VALUES (new.id, new.name, new.body, new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS macros_ad AFTER DELETE ON macros BEGIN
+    INSERT INTO macros_fts (macros_fts, rowid, name, body, tags)
+        VALUES ('delete', old.id, old.name, old.body, old.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS macros_au AFTER UPDATE ON macros BEGIN
+    INSERT INTO macros_fts (macros_fts, rowid, name, body, tags)
+        VALUES ('delete', old.id, old.name, old.body, old.tags);
+    INSERT INTO macros_fts (rowid, name, body, tags) VALUES (new.id, new.name, new.body, new.tags);
+END;
+CREATE TABLE IF NOT EXISTS profiles (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    config TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class LibraryError(Exception):
+    """Raised for unknown profiles, bad fields or malformed imports."""
+
+
+def fts_query(text):
+    """Turn user input into an FTS5 query: every word must match as a prefix."""
+    return ' '.join(f'"{w}"*' for w in re.findall(r'\w+', text))
+
+
+def _check_config(config):
+    unknown = set(config) - set(CONFIG_FIELDS)
+    if unknown:
+        raise LibraryError(f'unknown config field(s): {", ".join(sorted(unknown))}')
+    return {k: '' if v is None else str(v) for k, v in config.items()}
+
+
+class Library:
+    def __init__(self, path=None, seed=True):
+        self.path = path or os.path.join(cache_dir(), 'library.sqlite3')
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # Shared between the Tk thread and workers; the lock serialises access
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self._lock, self.db:
+            new = self.db.execute('PRAGMA user_version').fetchone()[0] == 0
+            self.db.executescript(SCHEMA)
+            self.db.execute('PRAGMA user_version = 1')
+        if new and seed:
+            self.add_macros(DEFAULT_MACROS)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---- macros ----
+
+    def add_macro(self, name, body, kind='macro', tags=''):
+        """Store a macro; return its id."""
+        if kind not in KINDS:
+            raise LibraryError(f'kind must be one of {", ".join(KINDS)}')
+        with self._lock, self.db:
+            cur = self.db.execute('INSERT INTO macros (name, kind, body, tags, updated) '
+                                  'VALUES (?, ?, ?, ?, ?)', (name, kind, body, tags, time.time()))
+        return cur.lastrowid
+
+    def add_macros(self, items):
+        """Bulk insert ``(name, body[, kind[, tags]])`` tuples in one transaction; return the count."""
+        now = time.time()
+        rows = []
+        for item in items:
+            item = tuple(item)
+            name, body, kind, tags = item + ('macro', '')[len(item) - 2:]
+            if kind not in KINDS:
+                raise LibraryError(f'{name}: kind must be one of {", ".join(KINDS)}')
+            rows.append((name, kind, body, tags or '', now))
+        with self._lock, self.db:
+            self.db.executemany('INSERT INTO macros (name, kind, body, tags, updated) '
+                                'VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def update_macro(self, macro_id, **fields):
+        bad = set(fields) - {'name', 'kind', 'body', 'tags'}
+        if bad:
+            raise LibraryError(f'cannot update {", ".join(sorted(bad))}')
+        if fields.get('kind', 'macro') not in KINDS:
+            raise LibraryError(f'kind must be one of {", ".join(KINDS)}')
+        sets = ', '.join(f'{k} = ?' for k in fields)
+        with self._lock, self.db:
+            self.db.execute(f'UPDATE macros SET {sets}, updated = ? WHERE id = ?',
+                            (*fields.values(), time.time(), macro_id))
+
+    def delete_macro(self, macro_id):
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM macros WHERE id = ?', (macro_id,))
+
+    def get_macro(self, macro_id):
+        with self._lock:
+            row = self.db.execute('SELECT id, name, kind, body, tags, updated FROM macros '
+                                  'WHERE id = ?', (macro_id,)).fetchone()
+        return Macro(*row) if row else None
+
+    def search(self, query='', limit=PAGE_SIZE, cursor=None, kind=None):
+        """One Page of macros matching ``query`` (best match first), or all by name.
+
+        Pass the returned ``cursor`` back to get the next page.
+        """
+        match = fts_query(query)
+        kind_sql, kind_args = ('AND m.kind = ?', (kind,)) if kind else ('', ())
+        with self._lock:
+            if match:
+                offset = cursor or 0
+                rows = self.db.execute(
+                    'SELECT m.id, m.name, m.kind, m.body, m.tags, m.updated '
+                    'FROM macros_fts JOIN macros m ON m.id = macros_fts.rowid '
+                    f'WHERE macros_fts MATCH ? {kind_sql} ORDER BY rank LIMIT ? OFFSET ?',
+                    (match, *kind_args, limit, offset)).fetchall()
+                nxt = offset + len(rows)
+            else:
+                # Keyset pagination: page N costs the same as page 1
+                after = cursor or ('', 0)
+                rows = self.db.execute(
+                    'SELECT m.id, m.name, m.kind, m.body, m.tags, m.updated FROM macros m '
+                    'WHERE m.name COLLATE NOCASE >= ? AND (m.name COLLATE NOCASE > ? OR m.id > ?) '
+                    f'{kind_sql} ORDER BY m.name COLLATE NOCASE, m.id LIMIT ?',
+                    (after[0], *after, *kind_args, limit)).fetchall()
+                nxt = (rows[-1][1], rows[-1][0]) if rows else None
+        return Page([Macro(*r) for r in rows], nxt if len(rows) == limit else None)
+
+    def count(self, query='', kind=None):
+        match = fts_query(query)
+        kind_sql, kind_args = ('AND m.kind = ?', (kind,)) if kind else ('', ())
+        with self._lock:
+            if match:
+                sql = ('SELECT count(*) FROM macros_fts JOIN macros m ON m.id = macros_fts.rowid '
+                       f'WHERE macros_fts MATCH ? {kind_sql}')
+                return self.db.execute(sql, (match, *kind_args)).fetchone()[0]
+            sql = f'SELECT count(*) FROM macros m WHERE 1 {kind_sql}'
+            return self.db.execute(sql, kind_args).fetchone()[0]
+
+    def import_file(self, path):
+        """Import macros from JSON (a list of {name, body, kind, tags}) or CSV with those columns."""
+        with open(path, newline='', encoding='utf-8') as f:
+            if path.lower().endswith('.json'):
+                data = json.load(f)
+                if not isinstance(data, list):
+                    raise LibraryError(f'{path}: expected a JSON list of macros')
+            else:
+                data = list(csv.DictReader(f))
+        try:
+            items = [(d['name'], d['body'], d.get('kind') or 'macro', d.get('tags') or '')
+                     for d in data]
+        except (KeyError, TypeError):
+            raise LibraryError(f'{path}: every macro needs a name and a body')
+        return self.add_macros(items)
+
+    # ---- profiles ----
+
+    def save_profile(self, name, config):
+        """Create or replace profile ``name`` with ``config`` (a dict of /config fields)."""
+        config = _check_config(config)
+        with self._lock, self.db:
+            self.db.execute('INSERT INTO profiles (name, config, updated) VALUES (?, ?, ?) '
+                            'ON CONFLICT(name) DO UPDATE SET config = excluded.config, '
+                            'updated = excluded.updated', (name, json.dumps(config), time.time()))
+
+    def get_profile(self, name):
+        with self._lock:
+            row = self.db.execute('SELECT id, name, config, updated FROM profiles WHERE name = ?',
+                                  (name,)).fetchone()
+        if not row:
+            raise LibraryError(f'no profile named {name!r}')
+        return Profile(row[0], row[1], json.loads(row[2]), row[3])
+
+    def profiles(self):
+        with self._lock:
+            rows = self.db.execute('SELECT id, name, config, updated FROM profiles '
+                                   'ORDER BY name COLLATE NOCASE').fetchall()
+        return [Profile(i, n, json.loads(c), u) for i, n, c, u in rows]
+
+    def delete_profile(self, name):
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM profiles WHERE name = ?', (name,))
+
+    def apply_profile(self, profile, addresses, **push_kw):
+        """POST a profile's fields to every address; return fleet PushResults.
+
+        ``profile`` is a name or a Profile; ``push_kw`` goes to ``fleet.push``.
+        Keymaps in the profile are then compiled and uploaded to each device
+        that took the config without restarting, as ``macropad_cli set``
+        does, so the pad replays them instead of parsing them on every press.
+        """
+        import fleet
+        if not isinstance(profile, Profile):
+            profile = self.get_profile(profile)
+        blobs = compiled_keymaps(profile.config)
+        on_result = push_kw.pop('on_result', None)
+
+        def finished(res):
+            # On the push worker that saved this device
+            if blobs and res.ok and not res.restart:
+                upload_keymaps(res.address, blobs)
+            if on_result:
+                on_result(res)
+
+        return fleet.push([(a, dict(profile.config)) for a in addresses], on_result=finished, **push_kw)
+
+
+def compiled_keymaps(config):
+    """``{slot: blob}`` for the keystroke keymaps in ``config`` that compile."""
+    import macro_compiler
+    out = {}
+    for slot in (1, 2):
+        keymap = config.get(f'keymap{slot}')
+        if not keymap or config.get(f'action{slot}', 'keystroke') != 'keystroke':
+            continue
+        try:
+            out[slot] = macro_compiler.compile_keymap(keymap)
+        except macro_compiler.MacroSyntaxError:
+            pass  # the pad types nothing for it either way
+    return out
+
+
+def upload_keymaps(address, blobs):
+    """Upload compiled keymaps the device doesn't already hold; return the slots uploaded.
+
+    Best effort: a device that refuses keeps parsing the keymap itself.
+    """
+    import metrics
+    from device_client import DeviceClient, DeviceError
+    client = DeviceClient(address)
+    done = []
+    try:
+        for slot, blob in blobs.items():
+            try:
+                if not client.macro_info(slot).get('valid'):
+                    client.upload_macro(slot, blob)
+                    done.append(slot)
+            except DeviceError as e:
+                if e.status == 404:  # firmware without /macro
+                    break
+                metrics.inc('keymap_upload_errors_total', device=client.base)
+    finally:
+        client.close()
+    return done
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Macro and profile library')
+    ap.add_argument('--db', help='library file (default: in the cache directory)')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('search')
+    p.add_argument('words', nargs='*')
+    p.add_argument('--kind', choices=KINDS)
+    p.add_argument('--limit', type=int, default=20)
+    p = sub.add_parser('add')
+    p.add_argument('name')
+    p.add_argument('body')
+    p.add_argument('--kind', choices=KINDS, default='macro')
+    p.add_argument('--tags', default='')
+    p = sub.add_parser('import')
+    p.add_argument('file')
+    p = sub.add_parser('profile', help='save a profile from key=value fields')
+    p.add_argument('name')
+    p.add_argument('fields', nargs='+', metavar='key=value')
+    p = sub.add_parser('apply', help='apply a profile to devices')
+    p.add_argument('name')
+    p.add_argument('addresses', nargs='+')
+    args = ap.parse_args()
+
+    try:
+        with Library(args.db) as lib:
+            if args.cmd == 'search':
+                query = ' '.join(args.words)
+                t0 = time.perf_counter()
+                page = lib.search(query, limit=args.limit, kind=args.kind)
+                dt = time.perf_counter() - t0
+                for m in page.rows:
+                    print(f'{m.id}\t{m.kind}\t{m.name}\t{m.body}')
+                print(f'{lib.count(query, args.kind)} match(es), first page in {dt * 1000:.1f} ms')
+            elif args.cmd == 'add':
+                print(lib.add_macro(args.name, args.body, args.kind, args.tags))
+            elif args.cmd == 'import':
+                print(f'imported {lib.import_file(args.file)} macro(s)')
+            elif args.cmd == 'profile':
+                lib.save_profile(args.name, dict(f.split('=', 1) for f in args.fields if '=' in f))
+            elif args.cmd == 'apply':
+                failed = 0
+                for r in lib.apply_profile(args.name, args.addresses):
+                    failed += not r.ok
+                    print(f'{r.address}\t{"ok" if r.ok else "FAILED " + r.error}')
+                raise SystemExit(1 if failed else 0)
+    except LibraryError as e:
+        raise SystemExit(f'error: {e}')
+
+
+if __name__ == '__main__':
+    main()
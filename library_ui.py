@@ -0,0 +1,244 @@
+"""Tk window for the macro and profile library (library.py).
+
+Typing in the search box filters the list after a short pause. The list
+fetches one page at a time and loads the next page when you scroll near
+the end, so a library of tens of thousands of macros opens as fast as
+an empty one. The selected macro can go on Button 1 or 2. Profiles can be
+saved from the main form, applied to the current device, or applied to
+many devices at once.
+
+``open_window(app)`` expects the configurator App: it calls
+``use_macro``, ``form_config``, ``apply_profile``, ``known_devices`` and
+``set_status`` on it, and runs fleet applies on its ``ui`` dispatcher.
+"""
+import re
+import tkinter as tk
+from tkinter import filedialog, messagebox, simpledialog, ttk
+
+from library import KINDS, PAGE_SIZE, Library, LibraryError
+
+COLUMNS = (('name', 'Name', 180), ('kind', 'Kind', 80), ('body', 'Body', 300), ('tags', 'Tags', 120))
+SEARCH_DELAY_MS = 150
+
+
+def _one_line(text, width=80):
+    text = ' '.join(text.split())
+    return text if len(text) <= width else text[:width - 1] + '…'
+
+
+class LibraryPanel(ttk.Frame):
+    def __init__(self, master, app, library):
+        super().__init__(master)
+        self.app = app
+        self.lib = library
+        self._cursor = None   # next page of the current search, None when all loaded
+        self._pending = None  # after() id of the debounced search
+        self._macros = {}     # iid -> Macro for the loaded rows
+
+        bar = ttk.Frame(self)
+        bar.pack(fill='x', pady=4)
+        ttk.Label(bar, text='Search').pack(side='left')
+        self.query = tk.StringVar()
+        entry = ttk.Entry(bar, textvariable=self.query, width=40)
+        entry.pack(side='left', padx=5)
+        entry.focus_set()
+        self.kind = ttk.Combobox(bar, values=('all',) + KINDS, width=10, state='readonly')
+        self.kind.set('all')
+        self.kind.pack(side='left')
+        self.found = ttk.Label(bar, text='')
+        self.found.pack(side='left', padx=10)
+        self.query.trace_add('write', lambda *_: self._schedule_search())
+        self.kind.bind('<<ComboboxSelected>>', lambda e: self.search())
+
+        body = ttk.Frame(self)
+        body.pack(fill='both', expand=True)
+        self.tree = ttk.Treeview(body, columns=[c for c, _, _ in COLUMNS], show='headings', height=16)
+        for col, title, width in COLUMNS:
+            self.tree.heading(col, text=title)
+            self.tree.column(col, width=width, anchor='w')
+        self.scroll = ttk.Scrollbar(body, orient='vertical', command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self._on_scroll)
+        self.tree.pack(side='left', fill='both', expand=True)
+        self.scroll.pack(side='right', fill='y')
+        self.tree.bind('<Double-1>', lambda e: self.use(1))
+
+        actions = ttk.Frame(self)
+        actions.pack(fill='x', pady=4)
+        ttk.Button(actions, text='Use for Button 1', command=lambda: self.use(1)).pack(side='left')
+        ttk.Button(actions, text='Use for Button 2', command=lambda: self.use(2)).pack(side='left', padx=5)
+        ttk.Button(actions, text='Add...', command=self.add).pack(side='left')
+        ttk.Button(actions, text='Delete', command=self.delete).pack(side='left', padx=5)
+        ttk.Button(actions, text='Import...', command=self.import_file).pack(side='left')
+
+        prof = ttk.LabelFrame(self, text='Profiles')
+        prof.pack(fill='x', pady=4)
+        self.profile = ttk.Combobox(prof, width=30, state='readonly')
+        self.profile.pack(side='left', padx=5, pady=5)
+        ttk.Button(prof, text='Save current as...', command=self.save_profile).pack(side='left')
+        ttk.Button(prof, text='Apply to device', command=self.apply_here).pack(side='left', padx=5)
+        ttk.Button(prof, text='Apply to fleet...', command=self.apply_fleet).pack(side='left')
+        ttk.Button(prof, text='Delete', command=self.delete_profile).pack(side='left', padx=5)
+
+        self.refresh_profiles()
+        self.search()
+
+    # ---- macro list ----
+
+    def _schedule_search(self):
+        if self._pending is not None:
+            self.after_cancel(self._pending)
+        self._pending = self.after(SEARCH_DELAY_MS, self.search)
+
+    def _kind(self):
+        return None if self.kind.get() == 'all' else self.kind.get()
+
+    def search(self):
+        self._pending = None
+        children = self.tree.get_children()
+        if children:
+            self.tree.delete(*children)
+        self._macros.clear()
+        self._cursor = None
+        query, kind = self.query.get(), self._kind()
+        self._load(self.lib.search(query, PAGE_SIZE, kind=kind))
+        self.found.config(text=f'{self.lib.count(query, kind)} macro(s)')
+
+    def _load(self, page):
+        for m in page.rows:
+            iid = str(m.id)
+            self._macros[iid] = m
+            self.tree.insert('', 'end', iid=iid, values=(m.name, m.kind, _one_line(m.body), m.tags))
+        self._cursor = page.cursor
+
+    def _on_scroll(self, first, last):
+        self.scroll.set(first, last)
+        # Near the bottom of what is loaded: fetch the next page
+        if self._cursor is not None and float(last) > 0.9:
+            cursor, self._cursor = self._cursor, None
+            self._load(self.lib.search(self.query.get(), PAGE_SIZE, cursor=cursor, kind=self._kind()))
+
+    def selected(self):
+        sel = self.tree.selection()
+        return self._macros.get(sel[0]) if sel else None
+
+    def use(self, slot):
+        m = self.selected()
+        if m is not None:
+            self.app.use_macro(slot, m)
+
+    def add(self):
+        name = simpledialog.askstring('Add macro', 'Name:', parent=self)
+        if not name:
+            return
+        kind = self._kind() or 'macro'
+        prompt = 'Keymap (e.g. CTRL+C):' if kind == 'keystroke' else 'Text to type:'
+        body = simpledialog.askstring('Add macro', prompt, parent=self)
+        if body:
+            self.lib.add_macro(name, body, kind)
+            self.search()
+
+    def delete(self):
+        m = self.selected()
+        if m is not None and messagebox.askyesno('Delete', f'Delete macro {m.name!r}?', parent=self):
+            self.lib.delete_macro(m.id)
+            self.tree.delete(str(m.id))
+            self._macros.pop(str(m.id), None)
+
+    def import_file(self):
+        path = filedialog.askopenfilename(parent=self, title='Import macros',
+                                          filetypes=[('Macros', '*.json *.csv'), ('All files', '*')])
+        if not path:
+            return
+        try:
+            n = self.lib.import_file(path)
+        except (OSError, ValueError, LibraryError) as e:
+            messagebox.showerror('Import failed', str(e), parent=self)
+            return
+        self.app.set_status(f'Imported {n} macro(s)')
+        self.search()
+
+    # ---- profiles ----
+
+    def refresh_profiles(self):
+        names = [p.name for p in self.lib.profiles()]
+        self.profile.configure(values=names)
+        if self.profile.get() not in names:
+            self.profile.set(names[0] if names else '')
+
+    def _profile(self):
+        name = self.profile.get()
+        if not name:
+            messagebox.showinfo('Profiles', 'Save a profile first', parent=self)
+            return None
+        try:
+            return self.lib.get_profile(name)
+        except LibraryError as e:
+            messagebox.showerror('Profiles', str(e), parent=self)
+            self.refresh_profiles()
+            return None
+
+    def save_profile(self):
+        name = simpledialog.askstring('Save profile', 'Profile name:', parent=self,
+                                      initialvalue=self.profile.get())
+        if not name:
+            return
+        self.lib.save_profile(name, self.app.form_config())
+        self.refresh_profiles()
+        self.profile.set(name)
+        self.app.set_status(f'Profile {name!r} saved')
+
+    def delete_profile(self):
+        name = self.profile.get()
+        if name and messagebox.askyesno('Delete', f'Delete profile {name!r}?', parent=self):
+            self.lib.delete_profile(name)
+            self.refresh_profiles()
+
+    def apply_here(self):
+        p = self._profile()
+        if p is not None:
+            self.app.apply_profile(p)
+
+    def apply_fleet(self):
+        p = self._profile()
+        if p is None:
+            return
+        text = simpledialog.askstring('Apply to fleet', 'Device addresses (comma or space separated):',
+                                      parent=self, initialvalue=', '.join(self.app.known_devices()))
+        addresses = [a for a in re.split(r'[\s,]+', text or '') if a]
+        if not addresses:
+            return
+        done = []
+
+        def progress(r):
+            done.append(r)
+            failed = sum(not r.ok for r in done)
+            self.app.set_status(f'Profile {p.name}: {len(done)}/{len(addresses)} done, {failed} failed')
+
+        def finished(results):
+            failed = [r for r in results if not r.ok]
+            self.app.set_status(f'Profile {p.name}: {len(results) - len(failed)}/{len(results)} ok')
+            if failed:
+                messagebox.showwarning('Apply to fleet', '\n'.join(f'{r.address}: {r.error}' for r in failed))
+
+        self.app.set_status(f'Profile {p.name}: applying to {len(addresses)} device(s)...')
+        self.app.ui.submit(self.lib.apply_profile, p, addresses,
+                           on_result=lambda r: self.app.ui.call(progress, r), on_done=finished)
+
+_window = None
+_library = None
+
+
+def open_window(app, library=None):
+    """Show the library window (one per application)."""
+    global _window, _library
+    if _window is not None and _window.winfo_exists():
+        _window.deiconify()
+        _window.lift()
+        return _window
+    if library is None:
+        _library = _library or Library()
+        library = _library
+    _window = tk.Toplevel(app)
+    _window.title('Macro library')
+    LibraryPanel(_window, app, library).pack(fill='both', expand=True, padx=6, pady=6)
+    return _window
@@ -2,25 +2,59 @@
 """Lolin S3 Configurator — improved interface for the sketch.
 
 Features added:
-- Auto-discover common AP IPs (tries 192.168.4.1 and lolin.local)
+- Auto-discover devices: probes 192.168.4.1, lolin.local and every host on
+  the local subnets concurrently (see discovery.py)
 - Fetch and display current configuration
-- Save configuration and wait/poll for device to reboot
+- Save configuration; only wait for the device when it actually restarts
+  (AP/setup mode), probing candidates concurrently with backoff
+- Saves send only the fields changed since the last fetch, and refuse to
+  overwrite edits made on the device in the meantime
+- Fleet mode: push a CSV/JSON manifest of configs to many devices (see fleet.py)
+- Keystroke keymaps are validated and uploaded precompiled to HID reports
+  (see macro_compiler.py)
 - Simple status messages in UI
+- Diagnostics window: per-operation and per-device latency histograms and
+  error counts, exportable as Prometheus text or JSON (see metrics.py)
+- Macro and profile library: full-text search over saved macros, one-click
+  profile apply to this device or a fleet (see library.py)
+- Remembers devices by MAC: reconnects to the last-used pad on startup in
+  one round trip and monitors every known pad's liveness in the background
+  (see device_registry.py)
+- Scripting without the GUI: discover/get/set/diff/wait-ready with JSON
+  output (see macropad_cli.py)
+- Never blocks the UI: network work runs on workers and results come back
+  through the Tk thread; a watchdog logs (and profiles) any event-loop stall
+  over 100 ms (see ui_dispatch.py)
 
 Usage: python Macropad/lolin_configurator.py
 Requires: requests
 """
 import tkinter as tk
-from tkinter import messagebox
+from tkinter import filedialog, messagebox
 import threading
 import time
-import requests
+from dataclasses import replace
+
+import diagnostics
+import discovery
+import fleet
+import library_ui
+import metrics
+import macro_compiler
+from device_client import (AP_BASE, ConflictError, DeviceConfig, DeviceError, get_client, normalize_base,
+                           wait_ready)
+from device_registry import DeviceRegistry, HealthMonitor
+from ui_dispatch import Dispatcher, StallWatchdog
 
 
 class App(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title('Lolin S3 Configurator')
+        # Before any widget exists, so every callback is timed; blocking work
+        # goes through self.ui and its results come back on this thread
+        self.watchdog = StallWatchdog(self).start()
+        self.ui = Dispatcher(self)
 
         tk.Label(self, text='Device URL or IP').grid(row=0, column=0, sticky='w')
         self.ip_entry = tk.Entry(self, width=36)
@@ -47,40 +81,107 @@ class App(tk.Tk):
         btn_frame.grid(row=5, column=1, pady=8)
         tk.Button(btn_frame, text='Fetch', command=self.fetch).pack(side='left', padx=6)
         tk.Button(btn_frame, text='Save', command=self.save).pack(side='left', padx=6)
+        tk.Button(btn_frame, text='Fleet...', command=self.fleet_push).pack(side='left', padx=6)
+        tk.Button(btn_frame, text='Library...', command=lambda: library_ui.open_window(self)).pack(side='left', padx=6)
+        tk.Button(btn_frame, text='Diagnostics', command=lambda: diagnostics.open_window(self)).pack(side='left', padx=6)
 
         self.status = tk.Label(self, text='Ready', anchor='w')
         self.status.grid(row=6, column=0, columnspan=3, sticky='we', padx=6, pady=(0,6))
 
+        self._discover_stop = None
+        self._extra = {}
+        self.last_save_latency = None  # seconds from Save until the device was ready
+
+        # Known pads: reconnect to the last one used, keep everyone's liveness current
+        self.registry = DeviceRegistry()
+        self.monitor = HealthMonitor(self.registry, on_change=lambda d: self.ui.call(self._on_health, d)).start()
+        self.protocol('WM_DELETE_WINDOW', self._on_close)
+        self._reconnect()
+
     def set_status(self, txt):
         self.status.config(text=txt)
-        self.update_idletasks()
-
-    def _normalize_base(self, raw):
-        if not raw: return None
-        raw = raw.strip()
-        if raw.startswith('http://') or raw.startswith('https://'):
-            return raw.rstrip('/')
-        return 'http://' + raw.rstrip('/')
 
     def _url(self):
-        return self._normalize_base(self.ip_entry.get())
+        return normalize_base(self.ip_entry.get())
+
+    def _on_close(self):
+        self.watchdog.stop()
+        self.ui.shutdown()
+        self.monitor.stop()
+        self.destroy()
+
+    def _failed(self, what, e):
+        # on_error for device calls; anything else is a bug and goes to Tk's handler
+        if not isinstance(e, DeviceError):
+            self.set_status(f'{what} failed')
+            self.report_callback_exception(type(e), e, e.__traceback__)
+            return
+        messagebox.showerror('Error', f'{what} failed: {e}')
+        self.set_status(f'{what} failed')
+
+    def _reconnect(self):
+        # One probe of the last-used address instead of a scan; the form is
+        # filled from that same response
+        known = self.registry.devices()
+        if not known:
+            return
+        self.set_status(f'Reconnecting to {known[0].url}...')
+
+        def done(dev):
+            if dev is None:
+                self.set_status('No known device answered — use Auto-discover or enter an address')
+                return
+            if self._url():  # the user started typing meanwhile
+                return
+            self.ip_entry.insert(0, dev.url)
+            self._show_config(get_client(dev.url).use_config(dev.config))
+            self.set_status(f'Connected to {dev.url} ({dev.rtt * 1000:.0f} ms)')
+
+        self.ui.submit(self.registry.reconnect, on_done=done)
+
+    def _on_health(self, d):
+        if d.url != self._url():
+            return
+        if not d.alive:
+            self.set_status(f'{d.url} is not responding')
+        elif get_client(d.url).etag and d.version != get_client(d.url).etag:
+            self.set_status('Config changed on the device — Fetch to reload it')
+        else:
+            self.set_status(f'{d.url} is back ({d.rtt * 1000:.0f} ms)')
 
     def autodiscover(self):
-        # Try common AP address and mDNS name
-        candidates = ['http://192.168.4.1', 'http://lolin.local']
+        # Scan the AP address, mDNS name and local subnets concurrently; hits
+        # arrive on worker threads and are handed to the Tk thread one by one.
+        if self._discover_stop is not None:
+            return
         self.set_status('Auto-discovering...')
-        for c in candidates:
-            try:
-                r = requests.get(c + '/config', timeout=1.0)
-                if r.status_code == 200:
-                    self.ip_entry.delete(0, 'end')
-                    self.ip_entry.insert(0, c)
-                    self.set_status(f'Found device at {c}')
-                    self.fetch()
-                    return
-            except Exception:
-                pass
-        self.set_status('No device found (try entering IP or connect to AP)')
+        self._discover_stop = threading.Event()
+        self._discover_found = []
+        self.ui.submit(discovery.scan, on_found=lambda dev: self.ui.call(self._on_discovered, dev),
+                       stop=self._discover_stop, on_done=self._discovery_done,
+                       on_error=self._discovery_failed)
+
+    def _on_discovered(self, dev):
+        self._discover_found.append(dev)
+        self.registry.record(dev.url, dev.config, dev.rtt, save=False)
+        if len(self._discover_found) == 1:
+            self.ip_entry.delete(0, 'end')
+            self.ip_entry.insert(0, dev.url)
+            self.fetch()
+        self.set_status(f'Found {len(self._discover_found)} device(s), first at {self._discover_found[0].url}')
+
+    def _discovery_failed(self, e):
+        self._discover_stop = None
+        self.set_status(f'Auto-discover failed: {e}')
+
+    def _discovery_done(self, hits):
+        self._discover_stop = None
+        self.ui.submit(self.registry.save)
+        if not self._discover_found:
+            self.set_status('No device found (try entering IP or connect to AP)')
+        else:
+            urls = ', '.join(d.url for d in self._discover_found)
+            self.set_status(f'Found {len(self._discover_found)} device(s): {urls}')
 
     def fetch(self):
         base = self._url()
@@ -88,58 +189,204 @@ class App(tk.Tk):
             messagebox.showerror('Error', 'Enter device address or use Auto-discover')
             return
         self.set_status('Fetching config...')
-        try:
-            r = requests.get(base + '/config', timeout=3)
-            r.raise_for_status()
-            j = r.json()
-            self.ssid.delete(0, 'end'); self.ssid.insert(0, j.get('wifi_ssid',''))
-            self.wpass.delete(0, 'end'); self.wpass.insert(0, j.get('wifi_pass',''))
-            self.m1.delete('1.0', 'end'); self.m1.insert('1.0', j.get('macro1',''))
-            self.m2.delete('1.0', 'end'); self.m2.insert('1.0', j.get('macro2',''))
+        client = get_client(base)
+
+        def run():
+            cfg = client.get_config()
+            self.registry.record(base, {'mac': client.mac, 'version': client.etag, 'mode': client.mode})
+            return cfg
+
+        def done(cfg):
+            self._show_config(cfg)
             self.set_status('Config fetched')
-        except Exception as e:
-            messagebox.showerror('Error', f'Fetch failed: {e}')
-            self.set_status('Fetch failed')
+
+        self.ui.submit(run, on_done=done, on_error=lambda e: self._failed('Fetch', e))
+
+    def _show_config(self, cfg):
+        self.ssid.delete(0, 'end'); self.ssid.insert(0, cfg.wifi_ssid)
+        self.wpass.delete(0, 'end'); self.wpass.insert(0, cfg.wifi_pass)
+        self.m1.delete('1.0', 'end'); self.m1.insert('1.0', cfg.macro1)
+        self.m2.delete('1.0', 'end'); self.m2.insert('1.0', cfg.macro2)
 
     def save(self):
         base = self._url()
         if not base:
             messagebox.showerror('Error', 'Enter device address or use Auto-discover')
             return
+        payload = self._form_payload()
+        self.set_status('Saving config...')
+        client = get_client(base)
+        # Against the last fetch, only the edited fields go out; action/keymap
+        # fields the UI doesn't show are carried over from the cache untouched.
+        # Without a fetch the form's fields go out as they are, but the keymap
+        # sync still needs a DeviceConfig to read (library fields included).
+        cfg = replace(client.cached, **payload) if client.cached else payload
+        keymaps = cfg if client.cached else DeviceConfig.from_dict(payload)
+        t0 = time.monotonic()
+
+        def progress(key, sent, total):
+            self.ui.call(self.set_status, f'Uploading {key}: {sent * 100 // total}%')
+
+        def run():
+            # Macros too long for the config go up in chunks first (progress above)
+            res = client.save(cfg, timeout=(1.0, 5.0), wait=False, on_progress=progress)
+            latency = time.monotonic() - t0
+            # In station mode the firmware applies macros live; only AP mode restarts
+            compiled, warnings = ([], []) if res.restart else self._sync_keymaps(client, keymaps)
+            return res, latency, compiled, warnings
+
+        def done(out):
+            res, latency, compiled, warnings = out
+            self._extra = {}
+            for text in warnings:
+                messagebox.showwarning('Keymap', text)
+            if not res.restart:
+                self.last_save_latency = latency
+                note = f'; compiled keymap {", ".join(map(str, compiled))}' if compiled else ''
+                if res.sent:
+                    self.set_status(f'Saved {", ".join(res.sent)} — applied in {latency * 1000:.0f} ms{note}')
+                else:
+                    self.set_status(f'No changes to save{note}')
+                return
+            self.set_status('Saved — device rebooting')
+            self.ui.submit(self._wait_for_reboot, base, t0, on_done=self._rebooted)
+
+        def failed(e):
+            if not isinstance(e, ConflictError):
+                self._failed('Save', e)
+                return
+            self.set_status('Save refused — config changed on the device')
+            if messagebox.askyesno('Conflict', 'The device config changed since it was fetched. Fetch the current config now? (Your edits will be replaced.)'):
+                self.fetch()
+
+        self.ui.submit(run, on_done=done, on_error=failed)
+
+    def _form_payload(self):
         payload = {
             'wifi_ssid': self.ssid.get().strip(),
             'wifi_pass': self.wpass.get().strip(),
             'macro1': self.m1.get('1.0','end').strip(),
             'macro2': self.m2.get('1.0','end').strip(),
         }
-        self.set_status('Saving config...')
+        # Fields picked from the library that the form has no widget for
+        payload.update(self._extra)
+        return payload
+
+    def form_config(self):
+        # Everything a profile saved from this form should carry: the visible
+        # fields over the last fetched config. Blank WiFi fields are left out
+        # so applying the profile doesn't wipe a device's network settings.
+        client = get_client(self._url()) if self._url() else None
+        cfg = client.cached.to_dict() if client is not None and client.cached else {}
+        cfg.update(self._form_payload())
+        for key in ('wifi_ssid', 'wifi_pass'):
+            if not cfg.get(key):
+                cfg.pop(key, None)
+        return cfg
+
+    def use_macro(self, slot, macro):
+        # Put a library macro on a button; it goes to the device on the next Save
+        box = self.m1 if slot == 1 else self.m2
+        if macro.kind == 'keystroke':
+            self._extra.update({f'action{slot}': 'keystroke', f'keymap{slot}': macro.body})
+        else:
+            self._extra[f'action{slot}'] = 'macro'
+            box.delete('1.0', 'end'); box.insert('1.0', macro.body)
+        self.set_status(f'Button {slot}: {macro.name} — Save to apply')
+
+    def apply_profile(self, profile):
+        # Load a saved profile into the form and save it to the current device
+        widgets = {'wifi_ssid': self.ssid, 'wifi_pass': self.wpass}
+        texts = {'macro1': self.m1, 'macro2': self.m2}
+        self._extra = {}
+        for key, value in profile.config.items():
+            if key in widgets:
+                widgets[key].delete(0, 'end'); widgets[key].insert(0, value)
+            elif key in texts:
+                texts[key].delete('1.0', 'end'); texts[key].insert('1.0', value)
+            else:
+                self._extra[key] = value
+        self.save()
+
+    def known_devices(self):
+        found = [d.url for d in getattr(self, '_discover_found', [])]
+        alive = [d.url for d in self.registry.devices() if d.alive]
+        return list(dict.fromkeys(found + alive))
+
+    def _sync_keymaps(self, client, cfg):
+        # Keystroke buttons get their keymap precompiled to HID reports so the
+        # pad doesn't re-parse it on every press. Runs on a worker; returns the
+        # slots uploaded and warnings for the Tk thread to show.
+        done, warnings = [], []
+        for slot in (1, 2):
+            keymap = getattr(cfg, f'keymap{slot}', '')
+            if getattr(cfg, f'action{slot}', '') != 'keystroke' or not keymap:
+                continue
+            try:
+                blob = macro_compiler.compile_keymap(keymap)
+                if client.macro_info(slot).get('valid'):
+                    continue
+                client.upload_macro(slot, blob)
+                done.append(slot)
+            except macro_compiler.MacroSyntaxError as e:
+                warnings.append(f'Button {slot} keymap not compiled:\n' + '\n'.join(e.errors))
+            except DeviceError as e:
+                if e.status == 404:  # firmware without /macro: it keeps parsing the keymap itself
+                    break
+                warnings.append(f'Button {slot} keymap upload failed: {e}')
+        return done, warnings
+
+    def fleet_push(self):
+        path = filedialog.askopenfilename(title='Fleet manifest',
+                                          filetypes=[('Manifest', '*.csv *.json'), ('All files', '*')])
+        if not path:
+            return
         try:
-            r = requests.post(base + '/config', json=payload, timeout=5)
-            r.raise_for_status()
-            self.set_status('Saved — device rebooting')
-            # Wait/poll for device to come back up (either AP at 192.168.4.1 or same base)
-            threading.Thread(target=self._wait_for_reboot, args=(base,)).start()
-        except Exception as e:
-            messagebox.showerror('Error', f'Save failed: {e}')
-            self.set_status('Save failed')
-
-    def _wait_for_reboot(self, base):
-        # After POST the device restarts. Try polling the provided base and 192.168.4.1.
-        candidates = [base, 'http://192.168.4.1']
-        timeout = 20
-        start = time.time()
-        while time.time() - start < timeout:
-            for c in candidates:
-                try:
-                    r = requests.get(c + '/config', timeout=1.0)
-                    if r.status_code == 200:
-                        self.set_status(f'Device available at {c}')
-                        # Update ip field to discovered location
-                        self.ip_entry.delete(0, 'end'); self.ip_entry.insert(0, c)
-                        return
-                except Exception:
-                    pass
-            time.sleep(0.8)
+            entries = fleet.load_manifest(path)
+        except (OSError, ValueError, KeyError) as e:
+            messagebox.showerror('Error', f'Bad manifest: {e}')
+            return
+        out = path.rsplit('.', 1)[0] + '.results.json'
+        done = []
+
+        def run():
+            t0 = time.monotonic()
+            results = fleet.push(entries, on_result=lambda r: self.ui.call(progress, r))
+            fleet.write_results(out, results, time.monotonic() - t0, manifest=path)
+            return results
+
+        def progress(r):
+            done.append(r)
+            failed = sum(not r.ok for r in done)
+            self.set_status(f'Fleet: {len(done)}/{len(entries)} done, {failed} failed')
+
+        def finished(results):
+            failed = sum(not r.ok for r in results)
+            self.set_status(f'Fleet: {len(results) - failed}/{len(results)} ok, {failed} failed — results in {out}')
+
+        self.set_status(f'Fleet: pushing to {len(entries)} device(s)...')
+        self.ui.submit(run, on_done=finished, on_error=lambda e: self._failed('Fleet push', e))
+
+    def _wait_for_reboot(self, base, t0):
+        # On a worker: probe the provided base, where the registry last saw
+        # this pad in station mode, and the setup AP concurrently until one answers
+        mac = get_client(base).mac
+        known = self.registry.candidates(mac.lower()) if mac else []
+        c = wait_ready([base, *known, AP_BASE], timeout=20)
+        if c is None:
+            return None, None
+        latency = time.monotonic() - t0
+        metrics.observe('save_to_ready_seconds', latency, device=base, restart='true')
+        return c, latency
+
+    def _rebooted(self, out):
+        c, latency = out
+        if c:
+            self.last_save_latency = latency
+            self.set_status(f'Device available at {c} — ready {latency:.1f} s after save')
+            # Update ip field to discovered location
+            self.ip_entry.delete(0, 'end'); self.ip_entry.insert(0, c)
+            return
         self.set_status('Device did not appear — it may be on another network')
         messagebox.showinfo('Notice', 'Device did not respond after reboot. If you configured WiFi, the device may have connected to your router — check your router DHCP list.')
 
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""Compile keystroke keymaps into HID report sequences the firmware replays as-is.
+
+A keymap is the firmware's space-separated token list, e.g.
+``Ctrl+Shift+T Hello Enter Wait:200 Alt+Tab``:
+
+* ``Mod+Mod+Key`` with modifiers Ctrl/Control, Shift, Alt, Gui/Win/Cmd;
+* keys are single characters or names (Enter, Tab, Space, Esc, Backspace,
+  Delete, Insert, Home, End, PageUp, PageDown, Up, Down, Left, Right,
+  F1-F12, CapsLock, PrintScreen);
+* any other word without modifiers is typed as text, one key per character;
+* ``Wait:<ms>`` pauses.
+
+The compiled form is a flat list of 8-byte boot-keyboard reports with
+explicit hold times. Modifiers held across consecutive strokes (``Ctrl+C
+Ctrl+V``) are pressed once, and distinct keys roll over without an empty
+report in between. Without a valid blob (none uploaded yet, or stale after
+the keymap changed) ``executeAction`` parses the keymap on the press with a
+port of ``parse`` and ``to_reports`` (``runKeymap``), so both paths send the
+same reports and a keymap with errors types nothing either way.
+
+Blob layout (little endian)::
+
+    0  'M' 'K'   magic
+    2  u8        version (1)
+    3  u8        flags (0)
+    4  u32       FNV-1a of the source keymap; stale blobs are ignored
+    8  u16       record count
+    10 records   3 bytes each: modifiers, key usage, wait ms after sending
+                 key 0xFF = no report, wait (modifiers << 8 | wait) ms
+
+Usage: python macro_compiler.py "Ctrl+C Ctrl+V" [--hold 3] [--out macro.bin]
+"""
+import argparse
+import struct
+import sys
+from collections import namedtuple
+
+MAGIC = b'MK'
+VERSION = 1
+HEADER = struct.Struct('<2sBBIH')
+RECORD = struct.Struct('<BBB')
+WAIT_KEY = 0xFF
+MAX_WAIT_MS = 0xFFFF
+DEFAULT_HOLD_MS = 3
+MAX_HOLD_MS = 0xFF  # one byte per record
+
+MOD_CTRL, MOD_SHIFT, MOD_ALT, MOD_GUI = 0x01, 0x02, 0x04, 0x08
+MODIFIERS = {'ctrl': MOD_CTRL, 'control': MOD_CTRL, 'shift': MOD_SHIFT, 'alt': MOD_ALT,
+             'gui': MOD_GUI, 'win': MOD_GUI, 'cmd': MOD_GUI, 'meta': MOD_GUI}
+
+NAMED_KEYS = {
+    'enter': 0x28, 'return': 0x28, 'esc': 0x29, 'escape': 0x29, 'backspace': 0x2A,
+    'tab': 0x2B, 'space': 0x2C, 'capslock': 0x39, 'printscreen': 0x46, 'scrolllock': 0x47,
+    'pause': 0x48, 'insert': 0x49, 'home': 0x4A, 'pageup': 0x4B, 'delete': 0x4C, 'del': 0x4C,
+    'end': 0x4D, 'pagedown': 0x4E, 'right': 0x4F, 'left': 0x50, 'down': 0x51, 'up': 0x52,
+}
+NAMED_KEYS.update({f'f{i}': 0x39 + i for i in range(1, 13)})
+
+# US layout: char -> (usage, needs shift)
+ASCII = {'\n': (0x28, False), '\t': (0x2B, False), ' ': (0x2C, False)}
+for _i, _c in enumerate('abcdefghijklmnopqrstuvwxyz'):
+    ASCII[_c] = (0x04 + _i, False)
+    ASCII[_c.upper()] = (0x04 + _i, True)
+for _i, _c in enumerate('1234567890'):
+    ASCII[_c] = (0x1E + _i, False)
+    ASCII['!@#$%^&*()'[_i]] = (0x1E + _i, True)
+for _c, _s, _u in zip("-=[]\\;'`,./", '_+{}|:"~<>?', (0x2D, 0x2E, 0x2F, 0x30, 0x31, 0x33, 0x34,
+                                                     0x35, 0x36, 0x37, 0x38)):
+    ASCII[_c] = (_u, False)
+    ASCII[_s] = (_u, True)
+
+Stroke = namedtuple('Stroke', 'mods key')  # one key press with its modifiers
+Wait = namedtuple('Wait', 'ms')
+Report = namedtuple('Report', 'mods key wait')
+SimResult = namedtuple('SimResult', 'reports ms allocs')
+
+
+class MacroSyntaxError(ValueError):
+    """Raised for an invalid keymap; ``errors`` lists every problem found."""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def fnv1a(data):
+    """32-bit FNV-1a over ``data`` (bytes), as the firmware computes it."""
+    h = 2166136261
+    for b in data:
+        h = ((h ^ b) * 16777619) & 0xFFFFFFFF
+    return h
+
+
+def keymap_hash(keymap):
+    """FNV-1a over the keymap's UTF-8 bytes (matches the firmware's check)."""
+    return fnv1a(keymap.encode('utf-8'))
+
+
+def _split(token):
+    # Same split as the firmware: modifiers before the last '+', but a
+    # trailing '++' means the '+' key
+    if token.endswith('++'):
+        return token[:-2], '+'
+    if token == '+':
+        return '', '+'
+    mods, _, key = token.rpartition('+')
+    return mods, key
+
+
+def parse(keymap):
+    """Return the keymap as a list of Stroke/Wait items; raise MacroSyntaxError."""
+    out, errors = [], []
+    for n, token in enumerate(keymap.split(), 1):
+        if token.lower().startswith('wait:'):
+            digits = token[5:]
+            # Plain ASCII digits only, as the firmware's parser reads them
+            ms = int(digits) if digits.isascii() and digits.isdigit() else -1
+            if not 0 <= ms <= MAX_WAIT_MS:
+                errors.append(f'token {n} {token!r}: wait must be 0-{MAX_WAIT_MS} ms')
+            else:
+                out.append(Wait(ms))
+            continue
+        mod_part, key = _split(token)
+        mods = 0
+        for m in filter(None, mod_part.split('+')) if mod_part else ():
+            bit = MODIFIERS.get(m.lower())
+            if bit is None:
+                errors.append(f'token {n} {token!r}: unknown modifier {m!r}')
+            mods |= bit or 0
+        if not key:
+            errors.append(f'token {n} {token!r}: missing key after modifiers')
+        elif key.lower() in NAMED_KEYS:
+            out.append(Stroke(mods, NAMED_KEYS[key.lower()]))
+        elif len(key) == 1:
+            if key not in ASCII:
+                errors.append(f'token {n} {token!r}: {key!r} has no US-layout key')
+                continue
+            usage, shift = ASCII[key]
+            # With modifiers a letter names the key (Ctrl+A is select-all, not Ctrl+Shift+A)
+            if shift and not (mods and key.isalpha()):
+                mods |= MOD_SHIFT
+            out.append(Stroke(mods, usage))
+        elif mods:
+            errors.append(f'token {n} {token!r}: unknown key name {key!r}')
+        else:
+            bad = sorted({c for c in key if c not in ASCII})
+            if bad:
+                errors.append(f'token {n} {token!r}: no US-layout key for {"".join(bad)!r}')
+                continue
+            for c in key:
+                usage, shift = ASCII[c]
+                out.append(Stroke(MOD_SHIFT if shift else 0, usage))
+    if errors:
+        raise MacroSyntaxError(errors)
+    return out
+
+
+def validate(keymap):
+    """List of problems in ``keymap`` (empty when it compiles)."""
+    try:
+        parse(keymap)
+    except MacroSyntaxError as e:
+        return e.errors
+    return []
+
+
+def to_reports(items, hold_ms=DEFAULT_HOLD_MS):
+    """Turn parsed items into the minimal report sequence, ending all-released.
+
+    Raises ValueError unless ``hold_ms`` is 0-MAX_HOLD_MS.
+    """
+    if not 0 <= hold_ms <= MAX_HOLD_MS:
+        raise ValueError(f'hold must be 0-{MAX_HOLD_MS} ms, not {hold_ms}')
+    out = []
+    mods, key = 0, 0
+
+    def send(m, k):
+        out.append(Report(m, k, hold_ms))
+
+    for item in items:
+        if isinstance(item, Wait):
+            if key or mods:
+                send(0, 0)  # nothing stays held across a pause
+                mods, key = 0, 0
+            ms = item.ms
+            while ms:
+                step = min(ms, MAX_WAIT_MS)
+                out.append(Report(step >> 8, WAIT_KEY, step & 0xFF))
+                ms -= step
+            continue
+        if key and (item.key == key or item.mods != mods):
+            send(mods, 0)  # release the key before it repeats or modifiers change
+            key = 0
+        if item.mods != mods:
+            if item.mods:
+                send(item.mods, 0)  # modifiers down one report ahead of the key
+            mods = item.mods
+        send(mods, item.key)
+        key = item.key
+    if key or mods:
+        send(0, 0)
+    return out
+
+
+def encode(reports, keymap):
+    body = b''.join(RECORD.pack(r.mods, r.key, r.wait) for r in reports)
+    return HEADER.pack(MAGIC, VERSION, 0, keymap_hash(keymap), len(reports)) + body
+
+
+def decode(blob):
+    """Return ``(keymap_hash, [Report, ...])``; raise ValueError if malformed."""
+    if len(blob) < HEADER.size:
+        raise ValueError('blob too short')
+    magic, version, _, h, count = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a compiled macro')
+    if len(blob) != HEADER.size + count * RECORD.size:
+        raise ValueError('record count does not match blob size')
+    return h, [Report(*RECORD.unpack_from(blob, HEADER.size + i * RECORD.size))
+               for i in range(count)]
+
+
+def compile_keymap(keymap, hold_ms=DEFAULT_HOLD_MS):
+    """Validate and compile ``keymap`` to an uploadable blob."""
+    return encode(to_reports(parse(keymap), hold_ms), keymap)
+
+
+def simulate_token_loop(keymap, report_ms=1.0):
+    """Reports, wall time and heap String allocations of the old token loop.
+
+    Models the ``executeAction`` that predates compiled keymaps and
+    ``runKeymap``: per token, one report per modifier press, a press+release
+    per character written, one per modifier release, one for releaseAll,
+    and two ``delay(10)``. Kept as the baseline for bench/bench_macro.py.
+    """
+    reports = 0
+    ms = 0.0
+    allocs = 4  # action/macro/keymap copies and the working copy ``s``
+    for token in keymap.split(' '):
+        allocs += 1  # substring
+        token = token.strip()
+        if not token:
+            continue
+        plus = token.rfind('+')
+        mods, keypart = ('', token) if plus == -1 else (token[:plus], token[plus + 1:])
+        if plus != -1:
+            allocs += 2  # mods + keypart substrings
+        held = set()
+        for m in filter(None, mods.split('+')) if mods else ():
+            allocs += 1
+            if m.strip().lower() in ('ctrl', 'control', 'alt', 'shift'):
+                held.add(m.strip().lower().replace('control', 'ctrl'))
+        allocs += 1  # String k = keypart
+        reports += len(held)
+        k = keypart.strip()
+        if k.lower() in ('enter', 'tab', 'space') or len(k) == 1:
+            reports += 2
+        else:
+            reports += 2 * len(k)
+        reports += len(held) + 1  # modifier releases + releaseAll
+        ms += 20
+    return SimResult(reports, ms + reports * report_ms, allocs)
+
+
+def simulate_blob(blob, report_ms=1.0):
+    """Reports and wall time the firmware needs to replay a compiled blob."""
+    _, recs = decode(blob)
+    reports = sum(r.key != WAIT_KEY for r in recs)
+    ms = sum(((r.mods << 8) | r.wait) if r.key == WAIT_KEY else r.wait for r in recs)
+    return SimResult(reports, ms + reports * report_ms, 0)
+
+
+def _hold_ms(text):
+    try:
+        ms = int(text)
+    except ValueError:
+        ms = -1
+    if not 0 <= ms <= MAX_HOLD_MS:
+        raise argparse.ArgumentTypeError(f'must be 0-{MAX_HOLD_MS} ms')
+    return ms
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Compile a keystroke keymap to HID reports')
+    ap.add_argument('keymap')
+    ap.add_argument('--hold', type=_hold_ms, default=DEFAULT_HOLD_MS, help='ms each report is held (0-255)')
+    ap.add_argument('--out', help='write the blob here')
+    args = ap.parse_args()
+    try:
+        blob = compile_keymap(args.keymap, args.hold)
+    except MacroSyntaxError as e:
+        for err in e.errors:
+            print(err, file=sys.stderr)
+        raise SystemExit(1)
+    old, new = simulate_token_loop(args.keymap), simulate_blob(blob)
+    print(f'{len(blob)} bytes, {new.reports} reports, ~{new.ms:.0f} ms '
+          f'(old token loop: {old.reports} reports, ~{old.ms:.0f} ms, {old.allocs} String allocations)')
+    if args.out:
+        with open(args.out, 'wb') as f:
+            f.write(blob)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Headless command line for Lolin S3 macropads, for scripts, cron and provisioning.
+
+Every command prints one JSON document on stdout. Nothing beyond argparse
+and json is imported at startup: the HTTP stack loads only for commands
+that talk to a device, and tkinter never does, so ``--help`` and argument
+errors return at interpreter-startup speed.
+
+    python macropad_cli.py discover 192.168.1.0/24
+    python macropad_cli.py get 192.168.1.50 --field macro1
+    python macropad_cli.py set 192.168.1.50 macro1='hello world' action2=keystroke keymap2='Ctrl+C'
+    python macropad_cli.py diff 192.168.1.50 --file wanted.json
+    python macropad_cli.py wait-ready 192.168.1.50 192.168.4.1 --timeout 30
+    python macropad_cli.py devices --probe
+
+A device can also be given by the MAC of a pad in the device registry
+(device_registry.py); its last known address is used.
+
+``--metrics PATH`` writes the timings and error counts gathered during the
+command (see metrics.py).
+
+Exit status: 0 on success, 1 when a device fails or ``diff`` finds
+differences or ``wait-ready`` times out, 2 for usage errors.
+"""
+import argparse
+import json
+import sys
+import time
+
+
+class CliError(Exception):
+    """A command failed; the message is printed to stderr and the exit status is 1."""
+
+
+def emit(doc, args):
+    json.dump(doc, sys.stdout, indent=2 if args.pretty else None)
+    sys.stdout.write('\n')
+
+
+def parse_assignments(pairs, file=None):
+    """``key=value`` arguments (on top of an optional JSON file) as a field dict."""
+    from device_client import CONFIG_FIELDS
+    wanted = {}
+    if file:
+        with open(file, encoding='utf-8') as f:
+            doc = json.load(f)
+        if not isinstance(doc, dict):
+            raise CliError(f'{file}: expected a JSON object of config fields')
+        wanted.update({k: str(v) for k, v in doc.items()})
+    for pair in pairs:
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise CliError(f'expected key=value, got {pair!r}')
+        wanted[key.strip()] = value
+    unknown = sorted(set(wanted) - set(CONFIG_FIELDS))
+    if unknown:
+        raise CliError(f'unknown field(s): {", ".join(unknown)} (known: {", ".join(CONFIG_FIELDS)})')
+    return wanted
+
+
+def resolve(device):
+    """A device argument as an address: MACs are looked up in the device registry."""
+    if device.count(':') != 5:
+        return device
+    from device_registry import DeviceRegistry
+    known = DeviceRegistry().get(device.lower())
+    if known is None:
+        raise CliError(f'no known device with MAC {device}')
+    return known.url
+
+
+def cmd_discover(args):
+    import discovery
+    hits = discovery.scan(args.networks or None, port=args.port, workers=args.workers,
+                          connect_timeout=args.timeout)
+    emit([{'url': d.url, 'host': d.host, 'port': d.port, 'rtt_ms': round(d.rtt * 1000, 1),
+           'config': d.config} for d in hits], args)
+    return 0
+
+
+def cmd_get(args):
+    from device_client import DeviceClient
+    client = DeviceClient(resolve(args.device), timeout=args.timeout)
+    try:
+        cfg = client.get_config().to_dict()
+    finally:
+        client.close()
+    if args.field:
+        if args.field not in cfg:
+            raise CliError(f'unknown field {args.field!r}')
+        emit(cfg[args.field], args)
+    else:
+        emit(dict(cfg, mode=client.mode, mac=client.mac, version=client.etag), args)
+    return 0
+
+
+def cmd_set(args):
+    from dataclasses import asdict, replace
+
+    import macro_compiler
+    from device_client import DeviceClient, DeviceError
+    wanted = parse_assignments(args.fields, args.file)
+    if not wanted:
+        raise CliError('nothing to set')
+    client = DeviceClient(resolve(args.device), timeout=args.timeout)
+    try:
+        cfg = replace(client.get_config(), **wanted)
+        res = client.save(cfg, ready_timeout=args.ready_timeout, wait=not args.no_wait)
+        out = dict(asdict(res), ok=True, compiled=[], keymap_errors={})
+        if res.restart:
+            out['ok'] = res.ready_url is not None or args.no_wait
+        else:
+            # Same as the GUI: keystroke buttons get their keymap precompiled
+            for slot in (1, 2):
+                keymap = getattr(cfg, f'keymap{slot}')
+                if getattr(cfg, f'action{slot}') != 'keystroke' or not keymap:
+                    continue
+                try:
+                    blob = macro_compiler.compile_keymap(keymap)
+                    if not client.macro_info(slot).get('valid'):
+                        client.upload_macro(slot, blob)
+                        out['compiled'].append(slot)
+                except macro_compiler.MacroSyntaxError as e:
+                    out['keymap_errors'][str(slot)] = e.errors
+                except DeviceError as e:
+                    if e.status == 404:  # firmware without /macro
+                        break
+                    out['keymap_errors'][str(slot)] = [str(e)]
+    finally:
+        client.close()
+    emit(out, args)
+    return 0 if out['ok'] else 1
+
+
+def cmd_diff(args):
+    from device_client import DeviceClient
+    wanted = parse_assignments(args.fields, args.file)
+    client = DeviceClient(resolve(args.device), timeout=args.timeout)
+    try:
+        have = client.get_config().to_dict()
+    finally:
+        client.close()
+    changes = {k: {'device': have[k], 'wanted': v} for k, v in wanted.items() if have[k] != v}
+    emit(changes, args)
+    return 1 if changes else 0
+
+
+def cmd_wait_ready(args):
+    from device_client import wait_ready
+    t0 = time.monotonic()
+    url = wait_ready([resolve(d) for d in args.devices], timeout=args.timeout, settle=0)
+    emit({'ready': url, 'elapsed': round(time.monotonic() - t0, 3)}, args)
+    return 0 if url else 1
+
+
+def cmd_devices(args):
+    from dataclasses import asdict
+
+    from device_registry import DeviceRegistry, HealthMonitor
+    reg = DeviceRegistry()
+    if args.probe:
+        HealthMonitor(reg, timeout=args.timeout).sweep()
+    emit([asdict(d) for d in reg.devices()], args)
+    return 0
+
+
+def build_parser():
+    ap = argparse.ArgumentParser(prog='macropad_cli.py',
+                                 description='Script Lolin S3 macropads without the GUI')
+    ap.add_argument('--pretty', action='store_true', help='indent the JSON output')
+    ap.add_argument('--metrics', metavar='PATH',
+                    help='write request timings on exit (.json snapshot or Prometheus text)')
+    sub = ap.add_subparsers(dest='command', metavar='command', required=True)
+
+    p = sub.add_parser('discover', help='scan the LAN for devices')
+    p.add_argument('networks', nargs='*', help='CIDR ranges to scan (default: local subnets)')
+    p.add_argument('--port', type=int, default=80)
+    p.add_argument('--workers', type=int, default=64)
+    p.add_argument('--timeout', type=float, default=0.3, help='connect timeout in seconds')
+    p.set_defaults(func=cmd_discover)
+
+    p = sub.add_parser('get', help='print a device config')
+    p.add_argument('device', help='URL, IP or registered MAC of the device')
+    p.add_argument('--field', help='print just this field')
+    p.add_argument('--timeout', type=float, default=3.0, help='per-request timeout in seconds')
+    p.set_defaults(func=cmd_get)
+
+    p = sub.add_parser('set', help='change fields and save; waits if the device restarts')
+    p.add_argument('device')
+    p.add_argument('fields', nargs='*', metavar='key=value')
+    p.add_argument('--file', help='JSON object of fields to set')
+    p.add_argument('--no-wait', action='store_true', help="return without waiting for a restart")
+    p.add_argument('--timeout', type=float, default=3.0, help='per-request timeout in seconds')
+    p.add_argument('--ready-timeout', type=float, default=20.0)
+    p.set_defaults(func=cmd_set)
+
+    p = sub.add_parser('diff', help='compare a device config with wanted values (exit 1 if they differ)')
+    p.add_argument('device')
+    p.add_argument('fields', nargs='*', metavar='key=value')
+    p.add_argument('--file', help='JSON object of wanted fields')
+    p.add_argument('--timeout', type=float, default=3.0, help='per-request timeout in seconds')
+    p.set_defaults(func=cmd_diff)
+
+    p = sub.add_parser('wait-ready', help='wait until any of the addresses answers')
+    p.add_argument('devices', nargs='+', metavar='device')
+    p.add_argument('--timeout', type=float, default=20.0, help='give up after this many seconds')
+    p.set_defaults(func=cmd_wait_ready)
+
+    p = sub.add_parser('devices', help='list known devices (last address, version, liveness)')
+    p.add_argument('--probe', action='store_true', help='probe each one first')
+    p.add_argument('--timeout', type=float, default=1.0, help='probe timeout in seconds')
+    p.set_defaults(func=cmd_devices)
+    return ap
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return run(args)
+    finally:
+        if args.metrics:
+            import metrics
+            metrics.write(args.metrics)
+
+
+def run(args):
+    try:
+        return args.func(args)
+    except (CliError, OSError, ValueError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    except Exception as e:
+        # DeviceError is only importable once a command has loaded device_client
+        dc = sys.modules.get('device_client')
+        if dc is None or not isinstance(e, dc.DeviceError):
+            raise
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
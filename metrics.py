@@ -0,0 +1,237 @@
+"""In-process counters and latency histograms for the configurator tools.
+
+Every network request, serial command and flash phase is timed with a
+span. A span records into a histogram named ``<name>_seconds``; when it
+fails, it also counts ``<name>_errors_total`` with a ``reason`` label.
+Labels identify the operation and the device (``device``/``port``), so
+per-device slowness shows up next to the fleet-wide totals. The registry
+is thread-safe and cheap enough to leave on: one lock acquisition per
+observation.
+
+    with metrics.span('http_request', method='GET', device=base) as sp:
+        r = session.get(url)
+        if r.status_code >= 500:
+            sp.fail(f'http_{r.status_code}')
+    metrics.inc('serial_retransmits_total', port=port)
+    metrics.write('metrics.prom')      # Prometheus text format; .json for a snapshot
+
+``summary()`` gives per-operation rows (count, errors, p50/p95/max) for the
+diagnostics panel (diagnostics.py).
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0)
+PREFIX = 'macropad_'
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Histogram:
+    """Cumulative bucket counts plus the most recent samples for quantiles."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'max', 'recent')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, keep=512):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.recent = deque(maxlen=keep)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):  # larger values only show up in +Inf (count)
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+        self.recent.append(value)
+
+    def cumulative(self):
+        out, total = [], 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+    def quantiles(self, *qs):
+        values = sorted(self.recent)
+        return [_quantile(values, q) for q in qs]
+
+
+class Span:
+    """Times a ``with`` block into ``<name>_seconds``; errors count into ``<name>_errors_total``.
+
+    Call ``fail(reason)`` for failures handled inside the block; an exception
+    escaping it is recorded with its class name as the reason (unless
+    ``fail`` already gave one) and re-raised.
+    """
+
+    __slots__ = ('registry', 'name', 'labels', 'error', 't0', 'elapsed')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.error = None
+        self.t0 = None
+        self.elapsed = None
+
+    def fail(self, reason='error'):
+        self.error = reason
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.t0
+        self.registry.observe(f'{self.name}_seconds', self.elapsed, **self.labels)
+        reason = self.error or (exc_type.__name__ if exc_type is not None else None)
+        if reason:
+            self.registry.inc(f'{self.name}_errors_total', reason=reason, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}    # (name, label key) -> value
+        self.histograms = {}  # (name, label key) -> Histogram
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        k = (name, _key(labels))
+        with self._lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def observe(self, name, value, **labels):
+        k = (name, _key(labels))
+        with self._lock:
+            h = self.histograms.get(k)
+            if h is None:
+                h = self.histograms[k] = Histogram(self.buckets)
+            h.observe(value)
+
+    def span(self, name, **labels):
+        return Span(self, name, labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        """Everything recorded so far as a JSON-serialisable dict."""
+        with self._lock:
+            counters = [{'name': n, 'labels': dict(k), 'value': v}
+                        for (n, k), v in sorted(self.counters.items())]
+            hists = []
+            for (n, k), h in sorted(self.histograms.items()):
+                p50, p95 = h.quantiles(0.5, 0.95)
+                hists.append({'name': n, 'labels': dict(k), 'count': h.count,
+                              'sum': round(h.sum, 6), 'max': round(h.max, 6),
+                              'p50': p50, 'p95': p95,
+                              'buckets': {str(b): c for b, c in h.cumulative()}})
+        return {'started': self.started, 'time': time.time(), 'counters': counters,
+                'histograms': hists}
+
+    def prometheus(self):
+        """The registry in Prometheus text exposition format (for node_exporter's textfile collector)."""
+        lines = []
+        with self._lock:
+            typed = set()
+            for (n, k), v in sorted(self.counters.items()):
+                name = PREFIX + n
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{_labels(k)} {v}')
+            for (n, k), h in sorted(self.histograms.items()):
+                name = PREFIX + n
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} histogram')
+                for bound, total in h.cumulative():
+                    le = _labels(k + (('le', repr(bound)),))
+                    lines.append(f'{name}_bucket{le} {total}')
+                le = _labels(k + (('le', '+Inf'),))
+                lines.append(f'{name}_bucket{le} {h.count}')
+                lines.append(f'{name}_sum{_labels(k)} {h.sum:.6f}')
+                lines.append(f'{name}_count{_labels(k)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """One row per timed operation and label set, slowest total time first.
+
+        Rows are dicts with name, labels, count, errors, mean, p50, p95 and max
+        (seconds).
+        """
+        with self._lock:
+            errors = {}
+            for (n, k), v in self.counters.items():
+                if n.endswith('_errors_total'):
+                    base = (n[:-len('_errors_total')], tuple(p for p in k if p[0] != 'reason'))
+                    errors[base] = errors.get(base, 0) + v
+            rows = []
+            for (n, k), h in self.histograms.items():
+                name = n[:-len('_seconds')] if n.endswith('_seconds') else n
+                p50, p95 = h.quantiles(0.5, 0.95)
+                rows.append({'name': name, 'labels': dict(k), 'count': h.count,
+                             'errors': errors.get((name, k), 0), 'total': h.sum,
+                             'mean': h.sum / h.count if h.count else 0.0,
+                             'p50': p50, 'p95': p95, 'max': h.max})
+        rows.sort(key=lambda r: r['total'], reverse=True)
+        return rows
+
+    def write(self, path):
+        """Write a JSON snapshot (``*.json``) or Prometheus text (anything else) atomically."""
+        if path.endswith('.json'):
+            data = json.dumps(self.snapshot(), indent=2)
+        else:
+            data = self.prometheus()
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return path
+
+
+REGISTRY = Registry()
+
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+span = REGISTRY.span
+snapshot = REGISTRY.snapshot
+prometheus = REGISTRY.prometheus
+summary = REGISTRY.summary
+write = REGISTRY.write
+reset = REGISTRY.reset
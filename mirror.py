@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""LAN firmware mirror: download each release once, serve it to every updater.
+
+``python mirror.py`` syncs the latest release from upstream. It fetches
+the release JSON, downloads every asset into the content-addressed cache,
+checks each against its SHA-256, and only then publishes the release. It
+serves the release to the LAN and re-syncs every ``--interval`` seconds.
+If upstream is down, the last synced release is still served, including
+after a restart.
+
+    GET /release                      the release JSON, asset URLs pointing here
+    GET /repos/<owner>/<repo>/releases/latest   the same, so $MACROPAD_RELEASE_API can point here
+    GET /assets/<sha256>/<name>       an asset from the object store (ETag, Range, HEAD)
+    GET /raw/<path>                   <raw base>/<path> fetched once and cached (old/flash.py)
+    GET /health                       tag, sync time and last error as JSON
+
+Updaters set ``$MACROPAD_MIRROR`` (e.g. ``http://10.0.0.5:8765``).
+``get_release``, ``fetch_release`` and ``fetch_raw`` try the mirror first
+and fall back to upstream when it is unreachable or serves a bad file:
+
+    release, paths = fetch_release(['firmware.bin', ...], on_progress=cb)
+
+Usage: python mirror.py [--host 0.0.0.0] [--port 8765] [--interval 300]
+       [--release-api URL] [--raw-base URL]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import metrics
+from firmware_download import Asset, Cache, DownloadError, assets_from_release, fetch_all
+from release_cache import GITHUB_REPO, ReleaseCache, release_api
+
+DEFAULT_PORT = 8765
+DEFAULT_RAW_BASE = f'https://raw.githubusercontent.com/{GITHUB_REPO}/main'
+RAW_TTL = 300  # seconds a /raw file is served before it is revalidated upstream
+
+_ASSET_RE = re.compile(r'^/assets/([0-9a-f]{64})/([^/]+)$')
+
+
+def mirror_base():
+    """The configured mirror (``$MACROPAD_MIRROR``) without a trailing slash, or None."""
+    return os.environ.get('MACROPAD_MIRROR', '').strip().rstrip('/') or None
+
+
+class Mirror:
+    """Release state and sync logic; ``MirrorServer`` puts it on HTTP."""
+
+    def __init__(self, release_api_url=None, raw_base=DEFAULT_RAW_BASE, cache=None, timeout=(5, 30)):
+        self.release_api = release_api_url or release_api()
+        self.raw_base = raw_base.rstrip('/') if raw_base else None
+        self.cache = cache or Cache()
+        self.timeout = timeout
+        self.releases = ReleaseCache(os.path.join(self.cache.root, 'mirror_upstream.json'), ttl=0)
+        self.state_path = os.path.join(self.cache.root, 'mirror.json')
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._raw_checked = {}  # url -> time.monotonic() of the last upstream check
+        self._raw_locks = {}
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                self.published = json.load(f)
+        except (OSError, ValueError):
+            self.published = None  # {'release': upstream JSON, 'assets': {name: sha}, 'synced': t}
+
+    def sync(self):
+        """Fetch and verify the latest release; publish it once every asset is in the cache.
+
+        Returns True if a new release was published. Raises DownloadError or
+        requests.RequestException when upstream can't be reached or an asset
+        fails verification; the previous release keeps being served.
+        """
+        with self._sync_lock:
+            try:
+                with metrics.span('mirror_sync'):
+                    hit, _ = self.releases.revalidate(self.release_api)
+                    release = hit.data
+                    names = [a['name'] for a in release.get('assets', [])]
+                    paths = fetch_all(assets_from_release(release, names), self.cache, timeout=self.timeout)
+            except (requests.RequestException, DownloadError, ValueError, KeyError) as e:
+                self.last_error = str(e)
+                raise
+            # Object paths end in the file's verified SHA-256
+            shas = {name: os.path.basename(path) for name, path in paths.items()}
+            self.last_error = None
+            with self._lock:
+                old = self.published
+                changed = old is None or old['release'].get('tag_name') != release.get('tag_name') \
+                    or old['assets'] != shas
+                self.published = {'release': release, 'assets': shas, 'synced': time.time()}
+                state = json.dumps(self.published)
+            tmp = self.state_path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(state)
+            os.replace(tmp, self.state_path)
+            if changed:
+                metrics.inc('mirror_releases_published_total')
+            return changed
+
+    def release_for(self, base):
+        """The published release JSON with asset URLs and digests pointing at ``base``."""
+        with self._lock:
+            pub = self.published
+        if pub is None:
+            return None
+        release = dict(pub['release'])
+        assets = []
+        for a in release.get('assets', []):
+            sha = pub['assets'].get(a['name'])
+            if sha:
+                assets.append(dict(a, digest=f'sha256:{sha}',
+                                   browser_download_url=f'{base}/assets/{sha}/{a["name"]}'))
+        release['assets'] = assets
+        return release
+
+    def raw(self, path, ttl=RAW_TTL):
+        """Object path for ``<raw base>/<path>``: revalidated upstream at most every ``ttl`` seconds."""
+        url = f'{self.raw_base}/{path}'
+        with self._lock:
+            lock = self._raw_locks.setdefault(url, threading.Lock())
+        with lock:  # one upstream fetch per file, however many updaters ask at once
+            entry = self.cache.lookup(url)
+            checked = self._raw_checked.get(url)
+            if entry and checked and time.monotonic() - checked < ttl:
+                return self.cache.path(entry['sha256'])
+            try:
+                paths = fetch_all([Asset(os.path.basename(path), url)], self.cache, timeout=self.timeout)
+            except DownloadError as e:
+                self.last_error = str(e)
+                if entry:
+                    return self.cache.path(entry['sha256'])  # stale beats nothing
+                raise
+            self._raw_checked[url] = time.monotonic()
+            return paths[os.path.basename(path)]
+
+    def run_sync_loop(self, interval, stop):
+        while not stop.is_set():
+            try:
+                self.sync()
+            except (requests.RequestException, DownloadError, ValueError, KeyError):
+                pass  # recorded in last_error and metrics; keep serving what we have
+            stop.wait(interval)
+
+
+class _MirrorHandler(BaseHTTPRequestHandler):
+    server_version = 'MacropadMirror/1.0'
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers then sendfile on keep-alive would wait on delayed ACKs
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+    def do_GET(self):
+        self._route(head=False)
+
+    def _base(self):
+        # Rewrite asset URLs for however this client reached us
+        return f'http://{self.headers.get("Host") or "%s:%d" % self.server.server_address[:2]}'
+
+    def _send(self, code, body=b'', ctype='text/plain', headers=(), head=False):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+        metrics.inc('mirror_requests_total', route=self._route_name, status=str(code))
+
+    def _route(self, head):
+        mirror = self.server.mirror
+        path = self.path.split('?', 1)[0]
+        m = _ASSET_RE.match(path)
+        if m:
+            self._route_name = 'asset'
+            obj = mirror.cache.path(m.group(1))
+            if not os.path.isfile(obj):
+                return self._send(404, b'Not found', head=head)
+            return self._file(obj, m.group(1), head)
+        if path == '/release' or re.match(r'^/repos/[^/]+/[^/]+/releases/latest$', path):
+            self._route_name = 'release'
+            release = mirror.release_for(self._base())
+            if release is None:
+                return self._send(503, b'Mirror has not synced yet', head=head)
+            body = json.dumps(release).encode()
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+            if self.headers.get('If-None-Match') == etag:
+                return self._send(304, headers=[('ETag', etag)], head=True)
+            return self._send(200, body, 'application/json', [('ETag', etag)], head)
+        if path.startswith('/raw/') and mirror.raw_base and '..' not in path.split('/'):
+            self._route_name = 'raw'
+            try:
+                obj = mirror.raw(path[len('/raw/'):])
+            except DownloadError as e:
+                return self._send(502, str(e).encode(), head=head)
+            return self._file(obj, os.path.basename(obj), head)
+        if path == '/health':
+            self._route_name = 'health'
+            pub = mirror.published
+            body = json.dumps({'tag': pub and pub['release'].get('tag_name'),
+                               'synced': pub and pub['synced'], 'error': mirror.last_error}).encode()
+            return self._send(200, body, 'application/json', head=head)
+        self._route_name = 'other'
+        self._send(404, b'Not found', head=head)
+
+    def _file(self, obj, sha, head):
+        size = os.path.getsize(obj)
+        etag = f'"{sha}"'
+        headers = [('ETag', etag), ('Accept-Ranges', 'bytes')]
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, headers=headers, head=True)
+        start, end, code = 0, size - 1, 200
+        rng = self.headers.get('Range')
+        if rng and rng.startswith('bytes=') and ',' not in rng and \
+                self.headers.get('If-Range', etag) == etag:
+            a, _, b = rng[6:].strip().partition('-')
+            try:
+                if a:
+                    start, end = int(a), min(int(b), size - 1) if b else size - 1
+                else:
+                    start = max(0, size - int(b))
+            except ValueError:
+                start = end = -1
+            if start < 0 or start > end or start >= size:
+                return self._send(416, headers=[('Content-Range', f'bytes */{size}')], head=head)
+            code = 206
+            headers.append(('Content-Range', f'bytes {start}-{end}/{size}'))
+        length = end - start + 1
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        metrics.inc('mirror_requests_total', route=self._route_name, status=str(code))
+        if head:
+            return
+        self.wfile.flush()
+        with open(obj, 'rb') as f:
+            self.connection.sendfile(f, start, length)
+        metrics.inc('mirror_bytes_sent_total', length)
+
+
+class MirrorServer:
+    """``Mirror`` served over HTTP on a daemon thread, with a background sync loop."""
+
+    def __init__(self, mirror, host='0.0.0.0', port=DEFAULT_PORT, interval=300.0):
+        self.mirror = mirror
+        self.interval = interval
+        self.httpd = ThreadingHTTPServer((host, port), _MirrorHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mirror = mirror
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{"127.0.0.1" if host == "0.0.0.0" else host}:{port}'
+
+    def start(self, sync=True):
+        self._threads = [threading.Thread(target=self.httpd.serve_forever, daemon=True, name='mirror-http')]
+        if sync:
+            self._threads.append(threading.Thread(target=self.mirror.run_sync_loop, daemon=True,
+                                                  args=(self.interval, self._stop), name='mirror-sync'))
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# ---- updater side ----
+
+def get_release(releases=None, upstream_api=None, on_update=None):
+    """The latest release JSON, from the mirror if one is configured and reachable."""
+    releases = releases or ReleaseCache()
+    base = mirror_base()
+    if base:
+        try:
+            return releases.get(f'{base}/release', on_update).data
+        except (requests.RequestException, ValueError):
+            metrics.inc('mirror_fallbacks_total', what='release')
+    return releases.get(upstream_api or release_api(), on_update).data
+
+
+def fetch_release(names, releases=None, upstream_api=None, cache=None, on_progress=None):
+    """Download and verify ``names`` from the latest release; return ``(release, paths)``.
+
+    Tries the mirror first; if it is unreachable or any file fails, falls back
+    to upstream (files already verified from the mirror stay cached).
+    """
+    releases = releases or ReleaseCache()
+    base = mirror_base()
+    if base:
+        try:
+            release = releases.get(f'{base}/release').data
+            return release, fetch_all(assets_from_release(release, names), cache, on_progress=on_progress)
+        except (requests.RequestException, ValueError, DownloadError):
+            metrics.inc('mirror_fallbacks_total', what='assets')
+    release = releases.get(upstream_api or release_api()).data
+    return release, fetch_all(assets_from_release(release, names), cache, on_progress=on_progress)
+
+
+def fetch_raw(files, upstream_base, cache=None, on_progress=None, timeout=(5, 20)):
+    """Download ``{name: path under the raw base}`` via the mirror's /raw, falling back to upstream."""
+    base = mirror_base()
+    if base:
+        try:
+            return fetch_all([Asset(n, f'{base}/raw/{p}') for n, p in files.items()], cache,
+                             timeout=timeout, on_progress=on_progress)
+        except DownloadError:
+            metrics.inc('mirror_fallbacks_total', what='raw')
+    return fetch_all([Asset(n, f'{upstream_base.rstrip("/")}/{p}') for n, p in files.items()], cache,
+                     timeout=timeout, on_progress=on_progress)
+
+
+def raw_urls(path, upstream_base):
+    """Where to look for ``path``: the mirror's copy first (if configured), then upstream."""
+    base = mirror_base()
+    upstream = f'{upstream_base.rstrip("/")}/{path}'
+    return [f'{base}/raw/{path}', upstream] if base else [upstream]
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Serve firmware releases to updaters on the LAN')
+    ap.add_argument('--host', default='0.0.0.0')
+    ap.add_argument('--port', type=int, default=DEFAULT_PORT)
+    ap.add_argument('--interval', type=float, default=300.0, help='seconds between upstream syncs')
+    ap.add_argument('--release-api', help='upstream release JSON (default: GitHub, or $MACROPAD_RELEASE_API)')
+    ap.add_argument('--raw-base', default=DEFAULT_RAW_BASE, help='upstream for /raw/ (old/flash.py)')
+    ap.add_argument('--cache', help='cache directory (default: $MACROPAD_CACHE or ~/.cache/macropad)')
+    args = ap.parse_args()
+
+    mirror = Mirror(args.release_api, args.raw_base, Cache(args.cache) if args.cache else None)
+    server = MirrorServer(mirror, args.host, args.port, args.interval)
+    try:
+        changed = mirror.sync()
+        tag = mirror.published['release'].get('tag_name')
+        print(f'synced {tag}{"" if changed else " (unchanged)"}')
+    except (requests.RequestException, DownloadError, ValueError, KeyError) as e:
+        print(f'initial sync failed: {e}' + ('; serving the last synced release' if mirror.published else ''))
+    server.start()
+    print(f'mirror on {server.url} (set MACROPAD_MIRROR={server.url} on the updaters)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,27 @@
-import os, threading, subprocess, time, json
-import requests
+import os, sys, time, queue
 import serial, serial.tools.list_ports
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
+from tkinter import ttk, scrolledtext, messagebox, filedialog
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from serial_monitor import SerialMonitor
+from release_cache import ReleaseCache, release_api
+from mirror import get_release, fetch_release, mirror_base
+import flasher
+from serial_proto import SerialTransport, SerialProtoError
+from station import Station, find_macropad_ports, DONE, FAILED
+from diagnostics import DiagnosticsPanel
+from hotplug import HotplugWatcher
+from ui_dispatch import Dispatcher, StallWatchdog
 
 # ================= CONFIG =================
 CHIP = "esp32s3"
 FLASH_BAUD = "460800"
 SERIAL_BAUD = 115200
+SCROLLBACK_LINES = 5000
 
 GITHUB_REPO = "Archer2121/Macropad"
-RELEASE_API = f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest"
-
-FW_DIR = "firmware"
-os.makedirs(FW_DIR, exist_ok=True)
+RELEASE_API = release_api(GITHUB_REPO)  # $MACROPAD_RELEASE_API overrides
 
 FILES = {
     "bootloader.bin": "0x0000",
@@ -24,28 +32,48 @@ FILES = {
 # ==========================================
 
 def find_macropad_port():
-    for p in serial.tools.list_ports.comports():
-        if p.vid == 0x303A:
-            return p.device
-        desc = (p.description or "").lower()
-        if "esp32" in desc or "cdc" in desc:
-            return p.device
-    return None
+    ports = find_macropad_ports()
+    return ports[0] if ports else None
 
 class MacropadApp(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("LOLIN S3 Macropad Control Center")
         self.geometry("920x650")
+        # Downloads, flashing and serial run on workers; widgets are only
+        # touched here, via self.ui.call. Event-loop stalls are logged
+        self.watchdog = StallWatchdog(self).start()
+        self.ui = Dispatcher(self)
 
         self.ser = None
         self.port = tk.StringVar()
         self.status = tk.StringVar(value="Disconnected")
         self.version = tk.StringVar(value="Checking firmware…")
+        self.factory_erase = tk.BooleanVar(value=False)
+        self.verify_flash = tk.BooleanVar(value=False)
+
+        self.flashing = False
+        self.auto_flash = tk.BooleanVar(value=False)
 
         self.build_ui()
         self.auto_detect()
-        threading.Thread(target=self.fetch_release_info, daemon=True).start()
+
+        # Pads are attached (or queued for flashing) as they are plugged in,
+        # and followed by USB serial number when a reset renumbers the port
+        self.flash_queue = []      # pad keys waiting for the station
+        self.queued_keys = set()   # pads auto-queued this session (not again after their reset)
+        self.attach_after = None   # pad to attach once the current flash is over
+        self.hotplug_events = queue.Queue()
+        self.hotplug = HotplugWatcher(self.hotplug_events.put).start()
+        self.after(100, self.drain_hotplug)
+
+        # Paint whatever we knew last time right away; refresh in the background
+        self.releases = ReleaseCache()
+        self.release = None
+        cached = self.releases.cached(RELEASE_API)
+        if cached:
+            self.set_release(cached.data)
+        self.fetch_release_info()
 
     # ---------- UI ----------
     def build_ui(self):
@@ -66,7 +94,9 @@ class MacropadApp(tk.Tk):
 
         self.serial_tab()
         self.flash_tab()
+        self.station_tab()
         self.macro_tab()
+        self.tabs.add(DiagnosticsPanel(self.tabs), text="Diagnostics")
 
     # ---------- Serial ----------
     def serial_tab(self):
@@ -75,6 +105,7 @@ class MacropadApp(tk.Tk):
 
         self.serial_box = scrolledtext.ScrolledText(tab)
         self.serial_box.pack(fill="both", expand=True)
+        self.monitor = SerialMonitor(self.serial_box, max_lines=SCROLLBACK_LINES)
 
         bottom = ttk.Frame(tab)
         bottom.pack(fill="x")
@@ -98,9 +129,119 @@ class MacropadApp(tk.Tk):
         ttk.Button(tab, text="Download & Flash Latest",
                    command=self.flash_firmware).pack()
 
+        opts = ttk.Frame(tab)
+        opts.pack(pady=4)
+        ttk.Checkbutton(opts, text="Check device flash first (slower, ignores history)",
+                        variable=self.verify_flash).pack(side="left", padx=6)
+        ttk.Checkbutton(opts, text="Factory erase (wipes saved settings)",
+                        variable=self.factory_erase).pack(side="left", padx=6)
+
         self.flash_log = scrolledtext.ScrolledText(tab, height=18)
         self.flash_log.pack(fill="both", expand=True, padx=10)
 
+    # ---------- Station ----------
+    def station_tab(self):
+        tab = ttk.Frame(self.tabs)
+        self.tabs.add(tab, text="Station")
+
+        bar = ttk.Frame(tab)
+        bar.pack(fill="x", padx=10, pady=6)
+        ttk.Button(bar, text="Scan Ports", command=self.scan_station).pack(side="left")
+        ttk.Button(bar, text="Flash All", command=self.flash_station).pack(side="left", padx=5)
+        ttk.Button(bar, text="Retry Failed", command=self.retry_station).pack(side="left")
+        ttk.Button(bar, text="Save Logs...", command=self.save_station_logs).pack(side="left", padx=5)
+        ttk.Checkbutton(bar, text="Flash pads as they are plugged in",
+                        variable=self.auto_flash).pack(side="left", padx=5)
+        self.station_status = tk.StringVar(value="No ports scanned")
+        ttk.Label(bar, textvariable=self.station_status).pack(side="right")
+
+        self.station_total = ttk.Progressbar(tab, length=420)
+        self.station_total.pack(fill="x", padx=10)
+
+        self.lanes_frame = ttk.Frame(tab)
+        self.lanes_frame.pack(fill="both", expand=True, padx=10, pady=6)
+        self.lane_widgets = {}
+        self.station = None
+
+    def scan_station(self, ports=None):
+        for w in self.lanes_frame.winfo_children():
+            w.destroy()
+        self.lane_widgets = {}
+        ports = ports or find_macropad_ports()
+        for row, port in enumerate(ports):
+            ttk.Label(self.lanes_frame, text=port, width=16).grid(row=row, column=0, sticky="w")
+            bar = ttk.Progressbar(self.lanes_frame, length=360)
+            bar.grid(row=row, column=1, padx=6, pady=2, sticky="ew")
+            state = tk.StringVar(value="ready")
+            ttk.Label(self.lanes_frame, textvariable=state, width=36).grid(row=row, column=2, sticky="w")
+            self.lane_widgets[port] = (bar, state)
+        self.lanes_frame.columnconfigure(1, weight=1)
+        self.station_status.set(f"{len(ports)} macropad(s) found")
+
+    def flash_station(self, ports=None):
+        if self.station and self.station.running():
+            return
+        ports = ports or list(self.lane_widgets)
+        if not ports:
+            self.scan_station()
+            ports = list(self.lane_widgets)
+        if not ports:
+            return
+        if self.ser and self.ser.is_open and self.ser.port in ports:
+            self.monitor.detach(close=True)
+            self.ser = None
+        self.flashing = True
+        self.station_status.set("Fetching firmware...")
+        self.ui.submit(self._station_thread, ports, self.factory_erase.get(),
+                       on_done=self._station_started, on_error=self._station_failed)
+
+    def retry_station(self):
+        if self.station:
+            failed = [l.port for l in self.station.lanes.values() if l.state == FAILED]
+            if failed:
+                self.flash_station(failed)
+
+    def _station_thread(self, ports, erase):
+        paths = self.download_firmware()
+        images = [(addr, paths[name]) for name, addr in FILES.items()]
+        return Station(ports, images, retries=1, erase=erase, baud=FLASH_BAUD).start()
+
+    def _station_started(self, station):
+        self.station = station
+        self._poll_station()
+
+    def _station_failed(self, e):
+        self.station_status.set(f"ERROR: {e}")
+        self.flashing = False
+
+    def _poll_station(self):
+        st = self.station
+        for port, lane in st.lanes.items():
+            if port in self.lane_widgets:
+                bar, state = self.lane_widgets[port]
+                bar["value"] = lane.percent
+                text = f"{lane.state} (attempt {lane.attempts})"
+                if lane.state == DONE:
+                    text = f"done in {lane.elapsed:.0f} s, wrote {len(lane.written)} region(s)"
+                elif lane.error:
+                    text += f": {lane.error}"
+                state.set(text)
+        self.station_total["value"] = st.progress()
+        if st.running():
+            self.after(150, self._poll_station)
+        else:
+            lanes = st.wait()
+            self.flashing = False
+            ok = sum(l.state == DONE for l in lanes)
+            self.station_status.set(f"{ok}/{len(lanes)} flashed in {st.finished - st.started:.0f} s")
+
+    def save_station_logs(self):
+        if not self.station:
+            return
+        d = filedialog.askdirectory(title="Folder for per-port logs")
+        if d:
+            self.station.write_logs(d)
+
     # ---------- Macros ----------
     def macro_tab(self):
         tab = ttk.Frame(self.tabs)
@@ -128,23 +269,56 @@ class MacropadApp(tk.Tk):
             self.port.set(ports[0])
             self.status.set("Select device")
 
-    def connect_serial(self):
+    def connect_serial(self, quiet=False):
         try:
-            self.ser = serial.Serial(self.port.get(), SERIAL_BAUD, timeout=0.1)
+            self.ser = serial.Serial(self.port.get(), SERIAL_BAUD, timeout=0.05)
             self.status.set("Connected")
-            threading.Thread(target=self.read_serial, daemon=True).start()
+            self.monitor.attach(self.ser)
         except Exception as e:
-            messagebox.showerror("Error", str(e))
-
-    def read_serial(self):
-        while self.ser:
+            if quiet:
+                self.status.set(f"Could not open {self.port.get()}: {e}")
+            else:
+                messagebox.showerror("Error", str(e))
+
+    def drain_hotplug(self):
+        changed = False
+        while True:
             try:
-                line = self.ser.readline().decode(errors="ignore")
-                if line:
-                    self.serial_box.insert(tk.END, line)
-                    self.serial_box.see(tk.END)
-            except:
+                ev = self.hotplug_events.get_nowait()
+            except queue.Empty:
                 break
+            changed = True
+            if ev.action == "remove":
+                if self.ser and self.ser.port == ev.port.device:
+                    self.monitor.detach(close=True)
+                    self.ser = None
+                    self.status.set("Disconnected (unplugged)")
+                continue
+            if ev.previous and ev.previous == self.port.get():
+                self.port.set(ev.port.device)  # same pad, renumbered by a reset
+            if self.auto_flash.get() and ev.port.key not in self.queued_keys:
+                self.queued_keys.add(ev.port.key)
+                self.flash_queue.append(ev.port.key)
+            elif self.flashing:
+                self.attach_after = ev.port.key
+            elif not self.ser:
+                self.port.set(ev.port.device)
+                self.connect_serial(quiet=True)
+        if changed:
+            self.port_box["values"] = [p.device for p in serial.tools.list_ports.comports()]
+        if not self.flashing and self.flash_queue:
+            ports = [p for p in map(self.hotplug.port_for, self.flash_queue) if p]
+            self.flash_queue = []
+            if ports:
+                self.scan_station(ports)
+                self.flash_station(ports)
+        elif not self.flashing and self.attach_after and not self.ser:
+            port = self.hotplug.port_for(self.attach_after)
+            self.attach_after = None
+            if port:
+                self.port.set(port)
+                self.connect_serial(quiet=True)
+        self.after(100, self.drain_hotplug)
 
     def send_serial(self):
         if self.ser:
@@ -152,78 +326,111 @@ class MacropadApp(tk.Tk):
             self.serial_entry.delete(0, tk.END)
 
     # ---------- GitHub Releases ----------
+    def set_release(self, data):
+        self.release = data
+        self.release_tag = data["tag_name"]
+        self.assets = {a["name"]: a["browser_download_url"] for a in data["assets"]}
+        self.version.set(f"Latest firmware: {self.release_tag}")
+
     def fetch_release_info(self):
-        try:
-            r = requests.get(RELEASE_API, timeout=6)
-            r.raise_for_status()
-            data = r.json()
-            self.release_tag = data["tag_name"]
-            self.assets = {a["name"]: a["browser_download_url"] for a in data["assets"]}
-            self.version.set(f"Latest firmware: {self.release_tag}")
-        except Exception as e:
+        # Conditional request (If-None-Match) only once the cached copy is
+        # older than the TTL; on_update fires if the release actually changed.
+        # A LAN mirror ($MACROPAD_MIRROR) is asked first, GitHub if it's down
+        self.ui.submit(get_release, self.releases, RELEASE_API,
+                       on_update=lambda h: self.ui.call(self.set_release, h.data),
+                       on_done=self.set_release, on_error=self._release_error)
+
+    def _release_error(self, e):
+        if self.release is None:
             self.version.set("Firmware info unavailable")
-            self.flash_log.insert(tk.END, f"Release fetch error: {e}\n")
+        self.flash_log.insert(tk.END, f"Release fetch error: {e}\n")
 
-    def download_firmware(self):
-        for name in FILES:
-            if name not in self.assets:
-                raise FileNotFoundError(f"Missing {name} in release")
+    def log_flash(self, text):
+        # Safe from any thread
+        self.ui.call(self.flash_log.insert, tk.END, text)
 
-            self.flash_log.insert(tk.END, f"Downloading {name}...\n")
-            r = requests.get(self.assets[name], timeout=15)
-            r.raise_for_status()
+    def set_progress(self, value):
+        # Safe from any thread
+        self.ui.call(self.progress.configure, value=value)
 
-            with open(os.path.join(FW_DIR, name), "wb") as f:
-                f.write(r.content)
+    def download_firmware(self):
+        # On a worker. Concurrent, SHA-256 verified, and served from the local
+        # cache when this release was downloaded before; from the mirror when one is set
+        source = mirror_base() or "GitHub"
+        self.log_flash(f"Fetching {len(FILES)} files (via {source})...\n")
+        release, paths = fetch_release(list(FILES), self.releases, RELEASE_API,
+                                       on_progress=self._download_progress)
+        self.ui.call(self.set_release, release)
+        self.log_flash(f"{len(paths)} files verified for {release['tag_name']}, "
+                       f"{paths.downloaded} bytes downloaded\n")
+        return paths
+
+    def _download_progress(self, done, total):
+        if total:
+            self.set_progress(30 * done / total)
 
     # ---------- Flash ----------
     def flash_firmware(self):
-        threading.Thread(target=self._flash_thread, daemon=True).start()
-
-    def _flash_thread(self):
+        self.flashing = True
+        self.progress["value"] = 0
+        # esptool needs the port: the monitor lets go of it here, on the Tk thread
+        released = bool(self.ser and self.ser.is_open)
+        if released:
+            self.monitor.detach(close=True)
+            self.ser = None
+        self.ui.submit(self._flash_thread, self.port.get(), self.factory_erase.get(),
+                       self.verify_flash.get(), released)
+
+    def _flash_thread(self, port, erase, verify, released):
         try:
-            self.progress["value"] = 0
-
-            if self.ser and self.ser.is_open:
-                self.ser.close()
-                self.ser = None
-                time.sleep(0.5)
-
-            self.download_firmware()
-            self.progress["value"] = 30
-
-            subprocess.run(
-                ["esptool", "--chip", CHIP, "--port", self.port.get(),
-                 "--before", "default-reset", "--after", "hard-reset",
-                 "erase-flash"],
-                check=True
-            )
-
-            self.progress["value"] = 50
-
-            cmd = ["esptool", "--chip", CHIP, "--port", self.port.get(),
-                   "--baud", FLASH_BAUD,
-                   "--before", "default-reset", "--after", "hard-reset",
-                   "write-flash"]
-
-            for name, addr in FILES.items():
-                cmd += [addr, os.path.join(FW_DIR, name)]
-
-            subprocess.run(cmd, check=True)
-
-            self.progress["value"] = 100
-            self.flash_log.insert(tk.END, "✔ Firmware updated successfully\n")
+            if released:
+                time.sleep(0.5)  # let the OS close the port before esptool opens it
+
+            paths = self.download_firmware()
+            self.set_progress(30)
+
+            # Only regions that differ from what this device last received
+            # are written; a full chip erase is opt-in
+            images = [(addr, paths[name]) for name, addr in FILES.items()]
+            result = flasher.flash(port, images, erase=erase, verify=verify,
+                                   baud=FLASH_BAUD, on_output=self._flash_output)
+            if result.written:
+                self.log_flash(f"Wrote {', '.join(result.written)}; "
+                               f"unchanged {', '.join(result.skipped) or 'none'}\n")
+            else:
+                self.log_flash("Device already has this firmware, nothing to write\n")
+
+            self.set_progress(100)
+            self.log_flash("✔ Firmware updated successfully\n")
 
         except Exception as e:
-            self.flash_log.insert(tk.END, f"ERROR: {e}\n")
-            self.progress["value"] = 0
+            self.log_flash(f"ERROR: {e}\n")
+            self.set_progress(0)
+        finally:
+            self.ui.call(setattr, self, "flashing", False)
+
+    def _flash_output(self, line):
+        pct = flasher.parse_progress(line)
+        if pct is not None:
+            self.set_progress(30 + 0.7 * pct)
+        else:
+            self.log_flash(line)
 
     # ---------- Macros ----------
     def send_macros(self):
         if not self.ser:
             return
-        payload = json.dumps({"btn1": self.m1.get(), "btn2": self.m2.get()})
-        self.ser.write(f"MACRO:{payload}\n".encode())
+        fields = {"macro1": self.m1.get(), "macro2": self.m2.get()}
+        self.ui.submit(self._send_fields, fields)
+
+    def _send_fields(self, fields):
+        # Framed + acknowledged; both macros land in a single flash write
+        try:
+            with self.monitor.paused(), SerialTransport(self.ser, on_text=self.monitor.write) as t:
+                changed = t.set_fields(fields)
+            self.monitor.write(f"[macros saved, {bin(changed).count('1')} field(s) changed]\n")
+        except SerialProtoError as e:
+            self.monitor.write(f"[macro update failed: {e}]\n")
 
 # ================= RUN =================
 MacropadApp().mainloop()
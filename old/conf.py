@@ -1,21 +1,43 @@
-import serial, threading
+import os, queue, sqlite3, sys
+import serial
 import serial.tools.list_ports
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+from hotplug import HotplugWatcher
+from library import Library
+from serial_monitor import SerialMonitor
+from serial_proto import SerialTransport, SerialProtoError
+from ui_dispatch import Dispatcher, StallWatchdog
+
 PRESETS = [
     "CTRL+C", "CTRL+V", "CTRL+X",
     "ALT+TAB", "WIN+D", "WIN+L",
     "CTRL+ALT+DEL"
 ]
 
+
+def presets():
+    # Keystroke macros saved in the library (seeded with PRESETS); the
+    # combobox lists the first page, any keymap can still be typed in
+    try:
+        with Library() as lib:
+            return [m.body for m in lib.search(kind="keystroke").rows] or PRESETS
+    except (sqlite3.Error, OSError):
+        return PRESETS
+
 class MacroEditor(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("Macropad Macro Editor")
         self.geometry("720x420")
+        self.watchdog = StallWatchdog(self).start()
+        self.ui = Dispatcher(self)
 
         self.port = tk.StringVar()
+        choices = presets()
         self.m1 = tk.StringVar(value=PRESETS[0])
         self.m2 = tk.StringVar(value=PRESETS[1])
 
@@ -26,21 +48,27 @@ class MacroEditor(tk.Tk):
         ttk.Button(self, text="Refresh Ports", command=self.refresh_ports).pack(pady=2)
 
         ttk.Label(self, text="Button 1").pack()
-        ttk.Combobox(self, values=PRESETS, textvariable=self.m1).pack()
+        ttk.Combobox(self, values=choices, textvariable=self.m1).pack()
 
         ttk.Label(self, text="Button 2").pack()
-        ttk.Combobox(self, values=PRESETS, textvariable=self.m2).pack()
+        ttk.Combobox(self, values=choices, textvariable=self.m2).pack()
 
         ttk.Button(self, text="Send Macros", command=self.send).pack(pady=6)
 
         ttk.Label(self, text="Serial Monitor").pack()
         self.serial_box = scrolledtext.ScrolledText(self, height=12)
         self.serial_box.pack(fill="both", expand=True, padx=10)
+        self.monitor = SerialMonitor(self.serial_box, max_lines=2000)
 
         self.ser = None
         self.refresh_ports()
         self.start_serial()
 
+        # Attach as soon as a pad is plugged in (or comes back after a reset)
+        self.hotplug_events = queue.Queue()
+        self.hotplug = HotplugWatcher(self.hotplug_events.put).start()
+        self.after(100, self.drain_hotplug)
+
     def refresh_ports(self):
         ports = [p.device for p in serial.tools.list_ports.comports()]
         self.ports["values"] = ports
@@ -49,27 +77,51 @@ class MacroEditor(tk.Tk):
 
     def start_serial(self):
         try:
-            self.ser = serial.Serial(self.port.get(), 115200, timeout=0.1)
-            threading.Thread(target=self.read_serial, daemon=True).start()
-        except:
-            pass
+            self.ser = serial.Serial(self.port.get(), 115200, timeout=0.05)
+            self.monitor.attach(self.ser)
+        except (serial.SerialException, ValueError) as e:
+            # No pad plugged in yet is normal; say so instead of failing silently
+            metrics.inc("serial_open_errors_total", port=self.port.get() or None, reason=type(e).__name__)
+            self.monitor.write(f"[not connected: {e}]\n")
 
-    def read_serial(self):
-        while self.ser:
+    def drain_hotplug(self):
+        while True:
             try:
-                line = self.ser.readline().decode(errors="ignore")
-                if line:
-                    self.serial_box.insert(tk.END, line)
-                    self.serial_box.see(tk.END)
-            except:
+                ev = self.hotplug_events.get_nowait()
+            except queue.Empty:
                 break
+            if ev.action == "remove":
+                if self.ser and self.ser.port == ev.port.device:
+                    self.monitor.detach(close=True)
+                    self.ser = None
+                    self.monitor.write(f"[{ev.port.device} unplugged]\n")
+            elif not self.ser:
+                self.port.set(ev.port.device)
+                self.start_serial()
+            self.ports["values"] = [p.device for p in serial.tools.list_ports.comports()]
+        self.after(100, self.drain_hotplug)
 
     def send(self):
-        try:
-            cmd = f"/set?m1={self.m1.get()}&m2={self.m2.get()}\n"
-            self.ser.write(cmd.encode())
-            messagebox.showinfo("Success", "Macros sent")
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
+        if not self.ser:
+            messagebox.showerror("Error", "Not connected")
+            return
+        # The presets are shortcuts, so both buttons become keystroke actions;
+        # all four fields are acknowledged and saved in one flash write
+        fields = {"action1": "keystroke", "keymap1": self.m1.get(),
+                  "action2": "keystroke", "keymap2": self.m2.get()}
+        # The acknowledged write runs on a worker; the dialogs come back here
+        self.ui.submit(self._send_fields, self.ser, fields,
+                       on_done=lambda _: messagebox.showinfo("Success", "Macros saved on the device"),
+                       on_error=self._send_failed)
+
+    def _send_fields(self, ser, fields):
+        with self.monitor.paused(), SerialTransport(ser, on_text=self.monitor.write) as t:
+            return t.set_fields(fields)
+
+    def _send_failed(self, e):
+        if not isinstance(e, SerialProtoError):
+            self.report_callback_exception(type(e), e, e.__traceback__)
+            return
+        messagebox.showerror("Error", str(e))
 
 MacroEditor().mainloop()
@@ -1,14 +1,25 @@
-import os, threading, subprocess, requests, serial, time
+import os, sys, serial, time, queue
 import serial.tools.list_ports
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from serial_monitor import SerialMonitor
+from release_cache import ReleaseCache
+from mirror import fetch_raw, raw_urls
+import flasher
+from hotplug import HotplugWatcher
+from ui_dispatch import Dispatcher, StallWatchdog
+
 CHIP = "esp32s3"
 BAUD_FLASH = "460800"
 BAUD_SERIAL = 115200
 
-VERSION_URL = "https://raw.githubusercontent.com/Archer2121/Macropad/main/version.txt"
-FW_BASE = "https://raw.githubusercontent.com/Archer2121/Macropad/main/main/build/esp32.esp32.lolin_s3"
+# $MACROPAD_RAW_BASE points both at a local stand-in (…/raw); a LAN mirror
+# ($MACROPAD_MIRROR, see mirror.py) is tried before it
+RAW_BASE = os.environ.get("MACROPAD_RAW_BASE", "https://raw.githubusercontent.com/Archer2121/Macropad/main")
+VERSION_URLS = raw_urls("version.txt", RAW_BASE)
+FW_DIR = "main/build/esp32.esp32.lolin_s3"
 
 FILES = {
     "bootloader": ("main.ino.bootloader.bin", "0x0000"),
@@ -17,19 +28,20 @@ FILES = {
     "app": ("main.ino.bin", "0x10000"),
 }
 
-BASE = os.path.dirname(os.path.abspath(__file__))
-FW_DIR = os.path.join(BASE, "firmware")
-os.makedirs(FW_DIR, exist_ok=True)
-
 class FirmwareUpdater(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("Macropad Firmware Updater")
         self.geometry("720x460")
+        # Network and flashing run on workers; widgets are updated via self.ui.call
+        self.watchdog = StallWatchdog(self).start()
+        self.ui = Dispatcher(self)
 
         self.port = tk.StringVar()
         self.progress = tk.IntVar()
         self.status = tk.StringVar(value="Idle")
+        self.available = tk.StringVar(value="Available firmware: checking…")
+        self.factory_erase = tk.BooleanVar(value=False)
 
         ttk.Label(self, text="COM Port").pack()
         self.ports = ttk.Combobox(self, textvariable=self.port, width=25)
@@ -37,83 +49,128 @@ class FirmwareUpdater(tk.Tk):
 
         ttk.Button(self, text="Refresh Ports", command=self.refresh_ports).pack(pady=3)
         ttk.Button(self, text="Update Firmware (GitHub)", command=self.start_update).pack(pady=5)
+        ttk.Checkbutton(self, text="Factory erase (wipes saved settings)",
+                        variable=self.factory_erase).pack()
 
+        ttk.Label(self, textvariable=self.available).pack()
         ttk.Progressbar(self, maximum=100, variable=self.progress).pack(fill="x", padx=10)
         ttk.Label(self, textvariable=self.status).pack(pady=4)
 
         ttk.Label(self, text="Serial Monitor").pack()
         self.serial_box = scrolledtext.ScrolledText(self, height=14)
         self.serial_box.pack(fill="both", expand=True, padx=10)
+        self.monitor = SerialMonitor(self.serial_box, max_lines=5000)
 
         self.ser = None
         self.refresh_ports()
 
+        # The port list follows pads being plugged in and out
+        self.hotplug_events = queue.Queue()
+        self.hotplug = HotplugWatcher(self.hotplug_events.put).start()
+        self.after(100, self.drain_hotplug)
+
+        self.releases = ReleaseCache()
+        cached = next(filter(None, map(self.releases.cached, VERSION_URLS)), None)
+        if cached:
+            self.show_version(cached)
+        self.ui.submit(self.check_version)
+
     def refresh_ports(self):
         ports = [p.device for p in serial.tools.list_ports.comports()]
         self.ports["values"] = ports
         if ports:
             self.port.set(ports[0])
 
+    def drain_hotplug(self):
+        events = []
+        while True:
+            try:
+                events.append(self.hotplug_events.get_nowait())
+            except queue.Empty:
+                break
+        for ev in events:
+            if ev.action == "remove" and self.ser and self.ser.port == ev.port.device:
+                self.monitor.detach(close=True)
+                self.ser = None
+        if events:
+            self.ports["values"] = [p.device for p in serial.tools.list_ports.comports()]
+            added = [ev.port.device for ev in events if ev.action == "add"]
+            current = self.port.get()
+            if added and (not current or current not in self.ports["values"]):
+                self.port.set(added[-1])
+        self.after(100, self.drain_hotplug)
+
+    def show_version(self, hit):
+        self.available.set(f"Available firmware: {hit.data.strip()}")
+
+    def check_version(self):
+        # On a worker
+        for url in VERSION_URLS:
+            hit = self.releases.lookup(url, on_update=lambda h: self.ui.call(self.show_version, h))
+            if hit:
+                self.ui.call(self.show_version, hit)
+                return
+        if not any(map(self.releases.cached, VERSION_URLS)):
+            self.ui.call(self.available.set, "Available firmware: unknown (offline)")
+
     def log(self, msg):
-        self.serial_box.insert(tk.END, msg)
-        self.serial_box.see(tk.END)
+        self.monitor.write(msg)
 
     def start_serial(self):
         if self.ser:
             return
         try:
-            self.ser = serial.Serial(self.port.get(), BAUD_SERIAL, timeout=0.1)
-            threading.Thread(target=self.read_serial, daemon=True).start()
+            self.ser = serial.Serial(self.port.get(), BAUD_SERIAL, timeout=0.05)
+            self.monitor.attach(self.ser)
         except Exception as e:
             self.log(f"[SERIAL ERROR] {e}\n")
 
-    def read_serial(self):
-        while self.ser:
-            try:
-                line = self.ser.readline().decode(errors="ignore")
-                if line:
-                    self.log(line)
-            except:
-                break
-
-    def start_update(self):
-        threading.Thread(target=self.update, daemon=True).start()
+    def _download_progress(self, done, total):
+        if total:
+            self.ui.call(self.progress.set, int(40 * done / total))
 
-    def update(self):
-        try:
-            self.progress.set(0)
-            self.status.set("Downloading firmware...")
-
-            for i, (_, (f, _)) in enumerate(FILES.items()):
-                r = requests.get(f"{FW_BASE}/{f}", timeout=20)
-                if r.status_code != 200:
-                    raise RuntimeError(f"Failed to download {f}")
-                with open(os.path.join(FW_DIR, f), "wb") as w:
-                    w.write(r.content)
-                self.progress.set(10 + i * 8)
-
-            self.status.set("Erasing flash...")
-            subprocess.run(
-                ["esptool", "--chip", CHIP, "--port", self.port.get(), "erase-flash"],
-                check=True
-            )
-
-            self.status.set("Flashing firmware...")
-            cmd = ["esptool", "--chip", CHIP, "--port", self.port.get(),
-                   "--baud", BAUD_FLASH, "write_flash"]
-            for _, (f, addr) in FILES.items():
-                cmd += [addr, os.path.join(FW_DIR, f)]
-            subprocess.run(cmd, check=True)
-
-            self.progress.set(100)
-            self.status.set("Update complete ✔")
-
-            time.sleep(2)
-            self.start_serial()
+    def _flash_output(self, line):
+        pct = flasher.parse_progress(line)
+        if pct is not None:
+            self.ui.call(self.progress.set, int(40 + 0.6 * pct))
 
-        except Exception as e:
-            self.progress.set(0)
-            self.status.set("Error")
-            messagebox.showerror("Error", str(e))
+    def start_update(self):
+        self.progress.set(0)
+        self.status.set("Downloading firmware...")
+        # esptool needs the port: the monitor lets go of it here, on the Tk thread
+        if self.ser:
+            self.monitor.detach(close=True)
+            self.ser = None
+        self.ui.submit(self.update, self.port.get(), self.factory_erase.get(),
+                       on_done=self._updated, on_error=self._update_failed)
+
+    def update(self, port, erase):
+        # On a worker; returns the pad's port after its post-flash reset
+        # No published hashes for the raw URLs: the cache revalidates by ETag
+        paths = fetch_raw({f: f"{FW_DIR}/{f}" for f, _ in FILES.values()}, RAW_BASE,
+                          on_progress=self._download_progress)
+
+        self.ui.call(self.status.set, "Erasing and flashing..." if erase else "Flashing changed regions...")
+        images = [(addr, paths[f]) for f, addr in FILES.values()]
+        key = flasher.device_key(port)
+        t0 = time.monotonic()
+        result = flasher.flash(port, images, erase=erase,
+                               baud=BAUD_FLASH, on_output=self._flash_output)
+        self.log(f"Wrote {len(result.written)} region(s), "
+                 f"{len(result.skipped)} unchanged\n")
+        self.ui.call(self.progress.set, 100)
+        self.ui.call(self.status.set, "Update complete ✔")
+
+        # The hard reset re-enumerates the pad, possibly on a new port
+        return self.hotplug.wait_for(key, timeout=5, since=t0) or self.hotplug.port_for(key) or port
+
+    def _updated(self, port):
+        self.port.set(port)
+        self.start_serial()
+
+    def _update_failed(self, e):
+        self.progress.set(0)
+        self.status.set("Error")
+        messagebox.showerror("Error", str(e))
 
 FirmwareUpdater().mainloop()
@@ -0,0 +1,153 @@
+"""On-disk cache for release metadata with conditional revalidation.
+
+Release lookups (the GitHub "latest release" JSON, or a plain ``version.txt``)
+are kept in ``releases.json`` in the firmware cache directory together with
+their ``ETag``/``Last-Modified`` validators. A lookup is answered from disk
+straight away:
+
+* younger than ``ttl``: no request at all;
+* older: returned immediately as stale while a background thread revalidates
+  with ``If-None-Match``/``If-Modified-Since`` (a 304 just refreshes the
+  timestamp and doesn't count against GitHub's rate limit);
+* missing: fetched synchronously.
+
+If the network is down, whatever is cached is still served, however old.
+``$MACROPAD_RELEASE_API`` points the lookups at a mirror or a local
+stand-in such as ``emulator.FakeReleaseServer``.
+
+    rc = ReleaseCache()
+    hit = rc.get(release_api(), on_update=lambda hit: ...)
+    hit.data, hit.source, hit.age
+"""
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+import requests
+
+import metrics
+from firmware_download import cache_dir
+
+GITHUB_REPO = 'Archer2121/Macropad'
+DEFAULT_TTL = 600
+
+# source: 'fresh' (within TTL), 'stale' (served from disk, revalidating in
+# the background) or 'network' (fetched now)
+Lookup = namedtuple('Lookup', 'data source age')
+
+
+def release_api(repo=GITHUB_REPO):
+    return os.environ.get('MACROPAD_RELEASE_API') or \
+        f'https://api.github.com/repos/{repo}/releases/latest'
+
+
+class ReleaseCache:
+    """``{url: {body, etag, last_modified, fetched}}`` persisted as JSON."""
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, timeout=6, session=None):
+        self.path = path or os.path.join(cache_dir(), 'releases.json')
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def cached(self, url):
+        """The cached Lookup for ``url`` without touching the network, or None."""
+        e = self.entries.get(url)
+        if not e:
+            return None
+        age = time.time() - e['fetched']
+        return Lookup(_decode(url, e['body']), 'fresh' if age < self.ttl else 'stale', age)
+
+    def revalidate(self, url):
+        """Conditional GET; return (Lookup, changed). Raises requests.RequestException."""
+        e = self.entries.get(url)
+        headers = {}
+        if e and e.get('etag'):
+            headers['If-None-Match'] = e['etag']
+        elif e and e.get('last_modified'):
+            headers['If-Modified-Since'] = e['last_modified']
+        with metrics.span('release_revalidate'):
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+            if r.status_code == 304 and e:
+                changed = False
+            else:
+                r.raise_for_status()
+                changed = not e or e['body'] != r.text
+                e = {'body': r.text}
+        metrics.inc('release_revalidations_total',
+                    result='not_modified' if r.status_code == 304 else 'changed' if changed else 'same')
+        # A new dict: other threads may be reading the cached one
+        e = dict(e, etag=r.headers.get('ETag') or e.get('etag'),
+                 last_modified=r.headers.get('Last-Modified') or e.get('last_modified'),
+                 fetched=time.time())
+        with self._lock:
+            self.entries[url] = e
+            self._save()
+        return Lookup(_decode(url, e['body']), 'network', 0.0), changed
+
+    def get(self, url, on_update=None, force=False):
+        """Return a Lookup for ``url``, revalidating in the background when stale.
+
+        ``on_update(lookup)`` is called from the background thread only if the
+        revalidated content differs from what was returned. ``force`` skips
+        the TTL check (but still serves the cache first). Raises
+        requests.RequestException only when nothing is cached.
+        """
+        hit = self.cached(url)
+        if hit is None:
+            return self.revalidate(url)[0]
+        if hit.source == 'stale' or force:
+            self._background(url, on_update)
+        return hit
+
+    def _background(self, url, on_update):
+        with self._lock:
+            if url in self._inflight:
+                return
+            t = threading.Thread(target=self._refresh, args=(url, on_update),
+                                 daemon=True, name='release-revalidate')
+            self._inflight[url] = t
+        t.start()
+
+    def _refresh(self, url, on_update):
+        try:
+            hit, changed = self.revalidate(url)
+        except (requests.RequestException, ValueError):
+            return
+        finally:
+            with self._lock:
+                self._inflight.pop(url, None)
+        if changed and on_update:
+            on_update(hit)
+
+    def wait(self, timeout=None):
+        """Join any background revalidation (for scripts and benchmarks)."""
+        for t in list(self._inflight.values()):
+            t.join(timeout)
+
+    def lookup(self, url, on_update=None):
+        """Like ``get`` but never raises: falls back to the cache, then None."""
+        try:
+            return self.get(url, on_update)
+        except (requests.RequestException, ValueError):
+            return None
+
+
+def _decode(url, body):
+    return body if url.endswith('.txt') else json.loads(body)
@@ -0,0 +1,155 @@
+"""Serial monitor plumbing shared by the Tk tools.
+
+``SerialReader`` drains a pyserial port on a worker thread with bulk
+``read(in_waiting)`` calls and incremental UTF-8 decoding, and appends the
+text to a bounded deque (single producer, single consumer, no locks).
+``SerialMonitor`` flushes that deque into a Tk text widget at a fixed frame
+rate from the Tk thread and keeps the scrollback under a line cap, so a
+chatty device can't stall the UI or grow memory without bound.
+
+    monitor = SerialMonitor(self.serial_box, max_lines=5000)
+    monitor.attach(serial.Serial(port, 115200, timeout=0.05))
+    monitor.write('local message\\n')   # safe from any thread
+"""
+import codecs
+import contextlib
+import threading
+from collections import deque
+
+import metrics
+
+
+class SerialReader(threading.Thread):
+    """Read ``ser`` until stopped, pushing decoded text chunks onto ``self.chunks``.
+
+    The deque holds at most ``max_chunks`` entries; if the consumer falls that
+    far behind, the oldest text is dropped (counted in ``dropped``).
+    """
+
+    def __init__(self, ser, max_chunks=4096, chunk_size=4096, on_error=None):
+        super().__init__(daemon=True, name='serial-reader')
+        self.ser = ser
+        self.port = getattr(ser, 'port', None)
+        self.chunk_size = chunk_size
+        self.chunks = deque(maxlen=max_chunks)
+        self.on_error = on_error
+        self.bytes_read = 0
+        self.dropped = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        ser, chunks = self.ser, self.chunks
+        while not self._stopped.is_set():
+            try:
+                # Block (up to the port timeout) for the first byte, then take
+                # whatever else has already arrived in one call.
+                data = ser.read(min(max(ser.in_waiting, 1), self.chunk_size))
+            except Exception as e:  # port unplugged, closed under us, ...
+                if not self._stopped.is_set():
+                    metrics.inc('serial_read_errors_total', port=self.port, reason=type(e).__name__)
+                    if self.on_error:
+                        self.on_error(e)
+                break
+            if not data:
+                continue
+            self.bytes_read += len(data)
+            metrics.inc('serial_read_bytes_total', len(data), port=self.port)
+            text = self._decoder.decode(data)
+            if text:
+                if len(chunks) == chunks.maxlen:
+                    self.dropped += 1
+                    metrics.inc('serial_dropped_chunks_total', port=self.port)
+                chunks.append(text)
+
+
+def drain(chunks):
+    """Pop everything currently in ``chunks`` and return it as one string."""
+    out = []
+    pop = chunks.popleft
+    try:
+        for _ in range(len(chunks)):
+            out.append(pop())
+    except IndexError:
+        pass
+    return ''.join(out)
+
+
+class SerialMonitor:
+    """Batch serial output into ``widget`` (a Tk Text/ScrolledText) at ``fps``."""
+
+    def __init__(self, widget, fps=30, max_lines=5000):
+        self.widget = widget
+        self.interval = max(1, int(1000 / fps))
+        self.max_lines = max_lines
+        self.reader = None
+        self.ser = None
+        self._local = deque()  # text written via write(), from any thread
+        self._error = None
+        # One flush loop for the widget's lifetime; idle ticks cost next to nothing
+        self.widget.after(self.interval, self._flush)
+
+    def attach(self, ser):
+        """Start reading ``ser`` (an open pyserial port) into the widget."""
+        self.detach()
+        self.ser = ser
+        self.reader = SerialReader(ser, on_error=self._on_error)
+        self.reader.start()
+
+    def detach(self, close=False):
+        """Stop reading; optionally close the port. Already-read text is kept."""
+        if self.reader:
+            self.reader.stop()
+            # Wait out the read in progress (bounded by the port timeout)
+            self.reader.join(0.5)
+            self._local.append(drain(self.reader.chunks))
+            self.reader = None
+        if close and self.ser is not None:
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+        self.ser = None
+
+    def write(self, text):
+        self._local.append(text)
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Stop reading for the duration (e.g. while a SerialTransport owns the port)."""
+        ser = self.ser
+        self.detach()
+        try:
+            yield ser
+        finally:
+            if ser is not None and ser.is_open:
+                self.attach(ser)
+
+    def _on_error(self, e):
+        self._error = e
+
+    def _flush(self):
+        text = drain(self._local)
+        if self.reader:
+            text += drain(self.reader.chunks)
+        if self._error is not None:
+            text += f'\n[serial error: {self._error}]\n'
+            self._error = None
+        if text:
+            self._append(text)
+        self.widget.after(self.interval, self._flush)
+
+    def _append(self, text):
+        w = self.widget
+        # Only follow the output if the user hasn't scrolled up to read something
+        follow = w.yview()[1] >= 0.999
+        w.insert('end', text)
+        lines = int(w.index('end-1c').split('.')[0])
+        if lines > self.max_lines:
+            w.delete('1.0', f'{lines - self.max_lines + 1}.0')
+        if follow:
+            w.see('end')
+
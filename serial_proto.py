@@ -0,0 +1,362 @@
+"""Framed, acknowledged config protocol over the macropad's USB serial port.
+
+Every request and reply is one frame::
+
+    A5 5A | type u8 | seq u8 | length u16 LE | payload | CRC-16/CCITT u16 LE
+
+The CRC (poly 0x1021, init 0xFFFF) covers type through payload. Replies
+carry the request's ``seq`` with ``type | 0x80`` and a status byte first.
+Frames share the port with the firmware's text output and ``help``-style
+commands; the parser hands anything outside a frame to ``on_text``.
+
+Up to ``window`` requests may be outstanding at once; the firmware answers
+them in order. A request whose reply doesn't arrive within ``timeout`` is
+resent, up to ``retries`` times. Field writes are staged with SET and land
+in a single flash write on COMMIT. COMMIT carries the mask of fields the
+host staged, so a SET that is still being retransmitted can't be skipped.
+
+    with SerialTransport(serial.Serial(port, 115200, timeout=0.02)) as t:
+        t.set_fields({'macro1': 'hello', 'macro2': 'world'})   # one flash write
+        t.get_all()
+"""
+import binascii
+import json
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+from device_client import CONFIG_FIELDS, INLINE_MACRO_MAX
+
+SYNC = b'\xa5\x5a'
+HEADER = struct.Struct('<2sBBH')
+MAX_PAYLOAD = 1024
+
+PING, GET, SET, COMMIT, GET_ALL, ABORT = 0x01, 0x02, 0x03, 0x04, 0x05, 0x06
+REPLY = 0x80
+TYPE_NAMES = {PING: 'ping', GET: 'get', SET: 'set', COMMIT: 'commit', GET_ALL: 'get_all', ABORT: 'abort'}
+
+OK, UNKNOWN_FIELD, BAD_REQUEST, TOO_LARGE, INCOMPLETE = 0, 1, 2, 3, 4
+STATUS_TEXT = {OK: 'ok', UNKNOWN_FIELD: 'unknown field', BAD_REQUEST: 'bad request',
+               TOO_LARGE: 'too large', INCOMPLETE: 'commit before all fields arrived'}
+
+# Same bit order as the firmware's ConfigField enum
+FIELD_BITS = {name: 1 << i for i, name in enumerate(CONFIG_FIELDS)}
+
+
+class SerialProtoError(Exception):
+    """A request timed out, the port failed, or the device returned an error status."""
+
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status
+
+
+def crc16(data, crc=0xFFFF):
+    return binascii.crc_hqx(data, crc)
+
+
+def encode_frame(ftype, seq, payload=b''):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f'payload of {len(payload)} bytes exceeds {MAX_PAYLOAD}')
+    body = struct.pack('<BBH', ftype, seq, len(payload)) + payload
+    return SYNC + body + struct.pack('<H', crc16(body))
+
+
+class Frame:
+    __slots__ = ('type', 'seq', 'payload')
+
+    def __init__(self, ftype, seq, payload):
+        self.type = ftype
+        self.seq = seq
+        self.payload = payload
+
+    @property
+    def status(self):
+        return self.payload[0] if self.payload else BAD_REQUEST
+
+    @property
+    def data(self):
+        return self.payload[1:]
+
+    def __repr__(self):
+        return f'Frame(type=0x{self.type:02x}, seq={self.seq}, payload={self.payload!r})'
+
+
+class FrameParser:
+    """Incremental decoder: ``feed(bytes)`` returns ``[Frame | bytes, ...]``.
+
+    ``bytes`` items are text that arrived outside any frame. Frames with a bad
+    CRC or impossible length are dropped (counted in ``crc_errors``) and
+    their bytes are rescanned for the next sync.
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.buf = bytearray()
+        self.max_payload = max_payload
+        self.crc_errors = 0
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        out = []
+        while buf:
+            i = buf.find(SYNC[0])
+            if i == -1:
+                out.append(bytes(buf))
+                buf.clear()
+                break
+            if i:
+                out.append(bytes(buf[:i]))
+                del buf[:i]
+            if len(buf) < 2:
+                break
+            if buf[1] != SYNC[1]:
+                out.append(bytes(buf[:1]))
+                del buf[:1]
+                continue
+            if len(buf) < HEADER.size:
+                break
+            _, ftype, seq, n = HEADER.unpack_from(buf)
+            if n > self.max_payload:
+                self.crc_errors += 1
+                out.append(bytes(buf[:1]))
+                del buf[:1]
+                continue
+            end = HEADER.size + n + 2
+            if len(buf) < end:
+                break
+            (crc,) = struct.unpack_from('<H', buf, end - 2)
+            if crc != crc16(bytes(buf[2:end - 2])):
+                self.crc_errors += 1
+                out.append(bytes(buf[:1]))
+                del buf[:1]
+                continue
+            out.append(Frame(ftype, seq, bytes(buf[HEADER.size:end - 2])))
+            del buf[:end]
+        return out
+
+
+class _Pending:
+    __slots__ = ('frame', 'future', 'deadline', 'attempts', 'sent')
+
+    def __init__(self, frame, future, deadline):
+        self.frame = frame
+        self.future = future
+        self.deadline = deadline
+        self.attempts = 1
+        self.sent = time.perf_counter()
+
+
+class SerialTransport:
+    """Request/reply client over an open pyserial port (or anything with read/write/in_waiting).
+
+    A reader thread owns all reads while the transport is running; pass
+    ``on_text`` to keep showing the firmware's log output (e.g. a
+    SerialMonitor's ``write``).
+    """
+
+    def __init__(self, ser, window=8, timeout=0.5, retries=3, on_text=None):
+        self.ser = ser
+        self.window = threading.BoundedSemaphore(window)
+        self.timeout = timeout
+        self.retries = retries
+        self.on_text = on_text
+        self.parser = FrameParser()
+        self.retransmits = 0
+        self.port = getattr(ser, 'port', None)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._seq = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        self._error = None  # why the reader stopped on its own
+
+    def start(self):
+        self._stopped.clear()
+        self._error = None
+        self._thread = threading.Thread(target=self._reader, daemon=True, name='serial-proto')
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(1.0)
+        self._fail_all(SerialProtoError('transport closed'))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, data):
+        with self._write_lock:
+            self.ser.write(data)
+
+    def submit(self, ftype, payload=b''):
+        """Send a request without waiting; returns a Future resolving to the reply Frame."""
+        if self._stopped.is_set() or not self._thread:
+            raise SerialProtoError(self._error or 'transport not running')
+        self.window.acquire()
+        fut = Future()
+        with self._lock:
+            # Checked again under the lock: a reader that stops fails everything
+            # pending after setting _stopped, so nothing added here is left behind
+            if self._stopped.is_set():
+                self.window.release()
+                raise SerialProtoError(self._error or 'transport not running')
+            seq = self._seq
+            while seq in self._pending:
+                seq = (seq + 1) & 0xFF
+            self._seq = (seq + 1) & 0xFF
+            frame = encode_frame(ftype, seq, payload)
+            self._pending[seq] = _Pending(frame, fut, time.monotonic() + self.timeout)
+        fut.add_done_callback(lambda _: self.window.release())
+        try:
+            self._write(frame)
+        except Exception as e:
+            self._resolve(seq, exc=SerialProtoError(f'write failed: {e}'), reason='write')
+        return fut
+
+    def call(self, ftype, payload=b'', check=True):
+        """Send a request and wait for its reply Frame; raise on a non-OK status if ``check``."""
+        reply = self.submit(ftype, payload).result()
+        if check and reply.status != OK:
+            raise SerialProtoError(f'request 0x{ftype:02x} failed: '
+                                   f'{STATUS_TEXT.get(reply.status, reply.status)}', reply.status)
+        return reply
+
+    def _resolve(self, seq, frame=None, exc=None, reason='timeout'):
+        with self._lock:
+            p = self._pending.pop(seq, None)
+        if p is None:
+            return  # duplicate reply to a retransmitted request
+        op = TYPE_NAMES.get(p.frame[2], str(p.frame[2]))
+        metrics.observe('serial_request_seconds', time.perf_counter() - p.sent, type=op, port=self.port)
+        if exc is not None:
+            metrics.inc('serial_request_errors_total', type=op, port=self.port, reason=reason)
+            p.future.set_exception(exc)
+        else:
+            if frame.status != OK:
+                metrics.inc('serial_request_errors_total', type=op, port=self.port,
+                            reason=STATUS_TEXT.get(frame.status, str(frame.status)))
+            p.future.set_result(frame)
+
+    def _fail_all(self, exc):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for p in pending.values():
+            if not p.future.done():
+                p.future.set_exception(exc)
+
+    def _reader(self):
+        ser = self.ser
+        while not self._stopped.is_set():
+            try:
+                data = ser.read(max(ser.in_waiting, 1))
+            except Exception as e:
+                # The port is gone (a pad unplugged): refuse new requests, fail the rest
+                self._error = f'read failed: {e}'
+                self._stopped.set()
+                self._fail_all(SerialProtoError(self._error))
+                return
+            if data:
+                crc_errors = self.parser.crc_errors
+                for item in self.parser.feed(data):
+                    if isinstance(item, Frame):
+                        if item.type & REPLY:
+                            with self._lock:
+                                p = self._pending.get(item.seq)
+                            if p and (p.frame[2] | REPLY) == item.type:
+                                self._resolve(item.seq, item)
+                    elif self.on_text:
+                        self.on_text(item.decode('utf-8', 'replace'))
+                if self.parser.crc_errors != crc_errors:
+                    metrics.inc('serial_crc_errors_total', self.parser.crc_errors - crc_errors,
+                                port=self.port)
+            self._check_timeouts()
+
+    def _check_timeouts(self):
+        now = time.monotonic()
+        resend, expired = [], []
+        with self._lock:
+            for seq, p in self._pending.items():
+                if now < p.deadline:
+                    continue
+                if p.attempts > self.retries:
+                    expired.append(seq)
+                else:
+                    p.attempts += 1
+                    p.deadline = now + self.timeout
+                    resend.append(p.frame)
+        for seq in expired:
+            self._resolve(seq, exc=SerialProtoError(f'no reply to seq {seq} after '
+                                                    f'{self.retries + 1} attempts'))
+        for frame in resend:
+            self.retransmits += 1
+            metrics.inc('serial_retransmits_total', type=TYPE_NAMES.get(frame[2], str(frame[2])),
+                        port=self.port)
+            try:
+                self._write(frame)
+            except Exception:
+                pass
+
+    # ---- config operations ----
+
+    def ping(self):
+        t0 = time.monotonic()
+        self.call(PING)
+        return time.monotonic() - t0
+
+    def get(self, field):
+        return self.call(GET, field.encode()).data.decode('utf-8')
+
+    def get_all(self):
+        return json.loads(self.call(GET_ALL).data.decode('utf-8'))
+
+    def set_fields(self, fields, commit=True):
+        """Stage ``{field: value}`` pipelined, then COMMIT them in one flash write.
+
+        Returns the mask of fields the device actually changed (0 if none).
+        Text macros over INLINE_MACRO_MAX bytes are refused before anything is
+        sent: the device only takes them as blobs, over HTTP.
+        """
+        unknown = set(fields) - set(FIELD_BITS)
+        if unknown:
+            raise ValueError(f'unknown field(s): {", ".join(sorted(unknown))}')
+        long = [k for k in ('macro1', 'macro2')
+                if len(str(fields.get(k, '')).encode('utf-8')) > INLINE_MACRO_MAX]
+        if long:
+            raise SerialProtoError(f'{" and ".join(long)} over {INLINE_MACRO_MAX} bytes: '
+                                   f'save long macros over WiFi (POST /macro/text)', TOO_LARGE)
+        futures = [self.submit(SET, k.encode() + b'\0' + str(v).encode('utf-8'))
+                   for k, v in fields.items()]
+        if not commit:
+            for f in futures:
+                _check(f.result())
+            return 0
+        mask = 0
+        for k in fields:
+            mask |= FIELD_BITS[k]
+        reply = self.submit(COMMIT, struct.pack('<H', mask)).result()
+        for f in futures:
+            _check(f.result())
+        if reply.status == INCOMPLETE:
+            # A SET was retransmitted after the COMMIT overtook it; all SETs are acked now
+            reply = self.call(COMMIT, struct.pack('<H', mask))
+        _check(reply)
+        return struct.unpack('<H', reply.data[:2])[0] if len(reply.data) >= 2 else 0
+
+    def abort(self):
+        self.call(ABORT)
+
+
+def _check(reply):
+    if reply.status != OK:
+        raise SerialProtoError(f'device replied {STATUS_TEXT.get(reply.status, reply.status)}',
+                               reply.status)
+    return reply
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Flashing station: flash every attached macropad at once.
+
+Each port gets its own esptool process (via ``flasher.flash``); a thread per
+port supervises it, parses its progress output into a ``Lane`` and retries
+it on failure. USB transfers to separate pads don't contend much, so a tray
+of N devices takes about as long as the slowest one.
+
+    station = Station(find_macropad_ports(), images, retries=1)
+    station.start()            # non-blocking; poll station.lanes / .progress()
+    station.wait()
+
+Usage: python station.py 0x0000=bootloader.bin 0x8000=partitions.bin ... [--ports P ...] [--all]
+"""
+import argparse
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import flasher
+
+ESPRESSIF_VID = 0x303A
+
+QUEUED, FLASHING, RETRYING, DONE, FAILED = 'queued', 'flashing', 'retrying', 'done', 'failed'
+
+
+def find_macropad_ports(others=False):
+    """Serial ports of ESP32-S3 macropads: Espressif's VID 0x303A, as hotplug matches them.
+
+    With ``others``, ports from other vendors whose description mentions
+    ESP32 or CDC follow (USB-UART bridges, but also any CDC-ACM device, so
+    bulk flashing only includes them when asked to).
+    """
+    import serial.tools.list_ports
+    native, other = [], []
+    for p in serial.tools.list_ports.comports():
+        if p.vid == ESPRESSIF_VID:
+            native.append(p.device)
+        elif others:
+            desc = (p.description or '').lower()
+            if 'esp32' in desc or 'cdc' in desc:
+                other.append(p.device)
+    return sorted(native) + sorted(other)
+
+
+@dataclass
+class Lane:
+    port: str
+    state: str = QUEUED
+    percent: float = 0.0
+    attempts: int = 0
+    error: str = ''
+    elapsed: float = 0.0
+    written: list = field(default_factory=list)
+    log: list = field(default_factory=list)
+
+
+_WRITING_RE = re.compile(r'Writing at (0x[0-9a-fA-F]+)')
+
+
+class _LaneProgress:
+    """Turn per-region esptool percentages into one size-weighted lane percentage."""
+
+    def __init__(self, lane, sizes):
+        self.lane = lane
+        self.sizes = sizes  # {addr int: bytes}
+        self.plan = []
+        self.done = {}
+
+    def set_plan(self, addrs):
+        self.plan = sorted(int(a, 0) for a in addrs)
+        self.done = dict.fromkeys(self.plan, 0.0)
+        if not self.plan:
+            self.lane.percent = 100.0
+
+    def line(self, text):
+        self.lane.log.append(text.rstrip('\n'))
+        pct = flasher.parse_progress(text)
+        m = _WRITING_RE.search(text)
+        if pct is None or not m or not self.plan:
+            return
+        at = int(m.group(1), 16)
+        region = max((a for a in self.plan if a <= at), default=self.plan[0])
+        self.done[region] = pct / 100.0
+        total = sum(self.sizes[a] for a in self.plan) or 1
+        self.lane.percent = 100.0 * sum(self.sizes[a] * f for a, f in self.done.items()) / total
+
+
+class Station:
+    """Flash ``images`` (``[(address, path), ...]``) to every port in ``ports``.
+
+    ``workers`` defaults to one per port. A failed port is retried up to
+    ``retries`` more times. ``on_update(lane)`` is called from worker threads
+    on state changes; UIs can just as well poll ``lanes``.
+    """
+
+    def __init__(self, ports, images, retries=1, workers=None, erase=False, verify=False,
+                 esptool=None, baud=flasher.FLASH_BAUD, on_update=None, retry_delay=1.0):
+        self.images = list(images)
+        self.lanes = {p: Lane(p) for p in ports}
+        self.retries = retries
+        self.workers = workers or max(1, len(self.lanes))
+        self.erase = erase
+        self.verify = verify
+        self.esptool = esptool
+        self.baud = baud
+        self.on_update = on_update
+        self.retry_delay = retry_delay
+        # One history shared by all lanes so concurrent records don't clobber each other
+        self.history = flasher.FlashHistory()
+        self.sizes = {int(a, 0): os.path.getsize(p) for a, p in self.images}
+        self.started = self.finished = None
+        self._pool = None
+        self._futures = []
+
+    def _notify(self, lane):
+        if self.on_update:
+            self.on_update(lane)
+
+    def _run(self, lane):
+        t0 = time.monotonic()
+        while True:
+            lane.attempts += 1
+            lane.state = FLASHING if lane.attempts == 1 else RETRYING
+            lane.percent = 0.0
+            lane.log.append(f'--- attempt {lane.attempts} ---')
+            self._notify(lane)
+            prog = _LaneProgress(lane, self.sizes)
+            try:
+                result = flasher.flash(lane.port, self.images, erase=self.erase, verify=self.verify,
+                                       esptool=self.esptool, baud=self.baud, history=self.history,
+                                       on_output=prog.line, on_plan=prog.set_plan)
+            except Exception as e:
+                lane.error = str(e)
+                lane.log.append(f'ERROR: {e}')
+                if lane.attempts <= self.retries:
+                    self._notify(lane)
+                    time.sleep(self.retry_delay * lane.attempts)
+                    continue
+                lane.state = FAILED
+            else:
+                lane.written = result.written
+                lane.error = ''
+                lane.percent = 100.0
+                lane.state = DONE
+            lane.elapsed = time.monotonic() - t0
+            self._notify(lane)
+            return lane
+
+    def start(self):
+        self.started = time.monotonic()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='station')
+        self._futures = [self._pool.submit(self._run, lane) for lane in self.lanes.values()]
+        self._pool.shutdown(wait=False)
+        return self
+
+    def running(self):
+        return any(not f.done() for f in self._futures)
+
+    def wait(self):
+        for f in self._futures:
+            f.result()
+        self.finished = time.monotonic()
+        return list(self.lanes.values())
+
+    def run(self):
+        return self.start().wait()
+
+    def progress(self):
+        """Mean lane percentage (failed lanes count as complete)."""
+        lanes = list(self.lanes.values())
+        if not lanes:
+            return 100.0
+        return sum(100.0 if l.state == FAILED else l.percent for l in lanes) / len(lanes)
+
+    def write_logs(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for lane in self.lanes.values():
+            name = lane.port.strip('/').replace('/', '_').replace('\\', '_') + '.log'
+            with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lane.log) + '\n')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Flash all attached macropads in parallel')
+    ap.add_argument('images', nargs='+', help='ADDRESS=FILE pairs')
+    ap.add_argument('--ports', nargs='*', help='default: every detected macropad')
+    ap.add_argument('--all', action='store_true',
+                    help='with no --ports, also non-Espressif ports described as ESP32 or CDC')
+    ap.add_argument('--retries', type=int, default=1)
+    ap.add_argument('--erase', action='store_true', help='factory erase before writing')
+    ap.add_argument('--logs', help='write one log file per port to this directory')
+    args = ap.parse_args()
+
+    images = [tuple(s.split('=', 1)) for s in args.images]
+    ports = args.ports or find_macropad_ports(others=args.all)
+    if not ports:
+        ap.error('no macropads found')
+    lock = threading.Lock()
+
+    def show(lane):
+        if lane.state in (DONE, FAILED, RETRYING):
+            with lock:
+                print(f'{lane.port}\t{lane.state}\tattempts={lane.attempts}\t'
+                      f'{lane.elapsed:.1f} s\t{lane.error}', flush=True)
+
+    station = Station(ports, images, retries=args.retries, erase=args.erase, on_update=show)
+    lanes = station.run()
+    if args.logs:
+        station.write_logs(args.logs)
+    ok = sum(l.state == DONE for l in lanes)
+    print(f'{ok}/{len(lanes)} flashed in {station.finished - station.started:.1f} s')
+    raise SystemExit(0 if ok == len(lanes) else 1)
+
+
+if __name__ == '__main__':
+    main()
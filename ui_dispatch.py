@@ -0,0 +1,290 @@
+"""Keep the Tk thread free: a worker dispatcher and a main-loop stall watchdog.
+
+Tk widgets may only be touched from the thread running ``mainloop``.
+``Dispatcher`` runs blocking network and serial calls on a thread pool. It
+hands their results (or exceptions) back through a queue that the Tk
+thread drains with ``after()``, so callbacks always run on the Tk thread.
+``call()`` schedules any function there from any thread.
+
+``StallWatchdog`` schedules a heartbeat on the event loop and watches it
+from a separate thread. When the loop falls more than ``threshold``
+seconds behind, the watchdog samples the Tk thread's stack until the loop
+recovers, and the cProfile of the Tk callback that was running is saved to
+``<cache>/stalls/*.prof``. Each stall is logged to stderr (or passed to
+``on_stall``) and counted in ``ui_stalls_total`` and ``ui_stall_seconds``.
+Callbacks are profiled only if they are registered after ``start()``, so
+start the watchdog before building widgets.
+
+    root = tk.Tk()
+    StallWatchdog(root).start()          # $MACROPAD_STALL_MS sets the threshold (default 100)
+    ui = Dispatcher(root)
+    ui.submit(client.get_config, on_done=show, on_error=report)
+    ui.call(status.config, text='Done')  # from a worker thread
+"""
+import cProfile
+import io
+import os
+import pstats
+import queue
+import sys
+import threading
+import time
+import tkinter
+import traceback
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from firmware_download import cache_dir
+
+# started: time.time() when the loop stopped turning; duration: seconds it was stuck;
+# callback: qualified name of the Tk callback running, if any; stack: the Tk thread's
+# stack seen most often while stuck; profile: .prof path of that callback, or None
+Stall = namedtuple('Stall', 'started duration callback stack profile')
+
+
+def default_threshold():
+    return float(os.environ.get('MACROPAD_STALL_MS') or 100) / 1000
+
+
+def _name(func):
+    # after() wraps its target in a 'callit' closure; name the target
+    code = getattr(func, '__code__', None)
+    if code is not None and code.co_name == 'callit' and 'func' in code.co_freevars:
+        func = func.__closure__[code.co_freevars.index('func')].cell_contents
+    owner = getattr(func, '__self__', None)
+    name = getattr(func, '__qualname__', None) or getattr(func, '__name__', None) or repr(func)
+    if owner is not None and '.' not in name:
+        name = f'{type(owner).__name__}.{name}'
+    return f'{getattr(func, "__module__", None) or "?"}:{name}'
+
+
+class Dispatcher:
+    """Run callables on worker threads; deliver results on the Tk thread.
+
+    The queue is drained every ``interval`` ms, at most ``budget`` seconds of
+    callbacks per turn, so a burst of results (a fleet push, a subnet scan)
+    can't starve redraws and input.
+    """
+
+    def __init__(self, root, workers=8, interval=15, budget=0.01):
+        self.root = root
+        self.interval = interval
+        self.budget = budget
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ui-work')
+        self._q = queue.SimpleQueue()
+        self._closed = False
+        self._job = root.after(interval, self._drain)
+
+    def call(self, fn, *args, **kw):
+        """Run ``fn(*args, **kw)`` on the Tk thread at its next drain; safe from any thread."""
+        self._q.put((time.perf_counter(), fn, args, kw))
+
+    def submit(self, fn, *args, on_done=None, on_error=None, **kw):
+        """Run ``fn(*args, **kw)`` on a worker; return its Future.
+
+        ``on_done(result)`` or ``on_error(exception)`` is then called on the
+        Tk thread. Without ``on_error``, exceptions go to Tk's
+        ``report_callback_exception`` like any failing callback.
+        """
+        fut = self.pool.submit(fn, *args, **kw)
+        fut.add_done_callback(lambda f: self.call(self._finish, f, on_done, on_error))
+        return fut
+
+    def _finish(self, fut, on_done, on_error):
+        if fut.cancelled():
+            return
+        e = fut.exception()
+        if e is None:
+            if on_done is not None:
+                on_done(fut.result())
+        elif on_error is not None:
+            on_error(e)
+        else:
+            self.root.report_callback_exception(type(e), e, e.__traceback__)
+
+    def _drain(self):
+        deadline = time.perf_counter() + self.budget
+        while time.perf_counter() < deadline:
+            try:
+                queued, fn, args, kw = self._q.get_nowait()
+            except queue.Empty:
+                break
+            metrics.observe('ui_dispatch_delay_seconds', time.perf_counter() - queued)
+            try:
+                fn(*args, **kw)
+            except Exception:
+                self.root.report_callback_exception(*sys.exc_info())
+        if not self._closed:
+            # Left-over work goes next turn, after pending window events
+            self._job = self.root.after(1 if not self._q.empty() else self.interval, self._drain)
+
+    def shutdown(self):
+        self._closed = True
+        try:
+            self.root.after_cancel(self._job)
+        except tkinter.TclError:
+            pass  # the root is already destroyed
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class _TimedCallWrapper(tkinter.CallWrapper):
+    # Every Tk -> Python callback registered while the watchdog runs goes through this
+    watchdog = None
+
+    def __call__(self, *args):
+        wd = self.watchdog
+        if wd is None:
+            return super().__call__(*args)
+        return wd._run(self.func, lambda: super(_TimedCallWrapper, self).__call__(*args))
+
+
+class StallWatchdog:
+    """Log every time the Tk event loop is blocked for longer than ``threshold`` seconds.
+
+    ``profile=False`` skips cProfile (stack samples are still taken).
+    ``on_stall(Stall)`` replaces the stderr log and is called on the Tk
+    thread once the loop is turning again. The last stalls are kept in
+    ``stalls``.
+    """
+
+    def __init__(self, root, threshold=None, interval=0.025, profile=True, on_stall=None,
+                 out_dir=None, keep=20):
+        self.root = root
+        self.threshold = default_threshold() if threshold is None else threshold
+        self.interval = interval
+        self.profile = profile
+        self.on_stall = on_stall
+        self.out_dir = out_dir or os.path.join(cache_dir(), 'stalls')
+        self.keep = keep
+        self.stalls = deque(maxlen=50)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._main = threading.get_ident()
+        self._due = None       # perf_counter() when the next heartbeat should run
+        self._stall = None     # dict describing the stall in progress
+        self._seq = 0          # counts top-level callbacks, to match a stall to its culprit
+        self._depth = 0        # > 1 inside nested event loops (dialogs)
+        self._current = None   # top-level callback running now
+        self._job = None
+        self._thread = None
+
+    def start(self):
+        _TimedCallWrapper.watchdog = self
+        tkinter.CallWrapper = _TimedCallWrapper
+        self._due = time.perf_counter() + self.interval
+        self._job = self.root.after(int(self.interval * 1000), self._beat)
+        self._thread = threading.Thread(target=self._watch, name='ui-watchdog', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if _TimedCallWrapper.watchdog is self:
+            _TimedCallWrapper.watchdog = None
+            tkinter.CallWrapper = _TimedCallWrapper.__bases__[0]
+        try:
+            self.root.after_cancel(self._job)
+        except tkinter.TclError:
+            pass
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    # ---- Tk thread ----
+
+    def _beat(self):
+        now = time.perf_counter()
+        metrics.observe('ui_loop_lag_seconds', max(0.0, now - self._due))
+        with self._lock:
+            st, self._stall = self._stall, None
+        if st is not None:
+            self._report(st, now)
+        if not self._stop.is_set():
+            self._due = time.perf_counter() + self.interval
+            self._job = self.root.after(int(self.interval * 1000), self._beat)
+
+    def _run(self, func, call):
+        if self._depth:  # a callback from a nested event loop: the outer profile covers it
+            self._depth += 1
+            try:
+                return call()
+            finally:
+                self._depth -= 1
+        self._seq += 1
+        seq, self._current, self._depth = self._seq, func, 1
+        prof = cProfile.Profile() if self.profile else None
+        try:
+            if prof is not None:
+                try:
+                    prof.enable()
+                except ValueError:  # another profiler is active
+                    prof = None
+            return call()
+        finally:
+            if prof is not None:
+                prof.disable()
+            self._depth, self._current = 0, None
+            with self._lock:
+                st = self._stall
+            if st is not None and st['seq'] == seq and prof is not None:
+                st['profile'] = self._dump(prof)
+
+    def _dump(self, prof):
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, time.strftime('stall-%Y%m%d-%H%M%S') + f'-{self._seq}.prof')
+        prof.dump_stats(path)
+        old = sorted(f for f in os.listdir(self.out_dir) if f.endswith('.prof'))
+        for f in old[:-self.keep]:
+            try:
+                os.unlink(os.path.join(self.out_dir, f))
+            except OSError:
+                pass
+        return path
+
+    def _report(self, st, now):
+        stack = st['samples'].most_common(1)[0][0] if st['samples'] else ''
+        stall = Stall(st['started'], now - st['t0'], st['callback'], stack, st.get('profile'))
+        self.stalls.append(stall)
+        metrics.inc('ui_stalls_total', callback=stall.callback or 'tk')
+        metrics.observe('ui_stall_seconds', stall.duration)
+        if self.on_stall is not None:
+            self.on_stall(stall)
+        else:
+            sys.stderr.write(format_stall(stall))
+
+    # ---- watchdog thread ----
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            late = time.perf_counter() - self._due
+            if late <= self.threshold:
+                continue
+            frame = sys._current_frames().get(self._main)
+            sample = ''.join(traceback.format_list(_own_frames(frame))) if frame is not None else ''
+            with self._lock:
+                if self._stall is None:
+                    cur = self._current
+                    self._stall = {'t0': self._due, 'started': time.time() - late, 'seq': self._seq,
+                                   'callback': _name(cur) if cur is not None else None,
+                                   'samples': Counter()}
+                self._stall['samples'][sample] += 1
+
+
+def _own_frames(frame, limit=12):
+    # The Tk thread's stack without the dispatch plumbing around every callback
+    skip = (__file__, tkinter.__file__)
+    frames = [f for f in traceback.extract_stack(frame) if f.filename not in skip]
+    return frames[-limit:]
+
+
+def format_stall(stall, top=12):
+    """A stall as log text: duration and callback, hottest stack, top of its profile."""
+    out = io.StringIO()
+    out.write(f'[ui stall] event loop blocked {stall.duration * 1000:.0f} ms'
+              f' in {stall.callback or "Tk"}\n')
+    if stall.stack:
+        out.write(stall.stack)
+    if stall.profile:
+        out.write(f'profile: {stall.profile}\n')
+        pstats.Stats(stall.profile, stream=out).sort_stats('cumulative').print_stats(top)
+    return out.getvalue()